@@ -0,0 +1,571 @@
+import asyncio
+import collections
+import contextlib
+import re
+
+from .reader import LITERAL_PATTERN
+from .client import (
+    ImapClientError, DEFAULT_MAILBOX, NOSELECT_FLAGS, default_decoders,
+    decode_data, ids_to_bytes, parse_headers, header_date, parse_list,
+    parse_list_status, parse_status, parse_copyuid, format_sequence_set,
+    message_from_bytes, parse_esearch
+)
+from .idset import IdSet
+
+
+# Responses of the server, e.g. b'A12 OK [READ-WRITE] SELECT completed',
+# b'* 3 FETCH (UID 7)' and b'[UIDVALIDITY 9] UIDs valid'.
+TAGGED_PATTERN = re.compile(
+    rb"^(?P<tag>A\d+) (?P<status>[A-Z]+)(?: (?P<text>.*))?$", re.DOTALL
+)
+UNTAGGED_PATTERN = re.compile(
+    rb"^\* (?:(?P<number>\d+) )?(?P<type>[A-Z-]+)(?: (?P<data>.*))?$",
+    re.DOTALL
+)
+RESPONSE_CODE_PATTERN = re.compile(
+    rb"^\[(?P<code>[A-Z-]+)(?: (?P<data>[^\]]*))?\]"
+)
+STATUS_RESPONSES = frozenset(("OK", "NO", "BAD", "BYE", "PREAUTH"))
+
+# Longest line accepted from the server (like imaplib._MAXLINE).
+MAX_LINE = 1000000
+
+# Argument of command sent as literal (e.g. non-ASCII criterion of SEARCH).
+Literal = collections.namedtuple("Literal", "data")
+
+# Command waiting for its tagged completion, untagged is a dictionary
+# {type: [data]} shaped like imaplib.IMAP4.untagged_responses.
+PendingCommand = collections.namedtuple("PendingCommand",
+                                        "tag future untagged")
+
+
+def quote(text):
+    '''Returns quoted string of IMAP (e.g. password of LOGIN).'''
+    return '"%s"' % text.replace("\\", "\\\\").replace('"', '\\"')
+
+
+class AsyncImapClient:
+    '''
+    asyncio counterpart of ImapClient, high-level methods are coroutines
+    returning the same data. Commands of concurrent tasks are pipelined on
+    the connection: each command is tagged and waits only for its own
+    completion, so one connection serves many in-flight requests. Like
+    pipelined ImapClient, untagged responses are attributed to the oldest
+    command in progress (servers complete commands in order).
+
+    Commands which need selected mailbox take mailbox argument. Commands in
+    the same mailbox run concurrently (SELECT is sent just before the first
+    of them, without waiting for its completion), switching to another
+    mailbox waits until they finish. Caches of ImapClient are not used.
+    '''
+    def __init__(self, reader, writer, *, addr=None, timeout=None):
+        self.reader = reader
+        self.writer = writer
+        self.addr = addr
+        self.timeout = timeout
+        self.username = None
+        self.mailbox = None
+        self.uidvalidity = None
+        self.uidnext = None
+        self.capabilities = tuple()
+        self.untagged_responses = dict()
+
+        self._tagnum = 0
+        self._pending = collections.OrderedDict()  # tag -> PendingCommand
+        self._send_lock = asyncio.Lock()
+        self._continuation = None
+        self._closed = None
+        self._greeting = asyncio.get_event_loop().create_future()
+
+        # Selected mailbox shared by commands in progress.
+        self._gate = asyncio.Condition()
+        self._selection = None  # (mailbox, readonly)
+        self._select_command = None
+        self._users = 0
+
+        self._read_task = asyncio.ensure_future(self._read_loop())
+
+    @classmethod
+    async def connect(cls, addr, port=993, *, ssl=True, timeout=None):
+        '''Opens connection and waits for the greeting of the server.'''
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(addr, port, ssl=ssl, limit=MAX_LINE),
+                timeout
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            raise ImapClientError("Unable to connect: %s" % e) from None
+        client = cls(reader, writer, addr=addr, timeout=timeout)
+        await client.start()
+        return client
+
+    async def start(self):
+        '''Waits for the greeting, reads capabilities.'''
+        await asyncio.wait_for(asyncio.shield(self._greeting), self.timeout)
+        if not self._refresh_capabilities(self.untagged_responses):
+            [(status, data, untagged)] = await self._run(("CAPABILITY",))
+            self._refresh_capabilities(untagged)
+
+    @property
+    def account(self):
+        '''Identifies the account (used as a key by caches).'''
+        return "%s@%s" % (self.username, self.addr)
+
+    def has_capability(self, name):
+        '''Checks whether the server advertises given capability.'''
+        return name.upper() in self.capabilities
+
+    def _refresh_capabilities(self, untagged):
+        data = untagged.get("CAPABILITY", None)
+        if not data or not isinstance(data[-1], bytes):
+            return False
+        self.capabilities = tuple(data[-1].decode("ascii").upper().split())
+        return True
+
+    # Reading responses
+
+    async def _read_loop(self):
+        try:
+            while True:
+                self._dispatch(await self._read_response())
+        except asyncio.CancelledError:
+            self._close(ImapClientError("connection closed"))
+            raise
+        except Exception as e:
+            self._close(ImapClientError("connection lost: %s" % e))
+
+    async def _read_response(self):
+        '''
+        Reads single response with its literals, returns the list of items
+        shaped like imaplib (bytes and (line, literal) tuples).
+        '''
+        items = list()
+        while True:
+            line = await self.reader.readline()
+            if not line.endswith(b"\r\n"):
+                raise ConnectionError("connection closed by server")
+            match = LITERAL_PATTERN.search(line)
+            if not match:
+                items.append(line[:-2])
+                return items
+            literal = await self.reader.readexactly(int(match.group("size")))
+            items.append((line[:-2], literal))
+
+    def _dispatch(self, items):
+        first = items[0][0] if isinstance(items[0], tuple) else items[0]
+        if first.startswith(b"+"):
+            if self._continuation and not self._continuation.done():
+                self._continuation.set_result(first)
+            return
+
+        match = UNTAGGED_PATTERN.match(first)
+        if match:
+            kind = match.group("type").decode("ascii")
+            data = match.group("data") or b""
+            if match.group("number"):
+                data = match.group("number") + (b" " + data if data else b"")
+            items[0] = (data, items[0][1]) if isinstance(items[0], tuple) \
+                       else data
+            untagged = self.untagged_responses
+            if self._pending:
+                untagged = next(iter(self._pending.values())).untagged
+            untagged.setdefault(kind, list()).extend(items)
+            if kind in STATUS_RESPONSES:
+                self._append_response_code(untagged, data)
+            if not self._greeting.done():
+                self._greeting.set_result(kind)
+            return
+
+        match = TAGGED_PATTERN.match(first)
+        if match is None:
+            raise ConnectionError("unexpected response: %r" % first)
+        command = self._pending.pop(match.group("tag"), None)
+        if command is None:
+            raise ConnectionError("unexpected tagged response: %r" % first)
+        text = match.group("text") or b""
+        self._append_response_code(command.untagged, text)
+        if not command.future.done():
+            command.future.set_result(
+                (match.group("status").decode("ascii"), [text])
+            )
+
+    @staticmethod
+    def _append_response_code(untagged, text):
+        '''Saves response code (e.g. [UIDVALIDITY 9]) like imaplib.'''
+        match = RESPONSE_CODE_PATTERN.match(text)
+        if match:
+            untagged.setdefault(match.group("code").decode("ascii"),
+                                list()).append(match.group("data"))
+
+    def _close(self, error):
+        '''Fails all commands in progress.'''
+        self._closed = error
+        for command in self._pending.values():
+            if not command.future.done():
+                command.future.set_exception(error)
+        self._pending.clear()
+        for future in (self._continuation, self._greeting):
+            if future is not None and not future.done():
+                future.set_exception(error)
+
+    # Sending commands
+
+    async def _send(self, name, *args):
+        '''
+        Writes tagged command, returns PendingCommand. Literal arguments
+        are sent after continuation request of the server (or at once with
+        LITERAL+), other commands are not interleaved meanwhile.
+        '''
+        async with self._send_lock:
+            if self._closed:
+                raise self._closed
+            self._tagnum += 1
+            tag = b"A%d" % self._tagnum
+            command = PendingCommand(
+                tag, asyncio.get_event_loop().create_future(), dict()
+            )
+            self._pending[tag] = command
+
+            line = tag + b" " + name.encode("ascii")
+            for arg in args:
+                if arg is None: continue
+                if not isinstance(arg, Literal):
+                    line += b" " + (arg if isinstance(arg, bytes)
+                                    else str(arg).encode("utf-8"))
+                    continue
+                if self.has_capability("LITERAL+"):
+                    line += b" {%d+}\r\n" % len(arg.data) + arg.data
+                    continue
+                self._continuation = asyncio.get_event_loop().create_future()
+                self.writer.write(line + b" {%d}\r\n" % len(arg.data))
+                await self.writer.drain()
+                done, _ = await asyncio.wait(
+                    (self._continuation, command.future), timeout=self.timeout,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if command.future in done:
+                    return command  # literal rejected
+                if not done:
+                    raise ImapClientError("no continuation from the server")
+                line = arg.data
+            self.writer.write(line + b"\r\n")
+            await self.writer.drain()
+        return command
+
+    async def _wait(self, command):
+        '''Returns (status, data, untagged) of the command.'''
+        try:
+            status, data = await asyncio.wait_for(
+                asyncio.shield(command.future), self.timeout
+            )
+        except asyncio.TimeoutError:
+            raise ImapClientError("no response from the server") from None
+        return status, data, command.untagged
+
+    async def _run(self, *commands):
+        '''
+        Sends commands (tuples (name, *args)) at once and returns the list
+        of (status, data, untagged) like ImapClient.pipeline.
+        '''
+        pending = [await self._send(*command) for command in commands]
+        return [await self._wait(command) for command in pending]
+
+    @staticmethod
+    def _uid_command(name, uid):
+        return ("UID", name) if uid else (name,)
+
+    # Selected mailbox
+
+    async def _acquire_mailbox(self, mailbox, readonly=False):
+        '''
+        Waits until the mailbox can be selected, sends SELECT (EXAMINE)
+        when the mailbox is not selected yet. Returns the command which
+        has selected the mailbox (it may be still in progress).
+        '''
+        selection = (mailbox, readonly)
+        async with self._gate:
+            while self._selection != selection and self._users:
+                await self._gate.wait()
+            self._users += 1
+            if self._selection != selection:
+                try:
+                    command = await self._send(
+                        "EXAMINE" if readonly else "SELECT", mailbox
+                    )
+                except BaseException:
+                    self._users -= 1
+                    self._gate.notify_all()
+                    raise
+                self._selection = selection
+                self._select_command = command
+                self.mailbox = mailbox
+                self.uidvalidity = None
+                command.future.add_done_callback(
+                    lambda future: self._selected(command, selection)
+                )
+            return self._select_command
+
+    async def _release_mailbox(self):
+        async with self._gate:
+            self._users -= 1
+            self._gate.notify_all()
+
+    def _selected(self, command, selection):
+        '''Saves UIDVALIDITY and UIDNEXT (or forgets failed selection).'''
+        if self._select_command is not command:
+            return
+        if command.future.cancelled() or command.future.exception() or \
+           command.future.result()[0] != "OK":
+            self._selection = None
+            self.mailbox = None
+            return
+        self.uidvalidity = self._response_code(command.untagged,
+                                               "UIDVALIDITY")
+        self.uidnext = self._response_code(command.untagged, "UIDNEXT")
+
+    @staticmethod
+    def _response_code(untagged, name):
+        try:
+            return int(untagged.get(name, [None])[-1])
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    @contextlib.asynccontextmanager
+    async def _in_mailbox(self, mailbox):
+        '''Keeps the mailbox selected, fails when SELECT has failed.'''
+        select = await self._acquire_mailbox(mailbox)
+        try:
+            yield
+            status, data, untagged = await self._wait(select)
+            if status != "OK":
+                raise ImapClientError(decode_data(data[-1]))
+        finally:
+            await self._release_mailbox()
+
+    async def _run_in(self, mailbox, *commands):
+        '''Runs commands (see _run) in the mailbox.'''
+        async with self._in_mailbox(mailbox or self.mailbox or
+                                    DEFAULT_MAILBOX):
+            return await self._run(*commands)
+
+    @staticmethod
+    def _check(results):
+        for status, data, untagged in results:
+            if status != "OK":
+                raise ImapClientError(decode_data(data[-1]))
+        return results
+
+    # High-level methods
+
+    async def login(self, username, password):
+        '''Identify client using plaintext password.'''
+        self.username = username
+        [(status, data, untagged)] = self._check(await self._run(
+            ("LOGIN", quote(username), quote(password))
+        ))
+        if not self._refresh_capabilities(untagged):
+            [(_, _, untagged)] = await self._run(("CAPABILITY",))
+            self._refresh_capabilities(untagged)
+        return status, data
+
+    async def logout(self):
+        try:
+            await self._run(("LOGOUT",))
+        except ImapClientError:
+            pass
+        await self.close()
+
+    async def close(self):
+        self._read_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._read_task
+        self.writer.close()
+
+    async def select(self, mailbox=DEFAULT_MAILBOX, readonly=False):
+        '''Select mailbox, returns ("OK", [number of messages]).'''
+        select = await self._acquire_mailbox(mailbox, readonly)
+        try:
+            result = await self._wait(select)
+            [(status, data, untagged)] = self._check([result])
+        finally:
+            await self._release_mailbox()
+        return status, untagged.get("EXISTS", [b"0"])[-1:]
+
+    async def status_mailboxes(self, mailboxes, items="(MESSAGES UNSEEN)",
+                               *, strict=True):
+        '''
+        Returns dictionary {mailbox: {item: number}} with status of given
+        mailboxes (all STATUS commands are in progress at once). Mailboxes
+        whose STATUS failed are omitted when strict is false.
+        '''
+        mailboxes = list(mailboxes)
+        results = await self._run(*[("STATUS", mailbox, items)
+                                    for mailbox in mailboxes])
+        statuses = dict()
+        for mailbox, (status, data, untagged) in zip(mailboxes, results):
+            if status != "OK":
+                if not strict: continue
+                raise ImapClientError(decode_data(data[-1]))
+            statuses[mailbox] = parse_status(untagged.get("STATUS", []))
+        return statuses
+
+    async def list(self, directory='""', pattern="*", *, status_items=None):
+        '''
+        Returns ("OK", [(name, flags)]) or triples (name, flags, status)
+        when status_items are given, see ImapClient.list.
+        '''
+        if status_items and self.has_capability("LIST-STATUS"):
+            [(status, data, untagged)] = self._check(await self._run(
+                ("LIST", directory, pattern,
+                 "RETURN (STATUS %s)" % status_items)
+            ))
+            statuses = parse_list_status(untagged.get("STATUS", []))
+            return status, [(name, flags, statuses.get(name, dict()))
+                            for name, flags
+                            in parse_list(untagged.get("LIST", []))]
+
+        [(status, data, untagged)] = self._check(await self._run(
+            ("LIST", directory, pattern)
+        ))
+        mailboxes = parse_list(untagged.get("LIST", []))
+        if not status_items:
+            return status, mailboxes
+
+        selectable = ['"%s"' % name for name, flags in mailboxes
+                      if not NOSELECT_FLAGS & set(map(str.upper, flags))]
+        statuses = await self.status_mailboxes(selectable, status_items,
+                                               strict=False)
+        return status, [(name, flags, statuses.get('"%s"' % name, dict()))
+                        for name, flags in mailboxes]
+
+    async def list_mailbox(self, mailbox=None, *criteria, uid=False,
+                           charset=None):
+        '''Returns ("OK", IdSet of ids or uids) of e-mails meeting criteria.'''
+        [(status, data, untagged)] = self._check(await self._run_in(
+            mailbox, self._uid_command("SEARCH", uid) + self._search_return() +
+                     (("CHARSET", charset) if charset else ()) +
+                     tuple(criteria or ("ALL",))
+        ))
+        return status, self._search_result(untagged)
+
+    def _search_return(self):
+        '''Returns RETURN option of ESEARCH (RFC 4731) when supported.'''
+        return ("RETURN", "(ALL)") if self.has_capability("ESEARCH") else ()
+
+    @staticmethod
+    def _search_result(untagged):
+        if "ESEARCH" in untagged:
+            return parse_esearch(untagged["ESEARCH"]).get("ALL", IdSet())
+        return IdSet(int(item) for line in untagged.get("SEARCH", [])
+                               if isinstance(line, bytes)
+                               for item in line.split())
+
+    async def csearch(self, criteria, charset="UTF-8", uid=False, *,
+                      mailbox=None):
+        '''
+        Returns e-mails (ids or uids) which meet specified criteria like
+        ImapClient.csearch. Values of criteria with decode flag are sent
+        as literals encoded with charset.
+        '''
+        if not isinstance(criteria, collections.abc.Sequence):
+            raise TypeError("expected a sequence object (tuple, list etc.)")
+        args = list(self._uid_command("SEARCH", uid) + self._search_return())
+        if charset:
+            args.extend(("CHARSET", charset))
+        try:
+            for criterion in criteria:
+                args.append(criterion["key"])
+                value = criterion.get("value", None)
+                if criterion.get("decode", False):
+                    args.append(Literal(value.encode(charset or "ascii")))
+                elif value:
+                    args.append(value)
+        except (KeyError, AttributeError, UnicodeError):
+            raise ImapClientError("invalid criterion (lack of key or " +
+                                  "value, or improper encoding)") from None
+
+        [(status, data, untagged)] = await self._run_in(mailbox, args)
+        if "SEARCH" not in untagged and "ESEARCH" not in untagged:
+            return status, decode_data(data[-1])
+        return status, self._search_result(untagged)
+
+    async def _fetch(self, ids, msg_parts, *, uid, mailbox):
+        [(status, data, untagged)] = self._check(await self._run_in(
+            mailbox, self._uid_command("FETCH", uid) +
+                     (ids_to_bytes(ids), msg_parts)
+        ))
+        return untagged.get("FETCH", [])
+
+    async def get_headers(self, ids, *, fields=None, uid=False,
+                          header_decoders=default_decoders, flags=True,
+                          sort_by_date=True, mailbox=None):
+        '''Returns ("OK", headers) like ImapClient.get_headers.'''
+        parse_fields = None
+        if fields:
+            parse_fields = set(field.upper() for field in fields)
+            if sort_by_date:
+                parse_fields.add("DATE")
+        msg_parts = ["FLAGS"] if flags else []
+        msg_parts.append("BODY.PEEK[HEADER.FIELDS (%s)]" % " ".join(fields)
+                         if fields else "BODY.PEEK[HEADER]")
+        data = await self._fetch(ids, "(%s)" % " ".join(msg_parts),
+                                 uid=uid, mailbox=mailbox)
+        headers = parse_headers(data, uid=uid, flags=flags,
+                                header_decoders=header_decoders,
+                                fields=parse_fields)
+        if sort_by_date:
+            headers = sorted(headers, key=header_date)
+        return "OK", headers
+
+    async def get_emails(self, ids, *, msg_parts="(RFC822)", uid=False,
+                         mailbox=None):
+        '''Returns ("OK", [email.message.Message]) for given ids.'''
+        data = await self._fetch(ids, msg_parts, uid=uid, mailbox=mailbox)
+        return "OK", [message_from_bytes(item[1]) for item in data
+                      if isinstance(item, tuple)]
+
+    async def store(self, ids, flags, *, command, uid=False, mailbox=None):
+        '''Alters flag dispositions for messages in mailbox.'''
+        if not isinstance(flags, str):
+            flags = " ".join(flags)
+        [(status, data, untagged)] = self._check(await self._run_in(
+            mailbox, self._uid_command("STORE", uid) +
+                     (ids_to_bytes(ids), command, flags)
+        ))
+        return status, [decode_data(item) for item in untagged.get("FETCH", [])
+                        if isinstance(item, bytes)]
+
+    async def add_flags(self, ids, flags, *, uid=False, mailbox=None):
+        return await self.store(ids, flags, command="+FLAGS", uid=uid,
+                                mailbox=mailbox)
+
+    async def set_flags(self, ids, flags, *, uid=False, mailbox=None):
+        return await self.store(ids, flags, command="FLAGS", uid=uid,
+                                mailbox=mailbox)
+
+    async def remove_flags(self, ids, flags, *, uid=False, mailbox=None):
+        return await self.store(ids, flags, command="-FLAGS", uid=uid,
+                                mailbox=mailbox)
+
+    async def move_emails(self, ids, mailbox, *, uid=False,
+                          source_mailbox=None):
+        '''
+        Moves messages like ImapClient.move_emails (MOVE, or COPY and UID
+        EXPUNGE of copied messages with UIDPLUS), returns COPYUID mapping.
+        '''
+        ids_bytes = ids_to_bytes(ids)
+        source_mailbox = source_mailbox or self.mailbox or DEFAULT_MAILBOX
+        name = "MOVE" if self.has_capability("MOVE") else "COPY"
+        async with self._in_mailbox(source_mailbox):
+            [(status, data, untagged)] = self._check(await self._run(
+                self._uid_command(name, uid) + (ids_bytes, mailbox)
+            ))
+            copyuid = parse_copyuid(untagged.get("COPYUID", []) + data)
+            if name == "COPY" and copyuid and \
+               self.has_capability("UIDPLUS"):
+                uids = format_sequence_set(sorted(copyuid["uids"]))
+                self._check(await self._run(
+                    ("UID", "STORE", uids, "+FLAGS.SILENT", "(\\Deleted)"),
+                    ("UID", "EXPUNGE", uids)
+                ))
+        return status, copyuid
@@ -0,0 +1,194 @@
+import binascii
+
+
+# Transfer encodings which do not change the content.
+IDENTITY_ENCODINGS = frozenset((None, "7bit", "8bit", "binary"))
+
+# Whitespace skipped by base64 decoder.
+BASE64_WHITESPACE = b" \t\r\n"
+
+# Bytes of the part read to guess the layout of base64 lines. Lines of
+# base64 should not be longer than 76 characters (RFC 2045).
+PROBE_SIZE = 1024
+
+
+class Base64Decoder:
+    '''
+    Decodes base64 fed in arbitrary chunks, keeps only the characters
+    which do not form a full quantum (4 characters) yet.
+    '''
+    def __init__(self):
+        self._rest = b""
+
+    def feed(self, data):
+        data = self._rest + data.translate(None, BASE64_WHITESPACE)
+        end = len(data) - len(data) % 4
+        self._rest = data[end:]
+        return binascii.a2b_base64(data[:end]) if end else b""
+
+    def flush(self):
+        rest, self._rest = self._rest, b""
+        if not rest.strip(b"="):
+            return b""
+        return binascii.a2b_base64(rest + b"=" * (-len(rest) % 4))
+
+
+class QuotedPrintableDecoder:
+    '''
+    Decodes quoted-printable fed in arbitrary chunks, escape sequence (=XX)
+    or soft line break split between chunks is held back.
+    '''
+    def __init__(self):
+        self._rest = b""
+
+    def feed(self, data):
+        data = self._rest + data
+        end = len(data)
+        escape = data.rfind(b"=", max(end - 2, 0))
+        if escape != -1:
+            end = escape
+        self._rest = data[end:]
+        return binascii.a2b_qp(data[:end])
+
+    def flush(self):
+        rest, self._rest = self._rest, b""
+        return binascii.a2b_qp(rest)
+
+
+class IdentityDecoder:
+
+    def feed(self, data):
+        return data
+
+    def flush(self):
+        return b""
+
+
+def get_decoder(encoding):
+    '''Returns incremental decoder of the transfer encoding.'''
+    if encoding == "base64":
+        return Base64Decoder()
+    elif encoding == "quoted-printable":
+        return QuotedPrintableDecoder()
+    return IdentityDecoder()
+
+
+class AttachmentStream:
+    '''
+    Streams decoded content of single part (see parse_bodystructure)
+    downloaded in chunks with partial FETCH, so memory used by download
+    does not depend on the size of the part.
+
+    fetch - callable(offset, length) returning octets of encoded part
+    part - description of the part from BODYSTRUCTURE
+    chunk_size - number of octets fetched at once
+
+    Decoded length (and ranges) is known for identity encodings and for
+    base64 with lines of equal length (as produced by mail clients),
+    probe() has to be called first to check the layout of base64 lines.
+    '''
+    def __init__(self, fetch, part, *, chunk_size=256*1024):
+        self.fetch = fetch
+        self.encoding = part.get("encoding", None)
+        self.size = part.get("size", None) or 0
+        self.chunk_size = chunk_size
+        self.length = None
+        self._line_length = None
+
+    @property
+    def supports_ranges(self):
+        return self.length is not None
+
+    def probe(self):
+        '''Determines decoded length, returns it or None when unknown.'''
+        if self.encoding in IDENTITY_ENCODINGS:
+            self.length = self.size
+        elif self.encoding == "base64" and self.size:
+            self.length = self._probe_base64()
+        return self.length
+
+    def _probe_base64(self):
+        head = self.fetch(0, min(self.size, PROBE_SIZE))
+        line_length = head.find(b"\r\n")
+        if line_length == -1:
+            if len(head) < self.size: return None
+            line_length = self.size  # single line
+        if not line_length or line_length % 4:
+            return None
+
+        stride = line_length + 2
+        tail_offset = max(self.size - 2*stride, 0)
+        tail = self.fetch(tail_offset, self.size - tail_offset)
+
+        # Shorter last line may be followed by line break too
+        size = self.size
+        if size % stride and tail.endswith(b"\r\n"):
+            size -= 2
+            tail = tail[:-2]
+        lines, rest = divmod(size, stride)
+        if rest > line_length: return None
+        chars = lines*line_length + rest
+        if chars % 4: return None
+
+        if not self._matches_layout(head[:size], 0, line_length) or \
+           not self._matches_layout(tail, tail_offset, line_length):
+            return None
+
+        self._line_length = line_length
+        tail = tail.rstrip(b"\r\n")
+        padding = len(tail) - len(tail.rstrip(b"="))
+        return chars // 4 * 3 - padding
+
+    @staticmethod
+    def _matches_layout(data, offset, line_length):
+        '''Checks whether line breaks are only at the ends of lines.'''
+        stride = line_length + 2
+        for index, byte in enumerate(data):
+            column = (offset + index) % stride
+            if column == line_length:
+                if byte != 13: return False  # CR
+            elif column == line_length + 1:
+                if byte != 10: return False  # LF
+            elif byte in BASE64_WHITESPACE:
+                return False
+        return True
+
+    def _encoded_offset(self, position):
+        '''Returns offset of base64 quantum with decoded position.'''
+        char = position // 3 * 4
+        return char // self._line_length * (self._line_length + 2) + \
+               char % self._line_length
+
+    def iter_range(self, start=0, stop=None):
+        '''
+        Yields decoded content from start to stop (excluded). Arbitrary
+        ranges are supported only when supports_ranges is true.
+        '''
+        if self.length is None:
+            start, stop = 0, None
+            offset, end, skip = 0, self.size, 0
+        else:
+            stop = self.length if stop is None else min(stop, self.length)
+            if start >= stop: return
+            if self.encoding in IDENTITY_ENCODINGS:
+                offset, end, skip = start, stop, 0
+            else:
+                offset = self._encoded_offset(start)
+                end = min(self._encoded_offset(stop - 1) + 4, self.size)
+                skip = start % 3
+
+        remaining = stop - start if stop is not None else None
+        decoder = get_decoder(self.encoding)
+        while offset < end:
+            data = self.fetch(offset, min(self.chunk_size, end - offset))
+            if not data: break
+            offset += len(data)
+            content = decoder.feed(data)
+            if offset >= end:
+                content += decoder.flush()
+            content, skip = content[skip:], max(skip - len(content), 0)
+            if remaining is not None:
+                content = content[:remaining]
+                remaining -= len(content)
+            if content:
+                yield content
@@ -0,0 +1,434 @@
+import threading
+import collections
+import sqlite3
+import json
+import os
+import hashlib
+import tempfile
+import bisect
+import time
+import base64
+import binascii
+
+
+class LRUCache:
+    '''Thread-safe mapping which keeps at most maxsize recently used items.'''
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def discard_if(self, predicate):
+        '''Removes all items whose keys meet the predicate.'''
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+def fields_key(fields):
+    '''Normalizes list of header fields (None means the whole header).'''
+    if fields is None:
+        return None
+    return frozenset(field.upper() for field in fields)
+
+
+def covers(cached_fields, fields):
+    '''Checks whether cached header contains all requested fields.'''
+    if cached_fields is None:
+        return True
+    if fields is None:
+        return False
+    return fields <= cached_fields
+
+
+class HeaderCache:
+    '''
+    Cache of e-mails' headers identified by (account, mailbox, uidvalidity,
+    uid). The pair uidvalidity/uid is never reused by the server (RFC 3501),
+    so headers never expire and only flags have to be refreshed. Recently
+    used headers are kept in memory, when path is given all headers are
+    persisted in SQLite database as well.
+    '''
+    def __init__(self, maxsize=10000, path=None):
+        self.memory = LRUCache(maxsize)
+        self.path = path
+        self._db = None
+        self._db_lock = threading.Lock()
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            with self._db:
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS headers ("
+                    "account TEXT, mailbox TEXT, uidvalidity INTEGER, "
+                    "uid INTEGER, fields TEXT, header TEXT, "
+                    "PRIMARY KEY (account, mailbox, uidvalidity, uid))"
+                )
+
+    def get_many(self, account, mailbox, uidvalidity, uids, fields=None):
+        '''
+        Returns dictionary {uid: header} with cached headers which contain
+        all requested fields. Uids absent in the dictionary have to be fetched
+        from the server.
+        '''
+        fields = fields_key(fields)
+        headers = dict()
+        missing = list()
+        for uid in uids:
+            entry = self.memory.get((account, mailbox, uidvalidity, uid))
+            if entry and covers(entry[0], fields):
+                headers[uid] = dict(entry[1])
+            else:
+                missing.append(uid)
+
+        if self._db and missing:
+            for uid, entry in self._load(account, mailbox, uidvalidity,
+                                         missing).items():
+                self.memory.put((account, mailbox, uidvalidity, uid), entry)
+                if covers(entry[0], fields):
+                    headers[uid] = dict(entry[1])
+
+        return headers
+
+    def put_many(self, account, mailbox, uidvalidity, headers, fields=None):
+        '''Saves headers given as dictionary {uid: header}.'''
+        fields = fields_key(fields)
+        for uid, header in headers.items():
+            self.memory.put((account, mailbox, uidvalidity, uid),
+                            (fields, dict(header)))
+
+        if self._db and headers:
+            fields_json = json.dumps(sorted(fields)) if fields else None
+            with self._db_lock, self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?)",
+                    [(account, mailbox, uidvalidity, uid, fields_json,
+                      json.dumps(header)) for uid, header in headers.items()]
+                )
+
+    def move_many(self, account, mailbox, uidvalidity, dest_mailbox,
+                  dest_uidvalidity, uids):
+        '''
+        Re-keys headers of e-mails moved to dest_mailbox, uids is dictionary
+        {uid: uid in dest_mailbox} (e.g. from COPYUID response code).
+        '''
+        for uid, dest_uid in uids.items():
+            entry = self.memory.pop((account, mailbox, uidvalidity, uid))
+            if entry is not None:
+                self.memory.put((account, dest_mailbox, dest_uidvalidity,
+                                 dest_uid), entry)
+
+        if self._db and uids:
+            with self._db_lock, self._db:
+                self._db.executemany(
+                    "UPDATE OR REPLACE headers SET mailbox = ?, "
+                    "uidvalidity = ?, uid = ? WHERE account = ? AND "
+                    "mailbox = ? AND uidvalidity = ? AND uid = ?",
+                    [(dest_mailbox, dest_uidvalidity, dest_uid, account,
+                      mailbox, uidvalidity, uid)
+                     for uid, dest_uid in uids.items()]
+                )
+
+    def discard_mailbox(self, account, mailbox):
+        '''Removes all headers of the mailbox (e.g. after its removal).'''
+        self.memory.discard_if(lambda key: key[:2] == (account, mailbox))
+        if self._db:
+            with self._db_lock, self._db:
+                self._db.execute(
+                    "DELETE FROM headers WHERE account = ? AND mailbox = ?",
+                    (account, mailbox)
+                )
+
+    def _load(self, account, mailbox, uidvalidity, uids, chunk=500):
+        entries = dict()
+        with self._db_lock:
+            for index in range(0, len(uids), chunk):
+                part = uids[index:index+chunk]
+                rows = self._db.execute(
+                    "SELECT uid, fields, header FROM headers "
+                    "WHERE account = ? AND mailbox = ? AND uidvalidity = ? "
+                    "AND uid IN (%s)" % ",".join("?" * len(part)),
+                    [account, mailbox, uidvalidity] + list(part)
+                )
+                for uid, fields_json, header_json in rows:
+                    fields = fields_key(json.loads(fields_json)) \
+                                 if fields_json else None
+                    entries[uid] = (fields, json.loads(header_json))
+        return entries
+
+
+class MessageStore:
+    '''
+    Store of raw e-mails (RFC822) on disk identified by (account, mailbox,
+    uidvalidity, uid), which like headers never change. Every message is
+    kept in a file named after the digest of its key (repeated reads are
+    served from the page cache). Least recently used files are removed when
+    total size exceeds maxsize (bytes).
+    '''
+    # Temporary files of interrupted writes older than this are removed
+    # (seconds, younger ones may still be written by other processes).
+    stale_tmp_age = 60*60
+
+    def __init__(self, path, maxsize=256*1024*1024):
+        self.path = path
+        self.maxsize = maxsize
+        self._files = collections.OrderedDict()  # name -> size
+        self._size = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        '''
+        Indexes files left by previous runs (oldest access first) and
+        removes stale temporary files of interrupted writes.
+        '''
+        files = list()
+        now = time.time()
+        for directory, _, names in os.walk(self.path):
+            for name in names:
+                if not name.endswith((".eml", ".tmp")): continue
+                try:
+                    stat = os.stat(os.path.join(directory, name))
+                    if name.endswith(".tmp"):
+                        if now - stat.st_mtime > self.stale_tmp_age:
+                            os.remove(os.path.join(directory, name))
+                        continue
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._files[name] = size
+            self._size += size
+        self._evict()
+
+    @staticmethod
+    def _name(account, mailbox, uidvalidity, uid):
+        key = "%s\0%s\0%s\0%s" % (account, mailbox, uidvalidity, uid)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest() + ".eml"
+
+    def _file(self, name):
+        return os.path.join(self.path, name[:2], name)
+
+    def get(self, account, mailbox, uidvalidity, uid):
+        '''Returns content of the message or None when it is not stored.'''
+        name = self._name(account, mailbox, uidvalidity, uid)
+        with self._lock:
+            if name not in self._files:
+                return None
+            self._files.move_to_end(name)
+        try:
+            with open(self._file(name), "rb") as f:
+                os.utime(f.fileno())
+                return f.read()
+        except OSError:
+            self._forget(name)
+            return None
+
+    def get_many(self, account, mailbox, uidvalidity, uids):
+        '''Returns dictionary {uid: content} with stored messages.'''
+        messages = dict()
+        for uid in uids:
+            content = self.get(account, mailbox, uidvalidity, uid)
+            if content is not None:
+                messages[uid] = content
+        return messages
+
+    def put(self, account, mailbox, uidvalidity, uid, content):
+        '''Saves the message (atomically, readers never see part of it).'''
+        if len(content) > self.maxsize:
+            return
+        name = self._name(account, mailbox, uidvalidity, uid)
+        directory = os.path.dirname(self._file(name))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, self._file(name))
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        with self._lock:
+            self._size += len(content) - self._files.pop(name, 0)
+            self._files[name] = len(content)
+            self._evict()
+
+    def put_many(self, account, mailbox, uidvalidity, messages):
+        '''Saves messages given as dictionary {uid: content}.'''
+        for uid, content in messages.items():
+            self.put(account, mailbox, uidvalidity, uid, content)
+
+    def _evict(self):
+        while self._size > self.maxsize and self._files:
+            name, size = self._files.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(self._file(name))
+            except OSError:
+                pass
+
+    def _forget(self, name):
+        with self._lock:
+            self._size -= self._files.pop(name, 0)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._files)
+
+    @property
+    def size(self):
+        with self._lock:
+            return self._size
+
+
+class MailboxIndex:
+    '''
+    Uids of the mailbox ordered by INTERNALDATE (the newest first), used for
+    pagination which does not shift when e-mails arrive or are expunged.
+    Position in the index is identified by (date, uid) of the e-mail.
+    '''
+    def __init__(self, uidvalidity):
+        self.uidvalidity = uidvalidity
+        self.refreshed = None
+        self.lock = threading.Lock()
+        self._keys = list()  # sorted (-date, -uid)
+        self._dates = dict()  # uid -> date
+
+    def update(self, items):
+        '''Adds e-mails given as iterable of (uid, date).'''
+        new = list()
+        for uid, date in items:
+            if uid in self._dates: continue
+            self._dates[uid] = date
+            new.append((-date, -uid))
+        if len(new) <= 64:
+            for key in new:
+                bisect.insort(self._keys, key)
+        else:
+            # Sorting merges the two sorted runs in linear time (insort of
+            # many e-mails would be quadratic).
+            self._keys.extend(new)
+            self._keys.sort()
+
+    def retain(self, uids):
+        '''Removes e-mails whose uids are not given (e.g. expunged).'''
+        uids = set(uids)
+        self._dates = {uid: date for uid, date in self._dates.items() 
+                                 if uid in uids}
+        self._keys = [key for key in self._keys if -key[1] in uids]
+
+    def page(self, after=None, limit=50):
+        '''
+        Returns the list of (uid, date) of at most limit e-mails following
+        the position after (date, uid), from the beginning when not given,
+        and flag whether there are more e-mails.
+        '''
+        start = 0
+        if after is not None:
+            start = bisect.bisect_right(self._keys, (-after[0], -after[1]))
+        keys = self._keys[start:start+limit]
+        return [(-uid, -date) for date, uid in keys], \
+               start + limit < len(self._keys)
+
+    def touch(self):
+        self.refreshed = time.monotonic()
+
+    def age(self):
+        if self.refreshed is None:
+            return float("inf")
+        return time.monotonic() - self.refreshed
+
+    @property
+    def max_uid(self):
+        return max(self._dates) if self._dates else 0
+
+    def __len__(self):
+        return len(self._keys)
+
+
+def encode_cursor(uidvalidity, date, uid):
+    '''Returns opaque cursor of the position in MailboxIndex.'''
+    text = "%d:%d:%d" % (uidvalidity, date, uid)
+    return base64.urlsafe_b64encode(text.encode("ascii")).decode("ascii")
+
+def decode_cursor(cursor):
+    '''Returns (uidvalidity, date, uid) of the cursor or None.'''
+    try:
+        text = base64.urlsafe_b64decode(cursor.encode("ascii"))
+        uidvalidity, date, uid = (int(item) for item in text.split(b":"))
+    except (ValueError, TypeError, UnicodeError, binascii.Error):
+        return None
+    return uidvalidity, date, uid
+
+
+class ListCache:
+    '''
+    Mailboxes of accounts (result of LIST with statuses) kept for ttl
+    seconds. Entries are dropped earlier when changes of the account are
+    noticed (IDLE events, untagged responses of NOOP, STORE, COPY etc.).
+    '''
+    def __init__(self, ttl=30, maxsize=1000):
+        self.ttl = ttl
+        self._entries = LRUCache(maxsize)
+        self._invalidated = LRUCache(maxsize)  # account -> time
+
+    def get(self, account):
+        entry = self._entries.get(account, None)
+        if entry is None:
+            return None
+        created, mailboxes = entry
+        if time.monotonic() - created > self.ttl:
+            self._entries.pop(account)
+            return None
+        return mailboxes
+
+    def put(self, account, mailboxes, since=None):
+        '''
+        Saves mailboxes of the account. When since (time.monotonic() before
+        LIST was sent) is given, mailboxes are not saved if the account has
+        been invalidated in the meantime.
+        '''
+        invalidated = self._invalidated.get(account, None)
+        if since is not None and invalidated is not None and \
+           invalidated >= since:
+            return
+        self._entries.put(account, (time.monotonic(), mailboxes))
+
+    def invalidate(self, account):
+        self._invalidated.put(account, time.monotonic())
+        self._entries.pop(account)
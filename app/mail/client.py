@@ -3,21 +3,78 @@ import socket
 import collections
 import re
 import email
+import email.utils
+import email.policy
 import datetime
 import string
 import random
+import binascii
+import base64
+import quopri
+import time
+import contextlib
+import itertools
+import warnings
 
 from email.header import decode_header
-from email.parser import HeaderParser
-from functools import partial#, partialmethod
-from app.utils import imap_recvall
+from functools import partial, lru_cache#, partialmethod
+from .reader import ResponseReader
+from .parser import (
+    parse_fetch, get_section, parse_header, decode_fields,
+    parse_bodystructure, FetchParseError
+)
+from .search import SearchQuery, make_document
+from .cache import LRUCache, MailboxIndex, encode_cursor, decode_cursor
+from .compress import DeflateSocket
+from .metrics import CommandEvent, MeteredSocket
+from .idset import IdSet
 
 # Set proper limit in order to avoid error: 
 # 'imaplib.error: command: SELECT => got more than 100000 bytes'
+# (SEARCH results of large mailboxes are sent as ranges with ESEARCH).
 imaplib._MAXLINE = 1000000
 socket.setdefaulttimeout(5)
 
 DEFAULT_MAILBOX = "INBOX"
+IMAP_SSL_PORT = 993
+
+# Longest sequence set sent in single command, longer ones are split into
+# several commands (servers limit the length of command line, RFC 7162
+# recommends accepting at least 8192 octets).
+MAX_SEQUENCE_SET = 8000
+
+# Sequence set of numbers only (no "*"), e.g. "1:3,7".
+SEQUENCE_SET_PATTERN = re.compile(r"^\d+(:\d+)?(,\d+(:\d+)?)*$")
+
+# Beginning of ESEARCH response (RFC 4731), e.g. b'(TAG "A1") UID MIN 2'.
+ESEARCH_PREFIX_PATTERN = re.compile(
+    rb'^\s*(?:\(TAG "[^"]*"\)\s*)?(?P<uid>UID\b)?', re.IGNORECASE
+)
+
+# Returned data of ESEARCH response, e.g. b'COUNT 3' or b'ALL 1:3,7' or
+# b'PARTIAL (-1:-50 7,9)'.
+ESEARCH_ITEM_PATTERN = re.compile(
+    rb"(?P<name>[A-Za-z]+)\s+(?P<value>\([^)]*\)|[^\s()]+)"
+)
+
+# Range of positions of PARTIAL (RFC 9394), e.g. "1:50" or "-1:-50".
+PARTIAL_PATTERN = re.compile(r"^(-?)[1-9]\d*:\1[1-9]\d*$")
+
+# Items of STATUS response, e.g. b'"INBOX" (MESSAGES 3 UNSEEN 1)'
+STATUS_ITEMS_PATTERN = re.compile(rb"\((?P<items>[^()]*)\)\s*$")
+
+# COPYUID response code (RFC 4315) in the text of response, e.g.
+# b'[COPYUID 38505 304,319:320 3956:3958] Done', or its value alone.
+COPYUID_PATTERN = re.compile(
+    rb"(?:^|\[COPYUID )(?P<uidvalidity>\d+) (?P<source>[\d:,]+) "
+    rb"(?P<dest>[\d:,]+)"
+)
+
+# Attributes of mailboxes which can not be selected (nor STATUSed).
+NOSELECT_FLAGS = frozenset(("\\NOSELECT", "\\NONEXISTENT"))
+
+# Untagged responses which mean that the selected mailbox has changed.
+CHANGE_RESPONSES = ("EXISTS", "EXPUNGE", "RECENT", "FETCH", "VANISHED")
 
 
 def decode_header_field(msg, name, default="ascii"):
@@ -44,6 +101,249 @@ def decode_header_field(msg, name, default="ascii"):
 
         return "".join(headers)
 
+def parse_sequence_set(seqset):
+    '''Expands sequence set (e.g. "1:3,7") to the list of numbers.'''
+    numbers = list()
+    for item in seqset.split(","):
+        if ":" in item:
+            first, last = sorted(int(number) for number in item.split(":"))
+            numbers.extend(range(first, last + 1))
+        elif item:
+            numbers.append(int(item))
+    return numbers
+
+def format_sequence_set(numbers):
+    '''Returns sequence set (e.g. "1:3,7") of sorted numbers.'''
+    ranges = list()
+    for number in numbers:
+        if ranges and ranges[-1][1] + 1 == number:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ",".join(str(first) if first == last else "%d:%d" % (first, last)
+                    for first, last in ranges)
+
+def parse_esearch(data):
+    '''
+    Returns dictionary of ESEARCH responses found in data (list of
+    responses without "ESEARCH" word): "UID" (bool), numbers of "MIN",
+    "MAX" and "COUNT" and IdSet of "ALL" and "PARTIAL" (RFC 9394) when
+    returned by the server.
+    '''
+    result = dict(UID=False)
+    for item in data:
+        if not isinstance(item, bytes): continue
+        prefix = ESEARCH_PREFIX_PATTERN.match(item)
+        result["UID"] = result["UID"] or bool(prefix.group("uid"))
+        for match in ESEARCH_ITEM_PATTERN.finditer(item, prefix.end()):
+            name = match.group("name").decode("ascii").upper()
+            value = match.group("value")
+            if name == "ALL":
+                result[name] = IdSet.from_sequence_set(value)
+            elif name == "PARTIAL":
+                _, _, found = value[1:-1].partition(b" ")
+                result[name] = IdSet() if found.upper() == b"NIL" else \
+                               IdSet.from_sequence_set(found)
+            elif value.isdigit():
+                result[name] = int(value)
+    return result
+
+def slice_partial(ids, partial):
+    '''
+    Returns part of IdSet at positions given like PARTIAL of RFC 9394,
+    e.g. "1:50" (the first ones) or "-1:-50" (the last ones).
+    '''
+    if not PARTIAL_PATTERN.match(partial):
+        raise ImapClientError("invalid partial range %r" % partial)
+    first, last = sorted((int(number) for number in partial.split(":")),
+                         key=abs)
+    if first < 0:
+        return ids[max(len(ids) + last, 0):len(ids) + first + 1]
+    return ids[max(first - 1, 0):last]
+
+def parse_copyuid(data):
+    '''
+    Returns dictionary {"uidvalidity": number, "uids": {uid: new uid}} from
+    COPYUID response code found in data (list of responses) or None.
+    '''
+    for item in data:
+        if not isinstance(item, bytes): continue
+        match = COPYUID_PATTERN.search(item)
+        if not match: continue
+        source = parse_sequence_set(match.group("source").decode("ascii"))
+        dest = parse_sequence_set(match.group("dest").decode("ascii"))
+        if len(source) != len(dest): continue
+        return dict(uidvalidity=int(match.group("uidvalidity")),
+                    uids=dict(zip(source, dest)))
+    return None
+
+@lru_cache(maxsize=100000)
+def parse_internaldate(value):
+    '''
+    Returns timestamp of INTERNALDATE (e.g. "17-Jul-1996 02:44:25 -0700").
+    Results are memoized, INTERNALDATE of an e-mail never changes.
+    '''
+    try:
+        return int(datetime.datetime.strptime(
+            value.strip(), "%d-%b-%Y %H:%M:%S %z"
+        ).timestamp())
+    except (ValueError, AttributeError):
+        return 0
+
+def parse_status(data):
+    '''
+    Returns dictionary {item: number} from STATUS response, e.g.
+    b'"INBOX" (MESSAGES 3 UNSEEN 1)'.
+    '''
+    status = dict()
+    for item in data:
+        if not isinstance(item, bytes): continue  # literal name of mailbox
+        match = STATUS_ITEMS_PATTERN.search(item)
+        if not match: continue
+        words = match.group("items").decode("ascii").split()
+        for name, value in zip(words[::2], words[1::2]):
+            status[name.upper()] = int(value)
+    return status
+
+def mailbox_name(text):
+    '''Removes quotes from the name of mailbox (in LIST/STATUS response).'''
+    return text.replace("\"", "").replace("'", "").strip()
+
+def parse_list(data):
+    '''Returns the list of (name, flags) from LIST response.'''
+    mailboxes = list()
+    for mailbox in data:
+        if not isinstance(mailbox, bytes): continue
+        metadata, name = re.split(r'"."', mailbox.decode("ascii"))
+        flags = list(map(lambda w: "\\" + w, re.findall(r"\w+", metadata)))
+        mailboxes.append((mailbox_name(name), flags))
+    return mailboxes
+
+def parse_list_status(data):
+    '''
+    Returns dictionary {name: {item: number}} from STATUS responses (e.g.
+    returned by LIST-STATUS).
+    '''
+    statuses = dict()
+    for item in data:
+        if not isinstance(item, bytes): continue
+        match = STATUS_ITEMS_PATTERN.search(item)
+        if not match: continue
+        name = mailbox_name(item[:match.start()].decode("ascii"))
+        statuses[name] = parse_status([item])
+    return statuses
+
+def split_address(addr):
+    '''Returns (host, port) of imap address, e.g. "localhost:9993".'''
+    host, separator, port = addr.rpartition(":")
+    if separator and port.isdigit() and ":" not in host:
+        return host, int(port)
+    return addr, IMAP_SSL_PORT
+
+def ids_to_bytes(ids):
+    '''
+    Converts ids given as iterable, string, bytes or single number to
+    sequence set (bytes). Numbers (iterables and strings without "*") are
+    sorted and compressed to ranges, e.g. [7, 3, 1, 2] or "1,2,3,7" to
+    b"1:3,7". Ranges of strings and IdSets are merged without expanding.
+    '''
+    if isinstance(ids, bytes):
+        return ids
+    if isinstance(ids, IdSet):
+        return ids.to_sequence_set().encode("ascii")
+    if isinstance(ids, str):
+        ids = ids.replace(" ", "")
+        if SEQUENCE_SET_PATTERN.match(ids):
+            return IdSet.from_sequence_set(ids).to_sequence_set() \
+                        .encode("ascii")
+        return ids.encode("utf-8")
+    if isinstance(ids, collections.abc.Iterable):
+        items = [item if isinstance(item, bytes) else str(item).encode("utf-8")
+                 for item in ids]
+        if all(item.isdigit() for item in items):
+            return format_sequence_set(
+                sorted(set(int(item) for item in items))
+            ).encode("ascii")
+        return b",".join(items)
+    return str(ids).encode("utf-8")
+
+def split_sequence_set(ids_bytes, max_length=None):
+    '''
+    Splits sequence set (bytes) into sets not longer than max_length
+    (MAX_SEQUENCE_SET by default), at commas (ranges are kept whole).
+    '''
+    if max_length is None:
+        max_length = MAX_SEQUENCE_SET
+    chunks = list()
+    start = 0
+    while len(ids_bytes) - start > max_length:
+        end = ids_bytes.rfind(b",", start, start + max_length + 1)
+        if end <= start:  # single item longer than max_length
+            end = ids_bytes.find(b",", start + 1)
+            if end == -1: break
+        chunks.append(ids_bytes[start:end])
+        start = end + 1
+    chunks.append(ids_bytes[start:])
+    return chunks
+
+def merge_copyuids(copyuids):
+    '''
+    Merges COPYUID mappings (see parse_copyuid) of several commands, None
+    when there is none.
+    '''
+    merged = None
+    for copyuid in copyuids:
+        if copyuid is None: continue
+        if merged is None:
+            merged = dict(uidvalidity=copyuid["uidvalidity"], uids=dict())
+        merged["uids"].update(copyuid["uids"])
+    return merged
+
+def parse_headers(data, *, uid, flags, header_decoders, fields=None,
+                  dates=None):
+    '''
+    Returns the list of decoded headers (with "id" and "Flags") from FETCH
+    responses of header section. When dates (dictionary) is given, it gets
+    timestamps of INTERNALDATE by id.
+    '''
+    headers = list()
+    for seq, items in parse_fetch(data):
+        raw_header = get_section(items)
+        if raw_header is None: continue
+        header = decode_fields(parse_header(raw_header, fields),
+                               header_decoders)
+        header["id"] = items.get("UID", None) if uid else seq
+        if flags and "FLAGS" in items:
+            header["Flags"] = items["FLAGS"]
+        if dates is not None and "INTERNALDATE" in items:
+            dates[header["id"]] = parse_internaldate(items["INTERNALDATE"])
+        headers.append(header)
+    return headers
+
+def message_from_bytes(data):
+    '''
+    Parses raw e-mail (bytes or memoryview) without decoding it to str
+    first, so 8-bit parts in other charsets than UTF-8 are kept intact.
+    Payloads of parts are decoded only when they are accessed
+    (get_payload(decode=True)). Headers stay raw (compat32) for
+    header_decoders.
+    '''
+    return email.message_from_bytes(bytes(data),
+                                    policy=email.policy.compat32)
+
+def header_date(header):
+    '''
+    Key for sorting headers by Date field (timestamp, 0 when the field is
+    missing or malformed).
+    '''
+    parsed = email.utils.parsedate_tz(header.get("Date", None) or "")
+    if not parsed:
+        return 0
+    try:
+        return email.utils.mktime_tz(parsed)
+    except (ValueError, OverflowError):
+        return 0
+
 def decode_data(data):
     try:
         data = data.decode("ascii")
@@ -92,13 +392,46 @@ def imaplib_decorator(args2save = list(), process_data = None):
 class ImapClient:
     '''
     Wraps imaplib.IMAP4_SSL and provides additional high-level methods for
-    accessing messages.
+    accessing messages. Address may include port ("host:port"), ssl_context
+    enables e.g. trusting own certificates. When compress is true, the
+    connection is compressed after login if the server supports
+    COMPRESS=DEFLATE (RFC 4978). Instrumentation (see app.mail.metrics)
+    gets duration, status and transferred bytes of each command. Timeout
+    (seconds) is set on the socket of the connection, the default socket
+    timeout is used when it is None.
     '''
-    def __init__(self, addr, timeout=None):
-        socket.setdefaulttimeout(timeout)
-        self.mail = imaplib.IMAP4_SSL(addr)
+    def __init__(self, addr, timeout=None, header_cache=None, 
+                 sync_cache=None, message_store=None, search_index=None,
+                 index_cache=None, list_cache=None, compress=False,
+                 ssl_context=None, instrumentation=None, display_cache=None):
+        host, port = split_address(addr)
+        self.addr = addr
         self.username = None
+        self.instrumentation = instrumentation
+        self._meter = None
+        with self._measure("CONNECT"):
+            self.mail = imaplib.IMAP4_SSL(host, port, ssl_context=ssl_context,
+                                          timeout=timeout)
+        if instrumentation is not None:
+            self._instrument()
         self.mailbox = None
+        self.uidvalidity = None
+        self.uidnext = None
+        self.highestmodseq = None
+        self.enabled = set()
+        self.header_cache = header_cache
+        self.sync_cache = sync_cache
+        self.message_store = message_store
+        self.search_index = search_index
+        self.index_cache = index_cache if index_cache is not None \
+                                       else LRUCache(10)
+        self.list_cache = list_cache
+        self.display_cache = display_cache
+        self._uids = None  # (key, IdSet) of the last SEARCH ALL
+        # Set when the connection is left in unknown state (ImapPool
+        # discards it instead of reusing).
+        self.broken = False
+        self.compress = compress
 
     def __getattr__(self, attr):
         '''
@@ -113,13 +446,6 @@ class ImapClient:
     # login = imaplib_decorator({1: "username"})(imaplib.IMAP4_SSL.login)
     # select = imaplib_decorator({1: "mailbox"})(imaplib.IMAP4_SSL.select)
 
-    def decode_data(data):
-        try:
-            data = data.decode("ascii")
-        except:
-            pass
-        return data
-
     create = imaplib_decorator(
                     process_data = decode_data
              )(imaplib.IMAP4_SSL.create)
@@ -142,11 +468,180 @@ class ImapClient:
 
         if status != "OK":
             raise ImapClientError(msg)
+
+        self._refresh_capabilities()
+        if self.compress:
+            self._start_compression()
+        self._enable_extensions()
         return status, msg
 
+    def _instrument(self):
+        '''
+        Counts bytes of the connection (MeteredSocket) and measures
+        commands run by imaplib (all of them go through _simple_command).
+        '''
+        sock = getattr(self.mail, "sock", None)
+        if sock is not None:
+            self._meter = MeteredSocket(sock)
+            self.mail.sock = self._meter
+            self.mail.file = self._meter.makefile("rb")
+        simple_command = self.mail._simple_command
+
+        def measured_command(name, *args):
+            with self._measure(self._command_name(name, *args)) as result:
+                status, data = simple_command(name, *args)
+                result["status"] = status
+            return status, data
+        self.mail._simple_command = measured_command
+
+    def _traffic(self):
+        '''
+        Returns bytes sent and received on the wire and received before
+        decompression so far.
+        '''
+        if self._meter is None:
+            return 0, 0, 0
+        sock = self.mail.sock
+        size = self._meter.received
+        if isinstance(sock, DeflateSocket):
+            size = sock.received
+        return self._meter.sent, self._meter.received, size
+
+    @contextlib.contextmanager
+    def _measure(self, command):
+        '''
+        Records the command (or processing) run in the block. The block
+        may set the status of the command in the yielded dictionary, the
+        status is "ERROR" when the block raises.
+        '''
+        result = dict(status="OK")
+        if self.instrumentation is None:
+            yield result
+            return
+        sent, received, size = self._traffic()
+        start = time.perf_counter()
+        try:
+            yield result
+        except BaseException:
+            result["status"] = "ERROR"
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            new_sent, new_received, new_size = self._traffic()
+            self.instrumentation.record(CommandEvent(
+                self.account if self.username else self.addr, command,
+                result["status"], duration, new_sent - sent,
+                new_received - received, new_size - size
+            ))
+
+    def has_capability(self, name):
+        '''Checks whether the server advertises given capability.'''
+        return name.upper() in self.mail.capabilities
+
+    def _refresh_capabilities(self):
+        '''
+        Servers may advertise more capabilities after authentication, 
+        usually in the response code of LOGIN (RFC 3501, 7.2.1).
+        '''
+        data = self.mail.untagged_responses.get("CAPABILITY", None)
+        if isinstance(data, list) and data and isinstance(data[-1], bytes):
+            self.mail.capabilities = tuple(
+                data[-1].decode("ascii").upper().split()
+            )
+
+    def _start_compression(self):
+        '''
+        Negotiates COMPRESS=DEFLATE and replaces the socket of imaplib, so
+        all following commands and responses (including the ones read
+        directly from the socket) are compressed.
+        '''
+        if not self.has_capability("COMPRESS=DEFLATE") or \
+           isinstance(self.mail.sock, DeflateSocket):
+            return
+        [(status, data, untagged)] = self.pipeline(("COMPRESS", "DEFLATE"))
+        if status != "OK":
+            return  # e.g. compression already active, stay uncompressed
+        self.mail.sock = DeflateSocket(self.mail.sock)
+        self.mail.file = self.mail.sock.makefile("rb")
+
+    def compression_stats(self):
+        '''
+        Returns counters of bytes sent and received before compression and
+        on the wire (see DeflateSocket) or None when not compressed.
+        '''
+        sock = getattr(self.mail, "sock", None)
+        if isinstance(sock, DeflateSocket):
+            return sock.stats()
+        return None
+
+    def _enable_extensions(self):
+        '''
+        Enables QRESYNC (or at least CONDSTORE) which are required for 
+        incremental synchronization (RFC 7162). ENABLE is allowed only 
+        in authenticated state, hence it is called just after login.
+        '''
+        if not self.has_capability("ENABLE"):
+            return
+        for extension in ("QRESYNC", "CONDSTORE"):
+            if self.has_capability(extension):
+                try:
+                    status, data = self.mail.enable(extension)
+                except imaplib.IMAP4.error:
+                    continue
+                if status == "OK":
+                    self.enabled.add(extension)
+                    if extension == "QRESYNC":
+                        self.enabled.add("CONDSTORE")
+                    break
+
+    @property
+    def account(self):
+        '''Identifies the account (used as a key by caches).'''
+        return "%s@%s" % (self.username, self.addr)
+
+    def _invalidate_list(self):
+        '''Drops cached list of mailboxes (their statuses have changed).'''
+        if self.list_cache is not None:
+            self.list_cache.invalidate(self.account)
+
+    def noop(self):
+        '''
+        Sends NOOP, drops cached list of mailboxes when the server reports
+        changes of the selected mailbox.
+        '''
+        untagged = self.mail.untagged_responses
+        for name in CHANGE_RESPONSES:
+            untagged.pop(name, None)
+        try:
+            status, data = self.mail.noop()
+        except imaplib.IMAP4.error as e:
+            raise ImapClientError(str(e)) from None
+        untagged = self.mail.untagged_responses
+        if any(name in untagged for name in CHANGE_RESPONSES):
+            self._invalidate_list()
+        return status, data
+
+    def _selected(self, mailbox):
+        '''
+        Saves name, UIDVALIDITY, UIDNEXT and HIGHESTMODSEQ (CONDSTORE) of 
+        successfully selected mailbox.
+        '''
+        self.mailbox = mailbox
+        self.uidvalidity = self._response_code("UIDVALIDITY")
+        self.uidnext = self._response_code("UIDNEXT")
+        self.highestmodseq = self._response_code("HIGHESTMODSEQ")
+
+    def _response_code(self, name):
+        '''Returns numeric value of the last response code (e.g. UIDNEXT).'''
+        try:
+            return int(self.mail.untagged_responses.get(name, [None])[-1])
+        except (TypeError, ValueError, AttributeError, IndexError):
+            return None
+
     def select(self, mailbox=DEFAULT_MAILBOX, readonly=False):
         '''Select mailbox.'''
         self.mailbox = mailbox
+        self.uidvalidity = None
         try:
             status, msg = self.mail.select(mailbox, readonly)
         except imaplib.IMAP4.error as e:
@@ -156,15 +651,164 @@ class ImapClient:
 
         if status != "OK":
             raise ImapClientError(msg)
+        self._selected(mailbox)
         return status, msg
 
-    def list(self, *args, **kwargs):
+    def pipeline(self, *commands):
+        '''
+        Sends several commands at once and waits for their completions,
+        so the whole batch takes one round trip. Commands are tuples
+        (name, *args), e.g. ("UID", "FETCH", b"1:4", "(FLAGS)"). Returns
+        the list of tuples (status, data, untagged) in the order of
+        commands, where data is the text of the tagged response and
+        untagged is dictionary of untagged responses received after the
+        completion of the previous command.
+        '''
+        encoding = getattr(self.mail, "_encoding", "ascii")
+        tags = list()
+        lines = list()
+        for name, *args in commands:
+            tag = self.mail._new_tag()
+            words = [tag, name.encode("ascii")]
+            for arg in args:
+                if arg is None: continue
+                words.append(arg if isinstance(arg, bytes)
+                             else str(arg).encode(encoding))
+            lines.append(b" ".join(words) + imaplib.CRLF)
+            tags.append(tag)
+
+        results = list()
+        names = " + ".join(self._command_name(*command)
+                           for command in commands)
+        with self._measure(names) as result:
+            try:
+                self.mail.send(b"".join(lines))
+                for tag in tags:
+                    while self.mail.tagged_commands[tag] is None:
+                        self.mail._get_response()
+                        if "BYE" in self.mail.untagged_responses:
+                            raise ImapClientError(
+                                self.mail.untagged_responses["BYE"][-1]
+                            )
+                    status, data = self.mail.tagged_commands.pop(tag)
+                    untagged = self.mail.untagged_responses
+                    self.mail.untagged_responses = dict()
+                    results.append((status, data, untagged))
+            except (imaplib.IMAP4.error, OSError) as e:
+                raise ImapClientError(str(e)) from None
+            result["status"] = next((status for status, _, _ in results
+                                     if status != "OK"), "OK")
+        return results
+
+    @staticmethod
+    def _command_name(name, *args):
+        '''Returns name of command for instrumentation, e.g. UID FETCH.'''
+        if name.upper() == "UID" and args:
+            return "UID " + str(args[0]).upper()
+        return name.upper()
+
+    def _select_and(self, mailbox, name, *args, readonly=False):
+        '''
+        Selects mailbox and runs the command in one round trip. Returns
+        (status, data) of the command like the methods of imaplib. When
+        SELECT fails, the server fails the command too (no mailbox is
+        selected).
+        '''
+        [(status, data)] = self._select_and_many(mailbox, [(name,) + args],
+                                                 readonly=readonly)
+        return status, data
+
+    def _select_and_many(self, mailbox, commands, *, readonly=False):
+        '''
+        Selects mailbox and runs the commands in one round trip, returns
+        the list of (status, data) of the commands (see _select_and).
+        '''
+        self.mailbox = mailbox
+        self.uidvalidity = None
+        self.mail.untagged_responses = dict()
+        (select_status, select_data, select_untagged), *results = \
+            self.pipeline(("EXAMINE" if readonly else "SELECT", mailbox),
+                          *commands)
+        if select_status != "OK":
+            self.mail.state = "AUTH"
+            raise ImapClientError(select_data)
+        self.mail.state = "SELECTED"
+        self.mail.is_readonly = readonly
+        self.mail.untagged_responses = select_untagged
+        self._selected(mailbox)
+        return [self._command_result(command, *result)
+                for command, result in zip(commands, results)]
+
+    @staticmethod
+    def _command_result(command, status, data, untagged):
+        '''
+        Returns (status, data) of pipelined command like imaplib: untagged
+        data of FETCH/STORE/SEARCH and the text of the tagged response of
+        other commands (e.g. COPYUID).
+        '''
+        name, *args = command
+        name = args[0].upper() if name.upper() == "UID" else name.upper()
+        result = dict(FETCH="FETCH", STORE="FETCH", SEARCH="SEARCH", 
+                      SORT="SORT", MOVE="COPYUID").get(name, None)
+        if status != "OK" or result is None:
+            return status, data
+        return status, untagged.get(result, [None])
+
+    def _run_chunks(self, chunks, name, *args, uid=False, select=None):
+        '''
+        Runs the command for each sequence set of chunks (see
+        split_sequence_set) in one round trip, after SELECT of the select
+        mailbox when given. Returns the list of (status, data) of the
+        commands (see _select_and).
+        '''
+        commands = [self._uid_command(name, uid) + (chunk,) + args
+                    for chunk in chunks]
+        if select:
+            return self._select_and_many(select, commands)
+        return [self._command_result(command, *result) for command, result
+                in zip(commands, self.pipeline(*commands))]
+
+    @staticmethod
+    def _uid_command(name, uid):
+        '''Returns the name of command (and subcommand for UID variant).'''
+        return ("UID", name) if uid else (name,)
+
+    def status_mailboxes(self, mailboxes, items="(MESSAGES UNSEEN)", *,
+                         strict=True):
+        '''
+        Returns dictionary {mailbox: {item: number}} with status of given
+        mailboxes. All STATUS commands are sent at once (pipelining). 
+        Mailboxes whose STATUS failed are omitted when strict is false.
+        '''
+        mailboxes = list(mailboxes)
+        if not mailboxes:
+            return dict()
+        results = self.pipeline(*[("STATUS", mailbox, items)
+                                  for mailbox in mailboxes])
+        statuses = dict()
+        for mailbox, (status, data, untagged) in zip(mailboxes, results):
+            if status != "OK":
+                if not strict: continue
+                raise ImapClientError(data)
+            statuses[mailbox] = parse_status(untagged.get("STATUS", []))
+        return statuses
+
+    def list(self, directory='""', pattern="*", *, status_items=None):
         '''
         IMAP LIST: Special-Use Mailboxes: https://tools.ietf.org/html/rfc6154
         Additional attributes: \All \Archive \Drafts \Flagged \Junk \Sent \Trash
+
+        When status_items are given (e.g. "(MESSAGES UNSEEN UIDNEXT)"),
+        returns triples (name, flags, {item: number}). Statuses come with
+        LIST response when LIST-STATUS (RFC 5819) is advertised, otherwise
+        STATUS commands are pipelined. Mailboxes which can not be selected
+        have empty status.
         '''
+        if status_items and self.has_capability("LIST-STATUS"):
+            return self._list_status(directory, pattern, status_items)
+
         try:
-            status, data = self.mail.list(*args, **kwargs)
+            status, data = self.mail.list(directory, pattern)
         except imaplib.IMAP4.error as e:
             raise ImapClientError(str(e)) from None
         except Exception as e:
@@ -173,20 +817,40 @@ class ImapClient:
         if status != "OK":
             raise ImapClientError(data)
 
-        mailboxes = list()
-        for mailbox in data:
-            metadata, name = re.split(r'"."', mailbox.decode("ascii"))
-            name = name.replace("\"", "").replace("'", "").rstrip().lstrip()
-            flags = list(map(lambda w: "\\" + w, re.findall("\w+", metadata)))
-            mailboxes.append((name, flags))
-
-        return status, mailboxes
+        mailboxes = parse_list(data)
+        if not status_items:
+            return status, mailboxes
+
+        selectable = ['"%s"' % name for name, flags in mailboxes
+                      if not NOSELECT_FLAGS & set(map(str.upper, flags))]
+        statuses = self.status_mailboxes(selectable, status_items,
+                                         strict=False)
+        return status, [(name, flags, statuses.get('"%s"' % name, dict()))
+                         for name, flags in mailboxes]
+
+    def _list_status(self, directory, pattern, items):
+        '''LIST with RETURN (STATUS ...) option (RFC 5819).'''
+        [(status, data, untagged)] = self.pipeline(
+            ("LIST", directory, pattern, "RETURN (STATUS %s)" % items)
+        )
+        if status != "OK":
+            raise ImapClientError(data)
+        statuses = parse_list_status(untagged.get("STATUS", []))
+        mailboxes = parse_list(untagged.get("LIST", []))
+        return status, [(name, flags, statuses.get(name, dict()))
+                        for name, flags in mailboxes]
 
-    def list_mailbox(self, mailbox=None, *criteria, uid=False, charset=None):
+    def list_mailbox(self, mailbox=None, *criteria, uid=False, charset=None,
+                     partial=None):
         '''
-        Returns the list of e-mails (ids or uids) from selected mailbox. 
+        Returns IdSet of e-mails (ids or uids) from selected mailbox. 
         Accepts additional criteria which are passed to search method. 
+        Partial (e.g. "1:50" or "-1:-50" for the newest ones) limits the
+        result to the range of positions, it is sent to servers which
+        support PARTIAL. Servers with ESEARCH send results as ranges.
         '''
+        if partial is not None and not PARTIAL_PATTERN.match(partial):
+            raise ImapClientError("invalid partial range %r" % partial)
         if not mailbox:
             mailbox = self.mailbox
             if not mailbox:
@@ -200,6 +864,10 @@ class ImapClient:
             raise e
 
         if select_status == "OK":
+            self._selected(mailbox)
+            if self.has_capability("ESEARCH"):
+                return self._esearch(criteria or ("ALL",), charset, uid,
+                                     partial)
             if uid:
                 search_status, data = self.uid(
                     "search", charset, *criteria or ("ALL",)
@@ -209,27 +877,71 @@ class ImapClient:
                     charset, *criteria or ("ALL",)
                 )
             if search_status == "OK":
-                return (search_status, [int(item) for item in data[0].split()])
+                ids = IdSet(int(item) for item in data[0].split())
+                if partial is not None:
+                    ids = slice_partial(ids, partial)
+                return (search_status, ids)
             else:
                 raise ImapClientError(data)
         else:
             raise ImapClientError(msg)
 
+    def _esearch(self, criteria, charset, uid, partial):
+        '''
+        Runs SEARCH with RETURN options of ESEARCH (RFC 4731), returns
+        ("OK", IdSet).
+        '''
+        if partial is not None and self.has_capability("PARTIAL"):
+            options = "(PARTIAL %s)" % partial
+        else:
+            options = "(MIN MAX COUNT ALL)"
+        args = ("RETURN", options)
+        if charset:
+            args += ("CHARSET", charset)
+        args += tuple(criteria)
+        try:
+            if uid:
+                status, data = self.mail._simple_command("UID", "SEARCH",
+                                                         *args)
+            else:
+                status, data = self.mail._simple_command("SEARCH", *args)
+        except imaplib.IMAP4.error as e:
+            raise ImapClientError(str(e))
+        if status != "OK":
+            raise ImapClientError(data)
+        status, data = self.mail._untagged_response(status, data, "ESEARCH")
+        result = parse_esearch(data)
+        if "PARTIAL" in result:
+            return status, result["PARTIAL"]
+        ids = result.get("ALL", IdSet())
+        if partial is not None:
+            ids = slice_partial(ids, partial)
+        return status, ids
+
     def csearch(self, criteria, charset="UTF-8", uid=False, 
-                timeout=5, clear_socket=True):
+                timeout=5, clear_socket=None):
         '''
         Returns e-mails (ids or uids) which meet specified criteria from 
         currently selected mailbox. Encodes criteria in accordance
-        with charset argument (UTF-8 by default).
+        with charset argument (UTF-8 by default). Timeout limits the time 
+        of waiting for each response (ImapClientError is raised when it
+        runs out). Unsolicited responses left by previous commands are
+        skipped by the reader, so clear_socket is deprecated (ignored).
         '''
+        if clear_socket is not None:
+            warnings.warn("clear_socket argument of csearch is deprecated "
+                          "and ignored", DeprecationWarning, stacklevel=2)
+        with self._measure("UID SEARCH" if uid else "SEARCH") as result:
+            status, data = self._csearch(criteria, charset, uid, timeout)
+            result["status"] = status
+        return status, data
+
+    def _csearch(self, criteria, charset, uid, timeout):
         if not isinstance(criteria, collections.abc.Sequence):
             raise TypeError("expected a sequence object (tuple, list etc.)")
 
         imap_socket = self.mail.socket()
-
-        # Clear socket
-        if clear_socket:
-            imap_recvall(imap_socket, timeout=0.00001)
+        reader = ResponseReader(imap_socket)
 
         # Split criteria into required encoding (literals) and not (strings)
         criteria_str = filter(lambda item: not item.get("decode", False), 
@@ -245,6 +957,8 @@ class ImapClient:
         if uid:
             query += b" UID"
         query += b" SEARCH "  
+        if self.has_capability("ESEARCH"):
+            query += b"RETURN (ALL) "
         if charset:
             query += b"CHARSET " + charset.encode("ascii") + b" "
 
@@ -285,42 +999,55 @@ class ImapClient:
                 query = query[:-1] + b"\r\n"
 
                 imap_socket.send(query)
-                data_recv = imap_recvall(imap_socket, timeout=timeout)
+                untagged, completion = self._read_csearch_response(
+                    reader, tag, timeout
+                )
 
-                if not data_recv.startswith(b'+'):
+                if not completion.startswith(b'+'):
                     break  
                 query = b""   
         else:
             query = query[:-1] + b"\r\n"
             imap_socket.send(query)
-            data_recv = imap_recvall(imap_socket, timeout=timeout)
-
-        resps = data_recv.split(b"\r\n")
-        status_raw = None
-        data_raw = None
-        for resp in resps:
-            if re.match(b"^[A-Z0-9]{5}", resp):
-                status_raw = resp.decode("ascii")
-            if resp.startswith(b"* SEARCH"):
-                data_raw = resp.decode("ascii")
+            untagged, completion = self._read_csearch_response(
+                reader, tag, timeout
+            )
 
-        status_match = re.search("^[A-Z0-9]{5} (?P<status>\w*)", status_raw)
+        status_raw = completion.decode("ascii", "replace")
+        status_match = re.search(r"^[A-Z0-9]+ (?P<status>\w*)", status_raw)
         if status_match:
             status = status_match.group("status")
         else:
             status = "ERROR"
 
-        if data_raw:
-            data_match = re.search("\* SEARCH (?P<ids>.*)", data_raw) 
-            if data_match:
-                data = [int(item) for item in data_match.group("ids").split(" ")]
-            else:
-                data = []
-        else:
+        data = None
+        for resp in untagged:
+            if resp.startswith(b"* SEARCH"):
+                if data is None:
+                    data = list()
+                data.extend(int(item) for item in resp[8:].split())
+            elif resp.startswith(b"* ESEARCH"):
+                data = parse_esearch([resp[9:]]).get("ALL", IdSet())
+        if data is None:
             data = status_raw
+        elif isinstance(data, list):
+            data = IdSet(data)
         
         return (status, data)
 
+    def _read_csearch_response(self, reader, tag, timeout):
+        '''
+        Returns (untagged, completion) of the command with the tag (str).
+        Timeouts and socket errors are raised as ImapClientError and the
+        client is marked as broken (the command may still be running).
+        '''
+        try:
+            return reader.read_response(tag=tag.encode("ascii"),
+                                        timeout=timeout)
+        except OSError as e:
+            self.broken = True
+            raise ImapClientError(str(e)) from None
+
 
     def len_mailbox(self, mailbox=None):
         '''Returns number of messages in a mailbox'''
@@ -338,19 +1065,11 @@ class ImapClient:
 
         if select_status != "OK":
             raise ImapClientError(data)
+        self._selected(mailbox)
         return "OK", int(data[0].decode("utf-8"))
 
     def _ids_to_bytes(self, ids):
-        if isinstance(ids, bytes):
-            ids_bytes = ids
-        elif isinstance(ids, str):
-            ids_bytes = bytes(ids.replace(" ", ""), "utf-8")
-        elif isinstance(ids, collections.Iterable):
-            ids_bytes = b','.join(item if isinstance(item, bytes) 
-                                  else bytes(str(item), "utf-8") for item in ids)
-        else: # assume ids is a number
-            ids_bytes = bytes(str(ids), "utf-8")
-        return ids_bytes
+        return ids_to_bytes(ids)
 
     def get_headers(
         self, ids, *, fields=None, uid=False, 
@@ -361,24 +1080,102 @@ class ImapClient:
         '''
         Returns the list with headers for given e-mails id-s/uid-s. Accepts
         iterables, string, bytes or single numbers. Fields argument enables
-        to retrive only selected fields (for bandwith optimization).
+        to retrive only selected fields (for bandwith optimization). When
+        the client has header cache, only headers of not cached e-mails are
+        fetched (flags are always refreshed). Headers are sorted by date
+        (the oldest first) with SORT (RFC 5256) when the server supports
+        it, otherwise by INTERNALDATE fetched together with the headers.
         '''
-        headers = list()
         ids_bytes = self._ids_to_bytes(ids)
-        parser = HeaderParser()
-
-        msg_parts = list()
-        if flags:
-            msg_parts.append("FLAGS")
-
+        # Fields kept by the parser, the others are skipped without decoding.
+        parse_fields = None
         if fields:
-            msg_parts.append("BODY.PEEK[HEADER.FIELDS (%s)]" % " ".join(fields))
+            parse_fields = set(field.upper() for field in fields)
+
+        order = None
+        dates = None
+        if sort_by_date:
+            if self.has_capability("SORT") and \
+               len(ids_bytes) <= MAX_SEQUENCE_SET:
+                order = self._sort_by_date(ids_bytes, uid=uid)
+            else:
+                dates = dict()
+
+        if self.header_cache is not None and self.uidvalidity is not None:
+            headers = self._get_cached_headers(
+                ids_bytes, fields=fields, uid=uid, 
+                header_decoders=header_decoders, flags=flags,
+                parse_fields=parse_fields, dates=dates
+            )
         else:
-            msg_parts.append("BODY.PEEK[HEADER]")
-        msg_parts = "(" + " ".join(msg_parts) + ")"
-
+            msg_parts = list()
+            if flags:
+                msg_parts.append("FLAGS")
+            if dates is not None:
+                msg_parts.append("INTERNALDATE")
+            msg_parts.append(self._header_part(fields))
+            msg_parts = "(" + " ".join(msg_parts) + ")"
+
+            data = self._fetch(ids_bytes, msg_parts, uid=uid)
+            headers = self._parse_headers(data, uid=uid, flags=flags,
+                                          header_decoders=header_decoders,
+                                          fields=parse_fields, dates=dates)
+
+        if order is not None:
+            position = {id: number for number, id in enumerate(order)}
+            headers.sort(key=lambda header: position.get(header["id"], -1))
+        elif dates is not None:
+            headers.sort(key=lambda header: (dates.get(header["id"], 0),
+                                             header["id"]))
+        return ("OK", headers)
+
+    def _sort_by_date(self, ids_bytes, *, uid=False):
+        '''
+        Returns ids of given e-mails sorted by date (the oldest first) by
+        the server (SORT, RFC 5256).
+        '''
         try:
             if uid:
+                status, data = self.mail.uid("sort", "(DATE)", "UTF-8",
+                                             "UID", ids_bytes)
+            else:
+                status, data = self.mail.sort("(DATE)", "UTF-8", ids_bytes)
+        except imaplib.IMAP4.error as e:
+            raise ImapClientError(str(e)) from None
+        if status != "OK":
+            raise ImapClientError(data)
+        return [int(id) for id in b" ".join(
+            item for item in data if item).split()]
+
+    def _header_part(self, fields):
+        if fields:
+            return "BODY.PEEK[HEADER.FIELDS (%s)]" % " ".join(fields)
+        return "BODY.PEEK[HEADER]"
+
+    def _fetch(self, ids_bytes, msg_parts, *, uid=False, mailbox=None):
+        '''
+        Runs FETCH/UID FETCH and returns data of successful response. When
+        mailbox is given, it is selected in the same round trip. Long
+        sequence sets are fetched by several pipelined commands.
+        '''
+        chunks = split_sequence_set(ids_bytes)
+        if len(chunks) > 1:
+            data = list()
+            for fetch_status, chunk_data in self._run_chunks(
+                chunks, "FETCH", msg_parts, uid=uid, select=mailbox
+            ):
+                if fetch_status != "OK":
+                    raise ImapClientError(chunk_data)
+                data.extend(chunk_data)
+            return data
+
+        try:
+            if mailbox:
+                fetch_status, data = self._select_and(
+                    mailbox, *self._uid_command("FETCH", uid),
+                    ids_bytes, msg_parts
+                )
+            elif uid:
                 fetch_status, data = self.mail.uid("fetch", 
                                                    ids_bytes, msg_parts)
             else:
@@ -388,84 +1185,735 @@ class ImapClient:
         except Exception as e: 
             raise e
 
-        if fetch_status == "OK":
-            for item in data:
-                if item == b')': continue   
-                if isinstance(item, tuple): 
-                    header = dict(parser.parsestr(
-                        item[1].decode("ascii"), headersonly=True)
-                    )
+        if fetch_status != "OK":
+            raise ImapClientError(data)
+        return data
 
-                    # Find message'id
-                    if uid:
-                        pattern = re.compile(".*UID (?P<id>\d+)")
-                    else:
-                        pattern = re.compile("(?P<id>\d+)")
-                    match_id = pattern.search(item[0].decode("ascii"))
-                    header["id"] = int(match_id.group("id")) if match_id else None
-
-                    # Find Flags
-                    if flags:
-                        pattern = re.compile("FLAGS \((?P<flags>.*)\) ")
-                        match_flags = pattern.search(item[0].decode("ascii"))
-                        if match_flags:
-                            msg_flags = match_flags.group("flags").split(" ")
-                            header["Flags"] = [flag for flag in msg_flags
-                                               if flag != "" and flag != " "]
-
-                    # Decode select fileds with given decoders
-                    for key in header.keys():
-                        header[key] = header_decoders.get(
-                                    key.upper(), lambda x: x[key])(header)
-                    
-                    headers.append(header)
-
-            if sort_by_date:
-                date_picker = lambda x: datetime.datetime.strptime(
-                                            x["Date"], 
-                                            "%a, %d %b %Y %H:%M:%S %z"   
-                                        )
-                headers = sorted(headers, key=date_picker)
-            return ("OK", headers)
+    def _parse_headers(self, data, *, uid, flags, header_decoders, 
+                       fields=None, dates=None):
+        with self._measure("parse headers"):
+            return parse_headers(data, uid=uid, flags=flags,
+                                 header_decoders=header_decoders,
+                                 fields=fields, dates=dates)
+
+    def get_headers_page(self, mailbox, *, cursor=None, limit=50, 
+                         fields=None, header_decoders=default_decoders,
+                         max_age=30):
+        '''
+        Returns page of headers of the mailbox in date order (the newest
+        first) following the cursor (the first page when not given) as
+        ("OK", {headers, next_cursor, total}). Pages do not shift when
+        e-mails arrive. The index of dates is refreshed (incrementally,
+        together with SELECT) for the first page or when it is older than
+        max_age seconds, otherwise the page costs single UID FETCH.
+        '''
+        position = None
+        if cursor:
+            position = decode_cursor(cursor)
+            if position is None:
+                raise ImapClientError("Invalid cursor.")
+
+        key = (self.account, mailbox.strip('"'))
+        index = self.index_cache.get(key)
+        if index is None or position is None or self.mailbox != mailbox or \
+           index.age() > max_age or position[0] != index.uidvalidity:
+            index = self._refresh_mailbox_index(mailbox, index)
+            self.index_cache.put(key, index)
+
+        if position is not None and position[0] != index.uidvalidity:
+            raise ImapClientError("The mailbox has been recreated " +
+                                  "(UIDVALIDITY changed), reload the list.")
+
+        with index.lock:
+            items, more = index.page(position[1:] if position else None,
+                                     limit)
+        headers = list()
+        if items:
+            uids = [uid for uid, _ in items]
+            status, headers = self.get_headers(
+                uids, fields=fields, uid=True, 
+                header_decoders=header_decoders, sort_by_date=False
+            )
+            order = {uid: number for number, uid in enumerate(uids)}
+            headers.sort(key=lambda header: order.get(header["id"], 0))
+
+        next_cursor = None
+        if items and more:
+            uid, date = items[-1]
+            next_cursor = encode_cursor(index.uidvalidity, date, uid)
+        return "OK", dict(headers=headers, next_cursor=next_cursor, 
+                          total=len(index))
+
+    def _refresh_mailbox_index(self, mailbox, index):
+        '''
+        Selects the mailbox and fetches dates of e-mails which arrived since
+        the last refresh in one round trip. Expunged e-mails are removed
+        when the number of e-mails does not match.
+        '''
+        start = index.max_uid + 1 if index is not None else 1
+        status, data = self._select_and(mailbox, "UID", "FETCH", 
+                                        "%d:*" % start, "(UID INTERNALDATE)")
+        exists = self._response_code("EXISTS")
+        if status != "OK":
+            if exists: raise ImapClientError(data)
+            data = list()  # empty mailbox
+
+        if index is None or index.uidvalidity != self.uidvalidity:
+            index = MailboxIndex(self.uidvalidity)
+            if start != 1 and exists:
+                data = self._fetch(b"1:*", "(UID INTERNALDATE)", uid=True)
+
+        with index.lock:
+            index.update(
+                (items["UID"], parse_internaldate(items.get("INTERNALDATE")))
+                for _, items in parse_fetch(data) if "UID" in items and 
+                                                     "INTERNALDATE" in items
+            )
+            if exists is not None and exists != len(index):
+                try:
+                    status, data = self.mail.uid("search", None, "ALL")
+                except imaplib.IMAP4.error as e:
+                    raise ImapClientError(str(e)) from None
+                if status != "OK":
+                    raise ImapClientError(data)
+                index.retain(int(uid) for uid in b" ".join(
+                    item for item in data if item).split())
+            index.touch()
+        return index
+
+    def _get_cached_headers(self, ids_bytes, *, fields, uid, 
+                            header_decoders, flags, parse_fields=None,
+                            dates=None):
+        '''
+        Fetches uids (and flags) of requested e-mails, takes headers from
+        the cache and downloads only the missing ones. When dates is given,
+        INTERNALDATE is fetched together with uids (see parse_headers).
+        '''
+        mailbox = self.mailbox.strip('"')
+        msg_parts = ["UID"]
+        if flags:
+            msg_parts.append("FLAGS")
+        if dates is not None:
+            msg_parts.append("INTERNALDATE")
+        data = self._fetch(ids_bytes, "(%s)" % " ".join(msg_parts), uid=uid)
+        index = list()
+        for seq, items in parse_fetch(data):
+            if "UID" not in items: continue
+            index.append((seq, items["UID"], items.get("FLAGS", [])))
+            if dates is not None and "INTERNALDATE" in items:
+                dates[items["UID"] if uid else seq] = \
+                    parse_internaldate(items["INTERNALDATE"])
+
+        uids = [msg_uid for _, msg_uid, _ in index]
+        cached = self.header_cache.get_many(self.account, mailbox, 
+                                            self.uidvalidity, uids, fields)
+        missing = [msg_uid for msg_uid in uids if msg_uid not in cached]
+
+        if missing:
+            data = self._fetch(self._ids_to_bytes(missing), 
+                               "(UID %s)" % self._header_part(fields), 
+                               uid=True)
+            fetched = dict()
+            for header in self._parse_headers(
+                data, uid=True, flags=False, header_decoders=header_decoders,
+                fields=parse_fields
+            ):
+                fetched[header.pop("id")] = header
+            self.header_cache.put_many(self.account, mailbox, 
+                                       self.uidvalidity, fetched, fields)
+            cached.update(fetched)
+
+        headers = list()
+        for seq, msg_uid, msg_flags in index:
+            if msg_uid not in cached: continue
+            header = dict(cached[msg_uid])
+            header["id"] = msg_uid if uid else seq
+            if flags:
+                header["Flags"] = msg_flags
+            headers.append(header)
+        return headers
+
+    def _parse_fetch_flags(self, data):
+        '''
+        Parses FETCH responses without literals, returns the list of tuples
+        (seq, uid, flags, modseq).
+        '''
+        return [(seq, items["UID"], items.get("FLAGS", []), 
+                 items.get("MODSEQ", None)) 
+                for seq, items in parse_fetch(data) if "UID" in items]
+
+    def sync(self, mailbox=None, modseq=None, uidvalidity=None, 
+             known_uids=None):
+        '''
+        Returns changes in the mailbox since given modification sequence
+        (CONDSTORE, RFC 7162): flags of changed and new e-mails, uids of
+        removed e-mails and the current modseq for the next call. 
+        Removed e-mails are reported by the server (QRESYNC) or found among
+        known_uids. When modseq is not given or uidvalidity has changed
+        "full" is set and "changed" contains all e-mails. Servers without
+        CONDSTORE are handled by comparing flags with the snapshot saved 
+        in sync_cache by the previous call.
+        '''
+        if not mailbox:
+            mailbox = self.mailbox or DEFAULT_MAILBOX
+        self.select(mailbox)
+
+        result = dict(uidvalidity=self.uidvalidity, uidnext=self.uidnext,
+                      modseq=self.highestmodseq, full=False, 
+                      changed=list(), vanished=list())
+
+        if modseq is None or uidvalidity != self.uidvalidity:
+            result["full"] = True
+            modseq = None
+
+        if self.highestmodseq is None:
+            return "OK", self._sync_snapshot(mailbox, modseq, result)
+
+        qresync = "QRESYNC" in self.enabled
+        if modseq is None:
+            data = self._fetch(b"1:*", "(UID FLAGS)", uid=True)
+        elif modseq >= self.highestmodseq:
+            data = list()
         else:
+            data = self._fetch(
+                b"1:*", "(UID FLAGS) (CHANGEDSINCE %d%s)" % 
+                    (modseq, " VANISHED" if qresync else ""), 
+                uid=True
+            )
+            if qresync:
+                for vanished in self.mail.untagged_responses.pop(
+                    "VANISHED", []
+                ):
+                    vanished = vanished.decode("ascii")
+                    vanished = vanished.replace("(EARLIER)", "").strip()
+                    result["vanished"].extend(parse_sequence_set(vanished))
+
+        # Without QRESYNC removed e-mails are searched among known uids, but
+        # only when something has changed since modseq.
+        if modseq is not None and modseq < self.highestmodseq and \
+           not qresync and known_uids:
+            result["vanished"] = self._find_vanished(known_uids)
+
+        for seq, msg_uid, msg_flags, msg_modseq in \
+            self._parse_fetch_flags(data):
+            result["changed"].append(dict(id=msg_uid, Flags=msg_flags, 
+                                          modseq=msg_modseq))
+        return "OK", result
+
+    def _find_vanished(self, uids):
+        '''Returns uids which are not present in the selected mailbox.'''
+        try:
+            status, data = self.mail.uid("search", None, "UID", 
+                                         self._ids_to_bytes(uids))
+        except imaplib.IMAP4.error as e:
+            raise ImapClientError(str(e)) from None
+
+        if status != "OK":
             raise ImapClientError(data)
+        existing = set(int(item) for item in (data[0] or b"").split())
+        return [uid for uid in uids if int(uid) not in existing]
 
-    def get_emails(self, ids, *, msg_parts = "(RFC822)", uid=False): 
+    def _sync_snapshot(self, mailbox, modseq, result):
+        '''
+        Synchronization for servers without CONDSTORE. Fetches flags of all 
+        e-mails and compares them with the snapshot from previous call. 
+        Numbers of snapshots play role of modseq.
+        '''
+        data = self._fetch(b"1:*", "(UID FLAGS)", uid=True)
+        current = {msg_uid: msg_flags for _, msg_uid, msg_flags, _ 
+                                      in self._parse_fetch_flags(data)}
+
+        key = (self.account, mailbox.strip('"'), self.uidvalidity)
+        snapshot = self.sync_cache.get(key) \
+                       if self.sync_cache is not None else None
+
+        if snapshot and modseq == snapshot[0]:
+            previous = snapshot[1]
+            result["vanished"] = [msg_uid for msg_uid in previous 
+                                          if msg_uid not in current]
+            changed = [msg_uid for msg_uid, msg_flags in current.items()
+                               if previous.get(msg_uid) != msg_flags]
+            number = snapshot[0] + 1 if changed or result["vanished"] \
+                         else snapshot[0]
+        else:
+            result["full"] = True
+            changed = list(current)
+            number = snapshot[0] + 1 if snapshot else 1
+
+        if self.sync_cache is not None:
+            self.sync_cache.put(key, (number, current))
+        result["modseq"] = number
+        result["changed"] = [dict(id=msg_uid, Flags=current[msg_uid], 
+                                  modseq=None) for msg_uid in changed]
+        return result
+
+    def get_email_for_display(self, id, *, uid=False, mailbox=None,
+                              header_decoders=default_decoders,
+                              mark_seen=False):
+        '''
+        Returns e-mail in the form of process_email_for_display. Downloads
+        BODYSTRUCTURE and the header first and then only text parts which
+        are shown, attachments are described by metadata. Falls back to
+        the whole e-mail when BODYSTRUCTURE can not be parsed. When the
+        client has display cache, e-mails (by uid) of the selected mailbox
+        are taken from it (e.g. prefetched ones). E-mails are fetched with
+        PEEK (the \\Seen flag is left alone) unless mark_seen is set (the
+        e-mail is opened by the user), then the header is fetched without
+        PEEK and e-mails from the cache are flagged by STORE.
+        '''
+        key = self._display_key(id, uid, mailbox)
+        if key is not None:
+            output = self.display_cache.get(key)
+            if output is not None:
+                if mark_seen:
+                    self.add_flags(id, "(\\Seen)", uid=uid)
+                return "OK", output
+
+        status, output = self._get_email_for_display(
+            id, uid=uid, mailbox=mailbox, header_decoders=header_decoders,
+            mark_seen=mark_seen
+        )
+        key = self._display_key(id, uid, None)
+        if key is not None and output is not None and \
+           header_decoders is default_decoders:
+            self.display_cache.put(key, output)
+        return status, output
+
+    def _display_key(self, id, uid, mailbox):
+        '''
+        Returns key of the e-mail in display cache or None when it can not
+        be cached (no cache, sequence number or not selected mailbox).
+        '''
+        if self.display_cache is None or not uid or \
+           not str(id).isdigit() or self.uidvalidity is None or \
+           mailbox not in (None, self.mailbox):
+            return None
+        return (self.account, self.mailbox, self.uidvalidity, int(id))
+
+    def _get_email_for_display(self, id, *, uid, mailbox, header_decoders,
+                               mark_seen):
+        ids_bytes = self._ids_to_bytes(id)
+        # BODY[HEADER] sets \Seen in the same round trip.
+        data = self._fetch(ids_bytes, "(UID BODYSTRUCTURE %s)" % (
+            "BODY[HEADER]" if mark_seen else "BODY.PEEK[HEADER]"
+        ), uid=uid, mailbox=mailbox)
+        if mark_seen:
+            self._invalidate_list()
+
+        try:
+            messages = [items for _, items in parse_fetch(data)
+                              if "BODYSTRUCTURE" in items]
+            if not messages:
+                return "OK", None
+            structure = parse_bodystructure(messages[0]["BODYSTRUCTURE"])
+        except FetchParseError:
+            status, emails = self.get_emails(
+                ids_bytes, uid=uid,
+                msg_parts="(RFC822)" if mark_seen else "(BODY.PEEK[])"
+            )
+            if not emails:
+                return "OK", None
+            return "OK", process_email_for_display(emails[0],
+                                                   header_decoders)
+
+        header = decode_fields(
+            parse_header(messages[0].get("BODY[HEADER]", None) or b""),
+            header_decoders
+        )
+        sections = get_display_sections(structure)
+        contents = dict()
+        if sections:
+            data = self._fetch(ids_bytes, "(%s)" % " ".join(
+                "BODY.PEEK[%s]" % section for section in sections
+            ), uid=uid)
+            for _, items in parse_fetch(data):
+                for section in sections:
+                    if "BODY[%s]" % section in items:
+                        contents[section] = items["BODY[%s]" % section]
+
+        if "UID" in messages[0]:
+            self._index_documents({messages[0]["UID"]: make_document(
+                header, get_part_texts(structure, contents)
+            )})
+        with self._measure("parse email"):
+            return "OK", process_bodystructure_for_display(structure,
+                                                           contents, header)
+
+    def get_part(self, id, section, *, uid=False, mailbox=None):
+        '''
+        Returns description of the part (see parse_bodystructure) of the
+        e-mail with given section or None when there is no such part.
+        '''
+        data = self._fetch(self._ids_to_bytes(id), "(BODYSTRUCTURE)",
+                           uid=uid, mailbox=mailbox)
+        try:
+            for _, items in parse_fetch(data):
+                if "BODYSTRUCTURE" in items:
+                    return "OK", find_part(
+                        parse_bodystructure(items["BODYSTRUCTURE"]), section
+                    )
+        except FetchParseError as e:
+            raise ImapClientError(str(e)) from None
+        return "OK", None
+
+    def fetch_partial(self, id, section, offset, length, *, uid=False):
+        '''
+        Returns 'length' octets of the section of the e-mail starting at
+        'offset' (partial FETCH), fewer at the end of the section.
+        '''
+        data = self._fetch(self._ids_to_bytes(id), 
+                           "(BODY.PEEK[%s]<%d.%d>)" % (section, offset, length),
+                           uid=uid)
+        name = "BODY[%s]<%d>" % (section, offset)
+        try:
+            for _, items in parse_fetch(data):
+                if name in items:
+                    return bytes(items[name] or b"")
+        except FetchParseError as e:
+            raise ImapClientError(str(e)) from None
+        return b""
+
+    def get_emails(self, ids, *, msg_parts = "(RFC822)", uid=False,
+                   mailbox=None): 
         '''
         Returns the list of emails (email.message.Message) for given id-s/uid-s. 
-        Accepts iterables, string, bytes or single numbers.
+        Accepts iterables, string, bytes or single numbers. When mailbox is
+        given, it is selected in the same round trip (pipelining). When the
+        client has message store, whole e-mails are read from it and only
+        the missing ones are downloaded.
         '''
         emails = list()
         ids_bytes = self._ids_to_bytes(ids)
 
-        try:
-            if uid:
-                fetch_status, data = self.mail.uid("fetch", ids_bytes, 
-                                                   msg_parts)
-            else:
-                fetch_status, data = self.mail.fetch(ids_bytes, msg_parts)
-        except imaplib.IMAP4.error as e:
-            raise ImapClientError(str(e)) from None
-        except Exception as e:
-            raise e
+        if self.message_store is not None and msg_parts == "(RFC822)":
+            return "OK", self._get_stored_emails(ids_bytes, uid=uid, 
+                                                 mailbox=mailbox)
 
-        if fetch_status == "OK":
-            for item in data:
-                if item == b')': continue   
-                if isinstance(item, tuple):
-                    msg = email.message_from_string(item[1].decode())
-                    emails.append(msg)
+        data = self._fetch(ids_bytes, msg_parts, uid=uid, mailbox=mailbox)
+        for item in data:
+            if item == b')': continue   
+            if isinstance(item, tuple):
+                emails.append(message_from_bytes(item[1]))
+        return ("OK", emails)
 
-            return ("OK", emails)
-        else:
+    def iter_emails(self, ids, *, uid=False, chunk_size=20):
+        '''
+        Yields e-mails (email.message.Message) for given id-s/uid-s of the
+        selected mailbox one by one as they arrive. Explicitly listed ids
+        are fetched in chunks of at most chunk_size e-mails, each response
+        is parsed as soon as it has been read, so only single e-mail is
+        kept in memory (e-mails of the message store are read by chunks).
+        '''
+        for chunk in self._split_ids(self._ids_to_bytes(ids), chunk_size):
+            if self.message_store is not None:
+                yield from self.get_emails(chunk, uid=uid)[1]
+                continue
+            for _, content in self._iter_fetch(chunk, "(RFC822)", uid=uid):
+                yield message_from_bytes(content)
+
+    @staticmethod
+    def _split_ids(ids_bytes, size):
+        '''
+        Splits sequence set into sets of at most size numbers. Sets with
+        "*" (unknown size) are not split.
+        '''
+        if not re.match(rb"^[\d,:]+$", ids_bytes):
+            yield ids_bytes
+            return
+        numbers = sorted(set(parse_sequence_set(ids_bytes.decode("ascii"))))
+        for start in range(0, len(numbers), size):
+            yield format_sequence_set(
+                numbers[start:start + size]
+            ).encode("ascii")
+
+    def _iter_fetch(self, ids_bytes, msg_parts, *, uid=False):
+        '''
+        Runs FETCH/UID FETCH and yields literals of responses (pairs (text,
+        literal) like in data of imaplib) as soon as each response has been
+        read. When iteration is stopped early, the rest of responses is
+        read and dropped, so the connection stays usable (it is marked as
+        broken when that fails). Recorded duration includes processing of
+        yielded items.
+        '''
+        tag = self.mail._new_tag()
+        words = [tag]
+        words.extend(word.encode("ascii")
+                     for word in self._uid_command("FETCH", uid))
+        words.extend([ids_bytes, msg_parts.encode("ascii")])
+        self.mail.untagged_responses.pop("FETCH", None)
+        with self._measure(self._command_name(
+            *self._uid_command("FETCH", uid)
+        )) as result:
+            try:
+                self.mail.send(b" ".join(words) + imaplib.CRLF)
+                while self.mail.tagged_commands[tag] is None:
+                    self.mail._get_response()
+                    if "BYE" in self.mail.untagged_responses:
+                        raise ImapClientError(
+                            self.mail.untagged_responses["BYE"][-1]
+                        )
+                    for item in self.mail.untagged_responses.pop("FETCH",
+                                                                 ()):
+                        if isinstance(item, tuple):
+                            yield item
+                status, data = self.mail.tagged_commands.pop(tag)
+            except GeneratorExit:
+                try:
+                    while self.mail.tagged_commands[tag] is None:
+                        self.mail._get_response()
+                        self.mail.untagged_responses.pop("FETCH", None)
+                    self.mail.tagged_commands.pop(tag)
+                except (imaplib.IMAP4.error, OSError):
+                    self.broken = True
+                raise
+            except (imaplib.IMAP4.error, OSError) as e:
+                raise ImapClientError(str(e)) from None
+            result["status"] = status
+        if status != "OK":
             raise ImapClientError(data)
 
-    def move_emails(self, ids, mailbox, *, uid=False):
-        '''Move 'message_set' messages onto end of 'new_mailbox'.'''
+    def _get_stored_emails(self, ids_bytes, *, uid, mailbox):
+        '''
+        Fetches uids of requested e-mails, takes raw e-mails from the message
+        store and downloads only the missing ones. Explicitly listed uids of
+        the selected mailbox are looked up without asking the server.
+        '''
+        uids = None
+        if uid and self.uidvalidity is not None and \
+           mailbox in (None, self.mailbox) and re.match(rb"^[\d,]+$", ids_bytes):
+            uids = [int(msg_uid) for msg_uid in ids_bytes.split(b",")]
+            stored = self.message_store.get_many(
+                self.account, self.mailbox.strip('"'), self.uidvalidity, uids
+            )
+            if len(stored) < len(set(uids)):
+                uids = None
+        if uids is None:
+            data = self._fetch(ids_bytes, "(UID)", uid=uid, mailbox=mailbox)
+            uids = [msg_uid for _, msg_uid, _, _ 
+                            in self._parse_fetch_flags(data)]
+            stored = dict()
+            if self.uidvalidity is not None:
+                stored = self.message_store.get_many(
+                    self.account, self.mailbox.strip('"'), self.uidvalidity, 
+                    uids
+                )
+
+        missing = [msg_uid for msg_uid in uids if msg_uid not in stored]
+        if missing:
+            data = self._fetch(self._ids_to_bytes(missing), "(UID RFC822)", 
+                               uid=True)
+            fetched = dict()
+            for _, items in parse_fetch(data):
+                if "UID" in items and items.get("RFC822", None) is not None:
+                    fetched[items["UID"]] = bytes(items["RFC822"])
+            if self.uidvalidity is not None:
+                self.message_store.put_many(self.account, 
+                                            self.mailbox.strip('"'),
+                                            self.uidvalidity, fetched)
+            stored.update(fetched)
+
+        emails = dict()
+        for msg_uid in uids:
+            if msg_uid in stored and msg_uid not in emails:
+                emails[msg_uid] = message_from_bytes(stored[msg_uid])
+        if missing:
+            self._index_documents({
+                msg_uid: make_document(get_message_header(emails[msg_uid]),
+                                       get_message_texts(emails[msg_uid]))
+                for msg_uid in missing if msg_uid in emails
+            })
+        return [emails[msg_uid] for msg_uid in uids if msg_uid in emails]
+
+    def _index_documents(self, documents, body=True):
+        '''Adds documents {uid: document} of the selected mailbox to index.'''
+        if self.search_index is None or self.uidvalidity is None:
+            return
+        self.search_index.add_many(self.account, self.mailbox.strip('"'),
+                                   self.uidvalidity, documents, body=body)
+
+    def index_mailbox(self, mailbox=None):
+        '''
+        Adds the newest e-mails of the mailbox (the selected one by default)
+        which are not indexed yet to the search index (at most batch_size
+        of the index at once). Run by background workers, indexed_search
+        does not wait for it.
+        '''
+        if self.search_index is None:
+            return
+        if mailbox:
+            self.select(mailbox, readonly=True)
+        status, uids = self._mailbox_uids()
+        if status != "OK" or self.uidvalidity is None:
+            return
+        try:
+            self._index_new_emails(uids)
+        except FetchParseError:
+            pass
+
+    def _mailbox_uids(self):
+        '''
+        Returns ("OK", IdSet) of uids of the selected mailbox. The result
+        of SEARCH ALL is reused while UIDVALIDITY, UIDNEXT and the number
+        of messages (EXISTS) of the mailbox do not change.
+        '''
+        key = (self.account, self.mailbox, self.uidvalidity, self.uidnext,
+               self._response_code("EXISTS"))
+        if self._uids is not None and self._uids[0] == key and \
+           None not in key:
+            return "OK", self._uids[1]
+        status, uids = self.csearch([{"key": "ALL"}], uid=True)
+        if status != "OK":
+            return status, uids
+        uids = IdSet(uids)
+        self._uids = (key, uids)
+        return status, uids
+
+    def _index_new_emails(self, uids):
+        '''
+        Downloads headers and shown text parts of the newest e-mails which
+        are not indexed yet (at most batch_size of the index at once).
+        '''
+        indexed = self.search_index.indexed_uids(
+            self.account, self.mailbox.strip('"'), self.uidvalidity
+        )
+        new = list(itertools.islice(
+            (msg_uid for msg_uid in reversed(uids) if msg_uid not in indexed),
+            self.search_index.batch_size
+        ))[::-1]
+        if not new:
+            return
+
+        data = self._fetch(self._ids_to_bytes(new), 
+                           "(UID BODYSTRUCTURE BODY.PEEK[HEADER])", uid=True)
+        messages = dict()
+        headers_only = dict()
+        groups = collections.defaultdict(list)
+        for _, items in parse_fetch(data):
+            if "UID" not in items: continue
+            header = decode_fields(
+                parse_header(items.get("BODY[HEADER]", None) or b""),
+                default_decoders
+            )
+            try:
+                structure = parse_bodystructure(items["BODYSTRUCTURE"])
+            except (KeyError, FetchParseError):
+                headers_only[items["UID"]] = make_document(header, [])
+                continue
+            sections = tuple(get_display_sections(structure))
+            messages[items["UID"]] = (header, structure)
+            groups[sections].append(items["UID"])
+
+        # E-mails with the same layout of parts are fetched together
+        contents = collections.defaultdict(dict)
+        for sections, group in groups.items():
+            if not sections: continue
+            msg_parts = "(UID %s)" % " ".join(
+                "BODY.PEEK[%s]" % section for section in sections
+            )
+            data = self._fetch(self._ids_to_bytes(group), msg_parts, uid=True)
+            for _, items in parse_fetch(data):
+                for section in sections:
+                    if "UID" in items and "BODY[%s]" % section in items:
+                        contents[items["UID"]][section] = \
+                            items["BODY[%s]" % section]
+
+        self._index_documents({
+            msg_uid: make_document(header, get_part_texts(structure, 
+                                                          contents[msg_uid]))
+            for msg_uid, (header, structure) in messages.items()
+        })
+        self._index_documents(headers_only, body=False)
+
+    def indexed_search(self, criteria, *, uid=False):
+        '''
+        Works like csearch, but answers from the local full-text index when
+        possible. Criteria not supported by the index are sent to the
+        server, e-mails which are not indexed are searched by the server
+        (limited with UID criterion). Returns IdSet like csearch.
+        '''
+        query = SearchQuery.from_criteria(criteria) \
+                    if self.search_index is not None else None
+        if query is None or self.uidvalidity is None:
+            return self.csearch(criteria, uid=uid)
+
+        status, all_uids = self._mailbox_uids()
+        if status != "OK":
+            return status, all_uids
+
+        # Not indexed e-mails are searched by the server, they are indexed
+        # in the background (index_mailbox).
+        mailbox = self.mailbox.strip('"')
+        found = self.search_index.search(self.account, mailbox,
+                                         self.uidvalidity, query)
+        if found is None:
+            return self.csearch(criteria, uid=uid)
+        indexed = self.search_index.indexed_uids(
+            self.account, mailbox, self.uidvalidity, body=query.needs_body
+        )
+        found &= indexed
+
+        rest = IdSet(msg_uid for msg_uid in all_uids
+                           if msg_uid not in indexed)
+        if rest:
+            status, data = self.csearch(
+                [{"key": "UID", "value": rest.to_sequence_set()}] + 
+                list(criteria), uid=True
+            )
+            if status != "OK":
+                return status, data
+            found.update(data if not isinstance(data, str) else [])
+
+        found = IdSet(found)
+        if not uid:
+            # Sequence numbers are positions in uids of the mailbox (found
+            # by bisection over runs of IdSet).
+            found = IdSet(all_uids.index(msg_uid) + 1 for msg_uid in found
+                                                     if msg_uid in all_uids)
+        return "OK", found
+
+    def move_emails(self, ids, mailbox, *, uid=False, source_mailbox=None):
+        '''
+        Move 'message_set' messages onto end of 'new_mailbox'. When
+        source_mailbox is given, it is selected in the same round trip.
+
+        Uses MOVE (RFC 6851) when advertised. Otherwise messages are
+        copied and, with UIDPLUS (RFC 4315), marked \\Deleted and removed
+        by UID EXPUNGE of just the copied uids. Returns COPYUID mapping
+        {"uidvalidity": number, "uids": {uid: new uid}} or None when the
+        server does not report it.
+        '''
         ids_bytes = self._ids_to_bytes(ids)
 
+        if self.has_capability("MOVE"):
+            return self._move(ids_bytes, mailbox, uid=uid,
+                              source_mailbox=source_mailbox)
+
+        chunks = split_sequence_set(ids_bytes)
+        if len(chunks) > 1:
+            results = self._run_chunks(chunks, "COPY", mailbox, uid=uid,
+                                       select=source_mailbox)
+            for copy_status, data in results:
+                if copy_status != "OK":
+                    raise ImapClientError(decode_data(data[-1]))
+            copyuid = merge_copyuids(parse_copyuid(data)
+                                     for _, data in results)
+        else:
+            copy_status, copyuid = self._copy(ids_bytes, mailbox, uid=uid,
+                                              source_mailbox=source_mailbox)
+        if copyuid and self.has_capability("UIDPLUS"):
+            self._expunge_uids(format_sequence_set(sorted(copyuid["uids"])))
+        self._moved(mailbox, copyuid)
+        return copy_status, copyuid
+
+    def _copy(self, ids_bytes, mailbox, *, uid, source_mailbox):
+        '''Copies messages, returns (status, COPYUID mapping).'''
         try:
-            if uid:
+            if source_mailbox:
+                copy_status, data = self._select_and(
+                    source_mailbox, *self._uid_command("COPY", uid),
+                    ids_bytes, mailbox
+                )
+            elif uid:
                 copy_status, data = self.mail.uid("copy", ids_bytes, mailbox)
             else:
                 copy_status, data = self.mail.copy(ids_bytes, mailbox)
@@ -478,22 +1926,87 @@ class ImapClient:
             if data[0]:
                 data = data[0].decode("ascii")
             raise ImapClientError(data)
+        return copy_status, parse_copyuid(data)
 
-        return copy_status, data
+    def _move(self, ids_bytes, mailbox, *, uid, source_mailbox):
+        '''
+        Moves messages with MOVE command (see move_emails), several
+        pipelined ones for long sequence sets.
+        '''
+        commands = [self._uid_command("MOVE", uid) + (chunk, mailbox)
+                    for chunk in split_sequence_set(ids_bytes)]
+        if source_mailbox:
+            results = self._select_and_many(source_mailbox, commands)
+        else:
+            results = [(status, untagged.get("COPYUID", []) + data)
+                       for status, data, untagged in self.pipeline(*commands)]
+        for status, data in results:
+            if status != "OK":
+                raise ImapClientError(decode_data(data[-1]))
+        copyuid = merge_copyuids(parse_copyuid(data)
+                                 for status, data in results)
+        self._moved(mailbox, copyuid)
+        return status, copyuid
 
-    def store(self, ids, flags, *, command, uid=False):
-        '''Alters flag dispositions for messages in mailbox.'''
+    def _expunge_uids(self, uids):
+        '''
+        Removes messages with given uids (sequence set) from the selected
+        mailbox, other messages marked \\Deleted are left intact.
+        '''
+        chunks = split_sequence_set(uids.encode("ascii"))
+        results = self.pipeline(*(
+            [("UID", "STORE", chunk, "+FLAGS.SILENT", "(\\Deleted)")
+             for chunk in chunks] +
+            [("UID", "EXPUNGE", chunk) for chunk in chunks]
+        ))
+        for status, data, untagged in results:
+            if status != "OK":
+                raise ImapClientError(data)
+
+    def _moved(self, mailbox, copyuid):
+        '''
+        Re-keys cached headers of moved messages (to avoid fetching them
+        again from the destination mailbox).
+        '''
+        self._invalidate_list()
+        if copyuid and self.header_cache is not None and \
+           self.mailbox and self.uidvalidity is not None:
+            self.header_cache.move_many(
+                self.account, self.mailbox.strip('"'), self.uidvalidity,
+                mailbox.strip('"'), copyuid["uidvalidity"], copyuid["uids"]
+            )
+
+    def store(self, ids, flags, *, command, uid=False, mailbox=None):
+        '''
+        Alters flag dispositions for messages in mailbox. When mailbox is
+        given, it is selected in the same round trip. Long sequence sets
+        are stored by several pipelined commands (data of the first one
+        is returned).
+        '''
         ids_bytes = self._ids_to_bytes(ids)
 
         if isinstance(flags, str):
             flags_str = flags
-        elif isinstance(flags, collections.Iterable):
+        elif isinstance(flags, collections.abc.Iterable):
             flags_str = " ".join(flags)
         else:
             flags_str = flags
 
+        chunks = split_sequence_set(ids_bytes)
         try: 
-            if uid:
+            if len(chunks) > 1:
+                results = self._run_chunks(chunks, "STORE", command, 
+                                           flags_str, uid=uid, select=mailbox)
+                store_status, data = next(
+                    (result for result in results if result[0] != "OK"),
+                    results[0]
+                )
+            elif mailbox:
+                store_status, data = self._select_and(
+                    mailbox, *self._uid_command("STORE", uid),
+                    ids_bytes, command, flags_str
+                )
+            elif uid:
                 store_status, data = self.mail.uid("store", ids_bytes, command, 
                                                    flags_str)
             else:   
@@ -509,20 +2022,30 @@ class ImapClient:
         if store_status != "OK":
             raise ImapClientError(data)
 
+        self._invalidate_list()
         return store_status, data
 
-    def add_flags(self, ids, flags, *, uid=False): 
-        return self.store(ids, flags, command="+FLAGS", uid=uid)
+    def add_flags(self, ids, flags, *, uid=False, mailbox=None):
+        return self.store(ids, flags, command="+FLAGS", uid=uid,
+                          mailbox=mailbox)
 
-    def set_flags(self, ids, flags, *, uid=False): 
-        return self.store(ids, flags, command="FLAGS", uid=uid)
+    def set_flags(self, ids, flags, *, uid=False, mailbox=None):
+        return self.store(ids, flags, command="FLAGS", uid=uid,
+                          mailbox=mailbox)
 
-    def remove_flags(self, ids, flags, *, uid=False): 
-        return self.store(ids, flags, command="-FLAGS", uid=uid)
+    def remove_flags(self, ids, flags, *, uid=False, mailbox=None):
+        return self.store(ids, flags, command="-FLAGS", uid=uid,
+                          mailbox=mailbox)
 
 
 def email_to_dict(msg, header_decoders = default_decoders):
-    '''Convert email.message.Message instance to dictionary representation.'''
+    '''
+    Convert email.message.Message instance to dictionary representation.
+    Only text parts are decoded (with charset of their Content-Type),
+    body of other parts (e.g. binary attachments) is their content encoded
+    with base64 (str). Parts already sent in base64 are passed on without
+    decoding (only line breaks are removed), others are encoded.
+    '''
     output = dict(header={})
 
     for key in msg.keys():
@@ -532,25 +2055,38 @@ def email_to_dict(msg, header_decoders = default_decoders):
     if msg.is_multipart():
         output["body"] = list()
         for part in msg.get_payload():
-            output["body"].append(email_to_dict(part))
-    else:
+            output["body"].append(email_to_dict(part, header_decoders))
+    elif msg.get_content_maintype() == "text":
         content = msg.get_payload(decode=True)
-        output["body"] = decode_content(content, msg.get_charset())
+        output["body"] = decode_content(content, msg.get_content_charset())
+    elif msg.get("Content-Transfer-Encoding", "").strip().lower() == \
+         "base64":
+        output["body"] = "".join(msg.get_payload().split())
+    else:
+        content = msg.get_payload(decode=True) or b""
+        output["body"] = base64.b64encode(content).decode("ascii")
 
     return output
 
 
 def decode_content(content, charset=None):
+    '''
+    Decodes text with given charset (of Content-Type), invalid bytes are
+    replaced. Common charsets are tried only when the charset is missing
+    or unknown.
+    '''
     if charset:
-        content = content.decode(charset)
-    else:
-        # Try one of the default charset
-        for chset in ['ascii', 'utf-8', 'utf-16', 'windows-1252', 'cp850']:
-            try: 
-                content = content.decode(chset)
-                break
-            except UnicodeError:
-                pass
+        try:
+            return content.decode(charset, "replace")
+        except LookupError:
+            pass
+    # Try one of the default charset
+    for chset in ['ascii', 'utf-8', 'utf-16', 'windows-1252', 'cp850']:
+        try: 
+            content = content.decode(chset)
+            break
+        except UnicodeError:
+            pass
     return content
 
 
@@ -620,10 +2156,159 @@ def process_email_for_display(msg, header_decoders = default_decoders):
                 output["content"] = None
             else:
                 content = msg.get_payload(decode=True)
-                body = decode_content(content, msg.get_charset())
+                body = decode_content(content, msg.get_content_charset())
                 output["content"] = body
         else:
             output["type"] = "unsupported"
             output["content"] = None
 
-    return output
\ No newline at end of file
+    return output
+
+
+def get_part_pref(part):
+    '''Works like get_msg_pref for parts described by BODYSTRUCTURE.'''
+    content_type = content_prefs.get(part["maintype"], None)
+    if content_type:
+        return content_type.get(part["subtype"], -1)
+    return -1
+
+def is_attachment(part):
+    return part["disposition"] == "attachment" or \
+           (part["maintype"] not in ("text", "multipart") and
+            ("filename" in part["disposition_params"] or
+             "name" in part["params"]))
+
+def get_part_texts(structure, contents):
+    '''Returns (subtype, text) of downloaded text parts (see decode_part).'''
+    texts = list()
+    for section, content in contents.items():
+        part = find_part(structure, section)
+        if part is not None and part["maintype"] == "text":
+            texts.append((part["subtype"], decode_part(part, content)))
+    return texts
+
+def get_message_header(msg):
+    '''Returns decoded fields of email.message.Message used by the index.'''
+    return {name: decode_header_field(msg, name) 
+            for name in ("Subject", "From", "To", "CC", "Date")
+            if msg[name] is not None}
+
+def get_message_texts(msg):
+    '''Returns (subtype, text) of text parts which are not attachments.'''
+    texts = list()
+    for part in msg.walk():
+        if part.get_content_maintype() != "text" or part.get_filename() or \
+           part.get("Content-Disposition", "").startswith("attachment"):
+            continue
+        content = part.get_payload(decode=True)
+        if content is None: continue
+        text = decode_content(content, part.get_content_charset())
+        if isinstance(text, str):
+            texts.append((part.get_content_subtype(), text))
+    return texts
+
+def find_part(part, section):
+    '''Returns the part (or subpart) described by BODYSTRUCTURE with section.'''
+    if part["section"] == section:
+        return part
+    for subpart in part.get("parts", ()):
+        found = find_part(subpart, section)
+        if found is not None:
+            return found
+    return None
+
+def get_display_sections(part):
+    '''
+    Returns sections of text parts which are shown by
+    process_bodystructure_for_display (the only ones to download).
+    '''
+    if part["maintype"] == "multipart":
+        if part["subtype"] == "alternative":
+            pref_part = part["parts"][0]
+            for subpart in part["parts"][1:]:
+                if get_part_pref(subpart) > get_part_pref(pref_part):
+                    pref_part = subpart
+            return get_display_sections(pref_part)
+        elif part["subtype"] == "mixed":
+            return [section for subpart in part["parts"]
+                            for section in get_display_sections(subpart)]
+        return []
+    if part["maintype"] == "text" and not is_attachment(part):
+        return [part["section"]]
+    return []
+
+def get_part_header(part):
+    '''Recreates MIME header of the part from BODYSTRUCTURE.'''
+    content_type = "%s/%s" % (part["maintype"], part["subtype"])
+    for name, value in part["params"].items():
+        content_type += '; %s="%s"' % (name, value)
+    header = {"Content-Type": content_type}
+    if "encoding" in part:
+        header["Content-Transfer-Encoding"] = part["encoding"]
+    if part["disposition"]:
+        disposition = part["disposition"]
+        for name, value in part["disposition_params"].items():
+            disposition += '; %s="%s"' % (name, value)
+        header["Content-Disposition"] = disposition
+    return header
+
+def decode_part(part, content):
+    '''Decodes transfer encoding and charset of the downloaded part.'''
+    if part["encoding"] == "base64":
+        try:
+            content = binascii.a2b_base64(content)
+        except binascii.Error:
+            pass
+    elif part["encoding"] == "quoted-printable":
+        content = quopri.decodestring(content)
+    return decode_content(content, part["params"].get("charset", None))
+
+def process_bodystructure_for_display(part, contents, header=None):
+    '''
+    Works like process_email_for_display, but takes the part described
+    by BODYSTRUCTURE and contents of downloaded sections. Attachments
+    are described by metadata (filename, content type, size, section).
+    '''
+    output = dict(header=header if header is not None
+                                else get_part_header(part))
+
+    if part["maintype"] == "multipart":
+        output["type"] = "node"
+
+        if part["subtype"] == "alternative":
+            pref_part = part["parts"][0]
+            for subpart in part["parts"][1:]:
+                if get_part_pref(subpart) > get_part_pref(pref_part):
+                    pref_part = subpart
+            output["content"] = [process_bodystructure_for_display(
+                                     pref_part, contents)]
+        elif part["subtype"] == "mixed":
+            output["content"] = [
+                process_bodystructure_for_display(subpart, contents)
+                    for subpart in part["parts"]
+            ]
+        else:
+            output["type"] = "unsupported"
+            output["content"] = None
+    elif is_attachment(part):
+        output["type"] = "attachment"
+        output["content"] = None
+        output["attachment"] = dict(
+            filename=part["disposition_params"].get(
+                "filename", part["params"].get("name", None)
+            ),
+            content_type="%s/%s" % (part["maintype"], part["subtype"]),
+            encoding=part["encoding"],
+            size=part["size"],
+            section=part["section"]
+        )
+    elif part["maintype"] == "text":
+        output["type"] = "plain"
+        content = contents.get(part["section"], None)
+        output["content"] = decode_part(part, content) \
+                                if content is not None else None
+    else:
+        output["type"] = "unsupported"
+        output["content"] = None
+
+    return output
@@ -0,0 +1,82 @@
+import io
+import zlib
+
+
+class DeflateSocket:
+    '''
+    Socket of IMAP connection after COMPRESS=DEFLATE (RFC 4978): data is
+    sent and received as raw deflate streams, each write is flushed so
+    commands are not held in the compressor. Other socket methods (e.g.
+    settimeout, shutdown) are delegated to the wrapped socket. Counts
+    bytes before compression (sent, received) and on the wire (raw_sent,
+    raw_received).
+    '''
+    def __init__(self, sock, level=zlib.Z_DEFAULT_COMPRESSION):
+        self.sock = sock
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        self._decompressor = zlib.decompressobj(-15)
+        self.sent = 0
+        self.raw_sent = 0
+        self.received = 0
+        self.raw_received = 0
+
+    def __getattr__(self, attr):
+        return getattr(self.sock, attr)
+
+    def sendall(self, data):
+        raw = self._compressor.compress(data) + \
+              self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.sock.sendall(raw)
+        self.sent += len(data)
+        self.raw_sent += len(raw)
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def recv(self, bufsize):
+        '''Returns up to bufsize decompressed bytes (b"" after EOF).'''
+        while True:
+            if self._decompressor.unconsumed_tail:
+                data = self._decompressor.decompress(
+                    self._decompressor.unconsumed_tail, bufsize
+                )
+            else:
+                raw = self.sock.recv(bufsize)
+                if not raw:
+                    return b""
+                self.raw_received += len(raw)
+                data = self._decompressor.decompress(raw, bufsize)
+            if data:
+                self.received += len(data)
+                return data
+
+    def makefile(self, mode="rb", buffering=-1):
+        '''Returns buffered binary reader of decompressed data.'''
+        if mode != "rb":
+            raise ValueError("only 'rb' mode is supported")
+        if buffering == -1:
+            buffering = io.DEFAULT_BUFFER_SIZE
+        return io.BufferedReader(SocketReader(self), buffering)
+
+    def stats(self):
+        '''Returns counters of transferred bytes as dictionary.'''
+        return dict(sent=self.sent, raw_sent=self.raw_sent,
+                    received=self.received, raw_received=self.raw_received)
+
+
+class SocketReader(io.RawIOBase):
+    '''
+    Raw stream reading from socket wrapper (e.g. DeflateSocket), used by
+    makefile.
+    '''
+    def __init__(self, sock):
+        self.sock = sock
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.sock.recv(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
@@ -0,0 +1,167 @@
+import threading
+import collections
+import queue
+import time
+import concurrent.futures
+
+from .client import ImapClientError
+
+
+# Account identified like in ImapPool (password is needed to connect).
+Account = collections.namedtuple("Account", ["addr", "username", "password"])
+
+# Single fetch: func(imap_client) returns (status, data) saved under key.
+FetchJob = collections.namedtuple("FetchJob", ["account", "key", "func"])
+
+
+class FetchOrchestrator:
+    '''
+    Fans out fetches of several mailboxes (of one or more accounts) over
+    connections of ImapPool served by bounded thread pool, so checking
+    several mailboxes takes about as long as the slowest of them. Jobs of
+    an account are taken from its queue by at most max_per_account
+    connections (limit of the pool), each working through the jobs
+    serially. Each upstream server (imap address) gets at most
+    max_per_host connections of the orchestrator at once.
+
+    pool - ImapPool providing authenticated connections
+    max_workers - number of threads shared by all runs
+    max_per_host - max number of connections per imap address
+    '''
+    def __init__(self, pool, *, max_workers=8, max_per_host=6):
+        self.pool = pool
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self._hosts = dict()
+        self._lock = threading.Lock()
+
+    def run(self, jobs, *, clients=None, timeout=None):
+        '''
+        Runs jobs and returns dictionary {key: (status, data)}. Failed
+        jobs (and jobs not finished within timeout seconds) get ("ERROR",
+        message). Clients given as dictionary {account: client} (e.g.
+        connection of the request) are used in the calling thread in
+        addition to pooled ones, they are not released.
+
+        Jobs not started before the timeout are dropped. Jobs which are
+        running at that moment are not interrupted, their results are
+        dropped, but the socket timeout of their connection is limited to
+        the time left, so they can not hold the connection (and the slot
+        of the host) after the server stops answering. Connections of jobs
+        failed after the deadline are marked as broken (discarded by the
+        pool).
+        '''
+        clients = clients or dict()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        results = dict()
+        queues = collections.OrderedDict()
+        for job in jobs:
+            queues.setdefault(job.account, queue.Queue()).put(job)
+
+        futures = list()
+        lent = list()
+        for account, jobs_queue in queues.items():
+            workers = min(jobs_queue.qsize(), self.pool.max_per_account)
+            if account in clients:
+                lent.append((account, jobs_queue))
+                workers -= 1
+            for _ in range(workers):
+                futures.append(self._executor.submit(
+                    self._work, account, jobs_queue, results,
+                    deadline=deadline
+                ))
+        for account, jobs_queue in lent:
+            self._work(account, jobs_queue, results, clients[account],
+                       deadline=deadline)
+
+        remaining = None
+        if deadline is not None:
+            remaining = max(deadline - time.monotonic(), 0)
+        concurrent.futures.wait(futures, timeout=remaining)
+
+        # Jobs left in queues will not be started any more.
+        for jobs_queue in queues.values():
+            while True:
+                try:
+                    jobs_queue.get_nowait()
+                except queue.Empty:
+                    break
+
+        output = dict(results)
+        for job in jobs:
+            if job.key not in output:
+                output[job.key] = ("ERROR", "The mailbox could not be " +
+                                            "fetched, try again later.")
+        return output
+
+    def _host_slots(self, addr):
+        with self._lock:
+            if addr not in self._hosts:
+                self._hosts[addr] = threading.BoundedSemaphore(
+                    self.max_per_host
+                )
+            return self._hosts[addr]
+
+    def _work(self, account, jobs_queue, results, client=None, *,
+              deadline=None):
+        '''Runs jobs of the account from the queue on single connection.'''
+        if client is not None:
+            self._run_jobs(client, jobs_queue, results, deadline)
+            return
+
+        with self._host_slots(account.addr):
+            if jobs_queue.empty():
+                return
+            try:
+                client = self.pool.acquire(*account)
+            except Exception:
+                return  # other connections will take the jobs
+            discard = True
+            try:
+                discard = not self._run_jobs(client, jobs_queue, results,
+                                             deadline)
+            finally:
+                self.pool.release(client, discard=discard)
+
+    def _run_jobs(self, client, jobs_queue, results, deadline):
+        '''
+        Runs jobs until the queue is empty, returns False when the
+        connection has failed (it should be discarded).
+        '''
+        while deadline is None or time.monotonic() < deadline:
+            try:
+                job = jobs_queue.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                results[job.key] = self._run_job(client, job, deadline)
+            except ImapClientError as e:
+                results[job.key] = ("ERROR", str(e))
+                if deadline is not None and time.monotonic() >= deadline:
+                    # Probably timed out in the middle of a command.
+                    client.broken = True
+                    return False
+            except Exception as e:
+                results[job.key] = ("ERROR", str(e))
+                return False
+        return True
+
+    @staticmethod
+    def _run_job(client, job, deadline):
+        '''
+        Runs the job with socket timeout of the client limited to the time
+        left until the deadline.
+        '''
+        if deadline is None:
+            return job.func(client)
+        sock = client.socket()
+        previous = sock.gettimeout()
+        timeout = max(deadline - time.monotonic(), 0.001)
+        if previous is not None:
+            timeout = min(timeout, previous)
+        sock.settimeout(timeout)
+        try:
+            return job.func(client)
+        finally:
+            sock.settimeout(previous)
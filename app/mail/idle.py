@@ -0,0 +1,345 @@
+import threading
+import socket
+import select
+import queue
+import time
+import re
+import math
+
+from .client import parse_sequence_set
+
+
+UNTAGGED_NUMBER_PATTERN = re.compile(
+    rb"^\* (?P<number>\d+) (?P<type>EXISTS|EXPUNGE|RECENT|FETCH)(?P<data>.*)$"
+)
+VANISHED_PATTERN = re.compile(rb"^\* VANISHED (?:\(EARLIER\) )?(?P<uids>\S+)")
+UID_PATTERN = re.compile(rb"UID (?P<uid>\d+)")
+FLAGS_PATTERN = re.compile(rb"FLAGS \((?P<flags>[^)]*)\)")
+
+
+def parse_idle_response(line):
+    '''
+    Converts untagged response received during IDLE into event (dictionary
+    with "type" key) or returns None when the response is not interesting.
+    '''
+    line = line.rstrip(b"\r\n")
+    match = UNTAGGED_NUMBER_PATTERN.match(line)
+    if match:
+        number = int(match.group("number"))
+        msg_type = match.group("type").decode("ascii").lower()
+        if msg_type == "exists":
+            return dict(type="exists", count=number)
+        if msg_type == "expunge":
+            return dict(type="expunge", id=number)
+        if msg_type == "fetch":
+            event = dict(type="fetch", id=number)
+            match_uid = UID_PATTERN.search(match.group("data"))
+            if match_uid:
+                event["uid"] = int(match_uid.group("uid"))
+            match_flags = FLAGS_PATTERN.search(match.group("data"))
+            if match_flags:
+                event["Flags"] = match_flags.group("flags").decode(
+                                     "ascii").split()
+            return event
+        return None
+
+    match = VANISHED_PATTERN.match(line)
+    if match:
+        return dict(type="vanished",
+                    uids=parse_sequence_set(match.group("uids").decode("ascii")))
+    return None
+
+
+class IdleWatcher(threading.Thread):
+    '''
+    Background thread which keeps dedicated connection in IDLE state
+    (RFC 2177) and publishes changes in the mailbox to subscribers (queues).
+    IDLE is renewed every renew_interval seconds (servers drop idling
+    clients after 30 minutes). The watcher stops when it has had no
+    subscribers for linger seconds. While idling, the thread sleeps in
+    select until the server sends something, IDLE has to be renewed or
+    the watcher is woken up (by stop or the last unsubscribe). on_change(watcher, event) is called
+    for every change, e.g. to invalidate caches. When the watcher fails,
+    error (the event published last) is set before on_stop is called.
+    '''
+    def __init__(self, connect, addr, username, password, mailbox, *,
+                 renew_interval=25*60, linger=30,
+                 response_timeout=30, on_stop=None, on_change=None):
+        super().__init__(daemon=True)
+        self.connect = connect
+        self.addr = addr
+        self.username = username
+        self.password = password
+        self.mailbox = mailbox
+        self.renew_interval = renew_interval
+        self.linger = linger
+        self.response_timeout = response_timeout
+        self.on_stop = on_stop
+        self.on_change = on_change
+
+        self.subscribers = list()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.unsubscribed_at = None
+        self.error = None
+        self.tagnum = 0
+        self.buffer = bytearray()
+        self._wakeup = None  # socket pair created by run
+
+    @property
+    def account(self):
+        '''Identifies the account like ImapClient.account.'''
+        return "%s@%s" % (self.username, self.addr)
+
+    def subscribe(self):
+        subscriber = queue.Queue()
+        with self.lock:
+            self.subscribers.append(subscriber)
+            self.unsubscribed_at = None
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+            if not self.subscribers:
+                self.unsubscribed_at = time.monotonic()
+                self.wake_up()
+
+    def publish(self, event):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+    def stop(self):
+        self.stopped.set()
+        self.wake_up()
+
+    def wake_up(self):
+        '''Interrupts waiting for the server (e.g. to check is_needed).'''
+        wakeup = self._wakeup
+        if wakeup is not None:
+            try:
+                wakeup[1].send(b"\0")
+            except OSError:
+                pass
+
+    def is_needed(self):
+        with self.lock:
+            if self.subscribers or self.unsubscribed_at is None:
+                return True
+            return time.monotonic() - self.unsubscribed_at < self.linger
+
+    def run(self):
+        imap_client = None
+        self._wakeup = socket.socketpair()
+        self._wakeup[1].setblocking(False)
+        try:
+            imap_client = self.connect(self.addr, self.username,
+                                       self.password)
+            if not imap_client.has_capability("IDLE"):
+                self.error = dict(type="error", unsupported=True,
+                                  msg="IDLE is not supported by the server.")
+                return
+            imap_client.select(self.mailbox, readonly=True)
+            sock = imap_client.socket()
+            while not self.stopped.is_set() and self.is_needed():
+                self.idle(sock)
+        except Exception as e:
+            self.error = dict(type="error", unsupported=False, msg=str(e))
+        finally:
+            self.stopped.set()
+            if self.on_stop:
+                self.on_stop(self)
+            if self.error is not None:
+                self.publish(self.error)
+            for wakeup in self._wakeup:
+                wakeup.close()
+            if imap_client is not None:
+                try:
+                    imap_client.logout()
+                except Exception:
+                    pass
+
+    def idle(self, sock):
+        '''Runs single IDLE command, returns after DONE has been accepted.'''
+        self.tagnum += 1
+        tag = b"IDLE" + str(self.tagnum).encode("ascii")
+        sock.sendall(tag + b" IDLE\r\n")
+
+        line = self.read_line(sock, self.response_timeout)
+        if not line.startswith(b"+"):
+            raise ConnectionError("IDLE rejected: %r" % line)
+
+        started = time.monotonic()
+        while not self.stopped.is_set():
+            line = self.next_line()
+            if line is not None:
+                self.handle(line)
+                continue
+            timeout = self.idle_timeout(started)
+            if timeout <= 0:
+                break
+            if self.wait(sock, timeout):
+                self.receive(sock, self.response_timeout)
+
+        sock.sendall(b"DONE\r\n")
+        while True:
+            line = self.read_line(sock, self.response_timeout)
+            if line.startswith(tag + b" "):
+                if not line.startswith(tag + b" OK"):
+                    raise ConnectionError("IDLE failed: %r" % line)
+                return
+            self.handle(line)
+
+    def handle(self, line):
+        if line.startswith(b"* BYE"):
+            raise ConnectionError("connection closed by server: %r" % line)
+        event = parse_idle_response(line)
+        if event:
+            if self.on_change:
+                self.on_change(self, event)
+            self.publish(event)
+
+    def idle_timeout(self, started):
+        '''
+        Returns seconds until IDLE has to be renewed or (without
+        subscribers) the watcher is no longer needed.
+        '''
+        now = time.monotonic()
+        timeout = started + self.renew_interval - now
+        with self.lock:
+            if not self.subscribers and self.unsubscribed_at is not None:
+                timeout = min(timeout,
+                              self.unsubscribed_at + self.linger - now)
+        return timeout
+
+    def wait(self, sock, timeout):
+        '''
+        Waits up to timeout seconds for data from the server, returns False
+        when there is none (timeout or woken up).
+        '''
+        pending = getattr(sock, "pending", None)
+        if pending is not None and pending():
+            return True  # decrypted data buffered by SSL socket
+        readable, _, _ = select.select([sock, self._wakeup[0]], [], [],
+                                       timeout)
+        if self._wakeup[0] in readable:
+            self._wakeup[0].recv(4096)
+        return sock in readable
+
+    def next_line(self):
+        '''Returns the next received line or None when not complete.'''
+        index = self.buffer.find(b"\r\n")
+        if index < 0:
+            return None
+        line = bytes(self.buffer[:index+2])
+        del self.buffer[:index+2]
+        return line
+
+    def receive(self, sock, timeout):
+        '''Receives data from the server (waits up to timeout seconds).'''
+        sock.settimeout(timeout)
+        try:
+            data = sock.recv(4096)
+        except socket.timeout:
+            raise ConnectionError("no response from the server") from None
+        if not data:
+            raise ConnectionError("connection closed by server")
+        self.buffer.extend(data)
+
+    def read_line(self, sock, timeout):
+        '''Returns next line, waits up to timeout seconds for it.'''
+        deadline = time.monotonic() + timeout
+        while True:
+            line = self.next_line()
+            if line is not None:
+                return line
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ConnectionError("no response from the server")
+            self.receive(sock, remaining)
+
+
+class IdleManager:
+    '''
+    Registry of IDLE watchers, one per account and mailbox. Watchers are
+    started with the first subscriber, so background connections scale
+    with active users rather than with polling frequency. After a watcher
+    fails, no new one is started for the mailbox for retry_interval
+    seconds, doubled after each consecutive failure up to
+    max_retry_interval (which is used right away when the server does not
+    support IDLE), so reconnecting clients do not log in again and again.
+    '''
+    def __init__(self, connect, *, retry_interval=5, max_retry_interval=300,
+                 **watcher_options):
+        self.connect = connect
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.watcher_options = watcher_options
+        self.watchers = dict()
+        self.failures = dict()  # key -> (retry_at, interval, error)
+        self.lock = threading.Lock()
+
+    def failure(self, addr, username, mailbox):
+        '''
+        Returns error event of the last failed watcher of the mailbox with
+        "retry" (seconds until a new watcher may be started) or None when
+        the mailbox can be watched.
+        '''
+        key = (addr, username, mailbox)
+        with self.lock:
+            if key not in self.failures:
+                return None
+            retry_at, _, error = self.failures[key]
+        remaining = retry_at - time.monotonic()
+        if remaining <= 0:
+            return None
+        return dict(error, retry=math.ceil(remaining))
+
+    def subscribe(self, addr, username, password, mailbox):
+        '''Returns (watcher, queue) pair, queue receives events.'''
+        key = (addr, username, mailbox)
+        with self.lock:
+            watcher = self.watchers.get(key, None)
+            if watcher is None or watcher.stopped.is_set():
+                watcher = IdleWatcher(self.connect, addr, username, password,
+                                      mailbox, on_stop=self._remove,
+                                      **self.watcher_options)
+                self.watchers[key] = watcher
+                subscriber = watcher.subscribe()
+                watcher.start()
+            else:
+                subscriber = watcher.subscribe()
+        return watcher, subscriber
+
+    def stop_account(self, addr, username):
+        with self.lock:
+            watchers = [watcher for key, watcher in self.watchers.items()
+                                if key[:2] == (addr, username)]
+            for key in [key for key in self.failures
+                            if key[:2] == (addr, username)]:
+                del self.failures[key]
+        for watcher in watchers:
+            watcher.stop()
+
+    def _remove(self, watcher):
+        '''Unregisters stopped watcher and records its failure.'''
+        key = (watcher.addr, watcher.username, watcher.mailbox)
+        with self.lock:
+            if self.watchers.get(key, None) is watcher:
+                del self.watchers[key]
+            if watcher.error is None:
+                self.failures.pop(key, None)
+                return
+            if watcher.error["unsupported"]:
+                interval = self.max_retry_interval
+            elif key in self.failures:
+                interval = min(self.failures[key][1] * 2,
+                               self.max_retry_interval)
+            else:
+                interval = self.retry_interval
+            self.failures[key] = (time.monotonic() + interval, interval,
+                                  watcher.error)
+            watcher.error["retry"] = interval
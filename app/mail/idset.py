@@ -0,0 +1,152 @@
+import array
+import bisect
+import collections.abc
+
+
+class IdSet(collections.abc.Sequence):
+    '''
+    Sorted set of e-mail ids (or uids) kept as runs of consecutive numbers,
+    like sequence set "1:3,7" of IMAP. Runs are stored in arrays (first
+    number, last number and count of ids up to the end of the run), so
+    memory depends on the number of runs, not ids. Supports len,
+    iteration, membership, indexing and slicing (which returns IdSet)
+    without expanding the runs. Compares equal to sequences of the same
+    numbers (e.g. lists).
+
+    ids - iterable of numbers in any order (duplicates are dropped)
+    '''
+    def __init__(self, ids=()):
+        self._firsts = array.array("L")
+        self._lasts = array.array("L")
+        self._ends = array.array("L")
+        if isinstance(ids, IdSet):
+            self._extend(ids.runs())
+        else:
+            self._extend((number, number) for number in sorted(set(ids)))
+
+    @classmethod
+    def from_runs(cls, runs):
+        '''Creates set from iterable of (first, last) pairs (any order).'''
+        result = cls()
+        result._extend(sorted((min(run), max(run)) for run in runs))
+        return result
+
+    @classmethod
+    def from_sequence_set(cls, seqset):
+        '''Creates set from sequence set (str or bytes, e.g. "1:3,7").'''
+        if isinstance(seqset, bytes):
+            seqset = seqset.decode("ascii")
+        runs = list()
+        for item in seqset.split(","):
+            if not item: continue
+            first, _, last = item.partition(":")
+            runs.append((int(first), int(last or first)))
+        return cls.from_runs(runs)
+
+    def _extend(self, runs):
+        '''Appends sorted runs, merging overlapping and adjacent ones.'''
+        for first, last in runs:
+            if self._lasts and first <= self._lasts[-1] + 1:
+                if last > self._lasts[-1]:
+                    self._ends[-1] += last - self._lasts[-1]
+                    self._lasts[-1] = last
+                continue
+            self._firsts.append(first)
+            self._lasts.append(last)
+            self._ends.append(len(self) + last - first + 1)
+
+    def runs(self):
+        '''Returns iterator of (first, last) pairs of runs.'''
+        return zip(self._firsts, self._lasts)
+
+    def to_sequence_set(self):
+        '''Returns sequence set (str) of the numbers, e.g. "1:3,7".'''
+        return ",".join(str(first) if first == last else
+                        "%d:%d" % (first, last)
+                        for first, last in self.runs())
+
+    @property
+    def min(self):
+        '''The smallest number or None when empty.'''
+        return self._firsts[0] if self._firsts else None
+
+    @property
+    def max(self):
+        '''The largest number or None when empty.'''
+        return self._lasts[-1] if self._lasts else None
+
+    def __len__(self):
+        return self._ends[-1] if self._ends else 0
+
+    def __iter__(self):
+        for first, last in self.runs():
+            yield from range(first, last + 1)
+
+    def __reversed__(self):
+        for first, last in zip(reversed(self._firsts),
+                               reversed(self._lasts)):
+            yield from range(last, first - 1, -1)
+
+    def __contains__(self, number):
+        if not isinstance(number, int):
+            return False
+        run = bisect.bisect_right(self._firsts, number) - 1
+        return run >= 0 and number <= self._lasts[run]
+
+    def index(self, number):
+        '''Returns position of the number (ValueError when missing).'''
+        if number not in self:
+            raise ValueError("%r is not in IdSet" % (number,))
+        run = bisect.bisect_right(self._firsts, number) - 1
+        return self._ends[run] - (self._lasts[run] - number) - 1
+
+    def count(self, number):
+        return 1 if number in self else 0
+
+    def _locate(self, position):
+        '''Returns (run, number) at non-negative position.'''
+        run = bisect.bisect_right(self._ends, position)
+        start = self._ends[run - 1] if run else 0
+        return run, self._firsts[run] + position - start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return IdSet(self[position]
+                             for position in range(start, stop, step))
+            result = IdSet()
+            if start >= stop:
+                return result
+            first_run, first = self._locate(start)
+            last_run, last = self._locate(stop - 1)
+            runs = list(zip(self._firsts[first_run:last_run + 1],
+                            self._lasts[first_run:last_run + 1]))
+            runs[0] = (first, runs[0][1])
+            runs[-1] = (runs[-1][0], last)
+            result._extend(runs)
+            return result
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("IdSet index out of range")
+        return self._locate(index)[1]
+
+    def __eq__(self, other):
+        if isinstance(other, IdSet):
+            return self._firsts == other._firsts and \
+                   self._lasts == other._lasts
+        if isinstance(other, collections.abc.Sequence) and \
+           not isinstance(other, (str, bytes)):
+            return len(self) == len(other) and \
+                   all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __bool__(self):
+        return bool(self._firsts)
+
+    def __repr__(self):
+        return "IdSet(%r)" % self.to_sequence_set()
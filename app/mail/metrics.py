@@ -0,0 +1,163 @@
+import io
+import time
+import logging
+import threading
+import collections
+
+from flask import g, has_request_context
+
+from .compress import SocketReader
+
+
+logger = logging.getLogger(__name__)
+
+# Single imap command (or our own processing, e.g. "parse headers") of an
+# account: status is the completion of the command ("ERROR" when it has
+# raised), duration in seconds, sent and received are bytes on the wire
+# and size is the length of the response before decompression.
+CommandEvent = collections.namedtuple("CommandEvent", [
+    "account", "command", "status", "duration", "sent", "received", "size"
+])
+
+
+class MeteredSocket:
+    '''
+    Socket of imap connection counting bytes sent and received. Other
+    socket methods are delegated to the wrapped socket (like DeflateSocket,
+    which is put on top of it when the connection gets compressed).
+    '''
+    def __init__(self, sock):
+        self.sock = sock
+        self.sent = 0
+        self.received = 0
+
+    def __getattr__(self, attr):
+        return getattr(self.sock, attr)
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+        self.sent += len(data)
+
+    def send(self, data):
+        sent = self.sock.send(data)
+        self.sent += sent
+        return sent
+
+    def recv(self, bufsize):
+        data = self.sock.recv(bufsize)
+        self.received += len(data)
+        return data
+
+    def makefile(self, mode="rb", buffering=-1):
+        '''Returns buffered binary reader of the socket.'''
+        if mode != "rb":
+            raise ValueError("only 'rb' mode is supported")
+        if buffering == -1:
+            buffering = io.DEFAULT_BUFFER_SIZE
+        return io.BufferedReader(SocketReader(self), buffering)
+
+
+class Instrumentation:
+    '''
+    Passes events of imap commands (CommandEvent) recorded by ImapClient
+    to sinks, objects with method record(event) (e.g. LogSink,
+    StatsRegistry, RequestTrace). Failing sinks do not break commands.
+    '''
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+
+    def record(self, event):
+        for sink in self.sinks:
+            try:
+                sink.record(event)
+            except Exception:
+                logger.exception("imap instrumentation sink failed")
+
+
+class LogSink:
+    '''Writes a log line for each command.'''
+    def __init__(self, logger=logger, level=logging.INFO):
+        self.logger = logger
+        self.level = level
+
+    def record(self, event):
+        self.logger.log(
+            self.level, "%s %s %s %.1f ms sent=%d received=%d size=%d",
+            event.account, event.command, event.status,
+            event.duration * 1000, event.sent, event.received, event.size
+        )
+
+
+class StatsRegistry:
+    '''
+    In-process statistics of commands (of all accounts) by name: number of
+    calls and errors (status other than OK), total and max duration,
+    bytes sent and received and total size of responses.
+    '''
+    FIELDS = ("count", "errors", "time", "max_time", "sent", "received",
+              "size")
+
+    def __init__(self):
+        self._stats = dict()
+        self._lock = threading.Lock()
+
+    def record(self, event):
+        with self._lock:
+            stats = self._stats.get(event.command, None)
+            if stats is None:
+                stats = self._stats[event.command] = dict.fromkeys(
+                    self.FIELDS, 0
+                )
+            stats["count"] += 1
+            if event.status != "OK":
+                stats["errors"] += 1
+            stats["time"] += event.duration
+            stats["max_time"] = max(stats["max_time"], event.duration)
+            stats["sent"] += event.sent
+            stats["received"] += event.received
+            stats["size"] += event.size
+
+    def snapshot(self):
+        '''Returns copy of statistics {command: {field: value}}.'''
+        with self._lock:
+            return {command: dict(stats)
+                    for command, stats in self._stats.items()}
+
+    def reset(self):
+        with self._lock:
+            self._stats = dict()
+
+
+class RequestTrace:
+    '''
+    Collects events of commands run in the thread of the current request
+    (flask.g), which are sent back in Server-Timing header when enabled
+    (see server_timing). Commands run by other threads (e.g. fetches of
+    FetchOrchestrator) are not included.
+    '''
+    def record(self, event):
+        if has_request_context():
+            g.setdefault("imap_events", list()).append(event)
+
+    @staticmethod
+    def events():
+        '''Returns events recorded during the current request.'''
+        return g.get("imap_events", list())
+
+
+def server_timing(events):
+    '''
+    Formats events as value of Server-Timing header: entry per command
+    with its duration (ms) and description and the total of all of them.
+    '''
+    entries = list()
+    for number, event in enumerate(events):
+        description = "%s %s %dB" % (event.command, event.status,
+                                     event.received)
+        entries.append('imap%d;desc="%s";dur=%.1f' % (
+            number, description.replace('"', "'"), event.duration * 1000
+        ))
+    entries.append("imap;dur=%.1f" % (
+        sum(event.duration for event in events) * 1000
+    ))
+    return ", ".join(entries)
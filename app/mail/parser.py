@@ -0,0 +1,293 @@
+import re
+import urllib.parse
+import email.header
+import email.errors
+
+
+# Single token of IMAP response: parenthesis, quoted string, literal marker
+# at the end of the line or atom (with optional section, e.g.
+# BODY[HEADER.FIELDS (SUBJECT)]<0>).
+TOKEN_PATTERN = re.compile(rb'''
+    [ ]*(?:
+        (?P<open>\()
+      | (?P<close>\))
+      | "(?P<quoted>(?:[^"\\]|\\.)*)"
+      | \{(?P<literal>\d+)\+?\}$
+      | (?P<atom>[^ ()"\[{]+(?:\[[^\]]*\](?:<[\d.]+>)?)?)
+    )
+''', re.VERBOSE)
+QUOTED_ESCAPE_PATTERN = re.compile(rb'\\(.)')
+
+# Data items whose values are converted to numbers.
+NUMBER_ITEMS = frozenset(("UID", "RFC822.SIZE"))
+
+# Tokens of parentheses.
+OPEN = object()
+CLOSE = object()
+
+
+class FetchParseError(ValueError):
+    '''Raised when FETCH response is malformed.'''
+    pass
+
+
+def iter_tokens(data):
+    '''
+    Splits FETCH response as returned by imaplib (list of bytes and tuples
+    (line, literal)) into tokens in one pass. Atoms are returned as bytes,
+    quoted strings as Quoted, literals as Literal, parentheses as OPEN and
+    CLOSE.
+    '''
+    for item in data:
+        if isinstance(item, tuple):
+            line, literal = item
+        elif isinstance(item, bytes):
+            line, literal = item, None
+        else:
+            continue
+
+        pos, end = 0, len(line)
+        while pos < end:
+            match = TOKEN_PATTERN.match(line, pos)
+            if match is None or match.end() == pos:
+                if line[pos:].strip():
+                    raise FetchParseError("Unexpected data: %r" % line[pos:])
+                break
+            pos = match.end()
+            kind = match.lastgroup
+            if kind == "atom":
+                yield match.group("atom")
+            elif kind == "open":
+                yield OPEN
+            elif kind == "close":
+                yield CLOSE
+            elif kind == "quoted":
+                yield Quoted(QUOTED_ESCAPE_PATTERN.sub(rb"\1",
+                                                       match.group("quoted")))
+            elif kind == "literal":
+                yield Literal(literal if literal is not None else b"")
+
+
+class Literal(bytes):
+    '''Value of literal ({n}) in the response.'''
+    pass
+
+
+class Quoted(bytes):
+    '''Value of quoted string in the response.'''
+    pass
+
+
+def parse_fetch(data):
+    '''
+    Parses FETCH response in one pass. Returns the list of pairs
+    (seq, items) where items is dictionary {name: value} with upper-cased
+    names of data items. UID and RFC822.SIZE are converted to int, FLAGS
+    to list of str, MODSEQ to int, INTERNALDATE to str, section literals
+    (e.g. BODY[HEADER]) are left as bytes.
+    '''
+    messages = list()
+    stack = list()
+    current = None
+    seq = None
+    for token in iter_tokens(data):
+        if token is OPEN:
+            stack.append(current)
+            current = list()
+        elif token is CLOSE:
+            if not stack:
+                continue  # trailing parenthesis left by imaplib
+            value, current = current, stack.pop()
+            if current is None:
+                messages.append((seq, fetch_items(value)))
+                seq = None
+            else:
+                current.append(value)
+        elif current is None:
+            if seq is None and type(token) is bytes and token.isdigit():
+                seq = int(token)
+            elif token.upper() != b"FETCH":
+                raise FetchParseError("Unexpected token: %r" % token)
+        else:
+            if token == b"NIL" and type(token) is bytes:
+                token = None
+            current.append(token)
+    if stack:
+        raise FetchParseError("Unterminated FETCH response.")
+    return messages
+
+
+def fetch_items(values):
+    '''Converts list of names and values into dictionary of data items.'''
+    items = dict()
+    for index in range(0, len(values) - 1, 2):
+        name = values[index].decode("ascii").upper()
+        value = values[index+1]
+        if name in NUMBER_ITEMS:
+            value = int(value)
+        elif name == "FLAGS":
+            value = [flag.decode("ascii") for flag in value]
+        elif name == "MODSEQ":
+            value = int(value[0])
+        elif name == "INTERNALDATE":
+            value = value.decode("ascii")
+        items[name] = value
+    return items
+
+
+def get_section(items, prefix="BODY["):
+    '''Returns the value of the first section (e.g. BODY[HEADER]).'''
+    for name, value in items.items():
+        if name.startswith(prefix) or name.startswith("RFC822"):
+            if isinstance(value, bytes):
+                return value
+    return None
+
+
+def decode_bytes(value):
+    '''Decodes raw value of header field (UTF-8 with fallback to latin-1).'''
+    try:
+        return value.decode("utf-8")
+    except UnicodeDecodeError:
+        return value.decode("latin-1")
+
+
+def parse_header(raw, fields=None):
+    '''
+    Splits raw header into dictionary {name: value} with unfolded values.
+    When fields (set of upper-cased names) are given, other fields are
+    skipped without decoding. The first occurrence of the field wins.
+    '''
+    header = dict()
+    names = set()
+    name = None
+    parts = None
+    for line in raw.splitlines():
+        if not line:
+            break
+        if line[:1] in (b" ", b"\t"):
+            if parts is not None:
+                parts.append(line)
+            continue
+        if parts is not None:
+            header[name] = decode_bytes(b"".join(parts).strip())
+        name, parts = None, None
+        key, sep, value = line.partition(b":")
+        if not sep:
+            continue
+        key = key.strip().decode("ascii", "replace")
+        upper = key.upper()
+        if upper in names or (fields is not None and upper not in fields):
+            continue
+        names.add(upper)
+        name, parts = key, [value]
+    if parts is not None:
+        header[name] = decode_bytes(b"".join(parts).strip())
+    return header
+
+
+def decode_fields(header, header_decoders):
+    '''
+    Applies decoders to the fields with encoded words (RFC 2047), values
+    of the other fields are already decoded.
+    '''
+    for key, value in header.items():
+        if "=?" in value:
+            decoder = header_decoders.get(key.upper(), None)
+            if decoder:
+                header[key] = decoder(header)
+    return header
+
+
+def decode_param(name, value):
+    '''Decodes value of MIME parameter (RFC 2231 or RFC 2047 encoded).'''
+    if name.endswith("*") and value.count("'") >= 2:
+        charset, _, text = value.split("'", 2)
+        try:
+            return urllib.parse.unquote(text, encoding=charset or "ascii",
+                                        errors="replace")
+        except LookupError:
+            return value
+    if "=?" in value:
+        try:
+            return str(email.header.make_header(
+                email.header.decode_header(value)
+            ))
+        except (email.errors.HeaderParseError, LookupError, 
+                UnicodeError):
+            return value
+    return value
+
+
+def structure_params(values):
+    '''Converts list of parameters (name value ...) into dictionary.'''
+    params = dict()
+    if not isinstance(values, list):
+        return params
+    for name, value in zip(values[::2], values[1::2]):
+        if value is None: continue
+        name = decode_bytes(name).lower()
+        value = decode_param(name, decode_bytes(value))
+        params[name.rstrip("*")] = value
+    return params
+
+
+def structure_string(value):
+    if isinstance(value, bytes):
+        return decode_bytes(value)
+    return None
+
+
+def parse_bodystructure(value, section=""):
+    '''
+    Converts BODYSTRUCTURE (nested lists returned by parse_fetch) into
+    the tree of dictionaries with keys: maintype, subtype, params,
+    disposition, disposition_params, section and parts (multipart) or
+    encoding and size (other parts). Sections are numbered in accordance
+    with RFC 3501 (e.g. "1.2"), non-multipart message has part "1" and
+    multipart message has empty section.
+    '''
+    if not isinstance(value, list) or not value:
+        raise FetchParseError("Invalid BODYSTRUCTURE: %r" % value)
+
+    if isinstance(value[0], list):
+        parts = list()
+        while value and isinstance(value[0], list):
+            number = str(len(parts) + 1)
+            parts.append(parse_bodystructure(
+                value[0], section + "." + number if section else number
+            ))
+            value = value[1:]
+        values = value + [None] * 4
+        part = dict(maintype="multipart", 
+                    subtype=(structure_string(values[0]) or "mixed").lower(),
+                    params=structure_params(values[1]), parts=parts,
+                    section=section)
+        disposition = values[2]
+    else:
+        values = value + [None] * 12
+        part = dict(maintype=(structure_string(values[0]) or "text").lower(),
+                    subtype=(structure_string(values[1]) or "plain").lower(),
+                    params=structure_params(values[2]),
+                    encoding=(structure_string(values[5]) or "7bit").lower(),
+                    section=section or "1")
+        try:
+            part["size"] = int(values[6])
+        except (TypeError, ValueError):
+            part["size"] = None
+        # Extension data follows fields specific for text and message parts.
+        if part["maintype"] == "text":
+            extension = values[8:]
+        elif (part["maintype"], part["subtype"]) == ("message", "rfc822"):
+            extension = values[10:]
+        else:
+            extension = values[7:]
+        disposition = extension[1]
+
+    part["disposition"] = None
+    part["disposition_params"] = dict()
+    if isinstance(disposition, list) and disposition:
+        part["disposition"] = (structure_string(disposition[0]) or "").lower()
+        if len(disposition) > 1:
+            part["disposition_params"] = structure_params(disposition[1])
+    return part
@@ -0,0 +1,203 @@
+import threading
+import time
+import hashlib
+import collections
+
+from .client import ImapClientError
+
+
+PooledConnection = collections.namedtuple(
+    "PooledConnection", ["client", "digest", "generation", "last_used"]
+)
+
+
+def credentials_digest(password):
+    '''Returns digest of the password used to match pooled connections.'''
+    return hashlib.sha256(password.encode("utf-8")).hexdigest()
+
+
+class ImapPool:
+    '''
+    Process-level pool of authenticated ImapClient objects grouped by account
+    (imap address, username). Connections are handed out exclusively and put
+    back after the request, so consecutive requests of the same user reuse
+    a live (and already selected) connection instead of repeating TCP/TLS
+    handshake and LOGIN.
+
+    connect - callable(addr, username, password) returning logged in client
+    max_per_account - max number of connections (idle + in use) per account
+    idle_timeout - seconds after which unused connection is closed
+    check_interval - connections idle longer than that are verified with
+                     NOOP before being handed out
+    acquire_timeout - seconds to wait for a connection when account limit
+                      has been reached
+    '''
+    def __init__(self, connect, *, max_per_account=3, idle_timeout=300,
+                 check_interval=30, acquire_timeout=10):
+        self.connect = connect
+        self.max_per_account = max_per_account
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.acquire_timeout = acquire_timeout
+
+        self._cond = threading.Condition()
+        self._idle = collections.defaultdict(list)
+        self._in_use = collections.Counter()
+        self._generation = collections.Counter()
+        self._checked_out = dict()
+
+    def acquire(self, addr, username, password):
+        '''
+        Returns authenticated client for the account. Reuses idle connection
+        when possible, otherwise opens a new one. Raises ImapClientError when
+        the account limit is reached and no connection has been released
+        within acquire_timeout.
+        '''
+        key = (addr, username)
+        digest = credentials_digest(password)
+        deadline = time.monotonic() + self.acquire_timeout
+
+        while True:
+            reserved, entry, to_close = self._reserve(key, digest, deadline)
+            self._close_all(to_close)
+
+            if not reserved:
+                raise ImapClientError("Too many connections for the " +
+                                      "account, try again later.")
+            if entry is None:
+                break
+            if time.monotonic() - entry.last_used < self.check_interval or \
+               self._is_alive(entry.client):
+                return self._checkout(key, digest, entry.client)
+
+            # Stale connection, try next idle one or reconnect transparently
+            self._close(entry.client)
+            with self._cond:
+                self._in_use[key] -= 1
+                self._cond.notify()
+
+        try:
+            client = self.connect(addr, username, password)
+        except Exception:
+            with self._cond:
+                self._in_use[key] -= 1
+                self._cond.notify()
+            raise
+        return self._checkout(key, digest, client)
+
+    def release(self, client, discard=False):
+        '''
+        Puts client back to the pool. Discarded clients (e.g. after socket
+        errors), broken ones and clients of retired accounts are logged out.
+        '''
+        with self._cond:
+            key, digest, generation = self._checked_out.pop(id(client))
+            self._in_use[key] -= 1
+            if generation != self._generation[key] or \
+               getattr(client, "broken", False) is True:
+                discard = True
+            if not discard:
+                self._idle[key].append(PooledConnection(
+                    client, digest, generation, time.monotonic()
+                ))
+            self._cond.notify()
+
+        if discard:
+            self._close(client)
+
+    def put(self, addr, username, password, client):
+        '''Adds already authenticated client (e.g. from login form).'''
+        key = (addr, username)
+        with self._cond:
+            if self._in_use[key] + len(self._idle[key]) < self.max_per_account:
+                self._idle[key].append(PooledConnection(
+                    client, credentials_digest(password),
+                    self._generation[key], time.monotonic()
+                ))
+                self._cond.notify()
+                return
+        self._close(client)
+
+    def discard_account(self, addr, username):
+        '''Closes idle connections of the account, busy ones on release.'''
+        key = (addr, username)
+        with self._cond:
+            self._generation[key] += 1
+            to_close = [entry.client for entry in self._idle.pop(key, [])]
+        self._close_all(to_close)
+
+    def clear(self):
+        '''Closes all idle connections.'''
+        with self._cond:
+            for key in self._idle:
+                self._generation[key] += 1
+            to_close = [entry.client for entries in self._idle.values()
+                                     for entry in entries]
+            self._idle.clear()
+        self._close_all(to_close)
+
+    def _reserve(self, key, digest, deadline):
+        '''
+        Reserves slot for the account. Returns whether the slot has been
+        reserved, the most recently used idle connection (or None when a new
+        one has to be opened) and the list of connections to close.
+        '''
+        to_close = list()
+        with self._cond:
+            while True:
+                to_close.extend(self._evict_idle())
+                idle = self._idle[key]
+                while idle:
+                    entry = idle.pop()
+                    if entry.digest != digest or \
+                       entry.generation != self._generation[key]:
+                        to_close.append(entry.client)
+                        continue
+                    self._in_use[key] += 1
+                    return True, entry, to_close
+
+                if self._in_use[key] < self.max_per_account:
+                    self._in_use[key] += 1
+                    return True, None, to_close
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False, None, to_close
+                self._cond.wait(remaining)
+
+    def _checkout(self, key, digest, client):
+        with self._cond:
+            self._checked_out[id(client)] = (key, digest,
+                                             self._generation[key])
+        return client
+
+    def _evict_idle(self):
+        '''Removes connections idle longer than idle_timeout.'''
+        now = time.monotonic()
+        evicted = list()
+        for key, entries in self._idle.items():
+            fresh = list()
+            for entry in entries:
+                if now - entry.last_used <= self.idle_timeout:
+                    fresh.append(entry)
+                else:
+                    evicted.append(entry.client)
+            self._idle[key] = fresh
+        return evicted
+
+    def _is_alive(self, client):
+        try:
+            status, _ = client.noop()
+        except Exception:
+            return False
+        return status == "OK"
+
+    def _close(self, client):
+        try:
+            client.logout()
+        except Exception:
+            pass
+
+    def _close_all(self, clients):
+        for client in clients:
+            self._close(client)
@@ -0,0 +1,104 @@
+import threading
+import collections
+import concurrent.futures
+
+from .client import ImapClientError
+
+
+# Prefetch scheduled by a request: tasks (func(imap_client)) for mailbox,
+# dropped when generation of the account has changed.
+PrefetchJob = collections.namedtuple("PrefetchJob",
+                                     ["mailbox", "generation", "tasks"])
+
+
+class Prefetcher:
+    '''
+    Warms caches (headers, displayed e-mails, search index) in the
+    background after requests. Jobs of an account are queued and run by
+    at most max_per_account threads of the shared pool (max_workers), each
+    on connection of ImapPool. Scheduling a job for another mailbox of the
+    account cancels pending jobs and stops the running ones (between
+    tasks), like cancel(). Only the newest max_pending jobs of an account
+    are kept. Failed tasks are ignored, they only warm caches.
+
+    pool - ImapPool providing authenticated connections
+    '''
+    def __init__(self, pool, *, max_workers=2, max_per_account=1,
+                 max_pending=2):
+        self.pool = pool
+        self.max_per_account = max_per_account
+        self.max_pending = max_pending
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self._accounts = dict()
+        self._lock = threading.Lock()
+
+    def schedule(self, account, mailbox, tasks):
+        '''
+        Queues tasks of the account (fanout.Account) working on the
+        mailbox.
+        '''
+        key = (account.addr, account.username)
+        with self._lock:
+            state = self._accounts.get(key, None)
+            if state is None:
+                state = self._accounts[key] = dict(
+                    mailbox=mailbox, generation=0, running=0,
+                    pending=collections.deque(maxlen=self.max_pending)
+                )
+            if state["mailbox"] != mailbox:
+                state["mailbox"] = mailbox
+                state["generation"] += 1
+                state["pending"].clear()
+            state["pending"].append(PrefetchJob(mailbox, state["generation"],
+                                                list(tasks)))
+            if state["running"] >= self.max_per_account:
+                return
+            state["running"] += 1
+        self._executor.submit(self._work, account, state)
+
+    def cancel(self, addr, username):
+        '''Drops pending jobs of the account and stops running ones.'''
+        with self._lock:
+            state = self._accounts.get((addr, username), None)
+            if state is not None:
+                state["generation"] += 1
+                state["pending"].clear()
+
+    def _next_job(self, state):
+        with self._lock:
+            if not state["pending"]:
+                state["running"] -= 1
+                return None
+            return state["pending"].popleft()
+
+    def _is_current(self, state, job):
+        with self._lock:
+            return state["generation"] == job.generation
+
+    def _work(self, account, state):
+        '''Runs queued jobs of the account on single connection.'''
+        client = None
+        discard = False
+        try:
+            while True:
+                job = self._next_job(state)
+                if job is None:
+                    break
+                for task in job.tasks:
+                    if not self._is_current(state, job):
+                        break
+                    if client is None:
+                        client = self.pool.acquire(*account)
+                    try:
+                        task(client)
+                    except ImapClientError:
+                        pass
+        except Exception:
+            discard = True
+            # Jobs left in the queue are dropped with the failed worker.
+            with self._lock:
+                state["pending"].clear()
+                state["running"] -= 1
+        finally:
+            if client is not None:
+                self.pool.release(client, discard=discard)
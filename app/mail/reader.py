@@ -0,0 +1,85 @@
+import re
+import socket
+import time
+
+
+# Line announcing literal, e.g. b'* 1 FETCH (BODY[] {342}\r\n'
+LITERAL_PATTERN = re.compile(rb"\{(?P<size>\d+)\+?\}\r\n$")
+
+
+class ResponseReader:
+    '''
+    Buffered reader of IMAP responses received directly from the socket.
+    Data is accumulated in bytearray, literals ({n}) are read as a whole
+    (they may contain CRLF) and reading stops as soon as the tagged
+    completion (or continuation request) arrives.
+    '''
+    def __init__(self, sock, bufsize=65536):
+        self.sock = sock
+        self.bufsize = bufsize
+        self.buffer = bytearray()
+
+    def read_response(self, tag=None, timeout=None):
+        '''
+        Reads responses until the tagged completion of the command (any
+        tagged response when tag is None) or continuation request ("+").
+        Returns the pair (untagged, completion) where untagged is the list
+        of untagged responses (bytes with literals included) and completion
+        is the last line, all without trailing CRLF. Timeout limits the
+        time of waiting for the whole response.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        prev_timeout = self.sock.gettimeout()
+        try:
+            untagged = list()
+            while True:
+                response = self.read_line(deadline)
+                if response.startswith(b"* "):
+                    untagged.append(response)
+                elif response.startswith(b"+") or tag is None or \
+                     response.startswith(tag + b" "):
+                    return untagged, response
+        finally:
+            self.sock.settimeout(prev_timeout)
+
+    def read_line(self, deadline=None):
+        '''Returns single response line (with literals) without CRLF.'''
+        parts = list()
+        while True:
+            line = self._read_until_crlf(deadline)
+            match = LITERAL_PATTERN.search(line)
+            if not match:
+                parts.append(line[:-2])
+                return b"".join(parts)
+            parts.append(line)
+            parts.append(self._read_exactly(int(match.group("size")),
+                                            deadline))
+
+    def _read_until_crlf(self, deadline):
+        start = 0
+        while True:
+            index = self.buffer.find(b"\r\n", start)
+            if index >= 0:
+                line = bytes(self.buffer[:index+2])
+                del self.buffer[:index+2]
+                return line
+            start = max(len(self.buffer) - 1, 0)
+            self._fill(deadline)
+
+    def _read_exactly(self, size, deadline):
+        while len(self.buffer) < size:
+            self._fill(deadline)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def _fill(self, deadline):
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise socket.timeout("no response from the server")
+            self.sock.settimeout(timeout)
+        data = self.sock.recv(self.bufsize)
+        if not data:
+            raise ConnectionError("connection closed by server")
+        self.buffer += data
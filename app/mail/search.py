@@ -0,0 +1,226 @@
+import threading
+import sqlite3
+import re
+import html
+import email.utils
+import datetime
+
+
+# Criteria answered from the index and columns they are matched against.
+TEXT_CRITERIA = dict(
+    SUBJECT=("subject",),
+    FROM=("sender",),
+    TO=("recipient",),
+    CC=("cc",),
+    BODY=("body",),
+    TEXT=("subject", "sender", "recipient", "cc", "body")
+)
+DATE_CRITERIA = frozenset(("SENTSINCE", "SENTBEFORE", "SENTON"))
+
+# Trigram tokenizer can not match shorter strings.
+MIN_TERM_LENGTH = 3
+
+HTML_SKIP_PATTERN = re.compile(r"<(script|style)\b.*?</\1\s*>",
+                               re.IGNORECASE | re.DOTALL)
+HTML_TAG_PATTERN = re.compile(r"<[^>]*>")
+
+
+def html_to_text(content):
+    '''Removes tags (and scripts, styles) from html, unescapes entities.'''
+    content = HTML_SKIP_PATTERN.sub(" ", content)
+    return html.unescape(HTML_TAG_PATTERN.sub(" ", content))
+
+def sent_date(value):
+    '''
+    Returns ordinal of the date from Date field (in its own time zone like
+    SENTSINCE/SENTBEFORE/SENTON criteria) or None.
+    '''
+    parsed = email.utils.parsedate_tz(value) if value else None
+    if not parsed:
+        return None
+    try:
+        return datetime.date(*parsed[:3]).toordinal()
+    except ValueError:
+        return None
+
+def make_document(header, texts):
+    '''
+    Returns document of the index for the e-mail. Header is a dictionary
+    with decoded fields, texts is the list of (subtype, text) of shown
+    text parts.
+    '''
+    fields = {name.upper(): value for name, value in header.items()}
+    return dict(
+        subject=fields.get("SUBJECT", None) or "",
+        sender=fields.get("FROM", None) or "",
+        recipient=fields.get("TO", None) or "",
+        cc=fields.get("CC", None) or "",
+        body="\n".join(html_to_text(text) if subtype == "html" else text
+                       for subtype, text in texts if text),
+        date=sent_date(fields.get("DATE", None))
+    )
+
+
+class SearchQuery:
+    '''Criteria of csearch translated into FTS5 query and date bounds.'''
+    def __init__(self, match, dates, needs_body):
+        self.match = match
+        self.dates = dates
+        self.needs_body = needs_body
+
+    @classmethod
+    def from_criteria(cls, criteria):
+        '''Returns query or None when criteria can not be answered locally.'''
+        terms = list()
+        dates = list()
+        needs_body = False
+        for criterion in criteria:
+            try:
+                key = criterion["key"].upper()
+                value = criterion.get("value", None) or ""
+            except (KeyError, AttributeError, TypeError):
+                return None
+            if key in TEXT_CRITERIA:
+                if len(value) < MIN_TERM_LENGTH:
+                    return None
+                columns = TEXT_CRITERIA[key]
+                needs_body = needs_body or "body" in columns
+                terms.append('{%s} : "%s"' % (" ".join(columns),
+                                              value.replace('"', '""')))
+            elif key in DATE_CRITERIA:
+                try:
+                    day = datetime.datetime.strptime(value, "%d-%b-%Y")
+                except ValueError:
+                    return None
+                dates.append((key, day.date().toordinal()))
+            else:
+                return None
+        if not terms and not dates:
+            return None
+        return cls(" AND ".join(terms) or None, dates, needs_body)
+
+
+class SearchIndex:
+    '''
+    Full-text index (SQLite FTS5 with trigram tokenizer, so like SEARCH it
+    matches substrings ignoring case) of e-mails identified by (account,
+    mailbox, uidvalidity, uid). Documents are added when e-mails are
+    downloaded anyway, messages indexed without body (e.g. BODYSTRUCTURE
+    could not be parsed) are used only for header criteria.
+
+    batch_size - max number of not indexed e-mails downloaded for the index
+                 during single search
+    '''
+    def __init__(self, path=":memory:", batch_size=100):
+        self.path = path
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "id INTEGER PRIMARY KEY, account TEXT, mailbox TEXT, "
+                "uidvalidity INTEGER, uid INTEGER, date INTEGER, "
+                "body INTEGER, UNIQUE (account, mailbox, uidvalidity, uid))"
+            )
+            self._db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS texts USING fts5("
+                "subject, sender, recipient, cc, body, tokenize='trigram')"
+            )
+
+    @staticmethod
+    def is_supported():
+        '''Checks whether SQLite is compiled with FTS5 (and trigrams).'''
+        try:
+            db = sqlite3.connect(":memory:")
+            db.execute("CREATE VIRTUAL TABLE test USING fts5("
+                       "text, tokenize='trigram')")
+            db.close()
+        except sqlite3.Error:
+            return False
+        return True
+
+    def add_many(self, account, mailbox, uidvalidity, documents, body=True):
+        '''
+        Adds documents given as dictionary {uid: document} (see
+        make_document). Documents of previous uidvalidity of the mailbox
+        are removed.
+        '''
+        if not documents:
+            return
+        with self._lock, self._db:
+            self._remove(
+                "account = ? AND mailbox = ? AND uidvalidity != ?",
+                (account, mailbox, uidvalidity)
+            )
+            for uid, document in documents.items():
+                row = self._db.execute(
+                    "SELECT id, body FROM messages WHERE account = ? AND "
+                    "mailbox = ? AND uidvalidity = ? AND uid = ?",
+                    (account, mailbox, uidvalidity, uid)
+                ).fetchone()
+                if row:
+                    if row[1] or not body: continue
+                    self._db.execute("DELETE FROM texts WHERE rowid = ?",
+                                     (row[0],))
+                    self._db.execute("DELETE FROM messages WHERE id = ?",
+                                     (row[0],))
+                rowid = self._db.execute(
+                    "INSERT INTO messages (account, mailbox, uidvalidity, "
+                    "uid, date, body) VALUES (?, ?, ?, ?, ?, ?)",
+                    (account, mailbox, uidvalidity, uid, document["date"],
+                     int(body))
+                ).lastrowid
+                self._db.execute(
+                    "INSERT INTO texts (rowid, subject, sender, recipient, "
+                    "cc, body) VALUES (?, ?, ?, ?, ?, ?)",
+                    (rowid, document["subject"], document["sender"],
+                     document["recipient"], document["cc"], document["body"])
+                )
+
+    def indexed_uids(self, account, mailbox, uidvalidity, body=False):
+        '''Returns set of indexed uids (only with body when body is true).'''
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT uid FROM messages WHERE account = ? AND mailbox = ? "
+                "AND uidvalidity = ?" + (" AND body = 1" if body else ""),
+                (account, mailbox, uidvalidity)
+            )
+            return set(uid for uid, in rows)
+
+    def search(self, account, mailbox, uidvalidity, query):
+        '''Returns set of indexed uids which meet the query.'''
+        sql = "SELECT messages.uid FROM messages"
+        conditions = ["messages.account = ?", "messages.mailbox = ?",
+                      "messages.uidvalidity = ?"]
+        params = [account, mailbox, uidvalidity]
+        if query.match:
+            # Full-text query runs once (a join would run it for each row).
+            conditions.append("messages.id IN (SELECT rowid FROM texts "
+                              "WHERE texts MATCH ?)")
+            params.append(query.match)
+        for key, day in query.dates:
+            operator = dict(SENTSINCE=">=", SENTBEFORE="<", SENTON="=")[key]
+            conditions.append("messages.date %s ?" % operator)
+            params.append(day)
+
+        with self._lock:
+            try:
+                rows = self._db.execute(
+                    sql + " WHERE " + " AND ".join(conditions), params
+                )
+                return set(uid for uid, in rows)
+            except sqlite3.Error:
+                return None
+
+    def discard_mailbox(self, account, mailbox):
+        '''Removes all documents of the mailbox (e.g. after its removal).'''
+        with self._lock, self._db:
+            self._remove("account = ? AND mailbox = ?", (account, mailbox))
+
+    def _remove(self, condition, params):
+        self._db.execute(
+            "DELETE FROM texts WHERE rowid IN (SELECT id FROM messages "
+            "WHERE %s)" % condition, params
+        )
+        self._db.execute("DELETE FROM messages WHERE %s" % condition, params)
@@ -1,24 +1,220 @@
 import json
 import re
+import ssl
 import imaplib
 import functools
+import queue
+import urllib.parse
+import time
 
 from flask import (
     render_template, redirect, url_for, request, flash, 
-    jsonify, session
+    jsonify, session, current_app, Response, abort
 )
 from flask_login import current_user, login_required
 
 from . import mail
 from .forms import LoginForm
 from .client import (
-    ImapClient, email_to_dict, ImapClientError, process_email_for_display
+    ImapClient, email_to_dict, ImapClientError, header_date
+)
+from .pool import ImapPool
+from .cache import HeaderCache, LRUCache, MessageStore, ListCache
+from .idle import IdleManager
+from .attachment import AttachmentStream
+from .search import SearchIndex
+from .fanout import FetchOrchestrator, FetchJob, Account
+from .prefetch import Prefetcher
+from .metrics import (
+    Instrumentation, LogSink, StatsRegistry, RequestTrace, server_timing
 )
 from app.utils import utf7_decode, utf7_encode
 
 DEFAULT_IDS_FROM = 0
 DEFAULT_IDS_TO = 50
 
+# Status of mailboxes returned by /mail/list.
+LIST_STATUS_ITEMS = "(MESSAGES UNSEEN UIDNEXT)"
+
+SECTION_PATTERN = re.compile(r"^\d+(\.\d+)*$")
+
+# Fields of headers returned by /mail/get_headers (and prefetched).
+HEADER_FIELDS = ["Subject", "Date", "From", "Content-Type"]
+
+
+def connect_imap(imap_addr, username, password, **kwargs):
+    '''Opens new connection with imap server and logs in the user.'''
+    imap_client = ImapClient(imap_addr, **kwargs)
+    imap_client.login(username, password)
+    return imap_client
+
+
+@mail.record_once
+def init_imap_pool(state):
+    config = state.app.config
+    header_cache = HeaderCache(
+        maxsize=config.get("IMAP_HEADER_CACHE_SIZE", 10000),
+        path=config.get("IMAP_HEADER_CACHE_PATH", None)
+    )
+    sync_cache = LRUCache(config.get("IMAP_SYNC_CACHE_SIZE", 100))
+    message_store = None
+    if config.get("IMAP_MESSAGE_STORE_PATH", None):
+        message_store = MessageStore(
+            config["IMAP_MESSAGE_STORE_PATH"],
+            maxsize=config.get("IMAP_MESSAGE_STORE_SIZE", 256*1024*1024)
+        )
+    search_index = None
+    if SearchIndex.is_supported():
+        search_index = SearchIndex(
+            config.get("IMAP_SEARCH_INDEX_PATH", None) or ":memory:",
+            batch_size=config.get("IMAP_SEARCH_INDEX_BATCH", 100)
+        )
+    state.app.extensions["imap_header_cache"] = header_cache
+    state.app.extensions["imap_sync_cache"] = sync_cache
+    state.app.extensions["imap_message_store"] = message_store
+    state.app.extensions["imap_search_index"] = search_index
+    index_cache = LRUCache(config.get("IMAP_MAILBOX_INDEX_SIZE", 100))
+    state.app.extensions["imap_index_cache"] = index_cache
+    list_cache = ListCache(ttl=config.get("IMAP_LIST_CACHE_TTL", 30))
+    state.app.extensions["imap_list_cache"] = list_cache
+    ssl_context = None
+    if config.get("IMAP_CA_FILE", None):
+        ssl_context = ssl.create_default_context(
+            cafile=config["IMAP_CA_FILE"]
+        )
+    state.app.extensions["imap_ssl_context"] = ssl_context
+    stats = StatsRegistry() if config.get("IMAP_METRICS_STATS", True) \
+                            else None
+    sinks = [sink for sink, enabled in (
+        (LogSink(), config.get("IMAP_METRICS_LOG", False)),
+        (stats, stats is not None),
+        (RequestTrace(), config.get("IMAP_DEBUG_HEADER", False))
+    ) if enabled]
+    instrumentation = Instrumentation(sinks) if sinks else None
+    state.app.extensions["imap_stats"] = stats
+    # Only prefetched e-mails are worth keeping for display.
+    display_cache = None
+    if config.get("IMAP_PREFETCH", False):
+        display_cache = LRUCache(config.get("IMAP_DISPLAY_CACHE_SIZE", 200))
+    state.app.extensions["imap_display_cache"] = display_cache
+    state.app.extensions["imap_instrumentation"] = instrumentation
+    timeout = config.get("IMAP_TIMEOUT", 5)
+    state.app.extensions["imap_pool"] = ImapPool(
+        functools.partial(connect_imap, timeout=timeout,
+                          header_cache=header_cache,
+                          sync_cache=sync_cache, message_store=message_store,
+                          search_index=search_index, index_cache=index_cache,
+                          list_cache=list_cache, ssl_context=ssl_context,
+                          compress=config.get("IMAP_COMPRESS", True),
+                          instrumentation=instrumentation,
+                          display_cache=display_cache),
+        max_per_account=config.get("IMAP_POOL_MAX_PER_ACCOUNT", 3),
+        idle_timeout=config.get("IMAP_POOL_IDLE_TIMEOUT", 300),
+        check_interval=config.get("IMAP_POOL_CHECK_INTERVAL", 30)
+    )
+    state.app.extensions["imap_idle"] = IdleManager(
+        functools.partial(connect_imap, timeout=timeout,
+                          ssl_context=ssl_context),
+        renew_interval=config.get("IMAP_IDLE_RENEW_INTERVAL", 25*60),
+        linger=config.get("IMAP_IDLE_LINGER", 30),
+        retry_interval=config.get("IMAP_IDLE_RETRY_INTERVAL", 5),
+        max_retry_interval=config.get("IMAP_IDLE_MAX_RETRY_INTERVAL", 300),
+        on_change=lambda watcher, event: list_cache.invalidate(watcher.account)
+    )
+    state.app.extensions["imap_fetch"] = FetchOrchestrator(
+        state.app.extensions["imap_pool"],
+        max_workers=config.get("IMAP_FETCH_WORKERS", 8),
+        max_per_host=config.get("IMAP_FETCH_MAX_PER_HOST", 6)
+    )
+    state.app.extensions["imap_prefetch"] = None
+    if config.get("IMAP_PREFETCH", False):
+        state.app.extensions["imap_prefetch"] = Prefetcher(
+            state.app.extensions["imap_pool"],
+            max_workers=config.get("IMAP_PREFETCH_WORKERS", 2),
+            max_per_account=config.get("IMAP_PREFETCH_MAX_PER_ACCOUNT", 1)
+        )
+    # Not indexed e-mails are added to the search index after searches.
+    state.app.extensions["imap_indexer"] = None
+    if search_index is not None:
+        state.app.extensions["imap_indexer"] = Prefetcher(
+            state.app.extensions["imap_pool"],
+            max_workers=config.get("IMAP_SEARCH_INDEX_WORKERS", 1),
+            max_pending=1
+        )
+
+
+def get_imap_pool():
+    return current_app.extensions["imap_pool"]
+
+def get_header_cache():
+    return current_app.extensions["imap_header_cache"]
+
+def get_sync_cache():
+    return current_app.extensions["imap_sync_cache"]
+
+def get_message_store():
+    return current_app.extensions["imap_message_store"]
+
+def get_search_index():
+    return current_app.extensions["imap_search_index"]
+
+def get_index_cache():
+    return current_app.extensions["imap_index_cache"]
+
+def get_list_cache():
+    return current_app.extensions["imap_list_cache"]
+
+def get_idle_manager():
+    return current_app.extensions["imap_idle"]
+
+def get_fetch_orchestrator():
+    return current_app.extensions["imap_fetch"]
+
+def get_ssl_context():
+    return current_app.extensions["imap_ssl_context"]
+
+def get_display_cache():
+    return current_app.extensions["imap_display_cache"]
+
+def get_prefetcher():
+    return current_app.extensions["imap_prefetch"]
+
+def get_indexer():
+    return current_app.extensions["imap_indexer"]
+
+def get_imap_stats():
+    return current_app.extensions["imap_stats"]
+
+def get_instrumentation():
+    return current_app.extensions["imap_instrumentation"]
+
+
+@mail.after_request
+def add_imap_timing(response):
+    '''
+    Adds Server-Timing header with imap commands run by the request when
+    IMAP_DEBUG_HEADER is enabled.
+    '''
+    if current_app.config.get("IMAP_DEBUG_HEADER", False):
+        events = RequestTrace.events()
+        if events:
+            response.headers["Server-Timing"] = server_timing(events)
+    return response
+
+
+@mail.route("/stats", methods=["GET"])
+def imap_stats():
+    '''
+    Returns statistics of imap commands of all accounts (StatsRegistry).
+    Available only when IMAP_DEBUG_HEADER and IMAP_METRICS_STATS are
+    enabled (not found otherwise).
+    '''
+    stats = get_imap_stats()
+    if stats is None or \
+       not current_app.config.get("IMAP_DEBUG_HEADER", False):
+        abort(404)
+    return jsonify({"status": "OK", "data": stats.snapshot()})
+
 
 @mail.route("/login", methods=["GET", "POST"])
 @login_required
@@ -31,7 +227,22 @@ def login():
 
         imap_client = None
         try:
-            imap_client = ImapClient(imap_addr, timeout = 5) # 5 seconds
+            imap_client = ImapClient(imap_addr,
+                                     timeout=current_app.config.get(
+                                         "IMAP_TIMEOUT", 5
+                                     ),
+                                     header_cache=get_header_cache(),
+                                     sync_cache=get_sync_cache(),
+                                     message_store=get_message_store(),
+                                     search_index=get_search_index(),
+                                     index_cache=get_index_cache(),
+                                     list_cache=get_list_cache(),
+                                     ssl_context=get_ssl_context(),
+                                     compress=current_app.config.get(
+                                         "IMAP_COMPRESS", True
+                                     ),
+                                     instrumentation=get_instrumentation(),
+                                     display_cache=get_display_cache())
         except imaplib.IMAP4.error:
             flash("Unable to connect with service provider. Pleade verify " + 
                   "whether the imap address is correct.")
@@ -46,11 +257,21 @@ def login():
                 session["imap_username"] = username
                 session["imap_password"] = password
                 session["imap_addr"] = imap_addr
+                get_imap_pool().put(imap_addr, username, password, 
+                                    imap_client)
                 return redirect(request.args.get("next") or url_for("mail.client"))
 
     return render_template("mail/login.html", form=form, user=current_user)
 
 def logout_from_imap():
+    username = session.get("imap_username", None)
+    imap_addr = session.get("imap_addr", None)
+    if username:
+        get_imap_pool().discard_account(imap_addr, username)
+        get_idle_manager().stop_account(imap_addr, username)
+        for prefetcher in (get_prefetcher(), get_indexer()):
+            if prefetcher is not None:
+                prefetcher.cancel(imap_addr, username)
     session.pop("imap_username", None)
     session.pop("imap_password", None)
     session.pop("imap_addr", None)
@@ -65,7 +286,12 @@ def logout():
 # IMAP INTERFACE
 ################################################################################
 
-def imap_authentication(redirect_to_login=False):
+def imap_authentication(redirect_to_login=False, streaming=False):
+    '''
+    Passes pooled connection of the user to the view. Streaming views keep
+    the connection until the response has been sent (it is discarded when
+    streaming fails).
+    '''
     def decorator(func):
         @functools.wraps(func)
         def authenticate(*args, **kwargs):
@@ -73,12 +299,27 @@ def imap_authentication(redirect_to_login=False):
             password = session.get("imap_password", None)
             imap_addr = session.get("imap_addr", None)
             if username and password:
+                imap_pool = get_imap_pool()
                 try:
-                    imap_client = ImapClient(imap_addr)
-                    imap_client.login(username, password)
-                    return func(imap_client, *args, **kwargs)
+                    imap_client = imap_pool.acquire(imap_addr, username, 
+                                                    password)
                 except ImapClientError:
-                    pass
+                    imap_client = None
+
+                if imap_client is not None:
+                    discard = True
+                    try:
+                        response = func(imap_client, *args, **kwargs)
+                        discard = False
+                        if streaming and response.is_streamed:
+                            hold_connection(response, imap_pool, imap_client)
+                            imap_client = None
+                        return response
+                    except ImapClientError:
+                        discard = False
+                    finally:
+                        if imap_client is not None:
+                            imap_pool.release(imap_client, discard=discard)
 
             if redirect_to_login:
                 return redirect(url_for("mail.login"))
@@ -88,6 +329,22 @@ def imap_authentication(redirect_to_login=False):
         return authenticate
     return decorator
 
+def hold_connection(response, imap_pool, imap_client):
+    '''Releases the connection when streamed response is closed.'''
+    state = dict(discard=False)
+
+    def stream(iterable):
+        try:
+            yield from iterable
+        except Exception:
+            state["discard"] = True
+            raise
+
+    response.response = stream(response.response)
+    response.call_on_close(lambda: imap_pool.release(
+        imap_client, discard=state["discard"]
+    ))
+
 def adjust_mailbox(mailbox):
     return '"' + mailbox + '"'
 
@@ -101,15 +358,26 @@ def client(imap_client):
 @mail.route("/list", methods=["GET", "POST"])
 @imap_authentication()
 def imap_list(imap_client):
+    '''
+    Mailboxes with their status (number of e-mails, unseen e-mails and next
+    uid). The list (with decoded names) is cached for a short time.
+    '''
+    list_cache = get_list_cache()
+    mailboxes = list_cache.get(imap_client.account)
+    if mailboxes is not None:
+        return jsonify({"status": "OK", "data": mailboxes})
     try:
-        status, data = imap_client.list()
+        since = time.monotonic()
+        status, data = imap_client.list(status_items=LIST_STATUS_ITEMS)
         mailboxes = list()
-        for name, flags in data:
+        for name, flags, mailbox_status in data:
             mailboxes.append({
                 "utf7": name,
                 "utf16": utf7_decode(name),
-                "flags": flags
+                "flags": flags,
+                "status": mailbox_status
             })
+        list_cache.put(imap_client.account, mailboxes, since=since)
         return jsonify({"status": "OK", "data": mailboxes})
     except ImapClientError as e:
         return jsonify({"status": "ERROR", "data": {"msg": str(e)}})
@@ -127,6 +395,9 @@ def imap_get_headers(imap_client):
         return jsonify({"status": "ERROR", 
                         "data": {"msg": "Undefined mailbox name."}})
 
+    if "cursor" in args or "limit" in args:
+        return get_headers_page(imap_client, args)
+
     if "ids" not in args and ("ids_from" not in args or "ids_to" not in args):
         return jsonify({"status": "ERROR", 
                         "`data": {"msg": "Undefined ids."}})
@@ -155,51 +426,237 @@ def imap_get_headers(imap_client):
 
             status, data = imap_client.get_headers(
                 ids,
-                fields=["Subject", "Date", "From", "Content-Type"],
+                fields=HEADER_FIELDS,
                 uid=is_uid, sort_by_date=False
             )
             data = list(reversed(data))
         else:
             status, data = "OK", [] # Empty mailbox
 
-        response = {"status": status, "data": data, "total_emails": count}
-        return jsonify(response)
+        response = jsonify({"status": status, "data": data, 
+                            "total_emails": count})
+        if count > 0 and "ids" not in args:
+            # Next range of the same length (sequence numbers).
+            next_ids = range(count, 0, -1)[ids_to:2 * ids_to - ids_from]
+            tasks = list()
+            if next_ids:
+                tasks.append(functools.partial(
+                    prefetch_headers, adjust_mailbox(args["mailbox"]),
+                    next_ids
+                ))
+            schedule_prefetch(response, args["mailbox"], tasks)
+        elif count > 0 and is_uid:
+            schedule_prefetch(response, args["mailbox"], 
+                              prefetch_emails_tasks(args["mailbox"], data))
+        return response
+
+    except ImapClientError as e:
+        return jsonify({"status": "ERROR", "data": {"msg": str(e)}})
+
+def get_headers_page(imap_client, args):
+    '''
+    Page of headers in date order following the cursor (opaque string
+    returned as next_cursor, the first page without cursor).
+    '''
+    try:
+        limit = int(args.get("limit", DEFAULT_IDS_TO))
+        if limit < 1:
+            raise ValueError
+    except ValueError:
+        return jsonify({"status": "ERROR", 
+                        "data": {"msg": "Invalid number of e-mails."}})
 
+    try:
+        status, page = imap_client.get_headers_page(
+            adjust_mailbox(args["mailbox"]), cursor=args.get("cursor", None),
+            limit=limit, fields=HEADER_FIELDS,
+            max_age=current_app.config.get("IMAP_MAILBOX_INDEX_MAX_AGE", 30)
+        )
     except ImapClientError as e:
         return jsonify({"status": "ERROR", "data": {"msg": str(e)}})
 
+    response = jsonify({"status": status, "data": page["headers"], 
+                        "next_cursor": page["next_cursor"], 
+                        "total_emails": page["total"]})
+    # Users usually open one of the newest unseen e-mails first.
+    tasks = prefetch_emails_tasks(args["mailbox"], page["headers"])
+    if page["next_cursor"]:
+        tasks.append(functools.partial(
+            prefetch_headers_page, adjust_mailbox(args["mailbox"]),
+            cursor=page["next_cursor"], limit=limit,
+            max_age=current_app.config.get("IMAP_MAILBOX_INDEX_MAX_AGE", 30)
+        ))
+    schedule_prefetch(response, args["mailbox"], tasks)
+    return response
+
+def schedule_prefetch(response, mailbox, tasks):
+    '''
+    Runs prefetch tasks (func(imap_client)) of the user in the background
+    once the response has been sent (and its connection released), when
+    prefetch is enabled. Prefetch of other mailbox is cancelled.
+    '''
+    prefetcher = get_prefetcher()
+    if prefetcher is None:
+        return
+    account = Account(session["imap_addr"], session["imap_username"],
+                      session["imap_password"])
+    response.call_on_close(lambda: prefetcher.schedule(account, mailbox,
+                                                       tasks))
+
+def schedule_indexing(response, mailbox):
+    '''
+    Adds not indexed e-mails of the mailbox to the search index in the
+    background once the response has been sent (see indexed_search).
+    '''
+    indexer = get_indexer()
+    if indexer is None:
+        return
+    account = Account(session["imap_addr"], session["imap_username"],
+                      session["imap_password"])
+    task = functools.partial(index_mailbox, adjust_mailbox(mailbox))
+    response.call_on_close(lambda: indexer.schedule(account, mailbox,
+                                                    [task]))
+
+def prefetch_emails_tasks(mailbox, headers):
+    '''
+    Returns prefetch tasks of the newest unseen e-mails (by uid) of the
+    headers (at most IMAP_PREFETCH_EMAILS).
+    '''
+    unseen = [header["id"] for header in headers 
+              if "\\Seen" not in header.get("Flags", ())]
+    unseen = unseen[:current_app.config.get("IMAP_PREFETCH_EMAILS", 3)]
+    return [functools.partial(prefetch_email, adjust_mailbox(mailbox), uid)
+            for uid in unseen]
+
+def prefetch_headers(mailbox, ids, imap_client):
+    imap_client.len_mailbox(mailbox)
+    imap_client.get_headers(ids, fields=HEADER_FIELDS, uid=False,
+                            sort_by_date=False)
+
+def prefetch_headers_page(mailbox, imap_client, **kwargs):
+    imap_client.get_headers_page(mailbox, fields=HEADER_FIELDS, **kwargs)
+
+def prefetch_email(mailbox, uid, imap_client):
+    imap_client.get_email_for_display(uid, uid=True, mailbox=mailbox)
+
+def index_mailbox(mailbox, imap_client):
+    imap_client.index_mailbox(mailbox)
+
+
+@mail.route("/unified", methods=["GET", "POST"])
+@imap_authentication()
+def imap_unified(imap_client):
+    '''
+    Newest headers of several mailboxes (INBOX by default) merged by date.
+    Mailboxes are fetched in parallel over pooled connections, the state of
+    each one (next_cursor for /mail/get_headers or error) is returned in
+    "mailboxes".
+    '''
+    if request.method == "POST":
+        args = request.form
+    elif request.method == "GET":
+        args = request.args
+
+    mailboxes = list()
+    for mailbox in args.getlist("mailbox") or ["INBOX"]:
+        if mailbox not in mailboxes:
+            mailboxes.append(mailbox)
+    try:
+        limit = int(args.get("limit", DEFAULT_IDS_TO))
+        if limit < 1:
+            raise ValueError
+    except ValueError:
+        return jsonify({"status": "ERROR", 
+                        "data": {"msg": "Invalid number of e-mails."}})
+
+    max_age = current_app.config.get("IMAP_MAILBOX_INDEX_MAX_AGE", 30)
+    def fetch(mailbox):
+        return lambda client: client.get_headers_page(
+            adjust_mailbox(mailbox), limit=limit, fields=HEADER_FIELDS,
+            max_age=max_age
+        )
+
+    account = Account(session["imap_addr"], session["imap_username"],
+                      session["imap_password"])
+    results = get_fetch_orchestrator().run(
+        [FetchJob(account, mailbox, fetch(mailbox)) for mailbox in mailboxes],
+        clients={account: imap_client},
+        timeout=current_app.config.get("IMAP_FETCH_TIMEOUT", 30)
+    )
+
+    headers = list()
+    states = dict()
+    for mailbox in mailboxes:
+        status, data = results[mailbox]
+        if status != "OK":
+            states[mailbox] = {"status": "ERROR", "msg": data}
+            continue
+        for header in data["headers"]:
+            header["mailbox"] = mailbox
+            headers.append(header)
+        states[mailbox] = {"status": "OK", "next_cursor": data["next_cursor"],
+                           "total_emails": data["total"]}
+    headers.sort(key=header_date, reverse=True)
+    return jsonify({"status": "OK", "data": headers, "mailboxes": states})
+
   
 @mail.route("/get_raw_emails", methods=["GET", "POST"])
-@imap_authentication()
+@imap_authentication(streaming=True)
 def imap_get_raw_emails(imap_client):
+    '''
+    Streams e-mails as JSON {"data": [e-mails], "status": "OK"} written
+    e-mail by e-mail as they are fetched (in chunks of
+    IMAP_RAW_EMAILS_CHUNK), so memory does not grow with the number of
+    e-mails. Status comes last: when fetching fails after the first
+    e-mail, it is "ERROR" with "msg" and data holds e-mails sent so far.
+    Bodies of text parts are decoded, bodies of other parts (attachments)
+    are encoded with base64.
+    '''
     if request.method == "POST":
         args = request.form
     elif request.method == "GET":
         args = request.args
 
     is_uid = args.get("uid", "False").upper() in ("TRUE", "T", "YES", "Y")
+    ids = args.get("ids", None)
+    if not ids:
+        return jsonify({"status": "ERROR", 
+                        "data": {"msg": "Unspecified e-mails ids."}})
     try:
-        ids = args.get("ids", None)
-        if ids:
-            status_select, _ = imap_client.select(
-                adjust_mailbox(args.get("mailbox", "INBOX"))
+        status_select, _ = imap_client.select(
+            adjust_mailbox(args.get("mailbox", "INBOX"))
+        )
+        emails = imap_client.iter_emails(
+            ids, uid=is_uid, chunk_size=current_app.config.get(
+                "IMAP_RAW_EMAILS_CHUNK", 20
             )
-            status, data = imap_client.get_emails(ids, uid=is_uid)
-
-            # Process & decode emails
-            emails = list()
-            for email in data:
-                emails.append(email_to_dict(email))
-
-            response = {"status": "OK", "data": emails}
-        else:
-            response = {"status": "ERROR", 
-                       "data": {"msg": "Unspecified e-mails ids."}}
-
-        return jsonify(response)
+        )
+        # Errors of the first fetch are reported like in other views.
+        first = next(emails, None)
     except ImapClientError as e:
         return jsonify({"status": "ERROR", "data": {"msg": str(e)}})
 
+    def generate():
+        try:
+            yield '{"data": ['
+            if first is not None:
+                yield json.dumps(email_to_dict(first))
+                try:
+                    for email in emails:
+                        yield ", " + json.dumps(email_to_dict(email))
+                except ImapClientError as e:
+                    yield '], "status": "ERROR", "msg": %s}' % json.dumps(
+                        str(e)
+                    )
+                    return
+            yield '], "status": "OK"}'
+        finally:
+            # Drains the fetch before the connection is released (not
+            # later, when the generator is collected).
+            emails.close()
+
+    return Response(generate(), mimetype="application/json")
+
 
 @mail.route("/get_email", methods=["GET", "POST"])
 @imap_authentication()
@@ -213,13 +670,11 @@ def imap_get_email(imap_client):
     try:
         email_id = args.get("id", None)
         if email_id:
-            imap_client.select(adjust_mailbox(args.get("mailbox", "INBOX")))
-            stuats, data = imap_client.get_emails(email_id, uid=is_uid)
-
-            output = None
-            if (len(data) > 0):
-                output = process_email_for_display(data[0])
-
+            status, output = imap_client.get_email_for_display(
+                email_id, uid=is_uid, 
+                mailbox=adjust_mailbox(args.get("mailbox", "INBOX")),
+                mark_seen=True
+            )
             response = {"status": "OK", "data": output}
         else:
             response = {"status": "ERROR", 
@@ -254,10 +709,10 @@ def imap_move_emails(imap_client):
 
     is_uid = args.get("uid", "False").upper() in ("TRUE", "T", "YES", "Y")
     try:
-        imap_client.select(adjust_mailbox(source_mailbox))
         status, data = imap_client.move_emails(
                             args["ids"], adjust_mailbox(dest_mailbox),
-                            uid=is_uid
+                            uid=is_uid, 
+                            source_mailbox=adjust_mailbox(source_mailbox)
                        )
         if status == "OK":
             return jsonify({"status": "OK", "data": data})
@@ -298,8 +753,8 @@ def imap_store(imap_client, command):
 
     is_uid = args.get("uid", "False").upper() in ("TRUE", "T", "YES", "Y")
     try:
-        imap_client.select(adjust_mailbox(args["mailbox"]))
-        status, data = flags_method(args["ids"], args["flags"], uid=is_uid)
+        status, data = flags_method(args["ids"], args["flags"], uid=is_uid,
+                                    mailbox=adjust_mailbox(args["mailbox"]))
         if status != "OK":
             return jsonify({"status": "ERROR", "data": {"msg": data}}) 
         else:
@@ -328,6 +783,7 @@ def imap_rename(imap_client):
                             adjust_mailbox(args["oldmailbox"]), 
                             adjust_mailbox(utf7_encode(args["newmailbox"]))
                        )
+        get_list_cache().invalidate(imap_client.account)
     except ImapClientError as e:
         return jsonify({"status": "ERROR", "data": {"msg": str(e)}})      
 
@@ -355,6 +811,7 @@ def imap_create(imap_client):
         status, data = imap_client.create(
                             adjust_mailbox(utf7_encode(args["mailbox"]))
                        )
+        get_list_cache().invalidate(imap_client.account)
     except ImapClientError as e:
         return jsonify({"status": "ERROR", "data": {"msg": str(e)}})  
 
@@ -380,6 +837,7 @@ def imap_delete(imap_client):
 
     try:
         status, data = imap_client.delete(adjust_mailbox(args["mailbox"]))
+        get_list_cache().invalidate(imap_client.account)
     except ImapClientError as e:
         return jsonify({"status": "ERROR", "data": {"msg": str(e)}})      
 
@@ -411,14 +869,16 @@ def imap_search(imap_client):
     criteria = json.loads(args["criteria"])
     try:
         imap_client.select(adjust_mailbox(args["mailbox"]))
-        status, data = imap_client.csearch(criteria, uid=is_uid)
+        status, data = imap_client.indexed_search(criteria, uid=is_uid)
     except ImapClientError as e:
         return jsonify({"status": "ERROR", "data": {"msg": str(e)}})        
 
     if status != "OK":
         return jsonify({"status": "ERROR", "data": {"msg": data}}) 
     else:
-        return jsonify({"status": "OK", "data": data})
+        response = jsonify({"status": "OK", "data": list(data)})
+        schedule_indexing(response, args["mailbox"])
+        return response
 
 
 @mail.route("/len_mailbox", methods=["GET", "POST"])
@@ -457,13 +917,178 @@ def imap_list_mailbox(imap_client):
                         "data": {"msg": "Undefined mailbox name."}})
 
     is_uid = args.get("uid", "False").upper() in ("TRUE", "T", "YES", "Y")
+    # Sequence set (e.g. "1:3,7") instead of the list of numbers.
+    compact = args.get("compact", "False").upper() in ("TRUE", "T", "YES",
+                                                       "Y")
     try:
         status, data = imap_client.list_mailbox(adjust_mailbox(args["mailbox"]),
-                                                uid=is_uid)
+                                                uid=is_uid,
+                                                partial=args.get("partial"))
     except ImapClientError as e:
         return jsonify({"status": "ERROR", "data": {"msg": str(e)}})     
 
     if status != "OK":
         return jsonify({"status": "ERROR", "data": {"msg": data}}) 
+    elif compact:
+        return jsonify({"status": "OK", "data": data.to_sequence_set()})
     else:
-        return jsonify({"status": "OK", "data": data})
\ No newline at end of file
+        return jsonify({"status": "OK", "data": list(data)})
+
+
+@mail.route("/sync", methods=["GET", "POST"])
+@imap_authentication()
+def imap_sync(imap_client):
+    if request.method == "POST":
+        args = request.form
+    elif request.method == "GET":
+        args = request.args
+
+    if "mailbox" not in args:
+        return jsonify({"status": "ERROR", 
+                        "data": {"msg": "Undefined mailbox name."}})
+
+    try:
+        modseq = int(args["modseq"]) if args.get("modseq") else None
+        uidvalidity = int(args["uidvalidity"]) \
+                          if args.get("uidvalidity") else None
+        known_uids = [int(uid) for uid in args["uids"].split(",")] \
+                         if args.get("uids") else None
+    except ValueError:
+        return jsonify({"status": "ERROR", 
+                        "data": {"msg": "Invalid modseq, uidvalidity or uids."}})
+
+    try:
+        status, data = imap_client.sync(adjust_mailbox(args["mailbox"]),
+                                        modseq=modseq, uidvalidity=uidvalidity,
+                                        known_uids=known_uids)
+    except ImapClientError as e:
+        return jsonify({"status": "ERROR", "data": {"msg": str(e)}})     
+
+    return jsonify({"status": "OK", "data": data})
+
+
+def server_sent_event(event):
+    '''
+    Formats event of IDLE watcher as Server-Sent Event. Errors are sent as
+    imap-error events (error is reserved for errors of EventSource).
+    '''
+    name = "imap-error" if event["type"] == "error" else event["type"]
+    return "event: %s\ndata: %s\n\n" % (name, json.dumps(event))
+
+@mail.route("/events", methods=["GET"])
+def imap_events():
+    '''
+    Stream of changes in the mailbox (Server-Sent Events) produced by IDLE
+    watcher: exists, expunge, vanished, fetch (flags) and imap-error
+    events. The stream ends after imap-error, which tells whether IDLE is
+    unsupported and in how many seconds (retry) the mailbox may be watched
+    again. Only the session is checked (the watcher has own connection).
+    '''
+    username = session.get("imap_username", None)
+    password = session.get("imap_password", None)
+    imap_addr = session.get("imap_addr", None)
+    if not username or not password:
+        return jsonify({"status": "ERROR", "data": "Not authorized access."})
+
+    mailbox = adjust_mailbox(request.args.get("mailbox", "INBOX"))
+    idle_manager = get_idle_manager()
+    failure = idle_manager.failure(imap_addr, username, mailbox)
+    if failure is not None:
+        return Response(["retry: 5000\n\n", server_sent_event(failure)],
+                        mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache"})
+
+    watcher, events = idle_manager.subscribe(imap_addr, username, password,
+                                             mailbox)
+    keepalive = current_app.config.get("IMAP_EVENTS_KEEPALIVE", 15)
+
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    event = events.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield server_sent_event(event)
+                if event["type"] == "error":
+                    break
+        finally:
+            watcher.unsubscribe(events)
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", 
+                             "X-Accel-Buffering": "no"})
+
+
+def content_disposition(filename):
+    '''Returns Content-Disposition of attachment (RFC 6266).'''
+    if not filename:
+        return "attachment"
+    fallback = filename.encode("ascii", "replace").decode("ascii")
+    fallback = fallback.replace("\\", "_").replace('"', "_")
+    return "attachment; filename=\"%s\"; filename*=UTF-8''%s" % (
+        fallback, urllib.parse.quote(filename, safe="")
+    )
+
+@mail.route("/attachment", methods=["GET"])
+@imap_authentication(streaming=True)
+def imap_attachment(imap_client):
+    '''
+    Streams single part of the e-mail (attachment) decoded on the fly.
+    Supports single byte range (Range header) when decoded length of the
+    part is known.
+    '''
+    args = request.args
+    is_uid = args.get("uid", "False").upper() in ("TRUE", "T", "YES", "Y")
+    email_id = args.get("id", None)
+    section = args.get("section", None)
+    if not email_id or not section or not SECTION_PATTERN.match(section):
+        return jsonify({"status": "ERROR", 
+                        "data": {"msg": "Unspecified e-mail's id or part."}})
+
+    try:
+        status, part = imap_client.get_part(
+            email_id, section, uid=is_uid,
+            mailbox=adjust_mailbox(args.get("mailbox", "INBOX"))
+        )
+        if part is None or part["maintype"] == "multipart":
+            return jsonify({"status": "ERROR", 
+                            "data": {"msg": "No such part of the e-mail."}})
+        stream = AttachmentStream(
+            functools.partial(imap_client.fetch_partial, email_id, section,
+                              uid=is_uid),
+            part, chunk_size=current_app.config.get(
+                "IMAP_ATTACHMENT_CHUNK_SIZE", 256*1024
+            )
+        )
+        length = stream.probe()
+    except ImapClientError as e:
+        return jsonify({"status": "ERROR", "data": {"msg": str(e)}})
+
+    content_type = "%s/%s" % (part["maintype"], part["subtype"])
+    if "charset" in part["params"]:
+        content_type += "; charset=%s" % part["params"]["charset"]
+    headers = {"Content-Disposition": content_disposition(
+        part["disposition_params"].get("filename", None) or 
+        part["params"].get("name", None)
+    )}
+
+    status, start, stop = 200, 0, None
+    if length is not None:
+        headers["Accept-Ranges"] = "bytes"
+        stop = length
+        if request.range and len(request.range.ranges) == 1:
+            byte_range = request.range.range_for_length(length)
+            if byte_range is None:
+                return Response(status=416, headers={
+                    "Content-Range": "bytes */%d" % length
+                })
+            status, (start, stop) = 206, byte_range
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, stop - 1,
+                                                           length)
+        headers["Content-Length"] = str(stop - start)
+
+    return Response(stream.iter_range(start, stop), status=status, 
+                    content_type=content_type, headers=headers)
@@ -16,7 +16,10 @@ var ajax_urls = {
     delete_mailbox: "/mail/delete",
     search_emails: "/mail/search",
     len_mailbox: "/mail/len_mailbox",
-    list_mailbox: "/mail/list_mailbox"
+    list_mailbox: "/mail/list_mailbox",
+    sync: "/mail/sync",
+    events: "/mail/events",
+    attachment: "/mail/attachment"
 };
 
 /**
@@ -75,6 +78,30 @@ function getEMailsHeaders(options) {
     sendRequest(ajax_urls.get_headers, params, options.callback);
 }
 
+/**
+ * Send XMLHttpRequest for the page of e-mails headers in date order (the
+ * newest first). Response contains next_cursor which points at the next
+ * page (null for the last page), pages do not shift when e-mails arrive.
+ * @param {Object} options 
+ */
+function getEMailsPage(options) {
+    if (options === undefined) options = {};
+    if (options.mailbox === undefined) {
+        throw "Undefined 'mailbox' argument.";   
+    }
+    if (options.limit === undefined) options.limit = 50;
+
+    var params = {
+        mailbox: options.mailbox,
+        limit: options.limit
+    };
+    if (options.cursor) {
+        params.cursor = options.cursor;
+    }
+
+    sendRequest(ajax_urls.get_headers, params, options.callback);
+}
+
 /**
  * Send XMLHttpRequest for e-mails which meet specified criteria.
  * @param {Object} options 
@@ -125,6 +152,83 @@ function getEMailsList(options) {
                 options.callback);
 }
 
+/**
+ * Send XMLHttpRequest for changes in the mailbox since the last sync 
+ * (options.modseq and options.uidvalidity are taken from previous response).
+ * @param {Object} options
+ */
+function syncMailbox(options) {
+    if (options === undefined) options = {};
+    if (options.mailbox === undefined) {
+        throw "Undefined mailbox.";
+    }
+
+    var params = {mailbox: options.mailbox};
+    if (options.modseq !== undefined) params.modseq = options.modseq;
+    if (options.uidvalidity !== undefined) {
+        params.uidvalidity = options.uidvalidity;
+    }
+    if (options.uids !== undefined) params.uids = options.uids.join(",");
+
+    sendRequest(ajax_urls.sync, params, options.callback);
+}
+
+/**
+ * Open stream of changes in the mailbox (Server-Sent Events). Callback is
+ * called with event object (type: exists, expunge, vanished, fetch, error).
+ * The stream is closed after error event (sent as imap-error), which says
+ * whether IDLE is unsupported and after how many seconds (retry) the
+ * mailbox may be watched again.
+ * @param {Object} options
+ * @return {EventSource}
+ */
+function subscribeMailboxEvents(options) {
+    if (options === undefined) options = {};
+    if (options.mailbox === undefined) {
+        throw "Undefined mailbox.";
+    }
+
+    var source = new EventSource(ajax_urls.events + "?mailbox=" + 
+                                 encodeURIComponent(options.mailbox));
+    ["exists", "expunge", "vanished", "fetch", "imap-error"].forEach(function(type) {
+        source.addEventListener(type, function(event) {
+            var data;
+            if (!event.data) return;
+            try {
+                data = JSON.parse(event.data);
+            } catch (e) {
+                return;
+            }
+            if (type === "imap-error") {
+                source.close();
+            }
+            if (options.callback !== undefined) {
+                options.callback(data);
+            }
+        });
+    });
+    return source;
+}
+
+/**
+ * Return URL for downloading the part (attachment) of the e-mail.
+ * @param {Object} options
+ * @return {string}
+ */
+function getAttachmentUrl(options) {
+    if (options === undefined) options = {};
+    if (options.id === undefined || options.section === undefined) {
+        throw "Undefined id or section.";
+    }
+
+    return ajax_urls.attachment + "?" + $.param({
+        id: options.id,
+        section: options.section,
+        uid: options.uid || false,
+        mailbox: options.mailbox || "INBOX"
+    });
+}
+
 /**
  * Send XMLHttpRequest for update flags of selected e-mails.
  * @param {Object} options
@@ -6,7 +6,8 @@ var settings = {
     default_mailbox: "INBOX",
     emails_per_page: 25,
     enable_uid: true,
-    enable_caching: true
+    enable_caching: true,
+    poll_interval: 60000 // ms, when the server does not support IDLE
 };
 
 /*******************************************************************************
@@ -19,6 +20,69 @@ var settings = {
  */
 var emanager;
 
+/**
+ * Stream of changes in the current mailbox.
+ * @type {EventSource}
+ */
+var mailboxEvents;
+
+/**
+ * Timers of polling (without IDLE) and of watching the mailbox again.
+ */
+var mailboxPolling;
+var mailboxRetry;
+
+/**
+ * Stop listening for changes in the mailbox.
+ */
+function unwatchMailbox() {
+    if (mailboxEvents !== undefined) {
+        mailboxEvents.close();
+        mailboxEvents = undefined;
+    }
+    clearInterval(mailboxPolling);
+    clearTimeout(mailboxRetry);
+}
+
+/**
+ * Refresh the list of e-mails every poll_interval.
+ */
+function pollMailbox() {
+    mailboxPolling = setInterval(function() {
+        emanager.updateSource();
+    }, settings.poll_interval);
+}
+
+/**
+ * Listen for changes in the mailbox and refresh the list of e-mails. The
+ * list is refreshed periodically when the server does not support IDLE,
+ * after other errors the mailbox is watched again when the server allows.
+ * @param {string} mailbox
+ */
+function watchMailbox(mailbox) {
+    unwatchMailbox();
+    if (typeof EventSource === "undefined") {
+        pollMailbox();
+        return;
+    }
+    mailboxEvents = subscribeMailboxEvents({
+        mailbox: mailbox,
+        callback: function(event) {
+            if (event.type !== "error") {
+                emanager.updateSource();
+            } else if (event.unsupported) {
+                mailboxEvents = undefined;
+                pollMailbox();
+            } else {
+                mailboxEvents = undefined;
+                mailboxRetry = setTimeout(function() {
+                    watchMailbox(mailbox);
+                }, (event.retry || 5) * 1000);
+            }
+        }
+    });
+}
+
 function initClient() {
     emanager = new EMailsManager({
             emailsPerPage: settings.emails_per_page,
@@ -53,6 +117,7 @@ function initClient() {
             uid: settings.enable_uid
         }));
     emanager.updateSource();  
+    watchMailbox(settings.default_mailbox);
     getMailboxes({callback: updateMailboxesList});
 
     $(document).mouseup(function (e) {
@@ -75,6 +140,7 @@ function initClient() {
                 uid: settings.enable_uid
             }));
         emanager.updateSource();  
+        watchMailbox($(this).data("name"));
     });
     $("#prev-emails-btn").click(function() {
         emanager.prevPage();
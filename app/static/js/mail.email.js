@@ -48,19 +48,23 @@ function updateEmailModal(response) {
         $modal.find("#email-header-to").html(
             email.header["To"].replace("<", "&lt").replace(">", "&gt"));
         var $emailBase = $modal.find("#email-base");
-        createEmailTree(email, $emailBase);
+        createEmailTree(email, $emailBase, {
+            id: $modal.data("email-id").toString(),
+            uid: settings.enable_uid,
+            mailbox: $modal.data("mailbox")
+        });
     } else {
         alert(JSON.stringify(response.data));
     }
 }
 
-function createEmailTree(email, $base) {
+function createEmailTree(email, $base, source) {
     var $emailPart = undefined;
     if (email.type == "node") {
         $emailPart = $("<li class='email-part email-node'></li>");
         var $emailNode = $("<ul class='email-part email-node'></ul>");
         for (var i = 0; i < email.content.length; i++) {
-            createEmailTree(email.content[i], $emailNode);
+            createEmailTree(email.content[i], $emailNode, source);
         }
         $emailPart.append($emailNode);
     } else if (email.type == "plain") {
@@ -72,6 +76,18 @@ function createEmailTree(email, $base) {
         $emailPart = $("<li class='email-part email-plain'></li>");
         $emailPart.html(email.content);
 
+    } else if (email.type == "attachment" && email.attachment !== undefined) {
+        $emailPart = $("<li class='email-part email-attachment'></li>");
+        var $link = $("<a></a>").attr("href", getAttachmentUrl({
+            id: source.id,
+            uid: source.uid,
+            mailbox: source.mailbox,
+            section: email.attachment.section
+        }));
+        $link.text((email.attachment.filename || "attachment") + " (" +
+                   email.attachment.content_type + ", " + 
+                   Math.round(email.attachment.size / 1024) + " kB)");
+        $emailPart.append($link);
     }
     if ($emailPart !== undefined) {
         $base.append($emailPart);
@@ -4,7 +4,6 @@ import sys
 import inspect
 import ctypes
 import binascii
-import socket
 from datetime import datetime
 import pytz
 import functools
@@ -148,22 +147,3 @@ def utf7_encode(s):
         r.append('&{0}-'.format(utf16be_to_base64(''.join(other_chars))))
         del other_chars[:]
     return str(''.join(r))
-
-
-def imap_recvall(sock, timeout=5, buflen=1024):
-    data_recv = b''
-    prev_timeout = sock.gettimeout()
-    while True:
-        try:
-            sock.settimeout(timeout)
-            temp_recv = sock.recv(buflen)
-        except socket.timeout:
-            temp_recv = b""
-            break
-        if not temp_recv:
-            break
-        data_recv = data_recv + temp_recv
-        if temp_recv.endswith(b"\r\n"):
-            break
-    sock.settimeout(prev_timeout)
-    return data_recv
\ No newline at end of file
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+'''
+Microbenchmark of parsing FETCH responses with headers: the previous
+per-item regex + HeaderParser path against the single-pass tokenizer
+(app.mail.parser) used by ImapClient.get_headers (parse_headers).
+
+Usage: python benchmarks/fetch_parser.py [number of messages] [repeats]
+'''
+import os
+import re
+import sys
+import timeit
+
+from email.parser import HeaderParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from app.mail.client import parse_headers, default_decoders
+
+
+HEADER = (
+    b'Delivered-To: jago.eboard@gmail.com\r\n'
+    b'Received: by 10.107.5.205 with SMTP id 196csp1072501iof; '
+    b'Thu, 17 Nov 2016\r\n 12:28:05 -0800 (PST)\r\n'
+    b'From: CodinGame <coders@codingame.com>\r\n'
+    b'To: jago.eboard@gmail.com\r\n'
+    b'Subject: =?utf-8?B?S3VwIHNvYmllIGN6YXMgbmEgxZp3acSZdGEgPg==?=\r\n'
+    b'Date: Thu, 17 Nov 2016 20:28:04 +0000\r\n'
+    b'Message-ID: <0100015873f98ebf-a084f107@email.amazonses.com>\r\n'
+    b'MIME-Version: 1.0\r\n'
+    b'Content-Type: multipart/alternative; boundary="b1_4d1e05d2"\r\n'
+    b'\r\n'
+)
+
+
+def make_response(count):
+    '''Returns UID FETCH response as returned by imaplib.'''
+    data = list()
+    for seq in range(1, count + 1):
+        data.append((
+            b'%d (UID %d FLAGS (\\Seen) BODY[HEADER] {%d}' 
+                % (seq, seq + 1000, len(HEADER)),
+            HEADER
+        ))
+        data.append(b')')
+    return data
+
+
+def legacy_parse_headers(data, *, uid, flags, header_decoders):
+    '''Previous implementation of ImapClient.get_headers parsing.'''
+    headers = list()
+    parser = HeaderParser()
+    for item in data:
+        if item == b')': continue   
+        if isinstance(item, tuple): 
+            header = dict(parser.parsestr(
+                item[1].decode("ascii"), headersonly=True)
+            )
+            if uid:
+                pattern = re.compile(".*UID (?P<id>\\d+)")
+            else:
+                pattern = re.compile("(?P<id>\\d+)")
+            match_id = pattern.search(item[0].decode("ascii"))
+            header["id"] = int(match_id.group("id")) if match_id else None
+            if flags:
+                pattern = re.compile("FLAGS \\((?P<flags>.*)\\) ")
+                match_flags = pattern.search(item[0].decode("ascii"))
+                if match_flags:
+                    msg_flags = match_flags.group("flags").split(" ")
+                    header["Flags"] = [flag for flag in msg_flags
+                                       if flag != "" and flag != " "]
+            for key in header.keys():
+                header[key] = header_decoders.get(
+                            key.upper(), lambda x: x[key])(header)
+            headers.append(header)
+    return headers
+
+
+def main(count=500, repeats=20):
+    data = make_response(count)
+    cases = [
+        ("legacy", lambda: legacy_parse_headers(
+            data, uid=True, flags=True, header_decoders=default_decoders)),
+        ("tokenizer", lambda: parse_headers(
+            data, uid=True, flags=True, 
+            header_decoders=default_decoders)),
+        ("tokenizer (fields)", lambda: parse_headers(
+            data, uid=True, flags=True, 
+            header_decoders=default_decoders, 
+            fields={"SUBJECT", "FROM", "DATE"})),
+    ]
+    print("Parsing %d headers, best of %d runs:" % (count, repeats))
+    for name, func in cases:
+        best = min(timeit.repeat(func, number=1, repeat=repeats))
+        print("  %-20s %8.2f ms" % (name, best * 1000))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
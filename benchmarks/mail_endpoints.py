@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+'''
+Benchmark of /mail/* endpoints against the fake IMAP server (TLS, seeded
+with generated mailboxes, optional latency). Reports latency of the first
+(cold) request and percentiles and throughput of the following ones for
+each endpoint. Results can be saved and compared with a baseline, the
+script exits with status 1 when median latency of any endpoint regressed
+by more than the tolerance.
+
+Usage: python benchmarks/mail_endpoints.py [--messages N] [--latency S]
+           [--requests N] [--concurrency N] [--only NAME ...]
+           [--save FILE] [--baseline FILE] [--tolerance 0.25]
+'''
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from flask import url_for
+
+from config import config, TestingConfig
+from app import create_app
+from tests.mail.fake_server import (
+    FakeImapServer, Mailbox, self_signed_context
+)
+
+
+SEARCH_CRITERIA = json.dumps([{"key": "SUBJECT", "value": "report",
+                               "decode": True}])
+
+# name -> (endpoint, function(number of request, messages) -> arguments)
+ENDPOINTS = [
+    ("list", "mail.imap_list", lambda n, count: {}),
+    ("len_mailbox", "mail.imap_len_mailbox",
+     lambda n, count: {"mailbox": "INBOX"}),
+    ("list_mailbox", "mail.imap_list_mailbox",
+     lambda n, count: {"mailbox": "INBOX", "uid": "True"}),
+    ("get_headers (ranges)", "mail.imap_get_headers",
+     lambda n, count: {"mailbox": "INBOX", "ids_from": 1 + n * 50 % count,
+                       "ids_to": 50 + n * 50 % count}),
+    ("get_headers (page)", "mail.imap_get_headers",
+     lambda n, count: {"mailbox": "INBOX", "limit": 50}),
+    ("unified", "mail.imap_unified",
+     lambda n, count: {"mailbox": ["INBOX", "Sent", "Work"], "limit": 50}),
+    ("search", "mail.imap_search",
+     lambda n, count: {"mailbox": "INBOX", "uid": "True",
+                       "criteria": SEARCH_CRITERIA}),
+    ("get_email", "mail.imap_get_email",
+     lambda n, count: {"mailbox": "INBOX", "uid": "True",
+                       "id": 1 + n * 7 % count}),
+    ("get_raw_emails", "mail.imap_get_raw_emails",
+     lambda n, count: {"mailbox": "INBOX", "uid": "True",
+                       "ids": "%d:%d" % (1 + n * 10 % count,
+                                         10 + n * 10 % count)}),
+    ("attachment", "mail.imap_attachment",
+     lambda n, count: {"mailbox": "INBOX", "uid": "True", "section": "2",
+                       "id": 10 * (1 + n % (count // 10))}),
+    ("sync", "mail.imap_sync", lambda n, count: {"mailbox": "INBOX"}),
+]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Benchmark:
+    '''Runs requests of the flask app logged into the fake server.'''
+    def __init__(self, app, address, messages):
+        self.app = app
+        self.address = address
+        self.messages = messages
+
+    def client(self):
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session["imap_username"] = "jago"
+            session["imap_password"] = "secret"
+            session["imap_addr"] = self.address
+        return client
+
+    def request(self, client, endpoint, args):
+        with self.app.test_request_context():
+            url = url_for(endpoint)
+        start = time.perf_counter()
+        response = client.get(url, query_string=args)
+        data = response.get_data()
+        response.close()  # streamed responses return the connection
+        elapsed = time.perf_counter() - start
+        if response.mimetype == "application/json":
+            status = json.loads(data.decode("utf-8")).get("status")
+            if status != "OK":
+                raise RuntimeError("%s failed: %s" % (endpoint, data[:200]))
+        return elapsed
+
+    def run(self, name, endpoint, make_args, requests, concurrency):
+        clients = [self.client() for _ in range(concurrency)]
+        first = self.request(clients[0], endpoint, make_args(0, self.messages))
+
+        def work(worker):
+            return [self.request(clients[worker], endpoint,
+                                 make_args(n, self.messages))
+                    for n in range(1 + worker, requests + 1, concurrency)]
+
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            times = [elapsed for result in executor.map(work,
+                                                        range(concurrency))
+                             for elapsed in result]
+        total = time.perf_counter() - start
+        return dict(first=first, p50=percentile(times, 0.5),
+                    p95=percentile(times, 0.95), max=max(times),
+                    throughput=len(times) / total)
+
+
+def compare(results, baseline, tolerance):
+    '''Returns the list of endpoints whose median latency regressed.'''
+    regressions = list()
+    for name, result in results.items():
+        if name not in baseline: continue
+        if result["p50"] > baseline[name]["p50"] * (1 + tolerance):
+            regressions.append((name, baseline[name]["p50"], result["p50"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=10000,
+                        help="number of e-mails in INBOX (10k-200k)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to each round trip")
+    parser.add_argument("--requests", type=int, default=20,
+                        help="measured requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--only", nargs="*", help="names of endpoints")
+    parser.add_argument("--save", help="file for results (JSON)")
+    parser.add_argument("--baseline", help="results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    context, cert = self_signed_context()
+    server = FakeImapServer([
+        Mailbox("INBOX", args.messages),
+        Mailbox("Sent", args.messages // 10, seed=1, uidvalidity=2),
+        Mailbox("Work", args.messages // 20, seed=2, uidvalidity=3)
+    ], users={"jago": "secret"}, latency=args.latency, ssl_context=context)
+    host, port = server.start_in_thread()
+
+    config["benchmark"] = type("BenchmarkConfig", (TestingConfig,), dict(
+        IMAP_CA_FILE=cert, SQLALCHEMY_ECHO=False
+    ))
+    benchmark = Benchmark(create_app("benchmark"), "localhost:%d" % port,
+                          args.messages)
+
+    print("%d e-mails, latency %.0f ms, %d requests, concurrency %d" % (
+        args.messages, args.latency * 1000, args.requests, args.concurrency
+    ))
+    print("%-22s %9s %9s %9s %9s %9s" % ("endpoint", "first ms", "p50 ms",
+                                         "p95 ms", "max ms", "req/s"))
+    results = dict()
+    for name, endpoint, make_args in ENDPOINTS:
+        if args.only and name not in args.only: continue
+        result = benchmark.run(name, endpoint, make_args, args.requests,
+                               args.concurrency)
+        results[name] = result
+        print("%-22s %9.1f %9.1f %9.1f %9.1f %9.1f" % (
+            name, result["first"] * 1000, result["p50"] * 1000,
+            result["p95"] * 1000, result["max"] * 1000, result["throughput"]
+        ))
+    server.stop_thread()
+
+    if args.save:
+        with open(args.save, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as source:
+            regressions = compare(results, json.load(source), args.tolerance)
+        for name, before, after in regressions:
+            print("REGRESSION %s: p50 %.1f ms -> %.1f ms" % (
+                name, before * 1000, after * 1000
+            ))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,78 @@ class Config:
     SQLALCHEMY_ECHO = True
     TEMPLATES_AUTO_RELOAD = True
 
+    # Timeout of imap connections (set on each socket)
+    IMAP_TIMEOUT = 5 # seconds
+
+    # Pool of authenticated imap connections (see app.mail.pool)
+    IMAP_POOL_MAX_PER_ACCOUNT = 3
+    IMAP_POOL_IDLE_TIMEOUT = 300 # seconds
+    IMAP_POOL_CHECK_INTERVAL = 30 # seconds
+
+    # Cache of e-mails' headers, kept in SQLite when path is given
+    IMAP_HEADER_CACHE_SIZE = 10000
+    IMAP_HEADER_CACHE_PATH = None
+
+    # Raw e-mails kept on disk (directory) when path is given
+    IMAP_MESSAGE_STORE_PATH = None
+    IMAP_MESSAGE_STORE_SIZE = 256*1024*1024 # bytes
+
+    # Full-text index answering /mail/search (in memory when no path)
+    IMAP_SEARCH_INDEX_PATH = None
+    IMAP_SEARCH_INDEX_BATCH = 100 # e-mails indexed after single search
+    IMAP_SEARCH_INDEX_WORKERS = 1 # background threads indexing e-mails
+
+    # Dates of e-mails used for pagination by cursors (per mailbox)
+    IMAP_MAILBOX_INDEX_SIZE = 100 # mailboxes
+    IMAP_MAILBOX_INDEX_MAX_AGE = 30 # seconds
+
+    # Mailboxes with statuses returned by /mail/list (invalidated by changes)
+    IMAP_LIST_CACHE_TTL = 30 # seconds
+
+    # COMPRESS=DEFLATE (RFC 4978) of pooled connections when supported
+    IMAP_COMPRESS = True
+
+    # Certificates trusted by imap connections instead of system ones (e.g.
+    # self-signed certificate of tests.mail.fake_server)
+    IMAP_CA_FILE = None
+
+    # Instrumentation of imap commands (see app.mail.metrics): log lines,
+    # statistics in app.extensions["imap_stats"] and (debug) Server-Timing
+    # header of /mail/* responses listing commands of the request and
+    # /mail/stats returning the statistics
+    IMAP_METRICS_LOG = False
+    IMAP_METRICS_STATS = True
+    IMAP_DEBUG_HEADER = False
+
+    # Parallel fetches of several mailboxes (/mail/unified)
+    IMAP_FETCH_WORKERS = 8 # threads shared by all requests
+    IMAP_FETCH_MAX_PER_HOST = 6 # connections per imap server
+    IMAP_FETCH_TIMEOUT = 30 # seconds
+
+    # E-mails fetched by single command of /mail/get_raw_emails (streamed)
+    IMAP_RAW_EMAILS_CHUNK = 20
+
+    # Background prefetch after /mail/get_headers (opt-in): the next page of
+    # headers and the newest unseen e-mails of the page (display cache)
+    IMAP_PREFETCH = False
+    IMAP_PREFETCH_WORKERS = 2 # threads shared by all accounts
+    IMAP_PREFETCH_MAX_PER_ACCOUNT = 1 # connections
+    IMAP_PREFETCH_EMAILS = 3
+    IMAP_DISPLAY_CACHE_SIZE = 200 # prefetched for /mail/get_email
+
+    # Flags snapshots used by /mail/sync for servers without CONDSTORE
+    IMAP_SYNC_CACHE_SIZE = 100
+
+    # IDLE watchers feeding /mail/events
+    IMAP_IDLE_RENEW_INTERVAL = 25*60 # seconds
+    IMAP_IDLE_LINGER = 30 # seconds without subscribers before logout
+    IMAP_IDLE_RETRY_INTERVAL = 5 # seconds after failure, doubled up to max
+    IMAP_IDLE_MAX_RETRY_INTERVAL = 300 # also when IDLE is unsupported
+    IMAP_EVENTS_KEEPALIVE = 15 # seconds
+
+    # Octets of attachment fetched at once by /mail/attachment
+    IMAP_ATTACHMENT_CHUNK_SIZE = 256*1024
+
     @staticmethod
     def init_app(app):
         pass
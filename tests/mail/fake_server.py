@@ -0,0 +1,1030 @@
+'''
+Scriptable IMAP4rev1 server (asyncio) used by tests and benchmarks of the
+mail subsystem. Mailboxes are seeded with generated e-mails (multipart
+with html alternative, some with attachments and malformed dates) which
+are built on demand from (seed, uid), so mailboxes of hundreds of
+thousands of e-mails cost only their uids. Latency of the link is
+simulated by delaying every batch of received data (pipelined commands
+pay it once), handlers of commands can be replaced to script responses.
+
+Usage: python -m tests.mail.fake_server [--messages N] [--latency S] ...
+'''
+import argparse
+import asyncio
+import base64
+import bisect
+import datetime
+import fnmatch
+import functools
+import os
+import quopri
+import random
+import re
+import ssl
+import subprocess
+import tempfile
+import threading
+import zlib
+
+
+DEFAULT_CAPABILITIES = ("IMAP4rev1", "LITERAL+", "IDLE", "UIDPLUS", "MOVE",
+                        "SORT", "LIST-STATUS", "COMPRESS=DEFLATE", "ESEARCH")
+
+# Literal announced at the end of command line, e.g. b'SUBJECT {6}'.
+LITERAL_PATTERN = re.compile(rb"\{(?P<size>\d+)(?P<plus>\+?)\}$")
+
+TOKEN_PATTERN = re.compile(rb'\s*(?:(?P<open>[(\[])|(?P<close>[)\]])|'
+                           rb'"(?P<quoted>(?:[^"\\]|\\.)*)"|'
+                           rb'(?P<atom>[^\s()\[\]"]+))')
+
+WORDS = ("report", "meeting", "invoice", "lunch", "project", "deadline",
+         "update", "review", "budget", "holiday", "release", "question",
+         "weekly", "draft", "offer", "contract", "zażółć", "gęślą", "jaźń",
+         "plan", "notes", "team", "customer", "ticket", "server", "backup")
+NAMES = ("Ann Smith", "Jago", "Bob Brown", "Zoë Nowak", "Support Team",
+         "Newsletter", "Kasia Wiśniewska", "John Doe")
+
+FIRST_DATE = datetime.datetime(2015, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class CommandError(Exception):
+    '''Command is rejected with BAD (or NO when no is true).'''
+    def __init__(self, message, no=False):
+        super().__init__(message)
+        self.no = no
+
+
+def tokenize(data):
+    '''
+    Splits arguments of command into nested lists of tokens: str for atoms
+    and quoted strings, bytes for literals (given as Literal).
+    '''
+    stack = [list()]
+    position = 0
+    for part in data:
+        if isinstance(part, Literal):
+            stack[-1].append(bytes(part))
+            continue
+        position = 0
+        while position < len(part):
+            match = TOKEN_PATTERN.match(part, position)
+            if not match or match.end() == position:
+                break
+            position = match.end()
+            if match.group("open"):
+                if match.group("open") == b"[" and stack[-1] and \
+                   isinstance(stack[-1][-1], str):
+                    # BODY[...] is kept as single atom
+                    end = part.index(b"]", position)
+                    stack[-1][-1] += "[" + part[position:end].decode() + "]"
+                    position = end + 1
+                    while position < len(part) and part[position:position+1] \
+                          not in b" ()":
+                        stack[-1][-1] += chr(part[position])
+                        position += 1
+                    continue
+                stack.append(list())
+            elif match.group("close"):
+                if len(stack) > 1:
+                    value = stack.pop()
+                    stack[-1].append(value)
+            elif match.group("quoted") is not None:
+                stack[-1].append(re.sub(rb"\\(.)", rb"\1",
+                                        match.group("quoted")).decode())
+            else:
+                stack[-1].append(match.group("atom").decode())
+    return stack[0]
+
+
+def format_set(numbers):
+    '''Returns sequence set (e.g. "1:3,7") of sorted numbers.'''
+    ranges = list()
+    for number in numbers:
+        if ranges and ranges[-1][1] + 1 == number:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ",".join(str(first) if first == last else "%d:%d" % (first, last)
+                    for first, last in ranges)
+
+
+class Literal(bytes):
+    '''Data of literal sent after continuation request.'''
+
+
+def quote(value):
+    return '"%s"' % value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def encode_word(text):
+    '''Encodes non-ascii text of header as RFC 2047 encoded word.'''
+    try:
+        text.encode("ascii")
+        return text
+    except UnicodeEncodeError:
+        return "=?utf-8?b?%s?=" % base64.b64encode(
+            text.encode("utf-8")).decode("ascii")
+
+
+class Part:
+    '''Entity of generated e-mail: header and body (bytes) with children.'''
+    def __init__(self, maintype, subtype, body=b"", *, params=None,
+                 encoding="7bit", disposition=None, children=()):
+        self.maintype = maintype
+        self.subtype = subtype
+        self.params = params or dict()
+        self.encoding = encoding
+        self.disposition = disposition
+        self.children = list(children)
+        if self.children:
+            boundary = self.params["boundary"].encode("ascii")
+            body = b"".join(b"--" + boundary + b"\r\n" + child.header +
+                            child.body + b"\r\n" for child in self.children)
+            body += b"--" + boundary + b"--\r\n"
+        self.body = body
+        lines = ["Content-Type: %s/%s" % (maintype, subtype) + "".join(
+            '; %s="%s"' % item for item in self.params.items())]
+        if not self.children:
+            lines.append("Content-Transfer-Encoding: %s" % encoding)
+        if disposition:
+            lines.append('Content-Disposition: %s; filename="%s"'
+                         % disposition)
+        self.header = ("\r\n".join(lines) + "\r\n\r\n").encode("ascii")
+
+    def structure(self):
+        '''Returns BODYSTRUCTURE of the entity.'''
+        params = "(%s)" % " ".join(
+            "%s %s" % (quote(name.upper()), quote(value))
+            for name, value in self.params.items()
+        ) if self.params else "NIL"
+        if self.children:
+            return "(%s %s %s NIL NIL)" % (
+                "".join(child.structure() for child in self.children),
+                quote(self.subtype.upper()), params
+            )
+        fields = [quote(self.maintype.upper()), quote(self.subtype.upper()),
+                  params, "NIL", "NIL", quote(self.encoding.upper()),
+                  str(len(self.body))]
+        if self.maintype == "text":
+            fields.append(str(self.body.count(b"\n")))
+        disposition = "NIL"
+        if self.disposition:
+            disposition = "(%s (\"FILENAME\" %s))" % (
+                quote(self.disposition[0].upper()), quote(self.disposition[1])
+            )
+        fields += ["NIL", disposition, "NIL"]
+        return "(%s)" % " ".join(fields)
+
+    def find(self, numbers):
+        '''Returns part with given section numbers (e.g. [1, 2]).'''
+        part = self
+        for number in numbers:
+            if part.children:
+                if not 0 < number <= len(part.children):
+                    return None
+                part = part.children[number - 1]
+            elif number != 1:
+                return None
+        return part
+
+
+class Summary:
+    '''
+    Date, subject and sender of generated e-mail, cheap enough to answer
+    SORT, header SEARCH and INTERNALDATE of whole mailboxes.
+    '''
+    def __init__(self, seed, number):
+        rnd = random.Random(-(seed * 1000003 + number))
+        self.date = FIRST_DATE + datetime.timedelta(
+            minutes=number * 10 + rnd.randint(0, 9)
+        )
+        self.internaldate = self.date.strftime("%d-%b-%Y %H:%M:%S +0000")
+        self.subject = " ".join(rnd.choice(WORDS)
+                                for _ in range(rnd.randint(2, 6))).capitalize()
+        self.sender = rnd.choice(NAMES)
+
+
+class Message:
+    '''Generated e-mail (deterministic for given seed and number).'''
+    def __init__(self, seed, number):
+        summary = generate_summary(seed, number)
+        self.internaldate = summary.internaldate
+        self.subject = summary.subject
+        self.sender = summary.sender
+        address = self.sender.split()[0].lower() + "@example.com"
+        if number % 50 == 0:
+            date_field = "Someday"  # malformed dates occur in real mailboxes
+        else:
+            date_field = summary.date.strftime("%a, %d %b %Y %H:%M:%S +0000")
+        rnd = random.Random(seed * 1000003 + number)
+        paragraphs = [" ".join(rnd.choice(WORDS) for _ in range(40)).capitalize()
+                      for _ in range(rnd.randint(1, 6))]
+        self.text = "\n\n".join(paragraphs)
+
+        plain = Part("text", "plain", self.text.replace("\n", "\r\n").encode(
+            "utf-8") + b"\r\n", params={"charset": "utf-8"}, encoding="8bit")
+        html = "<html><body>%s</body></html>" % "".join(
+            "<p>%s</p>" % paragraph for paragraph in paragraphs)
+        html = Part("text", "html", quopri.encodestring(
+            html.encode("utf-8")).replace(b"\n", b"\r\n") + b"\r\n",
+            params={"charset": "utf-8"}, encoding="quoted-printable")
+        kind = number % 10
+        if kind >= 7:
+            root = plain
+        else:
+            root = Part("multipart", "alternative", children=[plain, html],
+                        params={"boundary": "alt-%d" % number})
+            if kind == 0:
+                content = rnd.getrandbits(6000 * 8).to_bytes(6000, "little")
+                attachment = Part(
+                    "application", "pdf", base64.encodebytes(content).replace(
+                        b"\n", b"\r\n"), params={"name": "report.pdf"},
+                    encoding="base64", disposition=("attachment", "report.pdf")
+                )
+                root = Part("multipart", "mixed", children=[root, attachment],
+                            params={"boundary": "mix-%d" % number})
+        header = [
+            "From: %s <%s>" % (encode_word(self.sender), address),
+            "To: Jago <jago@example.com>",
+            "Subject: %s" % encode_word(self.subject),
+            "Date: %s" % date_field,
+            "Message-ID: <%d.%d@example.com>" % (seed, number),
+            "MIME-Version: 1.0"
+        ]
+        self.root = root
+        self.header = ("\r\n".join(header) + "\r\n").encode("utf-8") + \
+                      root.header
+        self.raw = self.header + root.body
+
+    def section(self, name):
+        '''Returns content of BODY[name] or None.'''
+        upper = name.upper()
+        if upper == "":
+            return self.raw
+        if upper == "HEADER":
+            return self.header
+        if upper == "TEXT":
+            return self.root.body
+        if upper.startswith("HEADER.FIELDS"):
+            match = re.match(r"HEADER\.FIELDS(\.NOT)?\s*\((.*)\)$", upper)
+            if not match:
+                return None
+            names = set(match.group(2).split())
+            lines = re.split(rb"\r\n(?![ \t])", self.header.rstrip(b"\r\n"))
+            selected = [line for line in lines if (line.split(b":")[0].decode(
+                "ascii").upper() in names) != bool(match.group(1))]
+            return b"".join(line + b"\r\n" for line in selected) + b"\r\n"
+        numbers, mime, _ = upper.partition(".MIME")
+        try:
+            part = self.root.find([int(number)
+                                   for number in numbers.split(".")])
+        except ValueError:
+            return None
+        if part is None:
+            return None
+        return part.header if mime else part.body
+
+    def search_text(self, key):
+        if key == "BODY": return self.text
+        return " ".join((self.subject, self.sender, self.text))
+
+
+@functools.lru_cache(maxsize=2**18)
+def generate_summary(seed, number):
+    return Summary(seed, number)
+
+@functools.lru_cache(maxsize=4096)
+def generate_message(seed, number):
+    return Message(seed, number)
+
+
+class Mailbox:
+    '''
+    Mailbox of the fake server. Generated e-mails have uids 1..count, other
+    e-mails (copied or delivered) are remembered by their (seed, number).
+    '''
+    def __init__(self, name, count=0, *, seed=0, uidvalidity=1):
+        self.name = name
+        self.seed = seed
+        self.uidvalidity = uidvalidity
+        self.uids = list(range(1, count + 1))
+        self.uidnext = count + 1
+        self.sources = dict()  # uid -> (seed, number) of copied e-mails
+        self.flags = dict()  # uid -> set of flags (when not default)
+
+    def message(self, uid):
+        return generate_message(*self.source(uid))
+
+    def summary(self, uid):
+        return generate_summary(*self.source(uid))
+
+    def search_text(self, uid, key):
+        '''Returns text matched by SEARCH key (e.g. SUBJECT) of e-mail.'''
+        if key == "SUBJECT": return self.summary(uid).subject
+        if key == "FROM": return self.summary(uid).sender
+        if key == "TO": return "Jago jago@example.com"
+        return self.message(uid).search_text(key)
+
+    def get_flags(self, uid):
+        if uid not in self.flags:
+            number = self.sources.get(uid, (self.seed, uid))[1]
+            flags = set()
+            if number % 3: flags.add("\\Seen")
+            if number % 17 == 0: flags.add("\\Flagged")
+            return flags
+        return self.flags[uid]
+
+    def add(self, source):
+        '''Adds e-mail given by (seed, number), returns its uid.'''
+        uid = self.uidnext
+        self.uidnext += 1
+        self.uids.append(uid)
+        if source != (self.seed, uid):
+            self.sources[uid] = source
+        return uid
+
+    def source(self, uid):
+        return self.sources.get(uid, (self.seed, uid))
+
+    def remove(self, uids):
+        '''Removes e-mails, returns their sequence numbers (descending).'''
+        uids = set(uids)
+        removed = [seq for seq, uid in enumerate(self.uids, 1) if uid in uids]
+        self.uids = [uid for uid in self.uids if uid not in uids]
+        for uid in uids:
+            self.flags.pop(uid, None)
+            self.sources.pop(uid, None)
+        return list(reversed(removed))
+
+    def resolve(self, sequence_set, uid=False):
+        '''Returns [(seq, uid)] of e-mails in the sequence set.'''
+        if not self.uids:
+            return list()
+        result = set()
+        last = self.uids[-1] if uid else len(self.uids)
+        for item in sequence_set.split(","):
+            start, _, end = item.partition(":")
+            try:
+                start = last if start == "*" else int(start)
+                end = start if not _ else (last if end == "*" else int(end))
+            except ValueError:
+                raise CommandError("Invalid sequence set") from None
+            start, end = min(start, end), max(start, end)
+            if uid:
+                low = bisect.bisect_left(self.uids, start)
+                high = bisect.bisect_right(self.uids, end)
+                result.update(range(low + 1, high + 1))
+            else:
+                result.update(range(max(start, 1),
+                                    min(end, len(self.uids)) + 1))
+        return [(seq, self.uids[seq - 1]) for seq in sorted(result)]
+
+
+class Session:
+    '''State of single connection.'''
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.state = "NONAUTH"
+        self.mailbox = None
+        self.readonly = False
+        self.compressor = None
+        self.decompressor = None
+        self.buffer = b""
+        self.pending = list()  # lines queued for the idling client
+        self.task = None
+
+    def write(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data) + \
+                   self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.writer.write(data)
+
+    def send(self, *lines):
+        self.write(b"".join((line if isinstance(line, bytes)
+                             else line.encode("utf-8")) + b"\r\n"
+                            for line in lines))
+
+    async def fill(self):
+        '''Reads next chunk of data (simulating latency of the link).'''
+        data = await self.reader.read(65536)
+        if not data:
+            raise ConnectionError("connection closed by client")
+        if self.server.latency:
+            await asyncio.sleep(self.server.latency)
+        if self.decompressor is not None:
+            data = self.decompressor.decompress(data)
+        self.buffer += data
+
+    async def read_line(self):
+        while b"\r\n" not in self.buffer:
+            await self.fill()
+        line, self.buffer = self.buffer.split(b"\r\n", 1)
+        return line
+
+    async def read_command(self):
+        '''Returns the list of parts of command (lines and Literals).'''
+        parts = list()
+        while True:
+            line = await self.read_line()
+            match = LITERAL_PATTERN.search(line)
+            if not match:
+                parts.append(line)
+                return parts
+            parts.append(line[:match.start()])
+            if not match.group("plus"):
+                self.send("+ Ready for literal data")
+                await self.writer.drain()
+            size = int(match.group("size"))
+            while len(self.buffer) < size:
+                await self.fill()
+            parts.append(Literal(self.buffer[:size]))
+            self.buffer = self.buffer[size:]
+
+    def selected(self):
+        if self.state != "SELECTED":
+            raise CommandError("No mailbox selected")
+        return self.server.mailboxes[self.mailbox]
+
+
+class FakeImapServer:
+    '''
+    IMAP4rev1 server for tests and benchmarks.
+
+    mailboxes - list of Mailbox (INBOX is created when missing)
+    users - dictionary {username: password}, any login accepted when None
+    latency - seconds added to every batch of data received from client
+    command_latency - dictionary {command: seconds} of processing time
+    capabilities - advertised capabilities (extensions can be disabled)
+    handlers - dictionary {command: function(session, tag, uid, args)}
+               replacing built-in handlers (function sends the responses,
+               it may be a coroutine)
+    ssl_context - server context (see self_signed_context) or None
+    '''
+    def __init__(self, mailboxes=(), *, users=None, latency=0.0,
+                 command_latency=None, capabilities=DEFAULT_CAPABILITIES,
+                 handlers=None, ssl_context=None):
+        self.mailboxes = {mailbox.name: mailbox for mailbox in mailboxes}
+        self.mailboxes.setdefault("INBOX", Mailbox("INBOX"))
+        self.users = users
+        self.latency = latency
+        self.command_latency = command_latency or dict()
+        self.capabilities = tuple(capabilities)
+        self.handlers = handlers or dict()
+        self.ssl_context = ssl_context
+        self.sessions = set()
+        self.commands = list()  # (name, arguments) of received commands
+        self._server = None
+        self._loop = None
+        self._thread = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        '''Starts listening, returns (host, port).'''
+        self._loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(
+            self._serve, host, port, ssl=self.ssl_context, limit=2**20
+        )
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def close(self):
+        self._server.close()
+        tasks = [session.task for session in self.sessions]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._server.wait_closed()
+
+    def start_in_thread(self, host="127.0.0.1", port=0):
+        '''Runs the server in event loop of daemon thread.'''
+        started = threading.Event()
+        result = dict()
+
+        def run():
+            loop = asyncio.new_event_loop()
+            result["address"] = loop.run_until_complete(self.start(host, port))
+            started.set()
+            loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return result["address"]
+
+    def stop_thread(self):
+        future = asyncio.run_coroutine_threadsafe(self.close(), self._loop)
+        future.result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def deliver(self, mailbox, count=1):
+        '''
+        Adds generated e-mails to the mailbox (thread-safe), idling clients
+        get EXISTS. Returns uids of new e-mails.
+        '''
+        def add():
+            target = self.mailboxes[mailbox]
+            uids = [target.add((target.seed, target.uidnext))
+                    for _ in range(count)]
+            for session in self.sessions:
+                if session.mailbox == mailbox:
+                    session.pending.append("* %d EXISTS" % len(target.uids))
+            return uids
+        if self._loop is not None and self._thread is not None:
+            async def run(): return add()
+            return asyncio.run_coroutine_threadsafe(run(), self._loop).result()
+        return add()
+
+    async def _serve(self, reader, writer):
+        session = Session(self, reader, writer)
+        session.task = asyncio.current_task()
+        self.sessions.add(session)
+        try:
+            session.send("* OK [CAPABILITY %s] Fake IMAP ready"
+                         % " ".join(self.capabilities))
+            await writer.drain()
+            while True:
+                parts = await session.read_command()
+                if not await self._dispatch(session, parts):
+                    break
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ssl.SSLError,
+                asyncio.CancelledError):
+            pass  # closed by client or by the server
+        finally:
+            self.sessions.discard(session)
+            writer.close()
+
+    async def _dispatch(self, session, parts):
+        '''Runs single command, returns False after LOGOUT.'''
+        line = parts[0]
+        tag, _, rest = line.partition(b" ")
+        tag = tag.decode("ascii", "replace")
+        args = tokenize([rest] + parts[1:])
+        if not args or not isinstance(args[0], str):
+            session.send("%s BAD Missing command" % tag)
+            return True
+        name = args.pop(0).upper()
+        uid = False
+        if name == "UID" and args:
+            uid = True
+            name = str(args.pop(0)).upper()
+        self.commands.append((("UID " if uid else "") + name, args))
+        delay = self.command_latency.get(name, 0)
+        if delay:
+            await asyncio.sleep(delay)
+
+        handler = self.handlers.get(name, None) or \
+                  getattr(self, "do_" + name.lower(), None)
+        if handler is None:
+            session.send("%s BAD Unknown command %s" % (tag, name))
+            return True
+        try:
+            result = handler(session, tag, uid, args)
+            if asyncio.iscoroutine(result):
+                result = await result
+        except CommandError as e:
+            session.send("%s %s %s" % (tag, "NO" if e.no else "BAD", e))
+        except (IndexError, ValueError, TypeError, KeyError) as e:
+            session.send("%s BAD Invalid arguments: %s" % (tag, e))
+        if session.pending:
+            session.send(*session.pending)
+            session.pending = list()
+        return name != "LOGOUT"
+
+    # Handlers of commands (they send untagged and tagged responses).
+
+    def do_capability(self, session, tag, uid, args):
+        session.send("* CAPABILITY " + " ".join(self.capabilities),
+                     "%s OK CAPABILITY completed" % tag)
+
+    def do_noop(self, session, tag, uid, args):
+        if session.pending:
+            session.send(*session.pending)
+            session.pending = list()
+        session.send("%s OK NOOP completed" % tag)
+
+    do_check = do_noop
+
+    def do_login(self, session, tag, uid, args):
+        username, password = args[0], args[1]
+        if self.users is not None and self.users.get(username) != password:
+            raise CommandError("[AUTHENTICATIONFAILED] Invalid credentials",
+                               no=True)
+        session.state = "AUTH"
+        session.send("%s OK [CAPABILITY %s] Logged in"
+                     % (tag, " ".join(self.capabilities)))
+
+    def do_logout(self, session, tag, uid, args):
+        session.send("* BYE Logging out", "%s OK LOGOUT completed" % tag)
+
+    def do_enable(self, session, tag, uid, args):
+        session.send("* ENABLED", "%s OK ENABLE completed" % tag)
+
+    def do_compress(self, session, tag, uid, args):
+        if "COMPRESS=DEFLATE" not in self.capabilities:
+            raise CommandError("Unknown command COMPRESS")
+        if session.compressor is not None:
+            raise CommandError("[COMPRESSIONACTIVE] Already compressed",
+                               no=True)
+        session.send("%s OK DEFLATE active" % tag)
+        session.compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        session.decompressor = zlib.decompressobj(-15)
+        if session.buffer:  # data pipelined after COMPRESS
+            session.buffer = session.decompressor.decompress(session.buffer)
+
+    def do_select(self, session, tag, uid, args, readonly=False):
+        name = args[0]
+        if name.upper() == "INBOX":
+            name = "INBOX"
+        if name not in self.mailboxes:
+            session.state = "AUTH"
+            session.mailbox = None
+            raise CommandError("Mailbox does not exist", no=True)
+        mailbox = self.mailboxes[name]
+        session.state = "SELECTED"
+        session.mailbox = name
+        session.readonly = readonly
+        session.send(
+            "* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)",
+            "* %d EXISTS" % len(mailbox.uids), "* 0 RECENT",
+            "* OK [UIDVALIDITY %d] UIDs valid" % mailbox.uidvalidity,
+            "* OK [UIDNEXT %d] Predicted next UID" % mailbox.uidnext,
+            "%s OK [%s] %s completed" % (
+                tag, "READ-ONLY" if readonly else "READ-WRITE",
+                "EXAMINE" if readonly else "SELECT"
+            )
+        )
+
+    def do_examine(self, session, tag, uid, args):
+        self.do_select(session, tag, uid, args, readonly=True)
+
+    def do_close(self, session, tag, uid, args):
+        session.state = "AUTH"
+        session.mailbox = None
+        session.send("%s OK CLOSE completed" % tag)
+
+    def do_list(self, session, tag, uid, args):
+        pattern = (args[0] + args[1]).replace("%", "*")
+        status_items = None
+        if len(args) > 3 and str(args[2]).upper() == "RETURN":
+            options = args[3]
+            if "STATUS" in [str(option).upper() for option in options]:
+                status_items = options[options.index("STATUS") + 1]
+        lines = list()
+        for name in self.mailboxes:
+            if not fnmatch.fnmatchcase(name, pattern): continue
+            lines.append('* LIST (\\HasNoChildren) "/" %s' % quote(name))
+            if status_items is not None:
+                lines.append(self._status_line(name, status_items))
+        session.send(*lines, "%s OK LIST completed" % tag)
+
+    def _status_line(self, name, items):
+        mailbox = self.mailboxes[name]
+        values = dict(
+            MESSAGES=len(mailbox.uids), RECENT=0, UIDNEXT=mailbox.uidnext,
+            UIDVALIDITY=mailbox.uidvalidity,
+            UNSEEN=sum(1 for uid in mailbox.uids
+                       if "\\Seen" not in mailbox.get_flags(uid))
+        )
+        return "* STATUS %s (%s)" % (quote(name), " ".join(
+            "%s %d" % (item.upper(), values[item.upper()]) for item in items
+        ))
+
+    def do_status(self, session, tag, uid, args):
+        if args[0] not in self.mailboxes:
+            raise CommandError("Mailbox does not exist", no=True)
+        session.send(self._status_line(args[0], args[1]),
+                     "%s OK STATUS completed" % tag)
+
+    def do_create(self, session, tag, uid, args):
+        if args[0] in self.mailboxes:
+            raise CommandError("Mailbox already exists", no=True)
+        self.mailboxes[args[0]] = Mailbox(args[0],
+                                          uidvalidity=len(self.mailboxes) + 1)
+        session.send("%s OK CREATE completed" % tag)
+
+    def do_delete(self, session, tag, uid, args):
+        if args[0] not in self.mailboxes or args[0] == "INBOX":
+            raise CommandError("Mailbox can not be deleted", no=True)
+        del self.mailboxes[args[0]]
+        session.send("%s OK DELETE completed" % tag)
+
+    def do_rename(self, session, tag, uid, args):
+        if args[0] not in self.mailboxes or args[1] in self.mailboxes:
+            raise CommandError("Mailbox can not be renamed", no=True)
+        mailbox = self.mailboxes.pop(args[0])
+        mailbox.name = args[1]
+        self.mailboxes[args[1]] = mailbox
+        session.send("%s OK RENAME completed" % tag)
+
+    def _search(self, mailbox, args, uid):
+        '''Returns [(seq, uid)] of e-mails which meet the criteria.'''
+        if args and str(args[0]).upper() == "CHARSET":
+            args = args[2:]
+        matches = mailbox.resolve("1:*")
+        position = 0
+        while position < len(args):
+            key = args[position]
+            position += 1
+            if isinstance(key, list):
+                continue
+            upper = key.upper()
+            if upper == "ALL":
+                continue
+            elif upper in ("SEEN", "UNSEEN", "FLAGGED", "UNFLAGGED",
+                           "DELETED", "UNDELETED"):
+                present = not upper.startswith("UN")
+                flag = "\\" + (upper if present else upper[2:]).capitalize()
+                matches = [item for item in matches if
+                           (flag in mailbox.get_flags(item[1])) == present]
+            elif upper in ("SUBJECT", "FROM", "TO", "BODY", "TEXT"):
+                value = args[position]
+                position += 1
+                if isinstance(value, bytes):
+                    value = value.decode("utf-8")
+                value = value.lower()
+                matches = [item for item in matches if value in
+                           mailbox.search_text(item[1], upper).lower()]
+            elif upper == "UID":
+                allowed = set(mailbox.resolve(args[position], uid=True))
+                position += 1
+                matches = [item for item in matches if item in allowed]
+            elif re.match(r"^[\d:*,]+$", key):
+                allowed = set(mailbox.resolve(key))
+                matches = [item for item in matches if item in allowed]
+            else:
+                raise CommandError("Unsupported search key %s" % key)
+        return matches
+
+    def do_search(self, session, tag, uid, args):
+        mailbox = session.selected()
+        if args and str(args[0]).upper() == "RETURN":
+            if "ESEARCH" not in self.capabilities:
+                raise CommandError("Unknown search key RETURN")
+            options = [option.upper() for option in args[1]]
+            matches = self._search(mailbox, args[2:], uid)
+            numbers = [item[1 if uid else 0] for item in matches]
+            session.send(self._esearch(tag, uid, options, numbers),
+                         "%s OK SEARCH completed" % tag)
+            return
+        matches = self._search(mailbox, args, uid)
+        session.send("* SEARCH" + "".join(" %d" % item[1 if uid else 0]
+                                          for item in matches),
+                     "%s OK SEARCH completed" % tag)
+
+    def _esearch(self, tag, uid, options, numbers):
+        '''Returns ESEARCH response (RFC 4731, PARTIAL of RFC 9394).'''
+        response = '* ESEARCH (TAG "%s")' % tag + (" UID" if uid else "")
+        if numbers and "MIN" in options:
+            response += " MIN %d" % numbers[0]
+        if numbers and "MAX" in options:
+            response += " MAX %d" % numbers[-1]
+        if "COUNT" in options:
+            response += " COUNT %d" % len(numbers)
+        if numbers and "ALL" in options:
+            response += " ALL " + format_set(numbers)
+        if "PARTIAL" in options:
+            if "PARTIAL" not in self.capabilities:
+                raise CommandError("Unknown return option PARTIAL")
+            partial = options[options.index("PARTIAL") + 1]
+            first, last = sorted((int(item) for item in partial.split(":")),
+                                 key=abs)
+            if first < 0:
+                part = numbers[max(len(numbers) + last, 0):
+                               len(numbers) + first + 1]
+            else:
+                part = numbers[first - 1:last]
+            response += " PARTIAL (%s %s)" % (partial,
+                                              format_set(part) or "NIL")
+        return response
+
+    def do_sort(self, session, tag, uid, args):
+        if "SORT" not in self.capabilities:
+            raise CommandError("Unknown command SORT")
+        mailbox = session.selected()
+        criteria = [key.upper() for key in args[0]]
+        matches = self._search(mailbox, args[2:], uid)
+        reverse = False
+        keys = list()
+        for key in criteria:
+            if key == "REVERSE":
+                reverse = True
+                continue
+            if key not in ("DATE", "ARRIVAL"):
+                raise CommandError("Unsupported sort key %s" % key)
+            keys.append(reverse)
+            reverse = False
+
+        def date(item):
+            return mailbox.summary(item[1]).date
+        matches.sort(key=lambda item: item[0])
+        for reverse in reversed(keys):
+            matches.sort(key=date, reverse=reverse)
+        session.send("* SORT" + "".join(" %d" % item[1 if uid else 0]
+                                        for item in matches),
+                     "%s OK SORT completed" % tag)
+
+    def _fetch_items(self, items):
+        if isinstance(items, str):
+            items = dict(ALL=["FLAGS", "INTERNALDATE", "RFC822.SIZE"],
+                         FAST=["FLAGS", "INTERNALDATE", "RFC822.SIZE"],
+                         FULL=["FLAGS", "INTERNALDATE", "RFC822.SIZE",
+                               "BODYSTRUCTURE"]).get(items.upper(), [items])
+        return list(items)
+
+    def do_fetch(self, session, tag, uid, args):
+        mailbox = session.selected()
+        items = self._fetch_items(args[1])
+        if uid and "UID" not in [item.upper() for item in items]:
+            items.insert(0, "UID")
+        for seq, msg_uid in mailbox.resolve(args[0], uid=uid):
+            parts = list()
+            for item in items:
+                parts.append(self._fetch_item(session, mailbox, msg_uid, item))
+            session.write(b"* %d FETCH (" % seq + b" ".join(parts) + b")\r\n")
+        session.send("%s OK FETCH completed" % tag)
+
+    def _fetch_item(self, session, mailbox, uid, item):
+        upper = item.upper()
+        if upper == "UID":
+            return b"UID %d" % uid
+        if upper == "FLAGS":
+            return ("FLAGS (%s)" % " ".join(sorted(
+                mailbox.get_flags(uid)))).encode("ascii")
+        if upper == "INTERNALDATE":
+            return ('INTERNALDATE "%s"' % mailbox.summary(uid).internaldate
+                    ).encode()
+        message = mailbox.message(uid)
+        if upper == "RFC822.SIZE":
+            return b"RFC822.SIZE %d" % len(message.raw)
+        if upper == "BODYSTRUCTURE":
+            return b"BODYSTRUCTURE " + message.root.structure().encode()
+        if upper in ("RFC822", "RFC822.HEADER", "RFC822.TEXT"):
+            content = dict(RFC822=message.raw, **{
+                "RFC822.HEADER": message.header,
+                "RFC822.TEXT": message.root.body
+            })[upper]
+            if upper != "RFC822.HEADER":
+                self._mark_seen(session, mailbox, uid)
+            return upper.encode() + b" {%d}\r\n" % len(content) + content
+        match = re.match(r"^BODY(\.PEEK)?\[(.*)\](?:<(\d+)\.(\d+)>)?$",
+                         item, re.IGNORECASE)
+        if not match:
+            raise CommandError("Unsupported fetch item %s" % item)
+        content = message.section(match.group(2))
+        if content is None:
+            content = b""
+        name = "BODY[%s]" % match.group(2)
+        if match.group(3) is not None:
+            offset = int(match.group(3))
+            content = content[offset:offset + int(match.group(4))]
+            name += "<%d>" % offset
+        if not match.group(1):
+            self._mark_seen(session, mailbox, uid)
+        return name.encode() + b" {%d}\r\n" % len(content) + content
+
+    def _mark_seen(self, session, mailbox, uid):
+        if not session.readonly:
+            mailbox.flags[uid] = mailbox.get_flags(uid) | {"\\Seen"}
+
+    def do_store(self, session, tag, uid, args):
+        mailbox = session.selected()
+        if session.readonly:
+            raise CommandError("Mailbox is read-only", no=True)
+        command = args[1].upper()
+        flags = set(args[2] if isinstance(args[2], list) else args[2:])
+        lines = list()
+        for seq, msg_uid in mailbox.resolve(args[0], uid=uid):
+            current = mailbox.get_flags(msg_uid)
+            if command.startswith("+"):
+                current = current | flags
+            elif command.startswith("-"):
+                current = current - flags
+            else:
+                current = set(flags)
+            mailbox.flags[msg_uid] = current
+            if not command.endswith(".SILENT"):
+                lines.append("* %d FETCH (%sFLAGS (%s))" % (
+                    seq, "UID %d " % msg_uid if uid else "",
+                    " ".join(sorted(current))
+                ))
+        session.send(*lines, "%s OK STORE completed" % tag)
+
+    def _copy(self, session, uid, args):
+        mailbox = session.selected()
+        if args[1] not in self.mailboxes:
+            raise CommandError("[TRYCREATE] Mailbox does not exist", no=True)
+        target = self.mailboxes[args[1]]
+        pairs = list()
+        for seq, msg_uid in mailbox.resolve(args[0], uid=uid):
+            new_uid = target.add(mailbox.source(msg_uid))
+            target.flags[new_uid] = set(mailbox.get_flags(msg_uid))
+            pairs.append((msg_uid, new_uid))
+        code = ""
+        if pairs and "UIDPLUS" in self.capabilities:
+            code = "[COPYUID %d %s %s] " % (
+                target.uidvalidity,
+                ",".join(str(source) for source, _ in pairs),
+                ",".join(str(dest) for _, dest in pairs)
+            )
+        return mailbox, pairs, code
+
+    def do_copy(self, session, tag, uid, args):
+        mailbox, pairs, code = self._copy(session, uid, args)
+        session.send("%s OK %sCOPY completed" % (tag, code))
+
+    def do_move(self, session, tag, uid, args):
+        if "MOVE" not in self.capabilities:
+            raise CommandError("Unknown command MOVE")
+        mailbox, pairs, code = self._copy(session, uid, args)
+        lines = ["* OK %sMoved" % code] if code else []
+        lines += ["* %d EXPUNGE" % seq
+                  for seq in mailbox.remove(source for source, _ in pairs)]
+        session.send(*lines, "%s OK MOVE completed" % tag)
+
+    def do_expunge(self, session, tag, uid, args):
+        mailbox = session.selected()
+        deleted = [msg_uid for _, msg_uid in mailbox.resolve("1:*")
+                   if "\\Deleted" in mailbox.get_flags(msg_uid)]
+        if uid:
+            allowed = set(msg_uid for _, msg_uid
+                          in mailbox.resolve(args[0], uid=True))
+            deleted = [msg_uid for msg_uid in deleted if msg_uid in allowed]
+        session.send(*["* %d EXPUNGE" % seq
+                       for seq in mailbox.remove(deleted)],
+                     "%s OK EXPUNGE completed" % tag)
+
+    async def do_idle(self, session, tag, uid, args):
+        session.send("+ idling")
+        await session.writer.drain()
+        idle = asyncio.ensure_future(session.read_line())
+        while True:
+            done, _ = await asyncio.wait([idle], timeout=0.05)
+            if session.pending:
+                session.send(*session.pending)
+                session.pending = list()
+                await session.writer.drain()
+            if done:
+                break
+        if idle.result().upper() != b"DONE":
+            raise CommandError("Expected DONE")
+        session.send("%s OK IDLE terminated" % tag)
+
+
+def self_signed_context(directory=None):
+    '''
+    Returns pair (server context, path of the certificate) with
+    self-signed certificate of localhost (generated by openssl).
+    '''
+    directory = directory or tempfile.mkdtemp(prefix="fake-imap-")
+    cert = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    if not os.path.exists(cert):
+        subprocess.run([
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+            "-keyout", key, "-out", cert, "-days", "7", "-subj",
+            "/CN=localhost", "-addext",
+            "subjectAltName=DNS:localhost,IP:127.0.0.1"
+        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    return context, cert
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9993)
+    parser.add_argument("--messages", type=int, default=10000,
+                        help="number of e-mails in INBOX")
+    parser.add_argument("--mailboxes", type=int, default=3,
+                        help="number of additional mailboxes")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to each round trip")
+    parser.add_argument("--plain", action="store_true",
+                        help="do not use TLS")
+    args = parser.parse_args()
+
+    mailboxes = [Mailbox("INBOX", args.messages)] + [
+        Mailbox("Folder%d" % number, args.messages // 10, seed=number,
+                uidvalidity=number + 1)
+        for number in range(1, args.mailboxes + 1)
+    ]
+    context, cert = (None, None) if args.plain else self_signed_context()
+    server = FakeImapServer(mailboxes, latency=args.latency,
+                            ssl_context=context)
+
+    async def run():
+        host, port = await server.start(args.host, args.port)
+        print("Listening on %s:%d%s" % (host, port, " (certificate: %s)"
+                                       % cert if cert else ""))
+        await asyncio.Event().wait()
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,8 @@ copy2 = ('NO', [b'[TRYCREATE] No folder [Gmail]/Spa2m (Failure)'])
 
 fetch = ('OK', [(b'2043 (BODY[HEADER.FIELDS (DATE SUBJECT FROM)] {123}', b'From: CodinGame <coders@codingame.com>\r\nSubject: New on CodinGame: Check it out!\r\nDate: Thu, 17 Nov 2016 20:28:04 +0000\r\n\r\n'), b')'])
 
+fetch_uid = ('OK', [(b'2043 (UID 2043 BODY[HEADER.FIELDS (SUBJECT FROM)] {87}', b'From: CodinGame <coders@codingame.com>\r\nSubject: New on CodinGame: Check it out!\r\n\r\n'), b')'])
+
 fetch2 = ('OK', [(b'2043 (BODY[HEADER] {2603}', b'Delivered-To: jago.eboard@gmail.com\r\nReceived: by 10.107.5.205 with SMTP id 196csp1072501iof; Thu, 17 Nov 2016\r\n 12:28:05 -0800 (PST)\r\nX-Received: by 10.55.91.193 with SMTP id p184mr5562808qkb.301.1479414485455;\r\n Thu, 17 Nov 2016 12:28:05 -0800 (PST)\r\nReturn-Path: <0100015873f98ebf-a084f107-f9bf-4f8a-b621-394d12755ba6-000000@amazonses.com>\r\nReceived: from a11-98.smtp-out.amazonses.com (a11-98.smtp-out.amazonses.com.\r\n [54.240.11.98]) by mx.google.com with ESMTPS id\r\n d200si3009645qke.121.2016.11.17.12.28.05 for <jago.eboard@gmail.com>\r\n (version=TLS1 cipher=ECDHE-RSA-AES128-SHA bits=128/128); Thu, 17 Nov 2016\r\n 12:28:05 -0800 (PST)\r\nReceived-SPF: pass (google.com: domain of\r\n 0100015873f98ebf-a084f107-f9bf-4f8a-b621-394d12755ba6-000000@amazonses.com\r\n designates 54.240.11.98 as permitted sender) client-ip=54.240.11.98;\r\nAuthentication-Results: mx.google.com; dkim=pass header.i=@codingame.com;\r\n dkim=pass header.i=@amazonses.com; spf=pass (google.com: domain of\r\n 0100015873f98ebf-a084f107-f9bf-4f8a-b621-394d12755ba6-000000@amazonses.com\r\n designates 54.240.11.98 as permitted sender)\r\n smtp.mailfrom=0100015873f98ebf-a084f107-f9bf-4f8a-b621-394d12755ba6-000000@amazonses.com\r\nDKIM-Signature: v=1; a=rsa-sha256; q=dns/txt; c=relaxed/simple;\r\n s=vvyipd3e25cam7dptlj6ozg25t7s54b2; d=codingame.com; t=1479414484;\r\n h=From:Reply-To:To:Message-ID:Subject:MIME-Version:Content-Type:Date;\r\n bh=7fOqTCnqQ4ULBcTlm0pqBWgwQNWKB8OPxTPAqK0QsVU=;\r\n b=0OUQjpOXtqWZtcVfMSNiPvIUGA6wrse2UmNiexcn/a8KFoFg4aLNldJFdK4ZonV7\r\n QKvzB+Mmq9uDGcKGGnPx37JS5qa2G0wn1fs6TJdqtJxYPis5ZhqcqiVjJDaPvMwp71+\r\n qNx00aT6sw9INEMa+sC5lLu27D1qlT2lQiuZdF8A=\r\nDKIM-Signature: v=1; a=rsa-sha256; q=dns/txt; c=relaxed/simple;\r\n s=6gbrjpgwjskckoa6a5zn6fwqkn67xbtw; d=amazonses.com; t=1479414484;\r\n h=From:Reply-To:To:Message-ID:Subject:MIME-Version:Content-Type:Date:Feedback-ID;\r\n bh=7fOqTCnqQ4ULBcTlm0pqBWgwQNWKB8OPxTPAqK0QsVU=;\r\n b=TL5AJgz1v4fqF1XlNS0wpXO+BPnuzEn9J8KrfMFCPxdw2vJEqCU5EJOuaAtzkSwd\r\n IY3lsxiAFqS4FWK9VvPFL8aFiSgSGpKzBraZrBxUSXG5Omv/qnWQuuBtzLcae1ZHuuj\r\n XRgJaYESD+1jIHHa0qSw6wIXc+dteE27i8e/iMUg=\r\nFrom: CodinGame <coders@codingame.com>\r\nReply-To: coders@codingame.com\r\nTo: jago.eboard@gmail.com\r\nMessage-ID: <0100015873f98ebf-a084f107-f9bf-4f8a-b621-394d12755ba6-000000@email.amazonses.com>\r\nSubject: New on CodinGame: Check it out!\r\nMIME-Version: 1.0\r\nContent-Type: multipart/mixed;\r\n boundary="----=_Part_863476_1863399191.1479408306680"\r\nDate: Thu, 17 Nov 2016 20:28:04 +0000\r\nX-SES-Outgoing: 2016.11.17-54.240.11.98\r\nFeedback-ID: 1.us-east-1.p7wQsMMJKDUXwGnrHN7YOmvsdgoP3aDJajrvK4B5DHw=:AmazonSES\r\n\r\n'), b')', (b'2044 (BODY[HEADER] {1965}', b'Delivered-To: jago.eboard@gmail.com\r\nReceived: by 10.107.5.205 with SMTP id 196csp529168iof; Sat, 19 Nov 2016\r\n 01:16:06 -0800 (PST)\r\nX-Received: by 10.194.85.107 with SMTP id g11mr2391881wjz.82.1479546966699;\r\n Sat, 19 Nov 2016 01:16:06 -0800 (PST)\r\nReturn-Path: <4x9223.32954065.1451270004@news.send24.pl>\r\nReceived: from smtp31.send24.pl (smtp31.send24.pl. [91.230.36.97]) by\r\n mx.google.com with ESMTPS id kw6si11096851wjb.292.2016.11.19.01.16.06 for\r\n <jago.eboard@gmail.com> (version=TLS1_2\r\n cipher=ECDHE-RSA-AES128-GCM-SHA256 bits=128/128); Sat, 19 Nov 2016 01:16:06\r\n -0800 (PST)\r\nReceived-SPF: pass (google.com: domain of\r\n 4x9223.32954065.1451270004@news.send24.pl designates 91.230.36.97 as\r\n permitted sender) client-ip=91.230.36.97;\r\nAuthentication-Results: mx.google.com; dkim=pass header.i=@send24.pl; spf=pass\r\n (google.com: domain of 4x9223.32954065.1451270004@news.send24.pl designates\r\n 91.230.36.97 as permitted sender)\r\n smtp.mailfrom=4x9223.32954065.1451270004@news.send24.pl; dmarc=fail (p=NONE\r\n dis=NONE) header.from=x-kom.pl\r\nReceived: from smtp31.send24.pl (smtp31.send24.pl [91.230.36.97])\r\nDKIM-Signature: v=1; a=rsa-sha1; c=relaxed/relaxed; d=send24.pl; s=default;\r\n t=1479546713; bh=ikU1qdokxbvPc0oagyGu6GqXo14=;\r\n h=From:To:Reply-To:Date:Subject;\r\n b=snI9faQRXlx3MegmChT1zb0ALO7kAZgZ9EiU1Zi0IIjqeUOeOxuu0V/N5SuKLU7s1\r\n yWXUAaoRzx6+w9tPMIl13sInH6vfWg0nBR6a2uYB7SMARD4d+TPKTDPjlIVfnpX6b7\r\n aty4gFvOyCH2b1BDcEzS+hHsTZ/jcLPhb0dB5slQ=\r\nFrom: "x-kom" <news@x-kom.pl>\r\nTo: "jago.eboard@gmail.com" <jago.eboard@gmail.com>\r\nReply-To: x-kom@x-kom.pl\r\nDate: Sat, 19 Nov 2016 10:11:51 +0100\r\nSubject: =?utf-8?B?S3VwIHNvYmllIGN6YXMgbmEgxZp3acSZdGEgPg==?=\r\nMIME-Version: 1.0\r\nContent-Type: multipart/alternative;\r\n boundary="_=aspNetEmail=_4b882ce32de44882bfa1c03b96015f81"\r\nPrecedence: bulk\r\nFeedback-ID: :32954065:9223:send24.pl\r\nX-Sid: 20161119.101151.1593@send24.pl\r\nMessage-ID: <4x9223.32954065.1451270004@news.send24.pl>\r\n\r\n'), b')'])
 
 fetch3 = ('OK', [(b'9 (FLAGS (\\Answered \\Seen) BODY[HEADER] {437}', b'MIME-Version: 1.0\r\nReceived: by 10.107.11.39 with HTTP; Sun, 4 Dec 2016 04:46:00 -0800 (PST)\r\nDate: Sun, 4 Dec 2016 13:46:00 +0100\r\nDelivered-To: jago.eboard@gmail.com\r\nMessage-ID: <CAB9kRExs3f-H5ZN6C_1j7BzVFdMBmEPeX+9jKHRLDcUUpkPmMg@mail.gmail.com>\r\nSubject: Test of Flags\r\nFrom: Jago Eboard <jago.eboard@gmail.com>\r\nTo: Jago Eboard <jago.eboard@gmail.com>\r\nContent-Type: multipart/alternative; boundary=94eb2c0b8e6ea1b4b10542d48d46\r\n\r\n'), b')'])
@@ -0,0 +1,142 @@
+import unittest
+import asyncio
+import re
+
+from app.mail.aioclient import AsyncImapClient
+from app.mail.client import ImapClientError
+
+
+class FakeServer:
+    '''
+    Writer of AsyncImapClient which answers commands with scripted
+    responses {command: (untagged, completion)}. Answers are held until
+    flush() when hold is true.
+    '''
+    def __init__(self, responses, capabilities=b"IMAP4rev1", hold=False):
+        self.responses = responses
+        self.hold = hold
+        self.reader = asyncio.StreamReader()
+        self.reader.feed_data(b"* OK [CAPABILITY %s] Ready\r\n"
+                              % capabilities)
+        self.commands = list()
+        self.held = list()
+        self.buffer = b""
+        self.scanned = 0
+
+    def write(self, data):
+        self.buffer += data
+        while True:
+            end = self.buffer.find(b"\r\n", self.scanned)
+            if end == -1: break
+            match = re.search(rb"\{(\d+)\}$", self.buffer[:end])
+            if match:
+                if len(self.buffer) < end + 2 + int(match.group(1)):
+                    self.reader.feed_data(b"+ Ready\r\n")
+                    break
+                self.scanned = end + 2 + int(match.group(1))
+                continue
+            line, self.buffer = self.buffer[:end], self.buffer[end+2:]
+            self.scanned = 0
+            tag, command = line.split(b" ", 1)
+            self.commands.append(command)
+            untagged, completion = self.responses.get(
+                command, (b"", b"BAD Unexpected command")
+            )
+            self.held.append(untagged + tag + b" " + completion + b"\r\n")
+        if not self.hold:
+            self.flush()
+
+    def flush(self):
+        for response in self.held:
+            self.reader.feed_data(response)
+        self.held = list()
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.reader.feed_eof()
+
+
+SELECT_RESPONSES = {
+    b'SELECT "INBOX"': (b"* 3 EXISTS\r\n* OK [UIDVALIDITY 7] Valid\r\n",
+                        b"OK [READ-WRITE] SELECT completed"),
+    b'SELECT "Work"': (b"* 1 EXISTS\r\n",
+                       b"OK [READ-WRITE] SELECT completed")
+}
+
+
+class AsyncImapClientTest(unittest.IsolatedAsyncioTestCase):
+
+    async def create_client(self, responses, **kwargs):
+        responses.update(SELECT_RESPONSES)
+        self.server = FakeServer(responses, **kwargs)
+        client = AsyncImapClient(self.server.reader, self.server, timeout=5)
+        await client.start()
+        self.addAsyncCleanup(client.close)
+        return client
+
+    async def test_runs_concurrent_commands_on_one_connection(self):
+        client = await self.create_client({
+            b"SEARCH ALL": (b"* SEARCH 1 2 3\r\n", b"OK SEARCH completed"),
+            b"SEARCH UNSEEN": (b"* SEARCH 2\r\n", b"OK SEARCH completed")
+        }, hold=True)
+        searches = asyncio.gather(
+            client.list_mailbox('"INBOX"'),
+            client.list_mailbox('"INBOX"', "UNSEEN")
+        )
+        await asyncio.sleep(0.01)
+        self.assertEqual(self.server.commands, [b'SELECT "INBOX"',
+                                                b"SEARCH ALL",
+                                                b"SEARCH UNSEEN"])
+        self.server.flush()
+        self.assertEqual(await searches, [("OK", [1, 2, 3]), ("OK", [2])])
+        self.assertEqual(client.uidvalidity, 7)
+
+    async def test_switches_mailbox_after_commands_in_progress(self):
+        client = await self.create_client({
+            b"SEARCH ALL": (b"* SEARCH 1\r\n", b"OK SEARCH completed"),
+        })
+        results = await asyncio.gather(client.list_mailbox('"INBOX"'),
+                                       client.list_mailbox('"Work"'),
+                                       client.list_mailbox('"INBOX"'))
+        self.assertEqual(self.server.commands, [
+            b'SELECT "INBOX"', b"SEARCH ALL", b"SEARCH ALL",
+            b'SELECT "Work"', b"SEARCH ALL"
+        ])
+        self.assertEqual(results, [("OK", [1])] * 3)
+        self.assertEqual(client.mailbox, '"Work"')
+
+    async def test_sends_literals_after_continuation(self):
+        value = "Zażółć".encode("utf-8")
+        command = b"UID SEARCH CHARSET UTF-8 SUBJECT {%d}\r\n" % len(value)
+        client = await self.create_client({
+            command + value: (b"* SEARCH 5 9\r\n", b"OK SEARCH completed")
+        })
+        status, uids = await client.csearch(
+            [{"key": "SUBJECT", "value": "Zażółć", "decode": True}],
+            uid=True, mailbox='"INBOX"'
+        )
+        self.assertEqual(uids, [5, 9])
+
+    async def test_parses_fetched_headers(self):
+        header = b"Subject: Test\r\nDate: Wed, 01 Feb 2017 10:00:00 +0100\r\n"
+        client = await self.create_client({
+            b"UID FETCH 5 (FLAGS BODY.PEEK[HEADER])": (
+                b"* 1 FETCH (UID 5 FLAGS (\\Seen) BODY[HEADER] {%d}\r\n"
+                % len(header) + header + b")\r\n", b"OK FETCH completed"
+            )
+        })
+        status, headers = await client.get_headers(5, uid=True,
+                                                   mailbox='"INBOX"')
+        self.assertEqual(headers[0]["Subject"], "Test")
+        self.assertEqual(headers[0]["id"], 5)
+        self.assertEqual(headers[0]["Flags"], ["\\Seen"])
+
+    async def test_fails_commands_when_connection_is_lost(self):
+        client = await self.create_client({}, hold=True)
+        search = asyncio.ensure_future(client.list_mailbox('"INBOX"'))
+        await asyncio.sleep(0.01)
+        self.server.close()
+        with self.assertRaises(ImapClientError):
+            await search
@@ -0,0 +1,69 @@
+import unittest
+import base64
+import quopri
+
+from app.mail.attachment import (
+    Base64Decoder, QuotedPrintableDecoder, AttachmentStream
+)
+
+
+def split(data, size):
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+
+class DecoderTest(unittest.TestCase):
+
+    def test_base64_decoder_accepts_chunks_split_anywhere(self):
+        content = bytes(range(256))*3
+        encoded = base64.encodebytes(content).replace(b"\n", b"\r\n")
+        decoder = Base64Decoder()
+        output = b"".join(decoder.feed(chunk) for chunk in split(encoded, 7))
+        self.assertEqual(output + decoder.flush(), content)
+
+    def test_quoted_printable_decoder_holds_back_split_escapes(self):
+        content = "Zażółć gęślą jaźń = ok\r\n".encode("utf-8")*20
+        encoded = quopri.encodestring(content)
+        decoder = QuotedPrintableDecoder()
+        output = b"".join(decoder.feed(chunk) for chunk in split(encoded, 2))
+        self.assertEqual(output + decoder.flush(), quopri.decodestring(encoded))
+
+
+class AttachmentStreamTest(unittest.TestCase):
+
+    def create_stream(self, encoded, encoding, chunk_size=100):
+        self.fetched = list()
+        def fetch(offset, length):
+            self.fetched.append((offset, length))
+            return encoded[offset:offset+length]
+        return AttachmentStream(fetch, dict(encoding=encoding,
+                                            size=len(encoded)),
+                                chunk_size=chunk_size)
+
+    def test_fetches_part_in_chunks(self):
+        stream = self.create_stream(b"x"*250, "7bit")
+        stream.probe()
+        self.assertEqual(b"".join(stream.iter_range()), b"x"*250)
+        self.assertEqual(self.fetched, [(0, 100), (100, 100), (200, 50)])
+
+    def test_knows_decoded_length_of_base64_with_equal_lines(self):
+        content = bytes(range(256))*10
+        encoded = base64.encodebytes(content).replace(b"\n", b"\r\n")
+        stream = self.create_stream(encoded, "base64")
+        self.assertEqual(stream.probe(), len(content))
+        self.assertTrue(stream.supports_ranges)
+
+    def test_streams_range_of_base64_fetching_only_needed_lines(self):
+        content = bytes(range(256))*10
+        encoded = base64.encodebytes(content).replace(b"\n", b"\r\n")
+        stream = self.create_stream(encoded, "base64")
+        stream.probe()
+        self.fetched = list()
+        self.assertEqual(b"".join(stream.iter_range(1000, 1100)),
+                         content[1000:1100])
+        self.assertLess(sum(length for _, length in self.fetched), 200)
+
+    def test_does_not_support_ranges_of_irregular_base64(self):
+        stream = self.create_stream(b"QUJD\r\nREVGR0g=\r\n", "base64")
+        self.assertIsNone(stream.probe())
+        self.assertFalse(stream.supports_ranges)
+        self.assertEqual(b"".join(stream.iter_range(2, 4)), b"ABCDEFGH")
@@ -0,0 +1,217 @@
+import unittest
+import tempfile
+import os
+import time
+
+from app.mail.cache import (
+    LRUCache, HeaderCache, MessageStore, MailboxIndex, ListCache,
+    encode_cursor, decode_cursor
+)
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_returns_saved_item(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+
+    def test_returns_default_when_missing(self):
+        cache = LRUCache(2)
+        self.assertEqual(cache.get("a", 5), 5)
+
+    def test_removes_least_recently_used_item(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertEqual(len(cache), 2)
+
+    def test_discard_if_removes_matching_keys(self):
+        cache = LRUCache(5)
+        cache.put(("x", 1), 1)
+        cache.put(("y", 1), 2)
+        cache.discard_if(lambda key: key[0] == "x")
+        self.assertNotIn(("x", 1), cache)
+        self.assertIn(("y", 1), cache)
+
+
+class HeaderCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.header = {"Subject": "Test", "From": "jago@gmail.com"}
+
+    def test_returns_only_cached_headers(self):
+        cache = HeaderCache()
+        cache.put_many("acc", "INBOX", 1, {10: self.header}, ["Subject"])
+        headers = cache.get_many("acc", "INBOX", 1, [10, 11], ["Subject"])
+        self.assertEqual(headers, {10: self.header})
+
+    def test_ignores_headers_with_different_uidvalidity(self):
+        cache = HeaderCache()
+        cache.put_many("acc", "INBOX", 1, {10: self.header})
+        self.assertEqual(cache.get_many("acc", "INBOX", 2, [10]), {})
+
+    def test_ignores_headers_without_requested_fields(self):
+        cache = HeaderCache()
+        cache.put_many("acc", "INBOX", 1, {10: self.header}, ["Subject"])
+        headers = cache.get_many("acc", "INBOX", 1, [10], ["Subject", "Date"])
+        self.assertEqual(headers, {})
+
+    def test_whole_header_covers_all_fields(self):
+        cache = HeaderCache()
+        cache.put_many("acc", "INBOX", 1, {10: self.header})
+        headers = cache.get_many("acc", "INBOX", 1, [10], ["subject"])
+        self.assertIn(10, headers)
+
+    def test_returns_copies_of_headers(self):
+        cache = HeaderCache()
+        cache.put_many("acc", "INBOX", 1, {10: self.header})
+        cache.get_many("acc", "INBOX", 1, [10])[10]["Flags"] = ["\\Seen"]
+        self.assertNotIn("Flags", cache.get_many("acc", "INBOX", 1, [10])[10])
+
+    def test_move_many_rekeys_headers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "headers.sqlite")
+            cache = HeaderCache(path=path)
+            cache.put_many("acc", "INBOX", 1, {10: self.header})
+            cache.move_many("acc", "INBOX", 1, "Work", 5, {10: 3})
+            self.assertEqual(cache.get_many("acc", "INBOX", 1, [10]), {})
+            self.assertEqual(cache.get_many("acc", "Work", 5, [3]),
+                             {3: self.header})
+
+            cache = HeaderCache(path=path)
+            self.assertEqual(cache.get_many("acc", "Work", 5, [3]),
+                             {3: self.header})
+
+    def test_loads_headers_from_database(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "headers.sqlite")
+            cache = HeaderCache(path=path)
+            cache.put_many("acc", "INBOX", 1, {10: self.header}, ["Subject"])
+
+            cache = HeaderCache(path=path)
+            headers = cache.get_many("acc", "INBOX", 1, [10], ["Subject"])
+            self.assertEqual(headers, {10: self.header})
+
+    def test_discard_mailbox_removes_headers(self):
+        cache = HeaderCache(path=":memory:")
+        cache.put_many("acc", "INBOX", 1, {10: self.header})
+        cache.discard_mailbox("acc", "INBOX")
+        self.assertEqual(cache.get_many("acc", "INBOX", 1, [10]), {})
+
+
+class MessageStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_returns_saved_message(self):
+        store = MessageStore(self.directory.name)
+        store.put("acc", "INBOX", 1, 10, b"Subject: Test\r\n\r\n")
+        self.assertEqual(store.get("acc", "INBOX", 1, 10),
+                         b"Subject: Test\r\n\r\n")
+        self.assertIsNone(store.get("acc", "INBOX", 2, 10))
+
+    def test_removes_least_recently_used_messages(self):
+        store = MessageStore(self.directory.name, maxsize=25)
+        store.put("acc", "INBOX", 1, 10, b"a"*10)
+        store.put("acc", "INBOX", 1, 11, b"b"*10)
+        store.get("acc", "INBOX", 1, 10)
+        store.put("acc", "INBOX", 1, 12, b"c"*10)
+        self.assertEqual(store.get_many("acc", "INBOX", 1, [10, 11, 12]),
+                         {10: b"a"*10, 12: b"c"*10})
+        self.assertEqual(store.size, 20)
+
+    def test_loads_messages_saved_by_previous_store(self):
+        store = MessageStore(self.directory.name)
+        store.put("acc", "INBOX", 1, 10, b"")
+        store = MessageStore(self.directory.name)
+        self.assertEqual(store.get("acc", "INBOX", 1, 10), b"")
+        self.assertEqual(len(store), 1)
+
+    def test_removes_stale_temporary_files(self):
+        store = MessageStore(self.directory.name)
+        store.put("acc", "INBOX", 1, 10, b"Subject: Test\r\n\r\n")
+        directory = os.path.join(self.directory.name, "ab")
+        os.makedirs(directory, exist_ok=True)
+        stale = os.path.join(directory, "stale.tmp")
+        fresh = os.path.join(directory, "fresh.tmp")
+        for path in (stale, fresh):
+            with open(path, "wb") as f:
+                f.write(b"Subject: Part")
+        os.utime(stale, (0, 0))
+        store = MessageStore(self.directory.name)
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(fresh))
+        self.assertEqual(len(store), 1)
+
+
+class MailboxIndexTest(unittest.TestCase):
+
+    def create_index(self):
+        index = MailboxIndex(1)
+        index.update([(1, 100), (2, 300), (3, 200), (4, 200)])
+        return index
+
+    def test_returns_the_newest_emails_first(self):
+        items, more = self.create_index().page(limit=3)
+        self.assertEqual(items, [(2, 300), (4, 200), (3, 200)])
+        self.assertTrue(more)
+
+    def test_pages_do_not_shift_when_emails_arrive(self):
+        index = self.create_index()
+        items, _ = index.page(limit=2)
+        index.update([(5, 400)])
+        items, more = index.page(after=items[-1][::-1], limit=2)
+        self.assertEqual(items, [(3, 200), (1, 100)])
+        self.assertFalse(more)
+
+    def test_merges_large_updates_into_the_order(self):
+        index = self.create_index()
+        index.update((uid, uid % 7 * 100) for uid in range(1, 1001))
+        items, more = index.page(limit=1000)
+        self.assertEqual(len(index), 1000)
+        self.assertEqual(items[:2], [(1000, 600), (993, 600)])
+        self.assertEqual(items, sorted(items, key=lambda item: (-item[1],
+                                                               -item[0])))
+
+    def test_retain_removes_expunged_emails(self):
+        index = self.create_index()
+        index.retain([1, 3])
+        self.assertEqual(index.page()[0], [(3, 200), (1, 100)])
+        self.assertEqual(index.max_uid, 3)
+
+    def test_decodes_encoded_cursor(self):
+        self.assertEqual(decode_cursor(encode_cursor(7, 1485943200, 12)),
+                         (7, 1485943200, 12))
+        self.assertIsNone(decode_cursor("not a cursor"))
+
+
+class ListCacheTest(unittest.TestCase):
+
+    def test_returns_mailboxes_within_ttl(self):
+        cache = ListCache(ttl=30)
+        cache.put("acc", ["INBOX"])
+        self.assertEqual(cache.get("acc"), ["INBOX"])
+        cache.ttl = -1
+        self.assertIsNone(cache.get("acc"))
+
+    def test_invalidate_drops_mailboxes(self):
+        cache = ListCache()
+        cache.put("acc", ["INBOX"])
+        cache.invalidate("acc")
+        self.assertIsNone(cache.get("acc"))
+
+    def test_does_not_save_list_older_than_invalidation(self):
+        cache = ListCache()
+        since = time.monotonic()
+        cache.invalidate("acc")
+        cache.put("acc", ["INBOX"], since=since)
+        self.assertIsNone(cache.get("acc"))
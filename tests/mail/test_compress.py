@@ -0,0 +1,34 @@
+import unittest
+import socket
+import zlib
+
+from app.mail.compress import DeflateSocket
+
+
+class DeflateSocketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client, self.server = socket.socketpair()
+        self.addCleanup(self.client.close)
+        self.addCleanup(self.server.close)
+        self.sock = DeflateSocket(self.client)
+
+    def test_compresses_and_flushes_each_write(self):
+        self.sock.sendall(b"TEST0 NOOP\r\n")
+        decompressor = zlib.decompressobj(-15)
+        self.assertEqual(decompressor.decompress(self.server.recv(1024)),
+                         b"TEST0 NOOP\r\n")
+        self.assertEqual(self.sock.sent, 12)
+        self.assertGreater(self.sock.raw_sent, 0)
+
+    def test_reads_decompressed_lines(self):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+        response = b"* 1 EXISTS\r\n" * 100 + b"TEST0 OK NOOP completed\r\n"
+        self.server.sendall(compressor.compress(response) + 
+                            compressor.flush(zlib.Z_SYNC_FLUSH))
+        stream = self.sock.makefile("rb")
+        lines = [stream.readline() for _ in range(101)]
+        self.assertEqual(lines[-1], b"TEST0 OK NOOP completed\r\n")
+        stats = self.sock.stats()
+        self.assertEqual(stats["received"], len(response))
+        self.assertLess(stats["raw_received"], len(response) // 10)
@@ -0,0 +1,139 @@
+import unittest
+import shutil
+import ssl
+
+from app.mail.client import ImapClient, ImapClientError
+from app.mail.cache import HeaderCache, LRUCache
+from app.mail.metrics import Instrumentation, StatsRegistry
+from tests.mail.fake_server import (
+    FakeImapServer, Mailbox, self_signed_context, DEFAULT_CAPABILITIES
+)
+
+
+@unittest.skipIf(shutil.which("openssl") is None, "openssl is not available")
+class FakeImapServerTest(unittest.TestCase):
+    '''ImapClient talking to the fake server over TLS.'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.context, cert = self_signed_context()
+        cls.client_context = ssl.create_default_context(cafile=cert)
+
+    def setUp(self):
+        self.server = FakeImapServer(
+            [Mailbox("INBOX", 120), Mailbox("Work", 5, seed=1,
+                                             uidvalidity=2)],
+            users={"jago": "secret"}, ssl_context=self.context
+        )
+        host, port = self.server.start_in_thread()
+        self.addCleanup(self.server.stop_thread)
+        self.address = "localhost:%d" % port
+
+    def connect(self, **kwargs):
+        iclient = ImapClient(self.address, timeout=5,
+                             ssl_context=self.client_context, **kwargs)
+        iclient.login("jago", "secret")
+        self.addCleanup(iclient.logout)
+        return iclient
+
+    def test_rejects_invalid_password(self):
+        iclient = ImapClient(self.address, timeout=5,
+                             ssl_context=self.client_context)
+        with self.assertRaises(ImapClientError):
+            iclient.login("jago", "wrong")
+
+    def test_lists_mailboxes_with_status(self):
+        iclient = self.connect()
+        status, mailboxes = iclient.list(status_items="(MESSAGES UNSEEN)")
+        self.assertEqual(mailboxes[1][0], "Work")
+        self.assertEqual(mailboxes[0][2]["MESSAGES"], 120)
+
+    def test_pages_headers_of_generated_mailbox(self):
+        iclient = self.connect(header_cache=HeaderCache())
+        status, page = iclient.get_headers_page('"INBOX"', limit=50,
+                                                fields=["Subject", "Date"])
+        self.assertEqual([header["id"] for header in page["headers"][:3]],
+                         [120, 119, 118])
+        self.assertEqual(page["total"], 120)
+        status, page = iclient.get_headers_page(
+            '"INBOX"', cursor=page["next_cursor"], limit=100,
+            fields=["Subject"]
+        )
+        self.assertEqual(len(page["headers"]), 70)
+        self.assertIsNone(page["next_cursor"])
+
+    def test_searches_with_literals_over_compressed_connection(self):
+        iclient = self.connect(compress=True)
+        self.assertIsNotNone(iclient.compression_stats())
+        iclient.select('"INBOX"')
+        status, uids = iclient.csearch(
+            [{"key": "SUBJECT", "value": "zażółć", "decode": True}], uid=True
+        )
+        status, headers = iclient.get_headers(uids, fields=["Subject"],
+                                              uid=True)
+        self.assertTrue(headers)
+        self.assertTrue(all("zażółć" in header["Subject"].lower()
+                            for header in headers))
+
+    def test_displays_multipart_email_with_attachment(self):
+        iclient = self.connect()
+        iclient.select('"INBOX"')
+        status, message = iclient.get_email_for_display(10, uid=True)
+        text, attachment = message["content"]
+        self.assertIn("<p>", text["content"][0]["content"])
+        self.assertEqual(attachment["attachment"]["filename"], "report.pdf")
+
+    def test_moves_emails_between_mailboxes(self):
+        iclient = self.connect()
+        status, copyuid = iclient.move_emails("1:2", '"Work"', uid=True,
+                                              source_mailbox='"INBOX"')
+        self.assertEqual(copyuid["uids"], {1: 6, 2: 7})
+        self.assertEqual(iclient.len_mailbox('"INBOX"'), ("OK", 118))
+
+    def test_measures_bytes_of_compressed_commands(self):
+        stats = StatsRegistry()
+        iclient = self.connect(compress=True,
+                               instrumentation=Instrumentation([stats]))
+        iclient.get_emails("1:10", uid=True, mailbox='"INBOX"')
+        fetch = stats.snapshot()["SELECT + UID FETCH"]
+        self.assertEqual(fetch["count"], 1)
+        self.assertGreater(fetch["sent"], 0)
+        self.assertGreater(fetch["size"], fetch["received"])
+        self.assertIn("LOGIN", stats.snapshot())
+
+    def test_displays_cached_email_without_fetching(self):
+        stats = StatsRegistry()
+        iclient = self.connect(display_cache=LRUCache(),
+                               instrumentation=Instrumentation([stats]))
+        first = iclient.get_email_for_display(10, uid=True,
+                                              mailbox='"INBOX"')
+        second = iclient.get_email_for_display(10, uid=True,
+                                               mailbox='"INBOX"')
+        self.assertEqual(first, second)
+        self.assertEqual(stats.snapshot()["SELECT + UID FETCH"]["count"], 1)
+        self.assertEqual(stats.snapshot()["UID FETCH"]["count"], 1)
+
+    def search_large_mailbox(self, capabilities):
+        server = FakeImapServer([Mailbox("Archive", 20000)],
+                                users={"jago": "secret"},
+                                capabilities=capabilities,
+                                ssl_context=self.context)
+        host, port = server.start_in_thread()
+        self.addCleanup(server.stop_thread)
+        self.address = "localhost:%d" % port
+        stats = StatsRegistry()
+        iclient = self.connect(instrumentation=Instrumentation([stats]))
+        status, uids = iclient.list_mailbox('"Archive"', uid=True)
+        self.assertEqual(len(uids), 20000)
+        self.assertIn(12345, uids)
+        status, newest = iclient.list_mailbox('"Archive"', uid=True,
+                                              partial="-1:-50")
+        self.assertEqual(newest, list(range(19951, 20001)))
+        return stats.snapshot()["UID SEARCH"]["received"]
+
+    def test_lists_large_mailbox_as_ranges_with_esearch(self):
+        plain = tuple(capability for capability in DEFAULT_CAPABILITIES
+                      if capability != "ESEARCH")
+        esearch = self.search_large_mailbox(plain + ("ESEARCH", "PARTIAL"))
+        self.assertLess(esearch, 500)
+        self.assertGreater(self.search_large_mailbox(plain), 100 * esearch)
@@ -0,0 +1,103 @@
+import unittest
+import threading
+import time
+from unittest.mock import Mock
+
+from app.mail.pool import ImapPool
+from app.mail.fanout import FetchOrchestrator, FetchJob, Account
+from app.mail.client import ImapClientError
+
+
+class FetchOrchestratorTest(unittest.TestCase):
+
+    def create_orchestrator(self, max_per_account=3, **kwargs):
+        self.connect = Mock(side_effect=lambda *args: Mock())
+        self.pool = ImapPool(self.connect, max_per_account=max_per_account)
+        return FetchOrchestrator(self.pool, **kwargs)
+
+    def test_fetches_mailboxes_in_parallel(self):
+        orchestrator = self.create_orchestrator()
+        account = Account("imap.gmail.com", "Test", "test")
+
+        def fetch(client):
+            time.sleep(0.2)
+            return ("OK", client)
+
+        start = time.monotonic()
+        results = orchestrator.run(
+            [FetchJob(account, mailbox, fetch) 
+             for mailbox in ("INBOX", "Sent", "Work")]
+        )
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(len(set(data for _, data in results.values())), 3)
+
+    def test_limits_connections_per_host(self):
+        orchestrator = self.create_orchestrator(max_per_host=2)
+        lock = threading.Lock()
+        state = dict(running=0, max_running=0)
+
+        def fetch(client):
+            with lock:
+                state["running"] += 1
+                state["max_running"] = max(state["running"],
+                                           state["max_running"])
+            time.sleep(0.05)
+            with lock:
+                state["running"] -= 1
+            return ("OK", None)
+
+        jobs = [FetchJob(Account("imap.gmail.com", user, "test"), 
+                         (user, mailbox), fetch)
+                for user in ("A", "B") for mailbox in ("INBOX", "Sent")]
+        results = orchestrator.run(jobs)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(state["max_running"], 2)
+
+    def test_uses_lent_client_and_reports_errors(self):
+        orchestrator = self.create_orchestrator(max_per_account=1)
+        account = Account("imap.gmail.com", "Test", "test")
+        lent = Mock()
+
+        def fail(client):
+            raise ImapClientError("No such mailbox.")
+
+        results = orchestrator.run(
+            [FetchJob(account, "INBOX", lambda client: ("OK", client)),
+             FetchJob(account, "Nope", fail)],
+            clients={account: lent}
+        )
+        self.assertEqual(results["INBOX"], ("OK", lent))
+        self.assertEqual(results["Nope"], ("ERROR", "No such mailbox."))
+        self.connect.assert_not_called()
+
+    def test_limits_socket_timeout_to_time_left(self):
+        orchestrator = self.create_orchestrator()
+        account = Account("imap.gmail.com", "Test", "test")
+        timeouts = list()
+
+        def fetch(client):
+            timeouts.append(client.socket().settimeout.call_args[0][0])
+            return ("OK", None)
+
+        self.connect.side_effect = lambda *args: Mock(**{
+            "socket.return_value.gettimeout.return_value": 5
+        })
+        orchestrator.run([FetchJob(account, "INBOX", fetch)], timeout=1)
+        self.assertLessEqual(timeouts[0], 1)
+        client = self.pool.acquire(*account)
+        client.socket().settimeout.assert_called_with(5)  # restored
+
+    def test_discards_connection_failed_after_deadline(self):
+        orchestrator = self.create_orchestrator()
+        account = Account("imap.gmail.com", "Test", "test")
+
+        def fetch(client):
+            time.sleep(0.2)
+            raise ImapClientError("timed out")
+
+        results = orchestrator.run([FetchJob(account, "INBOX", fetch)],
+                                   timeout=0.1)
+        self.assertEqual(results["INBOX"][0], "ERROR")
+        time.sleep(0.2)  # the job is still running after the timeout
+        self.pool.acquire(*account)
+        self.assertEqual(self.connect.call_count, 2)
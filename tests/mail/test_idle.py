@@ -0,0 +1,214 @@
+import unittest
+from unittest.mock import patch, Mock, call
+import socket
+import threading
+import time
+
+from app.mail.idle import parse_idle_response, IdleWatcher, IdleManager
+
+
+class ParseIdleResponseTest(unittest.TestCase):
+
+    def test_returns_exists_event(self):
+        event = parse_idle_response(b'* 23 EXISTS\r\n')
+        self.assertEqual(event, {"type": "exists", "count": 23})
+
+    def test_returns_expunge_event(self):
+        event = parse_idle_response(b'* 5 EXPUNGE\r\n')
+        self.assertEqual(event, {"type": "expunge", "id": 5})
+
+    def test_returns_fetch_event_with_flags(self):
+        event = parse_idle_response(
+            b'* 5 FETCH (UID 105 FLAGS (\\Seen \\Flagged))\r\n'
+        )
+        self.assertEqual(event, {"type": "fetch", "id": 5, "uid": 105,
+                                 "Flags": ["\\Seen", "\\Flagged"]})
+
+    def test_returns_vanished_event(self):
+        event = parse_idle_response(b'* VANISHED 7:9,12\r\n')
+        self.assertEqual(event, {"type": "vanished", "uids": [7, 8, 9, 12]})
+
+    def test_returns_none_for_other_responses(self):
+        self.assertIsNone(parse_idle_response(b'* OK Still here\r\n'))
+        self.assertIsNone(parse_idle_response(b'* 3 RECENT\r\n'))
+
+
+class IdleWatcherTest(unittest.TestCase):
+
+    def create_watcher(self, **kwargs):
+        return IdleWatcher(Mock(), "imap.gmail.com", "Test", "test",
+                           '"INBOX"', **kwargs)
+
+    def test_publishes_events_received_during_idle(self):
+        watcher = self.create_watcher(renew_interval=0)
+        events = watcher.subscribe()
+        sock = Mock()
+        sock.recv.side_effect = [
+            b'+ idling\r\n* 24 EXISTS\r\n',
+            b'IDLE1 OK IDLE terminated\r\n'
+        ]
+        watcher.idle(sock)
+        self.assertEqual(events.get_nowait(), {"type": "exists", "count": 24})
+
+    def test_sends_idle_and_done(self):
+        watcher = self.create_watcher(renew_interval=0)
+        sock = Mock()
+        sock.recv.side_effect = [b'+ idling\r\n',
+                                 b'IDLE1 OK IDLE terminated\r\n']
+        watcher.idle(sock)
+        self.assertEqual(sock.sendall.call_args_list,
+                         [call(b'IDLE1 IDLE\r\n'), call(b'DONE\r\n')])
+
+    def connect_server(self, watcher):
+        '''
+        Returns (sock, server) socket pair, server accepts IDLE and answers
+        DONE in background.
+        '''
+        sock, server = socket.socketpair()
+        watcher._wakeup = socket.socketpair()
+        for item in (sock, server) + watcher._wakeup:
+            self.addCleanup(item.close)
+        server.sendall(b'+ idling\r\n')
+        def answer_done():
+            data = b""
+            while not data.endswith(b"DONE\r\n"):
+                data += server.recv(4096)
+            server.sendall(b'IDLE1 OK IDLE terminated\r\n')
+        thread = threading.Thread(target=answer_done, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 1)
+        return sock, server
+
+    def test_waits_for_lines_until_renew_interval(self):
+        watcher = self.create_watcher(renew_interval=60)
+        watcher.subscribe()
+        sock, server = self.connect_server(watcher)
+        threading.Timer(0.1, server.sendall, [b'* 2 EXPUNGE\r\n']).start()
+        def stop_after_event(*args):
+            watcher.stop()
+        with patch.object(watcher, "publish",
+                          side_effect=stop_after_event) as publish:
+            watcher.idle(sock)
+        publish.assert_called_with({"type": "expunge", "id": 2})
+
+    def test_wakes_up_when_stopped(self):
+        watcher = self.create_watcher(renew_interval=60)
+        watcher.subscribe()
+        sock, _ = self.connect_server(watcher)
+        threading.Timer(0.1, watcher.stop).start()
+        started = time.monotonic()
+        watcher.idle(sock)
+        self.assertLess(time.monotonic() - started, 5)
+
+    def test_wakes_up_when_linger_runs_out(self):
+        watcher = self.create_watcher(renew_interval=60, linger=0.2)
+        events = watcher.subscribe()
+        sock, _ = self.connect_server(watcher)
+        threading.Timer(0.1, watcher.unsubscribe, [events]).start()
+        started = time.monotonic()
+        watcher.idle(sock)
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertFalse(watcher.is_needed())
+
+    def test_calls_on_change_with_events(self):
+        on_change = Mock()
+        watcher = self.create_watcher(renew_interval=0, on_change=on_change)
+        sock = Mock()
+        sock.recv.side_effect = [
+            b'+ idling\r\n* 3 EXPUNGE\r\n* OK Still here\r\n',
+            b'IDLE1 OK IDLE terminated\r\n'
+        ]
+        watcher.idle(sock)
+        on_change.assert_called_once_with(watcher, {"type": "expunge",
+                                                    "id": 3})
+        self.assertEqual(watcher.account, "Test@imap.gmail.com")
+
+    def test_raises_error_when_idle_rejected(self):
+        watcher = self.create_watcher()
+        sock = Mock()
+        sock.recv.side_effect = [b'IDLE1 BAD Unknown command\r\n']
+        with self.assertRaises(ConnectionError):
+            watcher.idle(sock)
+
+    def test_publishes_error_when_idle_not_supported(self):
+        imap_client = Mock()
+        imap_client.has_capability.return_value = False
+        on_stop = Mock()
+        watcher = IdleWatcher(Mock(return_value=imap_client),
+                              "imap.gmail.com", "Test", "test", '"INBOX"',
+                              on_stop=on_stop)
+        events = watcher.subscribe()
+        watcher.run()
+        event = events.get_nowait()
+        self.assertEqual(event["type"], "error")
+        self.assertTrue(event["unsupported"])
+        on_stop.assert_called_once_with(watcher)
+        self.assertTrue(imap_client.logout.called)
+
+    def test_is_needed_only_within_linger_after_last_unsubscribe(self):
+        watcher = self.create_watcher(linger=0)
+        events = watcher.subscribe()
+        self.assertTrue(watcher.is_needed())
+        watcher.unsubscribe(events)
+        self.assertFalse(watcher.is_needed())
+
+
+@patch("app.mail.idle.IdleWatcher.start")
+class IdleManagerTest(unittest.TestCase):
+
+    def test_starts_watcher_for_first_subscriber(self, start_mock):
+        manager = IdleManager(Mock())
+        watcher, events = manager.subscribe("imap.gmail.com", "Test", "test",
+                                            '"INBOX"')
+        self.assertTrue(start_mock.called)
+        self.assertIn(events, watcher.subscribers)
+
+    def test_shares_watcher_between_subscribers(self, start_mock):
+        manager = IdleManager(Mock())
+        watcher, _ = manager.subscribe("imap.gmail.com", "Test", "test",
+                                       '"INBOX"')
+        watcher2, _ = manager.subscribe("imap.gmail.com", "Test", "test",
+                                        '"INBOX"')
+        self.assertIs(watcher, watcher2)
+        self.assertEqual(start_mock.call_count, 1)
+
+    def test_stop_account_stops_watchers(self, start_mock):
+        manager = IdleManager(Mock())
+        watcher, _ = manager.subscribe("imap.gmail.com", "Test", "test",
+                                       '"INBOX"')
+        manager.stop_account("imap.gmail.com", "Test")
+        self.assertTrue(watcher.stopped.is_set())
+
+    def fail(self, manager, unsupported=False):
+        watcher, _ = manager.subscribe("imap.gmail.com", "Test", "test",
+                                       '"INBOX"')
+        watcher.error = dict(type="error", unsupported=unsupported,
+                             msg="Connection lost.")
+        watcher.stopped.set()
+        manager._remove(watcher)
+        return manager.failure("imap.gmail.com", "Test", '"INBOX"')
+
+    def test_backs_off_after_failures(self, start_mock):
+        manager = IdleManager(Mock(), retry_interval=5,
+                              max_retry_interval=12)
+        self.assertIsNone(manager.failure("imap.gmail.com", "Test",
+                                          '"INBOX"'))
+        self.assertEqual(self.fail(manager)["retry"], 5)
+        self.assertEqual(self.fail(manager)["retry"], 10)
+        failure = self.fail(manager)
+        self.assertEqual(failure["retry"], 12)
+        self.assertEqual(failure["msg"], "Connection lost.")
+
+    def test_waits_longest_when_idle_not_supported(self, start_mock):
+        manager = IdleManager(Mock(), retry_interval=5,
+                              max_retry_interval=300)
+        failure = self.fail(manager, unsupported=True)
+        self.assertEqual(failure["retry"], 300)
+        self.assertTrue(failure["unsupported"])
+
+    def test_stop_account_forgets_failures(self, start_mock):
+        manager = IdleManager(Mock())
+        self.fail(manager)
+        manager.stop_account("imap.gmail.com", "Test")
+        self.assertIsNone(manager.failure("imap.gmail.com", "Test",
+                                          '"INBOX"'))
@@ -0,0 +1,41 @@
+import unittest
+
+from app.mail.idset import IdSet
+
+
+class IdSetTest(unittest.TestCase):
+
+    def test_keeps_sorted_numbers_as_runs(self):
+        ids = IdSet([7, 3, 1, 2, 2, 9, 8])
+        self.assertEqual(list(ids.runs()), [(1, 3), (7, 9)])
+        self.assertEqual(ids.to_sequence_set(), "1:3,7:9")
+        self.assertEqual(len(ids), 6)
+        self.assertEqual(ids, [1, 2, 3, 7, 8, 9])
+        self.assertEqual(list(reversed(ids)), [9, 8, 7, 3, 2, 1])
+        self.assertEqual((ids.min, ids.max), (1, 9))
+
+    def test_parses_sequence_set_without_expanding_it(self):
+        ids = IdSet.from_sequence_set(b"5:1,200000:1,7")
+        self.assertEqual(list(ids.runs()), [(1, 200000)])
+        self.assertEqual(len(ids), 200000)
+        self.assertIn(150000, ids)
+        self.assertNotIn(200001, ids)
+        self.assertEqual(ids.index(150000), 149999)
+
+    def test_indexes_and_slices_across_runs(self):
+        ids = IdSet.from_sequence_set("1:3,7,10:20")
+        self.assertEqual(ids[3], 7)
+        self.assertEqual(ids[-1], 20)
+        self.assertEqual(ids[2:6], [3, 7, 10, 11])
+        self.assertEqual(ids[-3:].to_sequence_set(), "18:20")
+        self.assertEqual(ids[::5], [1, 11, 16])
+        self.assertEqual(ids[20:], [])
+        with self.assertRaises(IndexError):
+            ids[15]
+
+    def test_empty_set(self):
+        ids = IdSet()
+        self.assertFalse(ids)
+        self.assertEqual(ids.to_sequence_set(), "")
+        self.assertIsNone(ids.min)
+        self.assertEqual(IdSet.from_sequence_set(""), [])
@@ -2,12 +2,21 @@ import unittest
 from unittest.mock import patch, Mock, ANY, call
 import email
 import imaplib
+import io
+import re
+import socket
+import tempfile
+import zlib
 
 from tests.base import FlaskTestCase
 from app.mail.client import (
     ImapClient, email_to_dict, ImapClientError, DEFAULT_MAILBOX,
-    process_email_for_display, imaplib_decorator
+    process_email_for_display, imaplib_decorator, header_date,
+    message_from_bytes, ids_to_bytes, split_sequence_set, parse_esearch
 )
+from app.mail.idset import IdSet
+from app.mail.cache import HeaderCache, LRUCache, MessageStore, ListCache
+from app.mail.search import SearchIndex, make_document
 
 from tests.mail import imap_responses
 
@@ -21,33 +30,39 @@ class CSearchTest(unittest.TestCase):
         imap_mock.IMAP4.error = imaplib.IMAP4.error
         return mock
 
+    def mock_responses(self, socket_mock, *responses):
+        '''Server responses, A2444 is replaced by the tag of csearch.'''
+        responses = iter(responses)
+        def recv(bufsize):
+            sent = socket_mock.return_value.send.call_args_list[0][0][0]
+            return next(responses).replace(b"A2444", sent[:5])
+        socket_mock.return_value.recv.side_effect = recv
+
     def test_for_raising_error_when_criteria_not_sequence(self, imap_mock):
         iclient = ImapClient("imap.gmail.com")
         with self.assertRaises(TypeError):
-            iclient.csearch({"key": "value"}, clear_socket=False)
+            iclient.csearch({"key": "value"})
 
     def test_for_calling_socket_method(self, imap_mock):
         socket_mock = self.mock_socket(imap_mock)
-        socket_mock.return_value.recv.side_effect = [ 
+        self.mock_responses(socket_mock,
             b'+ go ahead\r\n', 
-            b'* SEARCH 3 4\r\nA2444 OK SEARCH completed (Success)\r\n' 
-        ]
+            b'* SEARCH 3 4\r\nA2444 OK SEARCH completed (Success)\r\n'
+        )
         iclient = ImapClient("imap.gmail.com")
-        iclient.csearch([{"key": "SUBJECT", "value": "Test", "decode": True}], 
-                        clear_socket=False)
+        iclient.csearch([{"key": "SUBJECT", "value": "Test", "decode": True}])
         self.assertTrue(socket_mock.called)
 
     def test_calls_socket_send_method_with_proper_args1(self, imap_mock):
         socket_mock = self.mock_socket(imap_mock)
-        socket_mock.return_value.recv.side_effect = [ 
+        self.mock_responses(socket_mock,
             b'+ go ahead\r\n', 
-            b'* SEARCH 3 4\r\nA2444 OK SEARCH completed (Success)\r\n' 
-        ]
+            b'* SEARCH 3 4\r\nA2444 OK SEARCH completed (Success)\r\n'
+        )
         send_mock = Mock()
         socket_mock.return_value.send = send_mock
         iclient = ImapClient("imap.gmail.com")
-        iclient.csearch([{"key": "SUBJECT", "value": "Test", "decode": True}], 
-                        clear_socket=False)
+        iclient.csearch([{"key": "SUBJECT", "value": "Test", "decode": True}])
         expected = [
             call(send_mock.call_args_list[0][0][0][:5] + # random tag
                  b" SEARCH CHARSET UTF-8 SUBJECT {4}\r\n"), 
@@ -58,17 +73,16 @@ class CSearchTest(unittest.TestCase):
 
     def test_calls_socket_send_method_with_proper_args2(self, imap_mock):
         socket_mock = self.mock_socket(imap_mock)
-        socket_mock.return_value.recv.side_effect = [ 
+        self.mock_responses(socket_mock,
             b'+ go ahead\r\n', 
             b'+ go ahead\r\n', 
-            b'* SEARCH 3 4\r\nA2444 OK SEARCH completed (Success)\r\n' 
-        ]
+            b'* SEARCH 3 4\r\nA2444 OK SEARCH completed (Success)\r\n'
+        )
         send_mock = Mock()
         socket_mock.return_value.send = send_mock
         iclient = ImapClient("imap.gmail.com")
         iclient.csearch([{"key": "FROM", "value": "JAGO", "decode": True}, 
-                         {"key": "SUBJECT", "value": "Test Mail", "decode": True}],
-                        clear_socket=False)
+                         {"key": "SUBJECT", "value": "Test Mail", "decode": True}])
         expected = [
             call(send_mock.call_args_list[0][0][0][:5] + # random tag 
                  b" SEARCH CHARSET UTF-8 FROM {4}\r\n"), 
@@ -80,45 +94,72 @@ class CSearchTest(unittest.TestCase):
 
     def test_returns_status_and_data(self, imap_mock):
         socket_mock = self.mock_socket(imap_mock)
-        socket_mock.return_value.recv.side_effect = [ 
+        self.mock_responses(socket_mock,
             b'+ go ahead\r\n', 
             b'+ go ahead\r\n', 
-            b'* SEARCH 3 4\r\nA2444 OK SEARCH completed (Success)\r\n' 
-        ]
+            b'* SEARCH 3 4\r\nA2444 OK SEARCH completed (Success)\r\n'
+        )
         send_mock = Mock()
         socket_mock.return_value.send = send_mock
         iclient = ImapClient("imap.gmail.com")
         status, data = iclient.csearch([
                             {"key": "FROM", "value": "JAGO", "decode": True}, 
                             {"key": "SUBJECT", "value": "Test Mail", "decode": True}
-                        ], clear_socket=False)
+                        ])
         self.assertEqual(status, "OK")
         self.assertEqual(set(data), set([3, 4]))
 
     def test_returns_status_and_msg_when_bad_or_error(self, imap_mock):
         socket_mock = self.mock_socket(imap_mock)
-        socket_mock.return_value.recv.side_effect = [ 
+        self.mock_responses(socket_mock,
             b'+ go ahead\r\n', 
             b'+ go ahead\r\n', 
             b'A2444 BAD Could not parse command\r\n'
-        ]
+        )
         send_mock = Mock()
         socket_mock.return_value.send = send_mock
         iclient = ImapClient("imap.gmail.com")
         status, data = iclient.csearch([
                             {"key": "FROM", "value": "JAGO", "decode": True}, 
                             {"key": "SUBJECT", "value": "Test Mail", "decode": True}
-                        ], clear_socket=False)
+                        ])
+        tag = send_mock.call_args_list[0][0][0][:5].decode("ascii")
         self.assertEqual(status, "BAD")
-        self.assertEqual(data, 'A2444 BAD Could not parse command')
+        self.assertEqual(data, tag + ' BAD Could not parse command')
+
+    def test_waits_for_completion_with_its_tag(self, imap_mock):
+        socket_mock = self.mock_socket(imap_mock)
+        self.mock_responses(socket_mock,
+            b'X0001 OK NOOP completed\r\n',
+            b'* SEARCH 3 4\r\nA2444 OK SEARCH completed (Success)\r\n'
+        )
+        iclient = ImapClient("imap.gmail.com")
+        status, data = iclient.csearch([{"key": "ALL"}])
+        self.assertEqual(status, "OK")
+        self.assertEqual(data, [3, 4])
+
+    def test_raises_error_on_timeout(self, imap_mock):
+        socket_mock = self.mock_socket(imap_mock)
+        socket_mock.return_value.recv.side_effect = socket.timeout
+        iclient = ImapClient("imap.gmail.com")
+        with self.assertRaises(ImapClientError):
+            iclient.csearch([{"key": "ALL"}])
+        self.assertTrue(iclient.broken)
+
+    def test_clear_socket_is_deprecated(self, imap_mock):
+        socket_mock = self.mock_socket(imap_mock)
+        self.mock_responses(socket_mock, b'A2444 OK SEARCH completed\r\n')
+        iclient = ImapClient("imap.gmail.com")
+        with self.assertWarns(DeprecationWarning):
+            iclient.csearch([{"key": "ALL"}], clear_socket=False)
 
     def test_raises_error_when_invalid_criterion(self, imap_mock):
         socket_mock = self.mock_socket(imap_mock)
-        socket_mock.return_value.recv.side_effect = [ 
+        self.mock_responses(socket_mock,
             b'+ go ahead\r\n', 
             b'+ go ahead\r\n', 
             b'A2444 BAD Could not parse command\r\n'
-        ]
+        )
         send_mock = Mock()
         socket_mock.return_value.send = send_mock
         iclient = ImapClient("imap.gmail.com")
@@ -126,7 +167,7 @@ class CSearchTest(unittest.TestCase):
             iclient.csearch([
                     {"key": "FROM", "decode": True}, 
                     {"key": "SUBJECT", "value": "Test Mail", "decode": True}
-                ], clear_socket=False)
+                ])
             
 
 @patch("app.mail.client.imaplib")
@@ -225,7 +266,7 @@ class StoreTest(unittest.TestCase):
         store_mock = self.mock_store(imap_mock, imap_responses.store)
         iclient = ImapClient("imap.gmail.com")
         status, data = iclient.store([1, 2, 3], "INBOX", command="+FLAGS")
-        store_mock.assert_called_with(b'1,2,3', "+FLAGS", "INBOX")
+        store_mock.assert_called_with(b'1:3', "+FLAGS", "INBOX")
 
     def test_accepts_single_id(self, imap_mock):
         store_mock = self.mock_store(imap_mock, imap_responses.store)
@@ -258,6 +299,7 @@ class MoveTest(unittest.TestCase):
         mock_ = Mock()
         mock_.return_value = response
         imap_mock.IMAP4_SSL.return_value.copy = mock_
+        imap_mock.IMAP4_SSL.return_value.capabilities = ("IMAP4REV1",)
         imap_mock.IMAP4.error = imaplib.IMAP4.error
         return mock_
 
@@ -296,13 +338,13 @@ class MoveTest(unittest.TestCase):
         move_mock = self.mock_move(imap_mock, imap_responses.copy)
         iclient = ImapClient("imap.gmail.com")
         iclient.move_emails([1, 2, 3], "INBOX")  
-        move_mock.assert_called_with(b'1,2,3', "INBOX")
+        move_mock.assert_called_with(b'1:3', "INBOX")
 
     def test_accepts_string_of_ids(self, imap_mock):
         move_mock = self.mock_move(imap_mock, imap_responses.copy)
         iclient = ImapClient("imap.gmail.com")
         iclient.move_emails("1, 2, 3", "INBOX")  
-        move_mock.assert_called_with(b'1,2,3', "INBOX")
+        move_mock.assert_called_with(b'1:3', "INBOX")
 
     def test_accepts_single_id(self, imap_mock):
         move_mock = self.mock_move(imap_mock, imap_responses.copy)
@@ -495,6 +537,45 @@ class EmailToDictTest(unittest.TestCase):
         self.assertIn("header", result["body"][0])
         self.assertIn("body", result["body"][0])
 
+    def test_decodes_text_with_charset_of_content_type(self):
+        msg = message_from_bytes(
+            b"Content-Type: text/plain; charset=ISO-8859-2\r\n"
+            b"Content-Transfer-Encoding: 8bit\r\n\r\n"
+            b"Za\xbf\xf3\xb3\xe6\r\n"
+        )
+        self.assertEqual(email_to_dict(msg)["body"], "Zażółć\r\n")
+
+    def test_encodes_binary_parts_with_base64(self):
+        msg = message_from_bytes(
+            b"Content-Type: multipart/mixed; boundary=XX\r\n\r\n"
+            b"--XX\r\nContent-Type: text/plain\r\n\r\nHi\r\n"
+            b"--XX\r\nContent-Type: application/pdf\r\n"
+            b"Content-Transfer-Encoding: base64\r\n\r\nJVBERi0xLjQK\r\n"
+            b"--XX--\r\n"
+        )
+        text, attachment = email_to_dict(msg)["body"]
+        self.assertEqual(text["body"], "Hi")
+        self.assertEqual(attachment["body"], "JVBERi0xLjQK")
+
+    def test_passes_base64_parts_on_without_decoding(self):
+        msg = message_from_bytes(
+            b"Content-Type: application/pdf\r\n"
+            b"Content-Transfer-Encoding: Base64\r\n\r\n"
+            b"JVBERi0x\r\nLjQK\r\n"
+        )
+        with patch.object(msg, "get_payload",
+                          wraps=msg.get_payload) as get_payload:
+            self.assertEqual(email_to_dict(msg)["body"], "JVBERi0xLjQK")
+        get_payload.assert_called_once_with()
+
+    def test_encodes_other_binary_parts_with_base64(self):
+        msg = message_from_bytes(
+            b"Content-Type: application/octet-stream\r\n"
+            b"Content-Transfer-Encoding: 8bit\r\n\r\n"
+            b"\x00\xff"
+        )
+        self.assertEqual(email_to_dict(msg)["body"], "AP8=")
+
 @patch("app.mail.client.imaplib")
 class GetEmailsTest(FlaskTestCase):
 
@@ -527,13 +608,13 @@ class GetEmailsTest(FlaskTestCase):
         fetch_mock = self.mock_fetch(imap_mock)
         iclient = ImapClient("imap.gmail.com")
         status, emails = iclient.get_emails([1, 2, 3])
-        fetch_mock.assert_called_with(b'1,2,3', ANY)
+        fetch_mock.assert_called_with(b'1:3', ANY)
 
     def test_accepts_string_of_ids(self, imap_mock):
         fetch_mock = self.mock_fetch(imap_mock)
         iclient = ImapClient("imap.gmail.com")
         status, emails = iclient.get_emails("1, 2, 3")
-        fetch_mock.assert_called_with(b'1,2,3', ANY)
+        fetch_mock.assert_called_with(b'1:3', ANY)
 
     def test_accepts_single_id(self, imap_mock):
         fetch_mock = self.mock_fetch(imap_mock)
@@ -605,13 +686,13 @@ class GetHeadersTest(FlaskTestCase):
         fetch_mock = self.mock_fetch(imap_mock, response = imap_responses.fetch2)
         iclient = ImapClient("imap.gmail.com")
         status, header = iclient.get_headers([1, 2, 3], fields = ["Subject", "From"])
-        fetch_mock.assert_called_with(b'1,2,3', ANY)
+        fetch_mock.assert_called_with(b'1:3', ANY)
 
     def test_accepts_string_of_ids(self, imap_mock):
         fetch_mock = self.mock_fetch(imap_mock, response = imap_responses.fetch2)
         iclient = ImapClient("imap.gmail.com")
         status, header = iclient.get_headers("1, 2, 3", fields = ["Subject", "From"])
-        fetch_mock.assert_called_with(b'1,2,3', ANY)
+        fetch_mock.assert_called_with(b'1:3', ANY)
 
     def test_accepts_single_id(self, imap_mock):
         fetch_mock = self.mock_fetch(imap_mock, response = imap_responses.fetch2)
@@ -661,6 +742,1039 @@ class GetHeadersTest(FlaskTestCase):
         iclient.get_headers(b'9', flags=True)
         self.assertIn("FLAGS", fetch_mock.call_args[0][1])
 
+@patch("app.mail.client.imaplib")
+class GetHeadersCacheTest(unittest.TestCase):
+
+    def create_client(self, imap_mock, responses):
+        uid_mock = Mock()
+        uid_mock.side_effect = responses
+        imap_mock.IMAP4_SSL.return_value.uid = uid_mock
+        iclient = ImapClient("imap.gmail.com", header_cache=HeaderCache())
+        iclient.username = "jago"
+        iclient.mailbox = '"INBOX"'
+        iclient.uidvalidity = 1
+        return iclient, uid_mock
+
+    def test_fetches_uids_and_flags_first(self, imap_mock):
+        iclient, uid_mock = self.create_client(imap_mock, [
+            ('OK', [b'2043 (UID 2043 FLAGS (\\Seen))']), 
+            imap_responses.fetch_uid
+        ])
+        iclient.get_headers(2043, fields=["Subject", "From"], uid=True,
+                            sort_by_date=False)
+        self.assertEqual(uid_mock.call_args_list[0], 
+                         call("fetch", b'2043', "(UID FLAGS)"))
+
+    def test_fetches_headers_only_once(self, imap_mock):
+        iclient, uid_mock = self.create_client(imap_mock, [
+            ('OK', [b'2043 (UID 2043 FLAGS (\\Seen))']), 
+            imap_responses.fetch_uid,
+            ('OK', [b'2043 (UID 2043 FLAGS (\\Seen \\Flagged))'])
+        ])
+        iclient.get_headers(2043, fields=["Subject", "From"], uid=True,
+                            sort_by_date=False)
+        status, headers = iclient.get_headers(
+            2043, fields=["Subject", "From"], uid=True, sort_by_date=False
+        )
+        self.assertEqual(uid_mock.call_count, 3)
+        self.assertEqual(headers[0]["Subject"], 
+                         "New on CodinGame: Check it out!")
+        self.assertEqual(headers[0]["Flags"], ["\\Seen", "\\Flagged"])
+        self.assertEqual(headers[0]["id"], 2043)
+
+    def test_returns_sequence_numbers_when_uid_not_set(self, imap_mock):
+        iclient, uid_mock = self.create_client(imap_mock, [
+            imap_responses.fetch_uid
+        ])
+        fetch_mock = Mock()
+        fetch_mock.return_value = ('OK', [b'7 (UID 2043 FLAGS ())'])
+        imap_mock.IMAP4_SSL.return_value.fetch = fetch_mock
+        status, headers = iclient.get_headers(
+            7, fields=["Subject", "From"], sort_by_date=False
+        )
+        uid_mock.assert_called_with("fetch", b'2043', ANY)
+        self.assertEqual(headers[0]["id"], 7)
+        self.assertEqual(headers[0]["Flags"], [])
+
+
+@patch("app.mail.client.imaplib")
+class GetEmailsStoreTest(unittest.TestCase):
+
+    raw_email = b'Subject: Test\r\n\r\nHi\r\n'
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = MessageStore(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def create_client(self, imap_mock, responses):
+        uid_mock = Mock()
+        uid_mock.side_effect = responses
+        imap_mock.IMAP4_SSL.return_value.uid = uid_mock
+        iclient = ImapClient("imap.gmail.com", message_store=self.store)
+        iclient.username = "jago"
+        iclient.mailbox = '"INBOX"'
+        iclient.uidvalidity = 1
+        return iclient, uid_mock
+
+    def test_downloads_and_stores_missing_emails(self, imap_mock):
+        iclient, uid_mock = self.create_client(imap_mock, [
+            ('OK', [b'1 (UID 5)']),
+            ('OK', [(b'1 (UID 5 RFC822 {%d}' % len(self.raw_email), 
+                     self.raw_email), b')'])
+        ])
+        status, emails = iclient.get_emails(5, uid=True)
+        uid_mock.assert_called_with("fetch", b'5', "(UID RFC822)")
+        self.assertEqual(emails[0]["Subject"], "Test")
+        self.assertEqual(self.store.get("jago@imap.gmail.com", "INBOX", 1, 5),
+                         self.raw_email)
+
+    def test_reads_stored_uids_without_asking_server(self, imap_mock):
+        iclient, uid_mock = self.create_client(imap_mock, [])
+        self.store.put("jago@imap.gmail.com", "INBOX", 1, 5, self.raw_email)
+        status, emails = iclient.get_emails(5, uid=True)
+        self.assertFalse(uid_mock.called)
+        self.assertEqual(emails[0]["Subject"], "Test")
+
+    def test_maps_sequence_numbers_to_stored_uids(self, imap_mock):
+        iclient, uid_mock = self.create_client(imap_mock, [])
+        fetch_mock = Mock()
+        fetch_mock.return_value = ('OK', [b'7 (UID 5)'])
+        imap_mock.IMAP4_SSL.return_value.fetch = fetch_mock
+        self.store.put("jago@imap.gmail.com", "INBOX", 1, 5, self.raw_email)
+        status, emails = iclient.get_emails(7)
+        fetch_mock.assert_called_with(b'7', "(UID)")
+        self.assertFalse(uid_mock.called)
+        self.assertEqual(len(emails), 1)
+
+
+@patch("app.mail.client.imaplib")
+class IndexedSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        if not SearchIndex.is_supported():
+            self.skipTest("SQLite without FTS5")
+
+    def create_client(self, imap_mock, search_results, batch_size=0):
+        imap_mock.IMAP4.error = imaplib.IMAP4.error
+        index = SearchIndex(batch_size=batch_size)
+        index.add_many("jago@imap.gmail.com", "INBOX", 1, {
+            10: make_document({"Subject": "Monthly report"}, []),
+            11: make_document({"Subject": "Lunch"}, [])
+        })
+        iclient = ImapClient("imap.gmail.com", search_index=index)
+        iclient.username = "jago"
+        iclient.mailbox = '"INBOX"'
+        iclient.uidvalidity = 1
+        iclient.csearch = Mock(side_effect=search_results)
+        return iclient
+
+    def test_searches_on_server_only_not_indexed_emails(self, imap_mock):
+        iclient = self.create_client(imap_mock, [("OK", [10, 11, 12]),
+                                                 ("OK", [12])])
+        criteria = [{"key": "SUBJECT", "value": "report", "decode": True}]
+        status, data = iclient.indexed_search(criteria, uid=True)
+        iclient.csearch.assert_called_with(
+            [{"key": "UID", "value": "12"}] + criteria, uid=True
+        )
+        self.assertEqual(data, [10, 12])
+        self.assertIsInstance(data, IdSet)
+
+    def test_returns_sequence_numbers_when_uid_not_set(self, imap_mock):
+        iclient = self.create_client(imap_mock, [("OK", [10, 11, 12]),
+                                                 ("OK", [12])])
+        status, data = iclient.indexed_search(
+            [{"key": "SUBJECT", "value": "report", "decode": True}]
+        )
+        self.assertEqual(data, [1, 3])
+        self.assertIsInstance(data, IdSet)
+
+    def test_sends_unsupported_criteria_to_server(self, imap_mock):
+        iclient = self.create_client(imap_mock, [("OK", [11])])
+        status, data = iclient.indexed_search([{"key": "UNSEEN"}], uid=True)
+        iclient.csearch.assert_called_once_with([{"key": "UNSEEN"}], 
+                                                uid=True)
+        self.assertEqual(data, [11])
+
+    def test_does_not_index_emails_while_searching(self, imap_mock):
+        iclient = self.create_client(imap_mock, [("OK", [10, 11, 12]),
+                                                 ("OK", [12])], batch_size=5)
+        status, data = iclient.indexed_search(
+            [{"key": "SUBJECT", "value": "report", "decode": True}], uid=True
+        )
+        self.assertFalse(imap_mock.IMAP4_SSL.return_value.uid.called)
+        self.assertEqual(data, [10, 12])
+
+    def test_index_mailbox_indexes_newest_emails_for_search(self, imap_mock):
+        iclient = self.create_client(imap_mock, [("OK", [10, 11, 12])],
+                                     batch_size=5)
+        iclient.uidnext = 13
+        imap_mock.IMAP4_SSL.return_value.untagged_responses = {
+            "EXISTS": [b"3"]
+        }
+        imap_mock.IMAP4_SSL.return_value.uid.side_effect = [
+            ('OK', [(b'1 (UID 12 BODYSTRUCTURE ("TEXT" "PLAIN" NIL NIL NIL '
+                     b'"7BIT" 17 1) BODY[HEADER] {17}', 
+                     b'Subject: Report\r\n'), b')']),
+            ('OK', [(b'1 (UID 12 BODY[1] {17}', b'Quarterly numbers'), b')'])
+        ]
+        iclient.index_mailbox()
+        # uids of SEARCH ALL are reused while UIDNEXT and EXISTS are equal
+        status, data = iclient.indexed_search(
+            [{"key": "BODY", "value": "quarterly", "decode": True}], uid=True
+        )
+        self.assertEqual(iclient.csearch.call_count, 1)
+        self.assertEqual(data, [12])
+
+
+@patch("app.mail.client.imaplib")
+class SyncTest(unittest.TestCase):
+
+    def create_client(self, imap_mock, untagged, enabled=()):
+        imap_mock.IMAP4.error = imaplib.IMAP4.error
+        imap = imap_mock.IMAP4_SSL.return_value
+        imap.select.return_value = ("OK", [b'10'])
+        imap.untagged_responses = untagged
+        iclient = ImapClient("imap.gmail.com")
+        iclient.username = "jago"
+        iclient.enabled = set(enabled)
+        return iclient, imap
+
+    def test_returns_all_emails_when_modseq_not_given(self, imap_mock):
+        iclient, imap = self.create_client(imap_mock, {
+            "UIDVALIDITY": [b'3'], "HIGHESTMODSEQ": [b'20']
+        }, enabled=["CONDSTORE"])
+        imap.uid.return_value = ("OK", [b'1 (UID 5 FLAGS (\\Seen))'])
+        status, data = iclient.sync("INBOX")
+        imap.uid.assert_called_with("fetch", b'1:*', "(UID FLAGS)")
+        self.assertTrue(data["full"])
+        self.assertEqual(data["modseq"], 20)
+        self.assertEqual(data["changed"][0]["id"], 5)
+
+    def test_fetches_changes_since_modseq(self, imap_mock):
+        iclient, imap = self.create_client(imap_mock, {
+            "UIDVALIDITY": [b'3'], "HIGHESTMODSEQ": [b'20']
+        }, enabled=["CONDSTORE"])
+        imap.uid.return_value = (
+            "OK", [b'1 (UID 5 MODSEQ (19) FLAGS (\\Seen \\Flagged))']
+        )
+        status, data = iclient.sync("INBOX", modseq=15, uidvalidity=3)
+        imap.uid.assert_called_with("fetch", b'1:*', 
+                                    "(UID FLAGS) (CHANGEDSINCE 15)")
+        self.assertFalse(data["full"])
+        self.assertEqual(data["changed"], [
+            {"id": 5, "Flags": ["\\Seen", "\\Flagged"], "modseq": 19}
+        ])
+
+    def test_returns_vanished_uids_when_qresync(self, imap_mock):
+        iclient, imap = self.create_client(imap_mock, {
+            "UIDVALIDITY": [b'3'], "HIGHESTMODSEQ": [b'20'],
+            "VANISHED": [b'(EARLIER) 7:9,12']
+        }, enabled=["CONDSTORE", "QRESYNC"])
+        imap.uid.return_value = ("OK", [None])
+        status, data = iclient.sync("INBOX", modseq=15, uidvalidity=3)
+        imap.uid.assert_called_with("fetch", b'1:*', 
+                                    "(UID FLAGS) (CHANGEDSINCE 15 VANISHED)")
+        self.assertEqual(data["vanished"], [7, 8, 9, 12])
+
+    def test_does_not_fetch_when_modseq_unchanged(self, imap_mock):
+        iclient, imap = self.create_client(imap_mock, {
+            "UIDVALIDITY": [b'3'], "HIGHESTMODSEQ": [b'20']
+        }, enabled=["CONDSTORE"])
+        status, data = iclient.sync("INBOX", modseq=20, uidvalidity=3)
+        self.assertFalse(imap.uid.called)
+        self.assertEqual(data["changed"], [])
+
+    def test_searches_known_uids_for_vanished_without_qresync(self,
+                                                              imap_mock):
+        iclient, imap = self.create_client(imap_mock, {
+            "UIDVALIDITY": [b'3'], "HIGHESTMODSEQ": [b'20']
+        }, enabled=["CONDSTORE"])
+        imap.uid.side_effect = [("OK", [None]), ("OK", [b'1 5'])]
+        status, data = iclient.sync("INBOX", modseq=15, uidvalidity=3,
+                                    known_uids=[1, 2, 5])
+        imap.uid.assert_called_with("search", None, "UID", b'1:2,5')
+        self.assertEqual(data["vanished"], [2])
+
+    def test_does_not_search_known_uids_when_not_needed(self, imap_mock):
+        iclient, imap = self.create_client(imap_mock, {
+            "UIDVALIDITY": [b'3'], "HIGHESTMODSEQ": [b'20']
+        }, enabled=["CONDSTORE", "QRESYNC"])
+        imap.uid.return_value = ("OK", [None])
+        iclient.sync("INBOX", modseq=15, uidvalidity=3, known_uids=[1, 2])
+        self.assertEqual(imap.uid.call_count, 1)  # FETCH only
+        iclient.enabled = {"CONDSTORE"}
+        iclient.sync("INBOX", modseq=20, uidvalidity=3, known_uids=[1, 2])
+        self.assertEqual(imap.uid.call_count, 1)
+
+    def test_returns_full_list_when_uidvalidity_changed(self, imap_mock):
+        iclient, imap = self.create_client(imap_mock, {
+            "UIDVALIDITY": [b'4'], "HIGHESTMODSEQ": [b'20']
+        }, enabled=["CONDSTORE"])
+        imap.uid.return_value = ("OK", [b'1 (UID 5 FLAGS ())'])
+        status, data = iclient.sync("INBOX", modseq=15, uidvalidity=3)
+        self.assertTrue(data["full"])
+
+    def test_compares_snapshots_without_condstore(self, imap_mock):
+        iclient, imap = self.create_client(imap_mock, {"UIDVALIDITY": [b'3']})
+        iclient.sync_cache = LRUCache()
+        imap.uid.return_value = ("OK", [b'1 (UID 5 FLAGS ())', 
+                                        b'2 (UID 6 FLAGS ())'])
+        status, data = iclient.sync("INBOX")
+        imap.uid.return_value = ("OK", [b'1 (UID 5 FLAGS (\\Seen))'])
+        status, data = iclient.sync("INBOX", modseq=data["modseq"], 
+                                    uidvalidity=3)
+        self.assertFalse(data["full"])
+        self.assertEqual(data["changed"], 
+                         [{"id": 5, "Flags": ["\\Seen"], "modseq": None}])
+        self.assertEqual(data["vanished"], [6])
+
+
+class FakeIMAP4(imaplib.IMAP4):
+    '''IMAP4 reading scripted server responses, remembers sent data.'''
+
+    def __init__(self, responses):
+        self.responses = responses
+        super().__init__()
+
+    def open(self, host="", port=None, timeout=None):
+        self.input = io.BytesIO(b"".join(self.responses))
+        self.sent = list()
+
+    def _connect(self):
+        self.tagpre = b"TEST"
+        self.tagre = re.compile(br"(?P<tag>TEST\d+) (?P<type>[A-Z]+) "
+                                br"(?P<data>.*)", re.ASCII)
+        self._cmd_log_len = 10
+        self._cmd_log_idx = 0
+        self._cmd_log = {}
+        self.capabilities = ("IMAP4REV1",)
+        self.state = "AUTH"
+
+    def readline(self):
+        return self.input.readline()
+
+    def read(self, size):
+        return self.input.read(size)
+
+    def send(self, data):
+        self.sent.append(data)
+
+
+def create_fake_client(ssl_mock, *responses, capabilities=(), state=None,
+                       **kwargs):
+    '''
+    Returns ImapClient connected (through patched IMAP4_SSL) to FakeIMAP4
+    with the responses, extra capabilities and state. Keyword arguments
+    are passed to ImapClient.
+    '''
+    def create_imap(*args, **_):
+        imap = FakeIMAP4(responses)
+        imap.capabilities += capabilities
+        if state is not None:
+            imap.state = state
+        return imap
+    ssl_mock.side_effect = create_imap
+    return ImapClient("imap.gmail.com", **kwargs)
+
+
+@patch("app.mail.client.imaplib.IMAP4_SSL")
+class PipelineTest(unittest.TestCase):
+
+    def test_sends_all_commands_at_once(self, ssl_mock):
+        iclient = create_fake_client(ssl_mock,
+            b'TEST0 OK NOOP completed\r\n', b'TEST1 OK NOOP completed\r\n'
+        )
+        iclient.pipeline(("NOOP",), ("NOOP",))
+        self.assertEqual(iclient.mail.sent,
+                         [b'TEST0 NOOP\r\nTEST1 NOOP\r\n'])
+
+    def test_matches_responses_by_tag(self, ssl_mock):
+        iclient = create_fake_client(ssl_mock,
+            b'* STATUS "INBOX" (MESSAGES 3 UNSEEN 1)\r\n',
+            b'TEST0 OK STATUS completed\r\n',
+            b'TEST1 NO Mailbox does not exist\r\n'
+        )
+        first, second = iclient.pipeline(("STATUS", '"INBOX"', "(MESSAGES)"),
+                                         ("STATUS", '"X"', "(MESSAGES)"))
+        self.assertEqual(first[0], "OK")
+        self.assertIn("STATUS", first[2])
+        self.assertEqual(second[0], "NO")
+        self.assertEqual(second[2], {})
+
+    def test_get_emails_selects_mailbox_in_the_same_round_trip(self, ssl_mock):
+        iclient = create_fake_client(ssl_mock,
+            b'* 2 EXISTS\r\n', b'* OK [UIDVALIDITY 7] UIDs valid\r\n',
+            b'TEST0 OK [READ-WRITE] SELECT completed\r\n',
+            b'* 1 FETCH (UID 5 RFC822 {21}\r\n', b'Subject: Test\r\n\r\nHi\r\n',
+            b')\r\n', b'TEST1 OK FETCH completed\r\n'
+        )
+        status, emails = iclient.get_emails(5, uid=True, mailbox='"INBOX"')
+        self.assertEqual(len(iclient.mail.sent), 1)
+        self.assertEqual(emails[0]["Subject"], "Test")
+        self.assertEqual(iclient.uidvalidity, 7)
+        self.assertEqual(iclient.mail.state, "SELECTED")
+
+    def test_raises_error_when_select_fails(self, ssl_mock):
+        iclient = create_fake_client(ssl_mock,
+            b'TEST0 NO Mailbox does not exist\r\n',
+            b'TEST1 BAD No mailbox selected\r\n'
+        )
+        with self.assertRaises(ImapClientError):
+            iclient.add_flags(5, "\\Seen", uid=True, mailbox='"X"')
+
+    def test_status_mailboxes_returns_items_of_each_mailbox(self, ssl_mock):
+        iclient = create_fake_client(ssl_mock,
+            b'* STATUS "INBOX" (MESSAGES 3 UNSEEN 1)\r\n',
+            b'TEST0 OK STATUS completed\r\n',
+            b'* STATUS "Work" (MESSAGES 7 UNSEEN 0)\r\n',
+            b'TEST1 OK STATUS completed\r\n'
+        )
+        statuses = iclient.status_mailboxes(['"INBOX"', '"Work"'])
+        self.assertEqual(statuses, {
+            '"INBOX"': {"MESSAGES": 3, "UNSEEN": 1},
+            '"Work"': {"MESSAGES": 7, "UNSEEN": 0}
+        })
+
+
+@patch("app.mail.client.imaplib.IMAP4_SSL")
+class ListStatusTest(unittest.TestCase):
+
+    def create_client(self, ssl_mock, *responses, capabilities=()):
+        return create_fake_client(ssl_mock, *responses,
+                                  capabilities=capabilities,
+                                  list_cache=ListCache())
+
+    def test_returns_status_with_list_when_list_status_supported(self,
+                                                                 ssl_mock):
+        iclient = self.create_client(ssl_mock,
+            b'* LIST (\\HasNoChildren) "/" "INBOX"\r\n',
+            b'* STATUS "INBOX" (MESSAGES 3 UNSEEN 1 UIDNEXT 9)\r\n',
+            b'* LIST (\\Noselect \\HasChildren) "/" "[Gmail]"\r\n',
+            b'TEST0 OK LIST completed\r\n',
+            capabilities=("LIST-STATUS",)
+        )
+        status, data = iclient.list(status_items="(MESSAGES UNSEEN UIDNEXT)")
+        self.assertEqual(iclient.mail.sent, [
+            b'TEST0 LIST "" * RETURN (STATUS (MESSAGES UNSEEN UIDNEXT))\r\n'
+        ])
+        self.assertEqual(data, [
+            ("INBOX", ["\\HasNoChildren"],
+             {"MESSAGES": 3, "UNSEEN": 1, "UIDNEXT": 9}),
+            ("[Gmail]", ["\\Noselect", "\\HasChildren"], {})
+        ])
+
+    def test_pipelines_status_of_selectable_mailboxes(self, ssl_mock):
+        iclient = self.create_client(ssl_mock,
+            b'* LIST (\\HasNoChildren) "/" "INBOX"\r\n',
+            b'* LIST (\\Noselect \\HasChildren) "/" "[Gmail]"\r\n',
+            b'* LIST (\\HasNoChildren) "/" "Work"\r\n',
+            b'TEST0 OK LIST completed\r\n',
+            b'* STATUS "INBOX" (MESSAGES 3 UNSEEN 1)\r\n',
+            b'TEST1 OK STATUS completed\r\n',
+            b'TEST2 NO Mailbox does not exist\r\n'
+        )
+        status, data = iclient.list(status_items="(MESSAGES UNSEEN)")
+        self.assertEqual(iclient.mail.sent[-1],
+                         b'TEST1 STATUS "INBOX" (MESSAGES UNSEEN)\r\n'
+                         b'TEST2 STATUS "Work" (MESSAGES UNSEEN)\r\n')
+        self.assertEqual([item for _, _, item in data],
+                         [{"MESSAGES": 3, "UNSEEN": 1}, {}, {}])
+
+    def test_noop_invalidates_list_when_mailbox_changed(self, ssl_mock):
+        iclient = self.create_client(ssl_mock,
+            b'TEST0 OK NOOP completed\r\n',
+            b'* 4 EXISTS\r\n', b'TEST1 OK NOOP completed\r\n'
+        )
+        iclient.list_cache.put(iclient.account, ["INBOX"])
+        iclient.noop()
+        self.assertEqual(iclient.list_cache.get(iclient.account), ["INBOX"])
+        iclient.noop()
+        self.assertIsNone(iclient.list_cache.get(iclient.account))
+
+
+@patch("app.mail.client.imaplib.IMAP4_SSL")
+class MoveEmailsTest(unittest.TestCase):
+
+    def create_client(self, ssl_mock, *responses, capabilities=()):
+        return create_fake_client(ssl_mock, *responses,
+                                  capabilities=capabilities,
+                                  header_cache=HeaderCache())
+
+    def test_uses_move_when_supported(self, ssl_mock):
+        iclient = self.create_client(ssl_mock,
+            b'* OK [UIDVALIDITY 7] UIDs valid\r\n',
+            b'TEST0 OK [READ-WRITE] SELECT completed\r\n',
+            b'* OK [COPYUID 9 4:5 20:21] Moved\r\n',
+            b'* 1 EXPUNGE\r\n', b'* 1 EXPUNGE\r\n',
+            b'TEST1 OK MOVE completed\r\n',
+            capabilities=("MOVE", "UIDPLUS")
+        )
+        status, data = iclient.move_emails("4,5", '"Work"', uid=True,
+                                           source_mailbox='"INBOX"')
+        self.assertEqual(iclient.mail.sent, [
+            b'TEST0 SELECT "INBOX"\r\nTEST1 UID MOVE 4:5 "Work"\r\n'
+        ])
+        self.assertEqual(data, {"uidvalidity": 9, "uids": {4: 20, 5: 21}})
+
+    def test_expunges_only_copied_messages_without_move(self, ssl_mock):
+        iclient = self.create_client(ssl_mock,
+            b'TEST0 OK [READ-WRITE] SELECT completed\r\n',
+            b'TEST1 OK [COPYUID 9 4:5 20:21] COPY completed\r\n',
+            b'TEST2 OK STORE completed\r\n',
+            b'* 1 EXPUNGE\r\n', b'* 1 EXPUNGE\r\n',
+            b'TEST3 OK EXPUNGE completed\r\n',
+            capabilities=("UIDPLUS",)
+        )
+        status, data = iclient.move_emails("4,5", '"Work"', uid=True,
+                                           source_mailbox='"INBOX"')
+        self.assertEqual(iclient.mail.sent[-1],
+                         b'TEST2 UID STORE 4:5 +FLAGS.SILENT (\\Deleted)\r\n'
+                         b'TEST3 UID EXPUNGE 4:5\r\n')
+        self.assertEqual(data["uids"], {4: 20, 5: 21})
+
+    def test_rekeys_cached_headers_of_moved_messages(self, ssl_mock):
+        header = b'Subject: Test\r\n\r\n'
+        iclient = self.create_client(ssl_mock,
+            b'* OK [UIDVALIDITY 7] UIDs valid\r\n',
+            b'TEST0 OK [READ-WRITE] SELECT completed\r\n',
+            b'* 1 FETCH (UID 4 FLAGS ())\r\n',
+            b'TEST1 OK FETCH completed\r\n',
+            b'* 1 FETCH (UID 4 BODY[HEADER.FIELDS (SUBJECT)] {%d}\r\n'
+            % len(header), header, b')\r\n',
+            b'TEST2 OK FETCH completed\r\n',
+            b'* OK [UIDVALIDITY 7] UIDs valid\r\n',
+            b'TEST3 OK [READ-WRITE] SELECT completed\r\n',
+            b'TEST4 OK [COPYUID 9 4 20] MOVE completed\r\n',
+            capabilities=("MOVE",)
+        )
+        iclient.select('"INBOX"')
+        status, headers = iclient.get_headers(4, uid=True, fields=["Subject"],
+                                              sort_by_date=False)
+        self.assertEqual(headers[0]["Subject"], "Test")
+        iclient.move_emails(4, '"Work"', uid=True, source_mailbox='"INBOX"')
+        self.assertEqual(
+            iclient.header_cache.get_many(iclient.account, "Work", 9, [20],
+                                          ["Subject"]),
+            {20: {"Subject": "Test"}}
+        )
+
+
+@patch("app.mail.client.imaplib.IMAP4_SSL")
+class GetEmailForDisplayTest(unittest.TestCase):
+
+    structure = (
+        b'((("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" '
+        b'8 1 NIL NIL NIL)("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "7BIT" '
+        b'11 1 NIL NIL NIL) "ALTERNATIVE" ("BOUNDARY" "b2") NIL NIL)'
+        b'("APPLICATION" "PDF" ("NAME" "a.pdf") NIL NIL "BASE64" 20000000 '
+        b'NIL ("ATTACHMENT" ("FILENAME" "a.pdf")) NIL) "MIXED" '
+        b'("BOUNDARY" "b1") NIL NIL)'
+    )
+
+    def create_client(self, ssl_mock):
+        header = b'Subject: Test\r\n\r\n'
+        responses = (
+            b'TEST0 OK [READ-WRITE] SELECT completed\r\n',
+            b'* 1 FETCH (UID 5 BODYSTRUCTURE ' + self.structure +
+            b' BODY[HEADER] {%d}\r\n' % len(header), header, b')\r\n',
+            b'TEST1 OK FETCH completed\r\n',
+            b'* 1 FETCH (UID 5 BODY[1.2] {11}\r\n', b'<p>Hi!</p>\n',
+            b')\r\n', b'TEST2 OK FETCH completed\r\n'
+        )
+        return create_fake_client(ssl_mock, *responses)
+
+    def test_fetches_only_preferred_text_part(self, ssl_mock):
+        iclient = self.create_client(ssl_mock)
+        iclient.get_email_for_display(5, uid=True, mailbox='"INBOX"')
+        self.assertEqual(iclient.mail.sent[-1],
+                         b'TEST2 UID FETCH 5 (BODY.PEEK[1.2])\r\n')
+
+    def test_returns_email_for_display(self, ssl_mock):
+        iclient = self.create_client(ssl_mock)
+        status, output = iclient.get_email_for_display(5, uid=True,
+                                                       mailbox='"INBOX"')
+        self.assertEqual(output["header"], {"Subject": "Test"})
+        self.assertEqual(output["type"], "node")
+        alternative, attachment = output["content"]
+        self.assertEqual(alternative["content"][0]["content"],
+                         "<p>Hi!</p>\n")
+        self.assertEqual(attachment["type"], "attachment")
+
+    def test_fetches_header_with_peek_by_default(self, ssl_mock):
+        iclient = self.create_client(ssl_mock)
+        iclient.get_email_for_display(5, uid=True, mailbox='"INBOX"')
+        self.assertIn(b'UID FETCH 5 (UID BODYSTRUCTURE BODY.PEEK[HEADER])',
+                      iclient.mail.sent[0])
+
+    def test_sets_seen_flag_when_opened_by_user(self, ssl_mock):
+        iclient = self.create_client(ssl_mock)
+        status, output = iclient.get_email_for_display(
+            5, uid=True, mailbox='"INBOX"', mark_seen=True
+        )
+        self.assertIn(b'UID FETCH 5 (UID BODYSTRUCTURE BODY[HEADER])',
+                      iclient.mail.sent[0])
+        self.assertEqual(output["header"], {"Subject": "Test"})
+
+    def test_sets_seen_flag_of_cached_email(self, ssl_mock):
+        ssl_mock.side_effect = lambda *args, **_: FakeIMAP4((
+            b'* 1 FETCH (UID 5 FLAGS (\\Seen))\r\n',
+            b'TEST0 OK STORE completed\r\n',
+        ))
+        iclient = ImapClient("imap.gmail.com", display_cache=LRUCache())
+        iclient.mail.state = "SELECTED"
+        iclient.mailbox = '"INBOX"'
+        iclient.uidvalidity = 7
+        iclient.display_cache.put(iclient._display_key(5, True, None),
+                                  {"type": "plain"})
+        status, output = iclient.get_email_for_display(
+            5, uid=True, mailbox='"INBOX"', mark_seen=True
+        )
+        self.assertEqual(output, {"type": "plain"})
+        self.assertEqual(iclient.mail.sent,
+                         [b'TEST0 UID STORE 5 +FLAGS (\\Seen)\r\n'])
+
+    def test_describes_attachments_with_metadata(self, ssl_mock):
+        iclient = self.create_client(ssl_mock)
+        status, output = iclient.get_email_for_display(5, uid=True,
+                                                       mailbox='"INBOX"')
+        self.assertEqual(output["content"][1]["attachment"], dict(
+            filename="a.pdf", content_type="application/pdf",
+            encoding="base64", size=20000000, section="2"
+        ))
+
+
+@patch("app.mail.client.imaplib.IMAP4_SSL")
+class GetPartTest(unittest.TestCase):
+
+    def create_client(self, ssl_mock):
+        responses = (
+            b'TEST0 OK [READ-WRITE] SELECT completed\r\n',
+            b'* 1 FETCH (UID 5 BODYSTRUCTURE ' + 
+            GetEmailForDisplayTest.structure + b')\r\n',
+            b'TEST1 OK FETCH completed\r\n',
+            b'* 1 FETCH (UID 5 BODY[2]<8> {4}\r\n', b'QUJD', b')\r\n',
+            b'TEST2 OK FETCH completed\r\n'
+        )
+        return create_fake_client(ssl_mock, *responses)
+
+    def test_get_part_returns_part_with_section(self, ssl_mock):
+        iclient = self.create_client(ssl_mock)
+        status, part = iclient.get_part(5, "1.2", uid=True, mailbox='"INBOX"')
+        self.assertEqual((part["maintype"], part["subtype"]), ("text", "html"))
+
+    def test_get_part_returns_none_for_unknown_section(self, ssl_mock):
+        iclient = self.create_client(ssl_mock)
+        status, part = iclient.get_part(5, "3", uid=True, mailbox='"INBOX"')
+        self.assertIsNone(part)
+
+    def test_fetch_partial_requests_and_returns_octets(self, ssl_mock):
+        iclient = self.create_client(ssl_mock)
+        iclient.get_part(5, "2", uid=True, mailbox='"INBOX"')
+        content = iclient.fetch_partial(5, "2", 8, 4, uid=True)
+        self.assertEqual(iclient.mail.sent[-1],
+                         b'TEST2 UID FETCH 5 (BODY.PEEK[2]<8.4>)\r\n')
+        self.assertEqual(content, b"QUJD")
+
+
+@patch("app.mail.client.imaplib.IMAP4_SSL")
+class CompressTest(unittest.TestCase):
+
+    def create_client(self, ssl_mock, compress=True):
+        def create_imap(*args, **kwargs):
+            imap = FakeIMAP4((
+                b'TEST0 OK [CAPABILITY IMAP4rev1 COMPRESS=DEFLATE] Logged\r\n',
+                b'TEST1 OK DEFLATE active\r\n'
+            ))
+            imap.sock, self.server = socket.socketpair()
+            self.addCleanup(imap.sock.close)
+            self.addCleanup(self.server.close)
+            return imap
+        ssl_mock.side_effect = create_imap
+        iclient = ImapClient("imap.gmail.com", compress=compress)
+        iclient.mail.state = "NONAUTH"
+        iclient.login("jago", "secret")
+        return iclient
+
+    def test_negotiates_compression_after_login(self, ssl_mock):
+        iclient = self.create_client(ssl_mock)
+        self.assertEqual(iclient.mail.sent[-1], b'TEST1 COMPRESS DEFLATE\r\n')
+        iclient.socket().sendall(b'TEST2 NOOP\r\n')
+        self.assertEqual(zlib.decompressobj(-15).decompress(
+            self.server.recv(1024)
+        ), b'TEST2 NOOP\r\n')
+        self.assertEqual(iclient.compression_stats()["sent"], 12)
+
+    def test_compression_can_be_disabled(self, ssl_mock):
+        iclient = self.create_client(ssl_mock, compress=False)
+        self.assertEqual(len(iclient.mail.sent), 1)
+        self.assertIsNone(iclient.compression_stats())
+
+
+class SequenceSetTest(unittest.TestCase):
+
+    def test_compresses_runs_of_ids_to_ranges(self):
+        self.assertEqual(ids_to_bytes([7, 3, 1, 2, 2]), b"1:3,7")
+        self.assertEqual(ids_to_bytes("5, 1,2,3:4"), b"1:5")
+        self.assertEqual(ids_to_bytes(range(20000, 0, -1)), b"1:20000")
+        self.assertEqual(ids_to_bytes("1:*"), b"1:*")
+
+    def test_merges_ranges_without_expanding_them(self):
+        self.assertEqual(ids_to_bytes("1:1000000000,5:3,2000000000"),
+                         b"1:1000000000,2000000000")
+        self.assertEqual(ids_to_bytes(IdSet.from_sequence_set("3:1,7")),
+                         b"1:3,7")
+
+    def test_splits_long_sets_at_commas(self):
+        self.assertEqual(split_sequence_set(b"1:3,5,7:9,11", max_length=6),
+                         [b"1:3,5", b"7:9,11"])
+        self.assertEqual(split_sequence_set(b"1:3"), [b"1:3"])
+
+
+@patch("app.mail.client.imaplib.IMAP4_SSL")
+class SplitCommandsTest(unittest.TestCase):
+
+    def test_stores_long_sets_in_one_round_trip(self, ssl_mock):
+        iclient = create_fake_client(ssl_mock,
+            b'TEST0 OK [READ-WRITE] SELECT completed\r\n',
+            b'* 1 FETCH (UID 1 FLAGS (\\Seen))\r\n',
+            b'TEST1 OK STORE completed\r\n',
+            b'* 4 FETCH (UID 7 FLAGS (\\Seen))\r\n',
+            b'TEST2 OK STORE completed\r\n'
+        )
+        with patch("app.mail.client.MAX_SEQUENCE_SET", 6):
+            status, data = iclient.add_flags(
+                [1, 2, 3, 5, 7, 8, 9, 11], "\\Seen", uid=True,
+                mailbox='"INBOX"'
+            )
+        self.assertEqual(status, "OK")
+        self.assertEqual(iclient.mail.sent, [
+            b'TEST0 SELECT "INBOX"\r\n'
+            b'TEST1 UID STORE 1:3,5 +FLAGS \\Seen\r\n'
+            b'TEST2 UID STORE 7:9,11 +FLAGS \\Seen\r\n'
+        ])
+
+    def test_merges_copyuid_of_split_moves(self, ssl_mock):
+        iclient = create_fake_client(ssl_mock,
+            b'* OK [COPYUID 9 1:3,5 20:23] Moved\r\n',
+            b'TEST0 OK MOVE completed\r\n',
+            b'TEST1 OK [COPYUID 9 7:9,11 24:27] MOVE completed\r\n',
+            capabilities=("MOVE",)
+        )
+        iclient.mail.state = "SELECTED"
+        with patch("app.mail.client.MAX_SEQUENCE_SET", 6):
+            status, copyuid = iclient.move_emails("1:3,5,7:9,11", '"Work"',
+                                                  uid=True)
+        self.assertEqual(len(iclient.mail.sent), 1)
+        self.assertEqual(copyuid["uids"][1], 20)
+        self.assertEqual(copyuid["uids"][11], 27)
+
+    def test_fetches_long_sets_by_several_commands(self, ssl_mock):
+        iclient = create_fake_client(ssl_mock,
+            b'* 1 FETCH (UID 1 FLAGS ())\r\n', b'TEST0 OK FETCH completed\r\n',
+            b'* 4 FETCH (UID 7 FLAGS ())\r\n', b'TEST1 OK FETCH completed\r\n'
+        )
+        iclient.mail.state = "SELECTED"
+        with patch("app.mail.client.MAX_SEQUENCE_SET", 6):
+            data = iclient._fetch(b"1:3,5,7:9,11", "(FLAGS)", uid=True)
+        self.assertEqual(len(data), 2)
+        self.assertEqual(len(iclient.mail.sent), 1)
+
+
+@patch("app.mail.client.imaplib.IMAP4_SSL")
+class ESearchTest(unittest.TestCase):
+
+    def create_client(self, ssl_mock, *responses, capabilities=("ESEARCH",)):
+        return create_fake_client(ssl_mock, *responses,
+                                  capabilities=capabilities)
+
+    def test_list_mailbox_returns_ranges_of_esearch(self, ssl_mock):
+        iclient = self.create_client(ssl_mock,
+            b'TEST0 OK [READ-WRITE] SELECT completed\r\n',
+            b'* ESEARCH (TAG "TEST1") UID MIN 1 MAX 200000 COUNT 199999 '
+            b'ALL 1:6,8:200000\r\n',
+            b'TEST1 OK SEARCH completed\r\n'
+        )
+        status, uids = iclient.list_mailbox("INBOX", uid=True)
+        self.assertEqual(iclient.mail.sent[1],
+                         b'TEST1 UID SEARCH RETURN (MIN MAX COUNT ALL) ALL\r\n')
+        self.assertIsInstance(uids, IdSet)
+        self.assertEqual(len(uids), 199999)
+        self.assertNotIn(7, uids)
+        self.assertEqual(uids[-2:], [199999, 200000])
+
+    def test_list_mailbox_sends_partial_when_supported(self, ssl_mock):
+        iclient = self.create_client(ssl_mock,
+            b'TEST0 OK [READ-WRITE] SELECT completed\r\n',
+            b'* ESEARCH (TAG "TEST1") UID PARTIAL (-1:-3 98:100)\r\n',
+            b'TEST1 OK SEARCH completed\r\n',
+            capabilities=("ESEARCH", "PARTIAL")
+        )
+        status, uids = iclient.list_mailbox("INBOX", uid=True,
+                                            partial="-1:-3")
+        self.assertEqual(iclient.mail.sent[1],
+                         b'TEST1 UID SEARCH RETURN (PARTIAL -1:-3) ALL\r\n')
+        self.assertEqual(uids, [98, 99, 100])
+
+    def test_list_mailbox_slices_result_without_partial(self, ssl_mock):
+        iclient = self.create_client(ssl_mock,
+            b'TEST0 OK [READ-WRITE] SELECT completed\r\n',
+            b'* SEARCH 1 2 3 5 8\r\n', b'TEST1 OK SEARCH completed\r\n',
+            capabilities=()
+        )
+        status, ids = iclient.list_mailbox("INBOX", partial="-1:-2")
+        self.assertEqual(ids, [5, 8])
+
+    def test_list_mailbox_rejects_invalid_partial(self, ssl_mock):
+        iclient = self.create_client(ssl_mock,
+            capabilities=("ESEARCH", "PARTIAL")
+        )
+        for partial in ("abc", "3", "0:5", "-1:5", "1:2)\r\nTEST9 LOGOUT"):
+            with self.assertRaises(ImapClientError):
+                iclient.list_mailbox("INBOX", partial=partial)
+        self.assertEqual(iclient.mail.sent, [])
+
+    def test_list_mailbox_returns_empty_set_without_matches(self, ssl_mock):
+        iclient = self.create_client(ssl_mock,
+            b'TEST0 OK [READ-WRITE] SELECT completed\r\n',
+            b'* ESEARCH (TAG "TEST1") COUNT 0\r\n',
+            b'TEST1 OK SEARCH completed\r\n'
+        )
+        status, ids = iclient.list_mailbox("INBOX", "UNSEEN")
+        self.assertEqual(status, "OK")
+        self.assertEqual(ids, [])
+
+    def test_parses_esearch_items(self, ssl_mock):
+        result = parse_esearch([b'(TAG "A1") UID MIN 2 MAX 9 COUNT 3 '
+                                b'ALL 2,8:9'])
+        self.assertEqual(result["UID"], True)
+        self.assertEqual((result["MIN"], result["MAX"], result["COUNT"]),
+                         (2, 9, 3))
+        self.assertEqual(result["ALL"].to_sequence_set(), "2,8:9")
+        self.assertEqual(parse_esearch([b'PARTIAL (1:10 NIL)'])["PARTIAL"],
+                         [])
+
+
+@patch("app.mail.client.imaplib.IMAP4_SSL")
+class IterEmailsTest(unittest.TestCase):
+
+    @staticmethod
+    def email_response(uid, subject):
+        message = b"Subject: %s\r\n\r\nHi\r\n" % subject
+        return (b"* %d FETCH (UID %d RFC822 {%d}\r\n"
+                % (uid, uid, len(message)) + message + b")\r\n")
+
+    def test_fetches_emails_in_chunks(self, ssl_mock):
+        iclient = create_fake_client(ssl_mock,
+            self.email_response(1, b"One"), self.email_response(2, b"Two"),
+            b"TEST0 OK FETCH completed\r\n",
+            self.email_response(5, b"Five"), b"TEST1 OK FETCH completed\r\n"
+        )
+        emails = iclient.iter_emails("5,1:2", uid=True, chunk_size=2)
+        self.assertEqual([msg["Subject"] for msg in emails],
+                         ["One", "Two", "Five"])
+        self.assertEqual(iclient.mail.sent, [
+            b"TEST0 UID FETCH 1:2 (RFC822)\r\n",
+            b"TEST1 UID FETCH 5 (RFC822)\r\n"
+        ])
+
+    def test_yields_emails_before_the_command_completes(self, ssl_mock):
+        iclient = create_fake_client(ssl_mock,
+            self.email_response(1, b"One"), self.email_response(2, b"Two"),
+            b"TEST0 OK FETCH completed\r\n",
+            b"TEST1 OK NOOP completed\r\n"
+        )
+        emails = iclient.iter_emails("1:2", uid=True)
+        self.assertEqual(next(emails)["Subject"], "One")
+        # The second e-mail has not been read yet.
+        self.assertTrue(iclient.mail.input.read().startswith(b"* 2 FETCH"))
+
+    def test_drops_rest_of_responses_when_closed_early(self, ssl_mock):
+        iclient = create_fake_client(ssl_mock,
+            self.email_response(1, b"One"), self.email_response(2, b"Two"),
+            b"TEST0 OK FETCH completed\r\n",
+            b"TEST1 OK NOOP completed\r\n"
+        )
+        emails = iclient.iter_emails("1:2", uid=True)
+        next(emails)
+        emails.close()
+        [(status, data, untagged)] = iclient.pipeline(("NOOP",))
+        self.assertEqual(status, "OK")
+        self.assertNotIn("FETCH", untagged)
+
+    def test_marks_client_as_broken_when_drain_fails(self, ssl_mock):
+        iclient = create_fake_client(ssl_mock,
+            self.email_response(1, b"One"), self.email_response(2, b"Two")
+        )
+        emails = iclient.iter_emails("1:2", uid=True)
+        self.assertFalse(iclient.broken)
+        next(emails)
+        emails.close()
+        self.assertTrue(iclient.broken)
+
+    def test_parses_8bit_emails_in_other_charsets(self, ssl_mock):
+        iclient = create_fake_client(ssl_mock,
+            self.email_response(1, b"Za\xbf\xf3\xb3\xe6"),
+            b"TEST0 OK FETCH completed\r\n"
+        )
+        [msg] = iclient.iter_emails("1", uid=True)
+        self.assertEqual(msg.get_payload(), "Hi\r\n")
+
+    def test_raises_error_when_fetch_fails(self, ssl_mock):
+        iclient = create_fake_client(ssl_mock,
+            b"TEST0 BAD Invalid sequence set\r\n"
+        )
+        with self.assertRaises(ImapClientError):
+            list(iclient.iter_emails("1", uid=True))
+
+
+@patch("app.mail.client.imaplib.IMAP4_SSL")
+class InstrumentationTest(unittest.TestCase):
+
+    def create_client(self, ssl_mock, *responses):
+        self.events = list()
+        return create_fake_client(
+            ssl_mock, *responses, state="NONAUTH",
+            instrumentation=Mock(record=self.events.append)
+        )
+
+    def test_records_commands_with_status(self, ssl_mock):
+        iclient = self.create_client(ssl_mock,
+            b'TEST0 OK Logged in\r\n',
+            b'TEST1 OK [READ-WRITE] SELECT completed\r\n',
+            b'* 1 FETCH (UID 5 RFC822 {21}\r\n', b'Subject: Test\r\n\r\nHi\r\n',
+            b')\r\n', b'TEST2 OK FETCH completed\r\n',
+            b'TEST3 NO Mailbox does not exist\r\n'
+        )
+        iclient.login("jago", "secret")
+        iclient.get_emails(5, uid=True, mailbox='"INBOX"')
+        with self.assertRaises(ImapClientError):
+            iclient.select('"X"')
+        self.assertEqual(
+            [(event.account, event.command, event.status)
+             for event in self.events],
+            [("imap.gmail.com", "CONNECT", "OK"),
+             ("jago@imap.gmail.com", "LOGIN", "OK"),
+             ("jago@imap.gmail.com", "SELECT + UID FETCH", "OK"),
+             ("jago@imap.gmail.com", "SELECT", "NO")]
+        )
+
+    def test_records_errors_of_failed_connection(self, ssl_mock):
+        iclient = self.create_client(ssl_mock)
+        iclient.mail.state = "SELECTED"
+        with self.assertRaises(ImapClientError):
+            iclient.pipeline(("NOOP",))  # connection closed (no response)
+        self.assertEqual(self.events[-1].command, "NOOP")
+        self.assertEqual(self.events[-1].status, "ERROR")
+
+
+@patch("app.mail.client.imaplib.IMAP4_SSL")
+class SortHeadersTest(unittest.TestCase):
+
+    @staticmethod
+    def header_response(seq, date, subject):
+        header = b'Subject: %s\r\nDate: Someday\r\n\r\n' % subject
+        return (b'* %d FETCH (UID %d INTERNALDATE "%s" BODY[HEADER] {%d}\r\n'
+                % (seq, seq, date, len(header)) + header + b')\r\n')
+
+    def create_client(self, ssl_mock, *responses, capabilities=()):
+        return create_fake_client(ssl_mock, *responses,
+                                  capabilities=capabilities,
+                                  state="SELECTED")
+
+    def test_sorts_by_internaldate_without_sort_extension(self, ssl_mock):
+        iclient = self.create_client(ssl_mock,
+            self.header_response(1, b"03-Feb-2017 10:00:00 +0000", b"One"),
+            self.header_response(2, b"01-Feb-2017 10:00:00 +0000", b"Two"),
+            b'TEST0 OK FETCH completed\r\n'
+        )
+        status, headers = iclient.get_headers("1:2", uid=True, flags=False)
+        self.assertEqual(iclient.mail.sent, [
+            b'TEST0 UID FETCH 1:2 (INTERNALDATE BODY.PEEK[HEADER])\r\n'
+        ])
+        self.assertEqual([header["Subject"] for header in headers],
+                         ["Two", "One"])
+
+    def test_uses_server_side_sort(self, ssl_mock):
+        iclient = self.create_client(ssl_mock,
+            b'* SORT 2 1\r\n', b'TEST0 OK SORT completed\r\n',
+            self.header_response(1, b"03-Feb-2017 10:00:00 +0000", b"One"),
+            self.header_response(2, b"01-Feb-2017 10:00:00 +0000", b"Two"),
+            b'TEST1 OK FETCH completed\r\n',
+            capabilities=("SORT",)
+        )
+        status, headers = iclient.get_headers([1, 2], uid=True, flags=False)
+        self.assertEqual(iclient.mail.sent[0],
+                         b'TEST0 UID SORT (DATE) UTF-8 UID 1:2\r\n')
+        self.assertEqual([header["id"] for header in headers], [2, 1])
+
+    def test_header_date_tolerates_malformed_dates(self, ssl_mock):
+        self.assertEqual(header_date({"Date": "Someday"}), 0)
+        self.assertEqual(header_date({}), 0)
+        self.assertEqual(
+            header_date({"Date": "Wed, 1 Feb 2017 10:00:00 +0100 (CET)"}),
+            1485939600
+        )
+
+
+@patch("app.mail.client.imaplib.IMAP4_SSL")
+class GetHeadersPageTest(unittest.TestCase):
+
+    @staticmethod
+    def header_response(seq, uid, subject):
+        header = b'Subject: %s\r\n\r\n' % subject
+        return (b'* %d FETCH (UID %d FLAGS () BODY[HEADER.FIELDS (SUBJECT)] '
+                b'{%d}\r\n' % (seq, uid, len(header)) + header + b')\r\n')
+
+    def create_client(self, ssl_mock):
+        responses = (
+            b'* 3 EXISTS\r\n', b'* OK [UIDVALIDITY 7] UIDs valid\r\n',
+            b'TEST0 OK [READ-WRITE] SELECT completed\r\n',
+            b'* 1 FETCH (UID 1 INTERNALDATE "01-Feb-2017 10:00:00 +0000")\r\n',
+            b'* 2 FETCH (UID 2 INTERNALDATE "03-Feb-2017 10:00:00 +0000")\r\n',
+            b'* 3 FETCH (UID 3 INTERNALDATE "02-Feb-2017 10:00:00 +0000")\r\n',
+            b'TEST1 OK FETCH completed\r\n',
+            self.header_response(2, 2, b'Two'), 
+            self.header_response(3, 3, b'Three'),
+            b'TEST2 OK FETCH completed\r\n',
+            self.header_response(1, 1, b'One'),
+            b'TEST3 OK FETCH completed\r\n'
+        )
+        iclient = create_fake_client(ssl_mock, *responses)
+        iclient.username = "jago"
+        return iclient
+
+    def test_returns_the_newest_emails_first(self, ssl_mock):
+        iclient = self.create_client(ssl_mock)
+        status, page = iclient.get_headers_page('"INBOX"', limit=2, 
+                                                fields=["Subject"])
+        self.assertEqual([header["Subject"] for header in page["headers"]],
+                         ["Two", "Three"])
+        self.assertEqual(page["total"], 3)
+        self.assertIsNotNone(page["next_cursor"])
+
+    def test_next_page_costs_single_fetch(self, ssl_mock):
+        iclient = self.create_client(ssl_mock)
+        status, page = iclient.get_headers_page('"INBOX"', limit=2, 
+                                                fields=["Subject"])
+        sent = len(iclient.mail.sent)
+        status, page = iclient.get_headers_page(
+            '"INBOX"', cursor=page["next_cursor"], limit=2, fields=["Subject"]
+        )
+        self.assertEqual(iclient.mail.sent[sent:], [
+            b'TEST3 UID FETCH 1 (FLAGS BODY.PEEK[HEADER.FIELDS (Subject)])\r\n'
+        ])
+        self.assertEqual(page["headers"][0]["Subject"], "One")
+        self.assertIsNone(page["next_cursor"])
+
+    def test_raises_error_for_invalid_cursor(self, ssl_mock):
+        iclient = self.create_client(ssl_mock)
+        with self.assertRaises(ImapClientError):
+            iclient.get_headers_page('"INBOX"', cursor="abc")
+
+
 @patch("app.mail.client.imaplib")
 class ListMailboxTest(FlaskTestCase):
 
@@ -683,7 +1797,15 @@ class ListMailboxTest(FlaskTestCase):
     def test_init_passes_addr_to_imap(self, imap_mock):
         imap_mock.IMAP4_SSL = Mock()
         iclient = ImapClient("imap.gmail.com")
-        imap_mock.IMAP4_SSL.assert_called_with("imap.gmail.com")
+        imap_mock.IMAP4_SSL.assert_called_with("imap.gmail.com", 993,
+                                               ssl_context=None, timeout=None)
+
+    def test_init_sets_timeout_of_connection_only(self, imap_mock):
+        imap_mock.IMAP4_SSL = Mock()
+        iclient = ImapClient("imap.gmail.com", timeout=7)
+        imap_mock.IMAP4_SSL.assert_called_with("imap.gmail.com", 993,
+                                               ssl_context=None, timeout=7)
+        self.assertEqual(socket.getdefaulttimeout(), 5)
 
     def test_init_saves_imap_object_in_mail(self, imap_mock):
         test_mock = Mock()
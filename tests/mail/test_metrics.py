@@ -0,0 +1,55 @@
+import unittest
+import logging
+from unittest.mock import Mock
+
+from app.mail.metrics import (
+    CommandEvent, Instrumentation, LogSink, StatsRegistry, server_timing
+)
+
+
+def event(command="UID FETCH", status="OK", duration=0.01, received=100):
+    return CommandEvent("jago@imap.gmail.com", command, status, duration,
+                        20, received, received)
+
+
+class StatsRegistryTest(unittest.TestCase):
+
+    def test_aggregates_commands_by_name(self):
+        stats = StatsRegistry()
+        stats.record(event(duration=0.01))
+        stats.record(event(duration=0.03, status="NO"))
+        stats.record(event("LOGIN"))
+        fetch = stats.snapshot()["UID FETCH"]
+        self.assertEqual(fetch["count"], 2)
+        self.assertEqual(fetch["errors"], 1)
+        self.assertAlmostEqual(fetch["time"], 0.04)
+        self.assertEqual(fetch["max_time"], 0.03)
+        self.assertEqual(fetch["received"], 200)
+        self.assertEqual(stats.snapshot()["LOGIN"]["count"], 1)
+        stats.reset()
+        self.assertEqual(stats.snapshot(), {})
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def test_passes_events_to_all_sinks_despite_failures(self):
+        failing = Mock(record=Mock(side_effect=ValueError))
+        sink = Mock()
+        with self.assertLogs("app.mail.metrics", logging.ERROR):
+            Instrumentation([failing, sink]).record(event())
+        sink.record.assert_called_with(event())
+
+    def test_log_sink_writes_line_per_command(self):
+        with self.assertLogs("app.mail.metrics", logging.INFO) as logs:
+            LogSink().record(event())
+        self.assertIn("UID FETCH OK 10.0 ms sent=20 received=100",
+                      logs.output[0])
+
+    def test_formats_server_timing_header(self):
+        self.assertEqual(
+            server_timing([event("LOGIN", duration=0.002, received=40),
+                           event("SELECT + UID FETCH", duration=0.0125)]),
+            'imap0;desc="LOGIN OK 40B";dur=2.0, '
+            'imap1;desc="SELECT + UID FETCH OK 100B";dur=12.5, '
+            'imap;dur=14.5'
+        )
@@ -0,0 +1,99 @@
+import unittest
+
+from app.mail.parser import (
+    parse_fetch, parse_header, decode_fields, get_section, FetchParseError,
+    parse_bodystructure
+)
+from app.mail.client import default_decoders
+from tests.mail import imap_responses
+
+
+class ParseFetchTest(unittest.TestCase):
+
+    def test_parses_data_items_without_literals(self):
+        messages = parse_fetch([
+            b'12 (UID 5 FLAGS (\\Seen \\Flagged) MODSEQ (77) RFC822.SIZE 44 '
+            b'INTERNALDATE "17-Jul-1996 02:44:25 -0700")'
+        ])
+        self.assertEqual(messages, [(12, {
+            "UID": 5, "FLAGS": ["\\Seen", "\\Flagged"], "MODSEQ": 77,
+            "RFC822.SIZE": 44, "INTERNALDATE": "17-Jul-1996 02:44:25 -0700"
+        })])
+
+    def test_returns_section_literals(self):
+        messages = parse_fetch(imap_responses.fetch_uid[1])
+        seq, items = messages[0]
+        self.assertEqual(items["UID"], 2043)
+        self.assertTrue(get_section(items).startswith(b"From: CodinGame"))
+
+    def test_parses_many_messages(self):
+        messages = parse_fetch(imap_responses.fetch2[1])
+        self.assertEqual([seq for seq, _ in messages], [2043, 2044])
+
+    def test_parses_items_after_literal(self):
+        messages = parse_fetch([
+            (b'1 (BODY[HEADER] {11}', b'Subject: a\r\n'),
+            b' UID 7 FLAGS ())'
+        ])
+        self.assertEqual(messages[0][1]["UID"], 7)
+        self.assertEqual(messages[0][1]["FLAGS"], [])
+
+    def test_raises_error_when_response_malformed(self):
+        with self.assertRaises(FetchParseError):
+            parse_fetch([b'1 (UID 7 FLAGS (\\Seen)'])
+
+
+class ParseHeaderTest(unittest.TestCase):
+
+    def test_unfolds_values(self):
+        header = parse_header(b'Subject: Long\r\n subject\r\n\r\n')
+        self.assertEqual(header, {"Subject": "Long subject"})
+
+    def test_skips_not_requested_fields(self):
+        header = parse_header(b'Subject: Test\r\nFrom: a@b.pl\r\n\r\n',
+                              {"FROM"})
+        self.assertEqual(header, {"From": "a@b.pl"})
+
+    def test_keeps_first_occurrence_of_field(self):
+        header = parse_header(b'Received: first\r\nReceived: second\r\n')
+        self.assertEqual(header, {"Received": "first"})
+
+    def test_decodes_encoded_words(self):
+        header = decode_fields(
+            parse_header(b'Subject: =?utf-8?B?xZp3acSZdGE=?=\r\n'),
+            default_decoders
+        )
+        self.assertEqual(header["Subject"], "Święta")
+
+
+class ParseBodystructureTest(unittest.TestCase):
+
+    def parse(self, structure):
+        messages = parse_fetch([b'1 (BODYSTRUCTURE ' + structure + b')'])
+        return parse_bodystructure(messages[0][1]["BODYSTRUCTURE"])
+
+    def test_numbers_part_of_single_part_message(self):
+        part = self.parse(b'("TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL '
+                          b'"7BIT" 3 1)')
+        self.assertEqual(part["section"], "1")
+        self.assertEqual(part["params"], {"charset": "us-ascii"})
+
+    def test_numbers_nested_parts(self):
+        part = self.parse(
+            b'((("TEXT" "PLAIN" NIL NIL NIL "7BIT" 3 1)'
+            b'("TEXT" "HTML" NIL NIL NIL "7BIT" 3 1) "ALTERNATIVE")'
+            b'("IMAGE" "PNG" NIL NIL NIL "BASE64" 10) "MIXED")'
+        )
+        self.assertEqual(part["subtype"], "mixed")
+        self.assertEqual([subpart["section"]
+                          for subpart in part["parts"][0]["parts"]],
+                         ["1.1", "1.2"])
+        self.assertEqual(part["parts"][1]["section"], "2")
+
+    def test_decodes_disposition_and_encoded_filename(self):
+        part = self.parse(
+            b'("APPLICATION" "PDF" NIL NIL NIL "BASE64" 10 NIL '
+            b'("ATTACHMENT" ("FILENAME*" "utf-8\'\'f%C3%B3o.pdf")) NIL)'
+        )
+        self.assertEqual(part["disposition"], "attachment")
+        self.assertEqual(part["disposition_params"], {"filename": "fóo.pdf"})
@@ -0,0 +1,111 @@
+import unittest
+from unittest.mock import Mock
+
+from app.mail.pool import ImapPool
+from app.mail.client import ImapClientError
+
+
+class ImapPoolTest(unittest.TestCase):
+
+    def create_pool(self, **kwargs):
+        self.connect = Mock(side_effect=lambda *args: Mock())
+        return ImapPool(self.connect, **kwargs)
+
+    def test_acquire_opens_new_connection_when_pool_empty(self):
+        pool = self.create_pool()
+        client = pool.acquire("imap.gmail.com", "Test", "test")
+        self.connect.assert_called_with("imap.gmail.com", "Test", "test")
+        self.assertIsNotNone(client)
+
+    def test_reuses_released_connection(self):
+        pool = self.create_pool()
+        client = pool.acquire("imap.gmail.com", "Test", "test")
+        pool.release(client)
+        client2 = pool.acquire("imap.gmail.com", "Test", "test")
+        self.assertIs(client, client2)
+        self.assertEqual(self.connect.call_count, 1)
+
+    def test_does_not_share_connections_between_accounts(self):
+        pool = self.create_pool()
+        client = pool.acquire("imap.gmail.com", "Test", "test")
+        pool.release(client)
+        client2 = pool.acquire("imap.gmail.com", "Test2", "test")
+        self.assertIsNot(client, client2)
+
+    def test_does_not_reuse_connection_for_different_password(self):
+        pool = self.create_pool()
+        client = pool.acquire("imap.gmail.com", "Test", "test")
+        pool.release(client)
+        client2 = pool.acquire("imap.gmail.com", "Test", "wrong")
+        self.assertIsNot(client, client2)
+        client.logout.assert_called_with()
+
+    def test_discarded_connection_is_logged_out(self):
+        pool = self.create_pool()
+        client = pool.acquire("imap.gmail.com", "Test", "test")
+        pool.release(client, discard=True)
+        client.logout.assert_called_with()
+        client2 = pool.acquire("imap.gmail.com", "Test", "test")
+        self.assertIsNot(client, client2)
+
+    def test_broken_connection_is_logged_out(self):
+        pool = self.create_pool()
+        client = pool.acquire("imap.gmail.com", "Test", "test")
+        client.broken = True
+        pool.release(client)
+        client.logout.assert_called_with()
+        client2 = pool.acquire("imap.gmail.com", "Test", "test")
+        self.assertIsNot(client, client2)
+
+    def test_checks_connection_with_noop_after_check_interval(self):
+        pool = self.create_pool(check_interval=0)
+        client = pool.acquire("imap.gmail.com", "Test", "test")
+        client.noop.return_value = ("OK", [b"NOOP completed"])
+        pool.release(client)
+        client2 = pool.acquire("imap.gmail.com", "Test", "test")
+        self.assertTrue(client.noop.called)
+        self.assertIs(client, client2)
+
+    def test_reconnects_when_noop_fails(self):
+        pool = self.create_pool(check_interval=0)
+        client = pool.acquire("imap.gmail.com", "Test", "test")
+        client.noop.side_effect = OSError("connection reset")
+        pool.release(client)
+        client2 = pool.acquire("imap.gmail.com", "Test", "test")
+        self.assertIsNot(client, client2)
+        self.assertEqual(self.connect.call_count, 2)
+
+    def test_evicts_idle_connections(self):
+        pool = self.create_pool(idle_timeout=0)
+        client = pool.acquire("imap.gmail.com", "Test", "test")
+        pool.release(client)
+        pool.acquire("imap.gmail.com", "Test2", "test")
+        client.logout.assert_called_with()
+
+    def test_raises_error_when_account_limit_reached(self):
+        pool = self.create_pool(max_per_account=1, acquire_timeout=0)
+        pool.acquire("imap.gmail.com", "Test", "test")
+        with self.assertRaises(ImapClientError):
+            pool.acquire("imap.gmail.com", "Test", "test")
+
+    def test_releases_slot_when_connect_fails(self):
+        pool = self.create_pool(max_per_account=1, acquire_timeout=0)
+        self.connect.side_effect = ImapClientError("Invalid credentials")
+        with self.assertRaises(ImapClientError):
+            pool.acquire("imap.gmail.com", "Test", "test")
+        self.connect.side_effect = lambda *args: Mock()
+        pool.acquire("imap.gmail.com", "Test", "test")
+
+    def test_put_adds_authenticated_client(self):
+        pool = self.create_pool()
+        client = Mock()
+        pool.put("imap.gmail.com", "Test", "test", client)
+        self.assertIs(pool.acquire("imap.gmail.com", "Test", "test"), client)
+        self.assertFalse(self.connect.called)
+
+    def test_discard_account_closes_busy_connections_on_release(self):
+        pool = self.create_pool()
+        client = pool.acquire("imap.gmail.com", "Test", "test")
+        pool.discard_account("imap.gmail.com", "Test")
+        pool.release(client)
+        client.logout.assert_called_with()
@@ -0,0 +1,65 @@
+import unittest
+import threading
+from unittest.mock import Mock, ANY
+
+from app.mail.prefetch import Prefetcher
+from app.mail.fanout import Account
+from app.mail.client import ImapClientError
+
+
+class PrefetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = Mock(acquire=Mock(side_effect=lambda *args: Mock()))
+        self.prefetcher = Prefetcher(self.pool, max_workers=2,
+                                     max_per_account=1)
+        self.account = Account("imap.gmail.com", "jago", "secret")
+        self.done = threading.Event()
+
+    def wait(self):
+        self.assertTrue(self.done.wait(5))
+        self.prefetcher._executor.shutdown(wait=True)
+
+    def test_runs_tasks_of_account_on_one_connection(self):
+        clients = list()
+        def failing(client):
+            raise ImapClientError("No such message.")
+        self.prefetcher.schedule(self.account, "INBOX", [
+            clients.append, failing, clients.append,
+            lambda client: self.done.set()
+        ])
+        self.wait()
+        self.assertEqual(len(clients), 2)
+        self.assertIs(clients[0], clients[1])
+        self.pool.release.assert_called_once_with(clients[0], discard=False)
+
+    def test_switching_mailbox_cancels_previous_jobs(self):
+        started = threading.Event()
+        resume = threading.Event()
+        calls = list()
+        def block(client):
+            started.set()
+            resume.wait(5)
+        self.prefetcher.schedule(self.account, "INBOX", [
+            block, lambda client: calls.append("INBOX")
+        ])
+        self.assertTrue(started.wait(5))
+        self.prefetcher.schedule(self.account, "INBOX", [
+            lambda client: calls.append("INBOX next")
+        ])
+        self.prefetcher.schedule(self.account, "Work", [
+            lambda client: calls.append("Work"),
+            lambda client: self.done.set()
+        ])
+        resume.set()
+        self.wait()
+        self.assertEqual(calls, ["Work"])
+
+    def test_discards_connection_after_unexpected_error(self):
+        def broken(client):
+            self.done.set()
+            raise OSError("Connection reset.")
+        self.prefetcher.schedule(self.account, "INBOX", [broken])
+        self.wait()
+        self.pool.release.assert_called_once_with(ANY, discard=True)
+
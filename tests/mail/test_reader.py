@@ -0,0 +1,64 @@
+import unittest
+from unittest.mock import Mock
+import socket
+
+from app.mail.reader import ResponseReader
+
+
+class ResponseReaderTest(unittest.TestCase):
+
+    def create_reader(self, *chunks):
+        sock = Mock()
+        sock.recv.side_effect = list(chunks)
+        return ResponseReader(sock)
+
+    def test_returns_untagged_responses_and_completion(self):
+        reader = self.create_reader(
+            b'* SEARCH 3 4\r\nA2444 OK SEARCH completed\r\n'
+        )
+        untagged, completion = reader.read_response()
+        self.assertEqual(untagged, [b'* SEARCH 3 4'])
+        self.assertEqual(completion, b'A2444 OK SEARCH completed')
+
+    def test_joins_responses_split_between_chunks(self):
+        reader = self.create_reader(b'* SEARCH 3', b' 4\r', b'\nA2444 OK',
+                                    b' SEARCH completed\r\n')
+        untagged, _ = reader.read_response()
+        self.assertEqual(untagged, [b'* SEARCH 3 4'])
+
+    def test_reads_literals_containing_crlf(self):
+        reader = self.create_reader(
+            b'* 1 FETCH (BODY[] {12}\r\nA1 OK\r\nX: y\r\n)\r\n',
+            b'A2 OK FETCH completed\r\n'
+        )
+        untagged, completion = reader.read_response(b"A2")
+        self.assertEqual(untagged, 
+                         [b'* 1 FETCH (BODY[] {12}\r\nA1 OK\r\nX: y\r\n)'])
+        self.assertEqual(completion, b'A2 OK FETCH completed')
+
+    def test_skips_responses_with_other_tags(self):
+        reader = self.create_reader(b'A1 OK NOOP completed\r\n',
+                                    b'A2 OK SEARCH completed\r\n')
+        _, completion = reader.read_response(b"A2")
+        self.assertEqual(completion, b'A2 OK SEARCH completed')
+
+    def test_stops_at_continuation_request(self):
+        reader = self.create_reader(b'+ go ahead\r\n')
+        _, completion = reader.read_response(b"A2")
+        self.assertEqual(completion, b'+ go ahead')
+
+    def test_does_not_read_after_completion(self):
+        reader = self.create_reader(b'A2 OK SEARCH completed\r\n',
+                                    b'* 5 EXISTS\r\n')
+        reader.read_response(b"A2")
+        self.assertEqual(reader.sock.recv.call_count, 1)
+
+    def test_raises_error_when_connection_closed(self):
+        reader = self.create_reader(b'* SEARCH 3', b'')
+        with self.assertRaises(ConnectionError):
+            reader.read_response()
+
+    def test_raises_timeout_when_response_incomplete(self):
+        reader = self.create_reader(b'* SEARCH 3', socket.timeout)
+        with self.assertRaises(socket.timeout):
+            reader.read_response(timeout=5)
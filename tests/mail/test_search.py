@@ -0,0 +1,77 @@
+import unittest
+
+from app.mail.search import (
+    SearchIndex, SearchQuery, make_document, html_to_text
+)
+
+
+class SearchQueryTest(unittest.TestCase):
+
+    def test_translates_text_criteria_to_columns(self):
+        query = SearchQuery.from_criteria([
+            {"key": "SUBJECT", "value": "Zażółć", "decode": True},
+            {"key": "BODY", "value": 'say "hi"', "decode": True}
+        ])
+        self.assertEqual(query.match, '{subject} : "Zażółć" AND '
+                                      '{body} : "say ""hi"""')
+        self.assertTrue(query.needs_body)
+
+    def test_translates_sent_dates(self):
+        query = SearchQuery.from_criteria([
+            {"key": "SENTSINCE", "value": "1-Feb-2017", "decode": False}
+        ])
+        self.assertIsNone(query.match)
+        self.assertEqual(query.dates[0][0], "SENTSINCE")
+
+    def test_returns_none_for_unsupported_criteria(self):
+        self.assertIsNone(SearchQuery.from_criteria([{"key": "UNSEEN"}]))
+        self.assertIsNone(SearchQuery.from_criteria([
+            {"key": "SUBJECT", "value": "ab", "decode": True}
+        ]))
+
+
+class SearchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        if not SearchIndex.is_supported():
+            self.skipTest("SQLite without FTS5")
+        self.index = SearchIndex()
+        self.index.add_many("acc", "INBOX", 1, {
+            10: make_document({"Subject": "Monthly Report",
+                               "From": "jago@gmail.com",
+                               "Date": "Wed, 01 Feb 2017 10:00:00 +0100"},
+                              [("html", "<p>Sales &amp; costs</p>")]),
+            11: make_document({"Subject": "Lunch", "From": "ann@gmail.com",
+                               "Date": "Fri, 03 Feb 2017 10:00:00 +0100"},
+                              [("plain", "Pizza?")])
+        })
+
+    def search(self, *criteria, uidvalidity=1):
+        return self.index.search("acc", "INBOX", uidvalidity,
+                                 SearchQuery.from_criteria(criteria))
+
+    def test_matches_substrings_ignoring_case(self):
+        self.assertEqual(self.search({"key": "SUBJECT", "value": "REPO"}),
+                         {10})
+
+    def test_searches_text_of_html_parts(self):
+        self.assertEqual(self.search({"key": "BODY", "value": "sales & c"}),
+                         {10})
+        self.assertEqual(self.search({"key": "BODY", "value": "<p>"}), set())
+
+    def test_combines_text_and_date_criteria(self):
+        self.assertEqual(self.search({"key": "TEXT", "value": "gmail"},
+                                     {"key": "SENTSINCE",
+                                      "value": "2-Feb-2017"}), {11})
+
+    def test_replaces_documents_of_previous_uidvalidity(self):
+        self.index.add_many("acc", "INBOX", 2, {
+            10: make_document({"Subject": "Other"}, [])
+        })
+        self.assertEqual(self.index.indexed_uids("acc", "INBOX", 1), set())
+        self.assertEqual(self.index.indexed_uids("acc", "INBOX", 2), {10})
+
+    def test_html_to_text_skips_styles(self):
+        self.assertEqual(
+            html_to_text("<style>p {}</style><b>a</b>").split(), ["a"]
+        )
@@ -1,7 +1,9 @@
 import unittest
-from unittest.mock import Mock, patch, ANY
+from unittest.mock import Mock, patch, ANY, call
 import json
 import email
+import queue
+import time
 
 from flask import url_for
 from app import create_app, db
@@ -10,7 +12,12 @@ from flask_login import login_user
 
 from app.mail.forms import LoginForm
 from app.models import User
-from app.mail.client import ImapClientError
+from app.mail.client import ImapClientError, slice_partial
+from app.mail.metrics import CommandEvent
+from app.mail.idset import IdSet
+from app.mail.views import get_instrumentation, get_display_cache
+from app.mail.cache import LRUCache
+from config import config, TestingConfig
 
 from tests.mail import imap_responses
 
@@ -45,7 +52,14 @@ class ListMailboxTest(TestCase):
         self.login_imap_client()
         response = self.client.get(url_for("mail.imap_list_mailbox"),
                                    query_string=dict(mailbox="INBOX")) 
-        mock.assert_called_with('"INBOX"', uid=False)    
+        mock.assert_called_with('"INBOX"', uid=False, partial=None)    
+
+    def test_pooled_connection_has_configured_timeout(self, mock_client):
+        self.mock_list_mailbox(mock_client)
+        self.login_imap_client()
+        self.client.get(url_for("mail.imap_list_mailbox"),
+                        query_string=dict(mailbox="INBOX"))
+        self.assertEqual(mock_client.call_args[1]["timeout"], 5)
 
     def test_returns_status_and_list_with_ids(self, mock_client):
         mock = self.mock_list_mailbox(mock_client)
@@ -87,7 +101,36 @@ class ListMailboxTest(TestCase):
         self.login_imap_client()
         response = self.client.get(url_for("mail.imap_list_mailbox"),
                                    query_string=dict(mailbox="INBOX", uid=True))     
-        mock.assert_called_with('"INBOX"', uid=True)                  
+        mock.assert_called_with('"INBOX"', uid=True, partial=None)
+
+    def test_returns_error_when_partial_is_invalid(self, mock_client):
+        mock = self.mock_list_mailbox(mock_client)
+        mock.side_effect = lambda mailbox, uid, partial: (
+            "OK", slice_partial(IdSet([1, 2, 3]), partial)
+        )
+        self.login_imap_client()
+        response = self.client.get(url_for("mail.imap_list_mailbox"),
+                                   query_string=dict(mailbox="INBOX",
+                                                     partial="abc"))
+        data = json.loads(response.data.decode("utf-8"))
+        self.assertEqual(data["status"], "ERROR")
+
+    def test_returns_ids_as_list_or_sequence_set(self, mock_client):
+        mock = self.mock_list_mailbox(
+            mock_client, response=("OK", IdSet([1, 2, 3, 7]))
+        )
+        self.login_imap_client()
+        response = self.client.get(url_for("mail.imap_list_mailbox"),
+                                   query_string=dict(mailbox="INBOX"))
+        data = json.loads(response.data.decode("utf-8"))
+        self.assertEqual(data["data"], [1, 2, 3, 7])
+        response = self.client.get(url_for("mail.imap_list_mailbox"),
+                                   query_string=dict(mailbox="INBOX",
+                                                     compact=True,
+                                                     partial="-1:-50"))
+        data = json.loads(response.data.decode("utf-8"))
+        self.assertEqual(data["data"], "1:3,7")
+        mock.assert_called_with('"INBOX"', uid=False, partial="-1:-50")
 
 @patch("app.mail.views.ImapClient")
 class LenMailboxTest(TestCase):
@@ -171,7 +214,7 @@ class CSearchTest(TestCase):
     def mock_csearch(self, imap_client, response = ("OK", ['1', '2', '3'])):
         mock = Mock()
         mock.return_value = response
-        imap_client.return_value.csearch = mock
+        imap_client.return_value.indexed_search = mock
         return mock
 
     def test_returns_error_for_not_authenticated_users(self, mock_client):
@@ -185,7 +228,7 @@ class CSearchTest(TestCase):
         data = json.loads(response.data.decode("utf-8"))
         self.assertEqual(data["status"], "ERROR")
 
-    def test_calls_csearch_method(self, mock_client):
+    def test_calls_indexed_search_method(self, mock_client):
         mock = self.mock_csearch(mock_client)
         self.login_imap_client()
         response = self.client.get(
@@ -197,7 +240,7 @@ class CSearchTest(TestCase):
                    )  
         self.assertTrue(mock.called)     
 
-    def test_for_passing_args_to_csearch_method(self, mock_client):
+    def test_for_passing_args_to_indexed_search_method(self, mock_client):
         mock = self.mock_csearch(mock_client)
         self.login_imap_client()
         response = self.client.get(
@@ -310,6 +353,22 @@ class CSearchTest(TestCase):
         mock.assert_called_with([{"key":"SUBJECT","value":"Test","decode":True}],
                                 uid=True)       
 
+    def test_indexes_mailbox_after_response(self, mock_client):
+        self.mock_csearch(mock_client)
+        self.login_imap_client()
+        with patch("app.mail.views.get_indexer") as mock_indexer:
+            response = self.client.get(
+                url_for("mail.imap_search"),
+                query_string=dict(mailbox="INBOX", criteria='[{"key":"ALL"}]')
+            )
+            self.assertFalse(mock_indexer().schedule.called)
+            response.close()
+        account, mailbox, [task] = mock_indexer().schedule.call_args[0]
+        self.assertEqual(mailbox, "INBOX")
+        imap_client = Mock()
+        task(imap_client)
+        imap_client.index_mailbox.assert_called_with('"INBOX"')
+
 
 @patch("app.mail.views.ImapClient")
 class RenameMailboxTest(TestCase):
@@ -415,7 +474,8 @@ class StoreTest(TestCase):
         self.client.get(url_for("mail.imap_store", command="add"),
                         query_string=dict(ids="1", mailbox="INBOX",
                                           flags="\\Flagged"))
-        add_flags_mock.assert_called_with("1", "\\Flagged", uid=False)
+        add_flags_mock.assert_called_with("1", "\\Flagged", uid=False,
+                                          mailbox='"INBOX"')
 
     def test_calls_remove_flags_method(self, mock_client):
         flags_mock = self.mock_store(mock_client, command="remove_flags")
@@ -423,7 +483,8 @@ class StoreTest(TestCase):
         self.client.get(url_for("mail.imap_store", command="remove"),
                         query_string=dict(ids="1", mailbox="INBOX",
                                           flags="\\Flagged"))
-        flags_mock.assert_called_with("1", "\\Flagged", uid=False)
+        flags_mock.assert_called_with("1", "\\Flagged", uid=False,
+                                      mailbox='"INBOX"')
 
     def test_calls_set_flags_method(self, mock_client):
         flags_mock = self.mock_store(mock_client, command="set_flags")
@@ -431,7 +492,8 @@ class StoreTest(TestCase):
         self.client.get(url_for("mail.imap_store", command="set"),
                         query_string=dict(ids="1", mailbox="INBOX",
                                           flags="\\Flagged"))
-        flags_mock.assert_called_with("1", "\\Flagged", uid=False)       
+        flags_mock.assert_called_with("1", "\\Flagged", uid=False,
+                                      mailbox='"INBOX"')       
 
     def test_returns_error_when_improper_command(self, mock_client):
         flags_mock = self.mock_store(mock_client, command="set_flags")
@@ -467,34 +529,25 @@ class StoreTest(TestCase):
         data = json.loads(response.data.decode("utf-8"))
         self.assertEqual(data["status"], "ERROR")
 
-    def test_for_calling_select_method(self, mock_client):
+    def test_selects_mailbox_together_with_store(self, mock_client):
         flags_mock = self.mock_store(mock_client, response=("OK", "YUPI"),
                                      command="add_flags")
-        select_mock = Mock()
-        select_mock.return_value = ("OK", "WORK")
-        mock_client.return_value.select = select_mock
         self.login_imap_client()
         self.client.get(url_for("mail.imap_store", command="add"),
                         query_string=dict(ids="1", mailbox="INBOX2",
-                                          flags="\\Flagged"))  
-        select_mock.assert_called_with('"INBOX2"')
-
+                                          flags="\\Flagged"))
+        self.assertEqual(flags_mock.call_args[1]["mailbox"], '"INBOX2"')
 
     def test_for_returning_error_when_select_fails(self, mock_client):
         flags_mock = self.mock_store(mock_client, response=("OK", "YUPI"),
-                                     command="add")
-
-        select_mock = Mock()
-        select_mock.return_value = ("NO", "FUCK")
-        select_mock.side_effect = ImapClientError
-        mock_client.return_value.select = select_mock
-
+                                     command="add_flags")
+        flags_mock.side_effect = ImapClientError
         self.login_imap_client()
         response = self.client.get(url_for("mail.imap_store", command="add"),
                                    query_string=dict(ids="1", mailbox="INBOX",
-                                                     flags="\\Flagged"))    
+                                                     flags="\\Flagged"))
         data = json.loads(response.data.decode("utf-8"))
-        self.assertTrue(select_mock.called)
+        self.assertTrue(flags_mock.called)
         self.assertEqual(data["status"], "ERROR")
 
     def test_returns_error_when_store_method_fails(self, mock_client):
@@ -514,7 +567,8 @@ class StoreTest(TestCase):
                         query_string=dict(ids="1", mailbox="INBOX",
                                           flags="\\Flagged",
                                           uid="YES"))
-        add_flags_mock.assert_called_with("1", "\\Flagged", uid=True)
+        add_flags_mock.assert_called_with("1", "\\Flagged", uid=True,
+                                          mailbox='"INBOX"')
 
 
 @patch("app.mail.views.ImapClient")
@@ -566,7 +620,8 @@ class MoveEmailsTest(TestCase):
         self.client.get(url_for("mail.imap_move_emails"),
                         query_string=dict(ids="1", dest_mailbox="INBOX",
                                           source_mailbox="INBOX2"))
-        move_mock.assert_called_with("1", '"INBOX"', uid=False)
+        move_mock.assert_called_with("1", '"INBOX"', uid=False,
+                                     source_mailbox='"INBOX2"')
 
     def test_returns_error_when_no_ids(self, mock_client):
         move_mock = self.mock_imap_client(mock_client)
@@ -604,27 +659,22 @@ class MoveEmailsTest(TestCase):
         self.assertEqual(data["status"], "OK")
         self.assertEqual(data["data"], "YUPI")    
 
-    def test_for_calling_select_method(self, mock_client):
+    def test_selects_source_mailbox_together_with_copy(self, mock_client):
         move_mock = self.mock_imap_client(mock_client, ("OK", "YUPI"))
-        select_mock = Mock()
-        select_mock.return_value = ("OK", "WORK")
-        mock_client.return_value.select = select_mock
         self.login_imap_client()
         response = self.client.get(url_for("mail.imap_move_emails"),
                             query_string=dict(ids="1", dest_mailbox="INBOX",
-                                              source_mailbox="INBOX2"))       
-        select_mock.assert_called_with('"INBOX2"')
+                                              source_mailbox="INBOX2"))
+        self.assertEqual(move_mock.call_args[1]["source_mailbox"],
+                         '"INBOX2"')
 
     def test_for_returning_error_when_select_fails(self, mock_client):
         move_mock = self.mock_imap_client(mock_client, ("OK", "YUPI"))
-        select_mock = Mock()
-        select_mock.return_value = ("NO", "FUCK")
-        select_mock.side_effect = ImapClientError
-        mock_client.return_value.select = select_mock
+        move_mock.side_effect = ImapClientError
         self.login_imap_client()
         response = self.client.get(url_for("mail.imap_move_emails"),
                             query_string=dict(ids="1", dest_mailbox="INBOX",
-                                              source_mailbox="INBOX2"))       
+                                              source_mailbox="INBOX2"))
         data = json.loads(response.data.decode("utf-8"))
         self.assertEqual(data["status"], "ERROR")
 
@@ -635,11 +685,11 @@ class MoveEmailsTest(TestCase):
                         query_string=dict(ids="1", dest_mailbox="INBOX",
                                           source_mailbox="INBOX2",
                                           uid="Y"))
-        move_mock.assert_called_with("1", '"INBOX"', uid=True)
+        move_mock.assert_called_with("1", '"INBOX"', uid=True,
+                                     source_mailbox='"INBOX2"')
 
 
 @patch("app.mail.views.ImapClient")
-@patch("app.mail.views.process_email_for_display")
 class GetEmailTest(TestCase):
 
     def create_app(self):
@@ -653,49 +703,48 @@ class GetEmailTest(TestCase):
 
     def mock_imap_client(self, mock_client):
         mock = Mock()
-        mock.get_emails.return_value = ("OK", ["EMAIL"])
-        mock.select.return_value = ("OK", b'1')
+        mock.get_email_for_display.return_value = ("OK", {"type": "plain"})
         mock_client.return_value = mock    
         return mock
 
-    def test_returns_error_for_not_authenticated_users(self, mock_process, 
-                                                       mock_client):
+    def test_returns_error_for_not_authenticated_users(self, mock_client):
         response = self.client.get(url_for("mail.imap_get_email"))
         data = json.loads(response.data.decode("utf-8"))
         self.assertEqual(data["status"], "ERROR")
 
-    def test_returns_ok_for_authenticated_users(self, mock_process, mock_client):
+    def test_returns_ok_for_authenticated_users(self, mock_client):
         self.login_imap_client()
         self.mock_imap_client(mock_client)
-        mock_process.return_value = None
         response = self.client.get(url_for("mail.imap_get_email"),
                                    query_string=dict(id='1'))
         data = json.loads(response.data.decode("utf-8"))
         self.assertEqual(data["status"], "OK")      
 
-    def test_calls_get_emails_with_proper_id(self, mock_process, mock_client):
+    def test_calls_get_email_for_display_with_proper_id(self, mock_client):
         self.login_imap_client()
         mock = self.mock_imap_client(mock_client)
-        mock_process.return_value = None
         response = self.client.get(url_for("mail.imap_get_email"),
                                    query_string=dict(id='1'))
-        mock.get_emails.assert_called_with('1', uid=False)
+        mock.get_email_for_display.assert_called_with('1', uid=False,
+                                                      mailbox='"INBOX"',
+                                                      mark_seen=True)
 
-    def test_calls_process_email_for_display(self, mock_process, mock_client):
+    def test_returns_email_for_display(self, mock_client):
         self.login_imap_client()
         self.mock_imap_client(mock_client)
-        mock_process.return_value = None
         response = self.client.get(url_for("mail.imap_get_email"),
                                    query_string=dict(id='1'))
-        mock_process.assert_called_with("EMAIL")
+        data = json.loads(response.data.decode("utf-8"))
+        self.assertEqual(data["data"], {"type": "plain"})
 
-    def test_accepts_uid_and_passes_it_further(self, mock_process, mock_client):
+    def test_accepts_uid_and_passes_it_further(self, mock_client):
         self.login_imap_client()
         mock = self.mock_imap_client(mock_client)
-        mock_process.return_value = None
         response = self.client.get(url_for("mail.imap_get_email"),
                                    query_string=dict(id='1', uid="TRUE"))
-        mock.get_emails.assert_called_with('1', uid=True)       
+        mock.get_email_for_display.assert_called_with('1', uid=True,
+                                                      mailbox='"INBOX"',
+                                                      mark_seen=True)
 
 
 @patch("app.mail.views.ImapClient")
@@ -713,7 +762,9 @@ class GetRawEmailsViewTest(TestCase):
 
     def mock_imap_client(self, mock_client):
         mock = Mock()
-        mock.get_emails.return_value = imap_responses.get_emails
+        mock.iter_emails.side_effect = lambda *args, **kwargs: (
+            email for email in imap_responses.get_emails[1]
+        )
         mock.select.return_value = ("OK", b'2044')
         mock_client.return_value = mock    
         return mock
@@ -724,21 +775,22 @@ class GetRawEmailsViewTest(TestCase):
         data = json.loads(response.data.decode("utf-8"))
         self.assertEqual(data["status"], "ERROR")
 
-    def test_calls_get_emails(self, mock_dict, mock_client):
+    def test_calls_iter_emails(self, mock_dict, mock_client):
         client_mock = self.mock_imap_client(mock_client)
         mock_dict.return_value = None
         self.login_imap_client()
         response = self.client.get(url_for("mail.imap_get_raw_emails"), 
                                            query_string = dict(ids="1,2"))
-        self.assertTrue(client_mock.get_emails.called)
+        self.assertTrue(client_mock.iter_emails.called)
 
-    def test_passes_ids_to_get_emails(self, mock_dict, mock_client):
+    def test_passes_ids_to_iter_emails(self, mock_dict, mock_client):
         client_mock = self.mock_imap_client(mock_client)
         mock_dict.return_value = None
         self.login_imap_client()
         response = self.client.get(url_for("mail.imap_get_raw_emails"), 
                                            query_string = dict(ids="1,2"))
-        client_mock.get_emails.assert_called_with("1,2", uid=False)
+        client_mock.iter_emails.assert_called_with("1,2", uid=False,
+                                                   chunk_size=20)
 
     def test_returns_error_when_ids_not_specified(
         self, mock_dict, mock_client
@@ -791,7 +843,7 @@ class GetRawEmailsViewTest(TestCase):
                                 query_string=dict(ids="1,2"))   
         client_mock.select.assert_called_once_with('"INBOX"')
 
-    def test_accepts_uid_and_passes_it_to_get_emails(
+    def test_accepts_uid_and_passes_it_to_iter_emails(
         self, mock_dict, mock_client
     ):
         client_mock = self.mock_imap_client(mock_client)
@@ -800,7 +852,44 @@ class GetRawEmailsViewTest(TestCase):
         response = self.client.get(url_for("mail.imap_get_raw_emails"), 
                                            query_string = dict(ids="1,2", 
                                                                uid="T"))
-        client_mock.get_emails.assert_called_with("1,2", uid=True)
+        client_mock.iter_emails.assert_called_with("1,2", uid=True,
+                                                   chunk_size=20)
+
+    def test_streams_emails_as_json(self, mock_dict, mock_client):
+        client_mock = self.mock_imap_client(mock_client)
+        mock_dict.side_effect = lambda msg: {"id": len(msg)}
+        self.login_imap_client()
+        response = self.client.get(url_for("mail.imap_get_raw_emails"), 
+                                   query_string=dict(ids="1:4"))
+        self.assertTrue(response.is_streamed)
+        data = json.loads(response.data.decode("utf-8"))
+        self.assertEqual(data["status"], "OK")
+        self.assertEqual(len(data["data"]), 4)
+
+    def test_reports_error_after_streamed_emails(self, mock_dict, 
+                                                 mock_client):
+        client_mock = self.mock_imap_client(mock_client)
+        def iter_emails(*args, **kwargs):
+            yield "first"
+            raise ImapClientError("Connection lost.")
+        client_mock.iter_emails.side_effect = iter_emails
+        mock_dict.return_value = {"id": 1}
+        self.login_imap_client()
+        response = self.client.get(url_for("mail.imap_get_raw_emails"), 
+                                   query_string=dict(ids="1:4"))
+        data = json.loads(response.data.decode("utf-8"))
+        self.assertEqual(data, {"data": [{"id": 1}], "status": "ERROR",
+                                "msg": "Connection lost."})
+
+    def test_returns_error_when_first_fetch_fails(self, mock_dict,
+                                                  mock_client):
+        client_mock = self.mock_imap_client(mock_client)
+        client_mock.iter_emails.side_effect = ImapClientError("No such")
+        self.login_imap_client()
+        response = self.client.get(url_for("mail.imap_get_raw_emails"), 
+                                   query_string=dict(ids="1:4"))
+        data = json.loads(response.data.decode("utf-8"))
+        self.assertEqual(data["status"], "ERROR")
 
 @patch("app.mail.views.ImapClient")
 class GetHeadersViewTest(TestCase):
@@ -962,6 +1051,173 @@ class GetHeadersViewTest(TestCase):
             sort_by_date=False
         )
 
+    def test_returns_page_for_cursor(self, imap_client):
+        mock = Mock()
+        mock.return_value = ("OK", {"headers": [{"id": 5}], 
+                                    "next_cursor": "Nzo0", "total": 10})
+        imap_client.return_value.get_headers_page = mock
+        self.login_imap_client()
+        response = self.client.get(url_for("mail.imap_get_headers"),
+                                   query_string=dict(mailbox="Praca", 
+                                                     cursor="NzoxMg", 
+                                                     limit=20))
+        data = json.loads(response.data.decode("utf-8"))
+        self.assertEqual(mock.call_args[0], ('"Praca"',))
+        self.assertEqual(mock.call_args[1]["cursor"], "NzoxMg")
+        self.assertEqual(mock.call_args[1]["limit"], 20)
+        self.assertEqual(data["data"], [{"id": 5}])
+        self.assertEqual(data["next_cursor"], "Nzo0")
+        self.assertEqual(data["total_emails"], 10)
+
+    def test_returns_error_for_invalid_limit(self, imap_client):
+        mock = Mock()
+        imap_client.return_value.get_headers_page = mock
+        self.login_imap_client()
+        response = self.client.get(url_for("mail.imap_get_headers"),
+                                   query_string=dict(mailbox="Praca", 
+                                                     limit="abc"))
+        data = json.loads(response.data.decode("utf-8"))
+        self.assertEqual(data["status"], "ERROR")
+        self.assertFalse(mock.called)
+
+
+@patch("app.mail.views.ImapClient")
+class SyncViewTest(TestCase):
+
+    def create_app(self):
+        return create_app("testing")
+
+    def login_imap_client(self, username="Testowy", password="Testowe"):
+         with self.client.session_transaction() as sess:
+            sess["imap_username"] = username
+            sess["imap_password"] = password 
+            sess["imap_addr"] = "testowy"  
+
+    def mock_sync(self, imap_client, 
+                  response = ("OK", {"modseq": 12, "changed": []})):
+        mock = Mock()
+        mock.return_value = response
+        imap_client.return_value.sync = mock
+        return mock
+
+    def test_returns_error_when_no_mailbox(self, mock_client):
+        mock = self.mock_sync(mock_client)
+        self.login_imap_client()
+        response = self.client.get(url_for("mail.imap_sync"))
+        data = json.loads(response.data.decode("utf-8"))
+        self.assertEqual(data["status"], "ERROR")
+
+    def test_passes_modseq_uidvalidity_and_uids_to_sync(self, mock_client):
+        mock = self.mock_sync(mock_client)
+        self.login_imap_client()
+        response = self.client.get(
+            url_for("mail.imap_sync"),
+            query_string=dict(mailbox="INBOX", modseq="10", uidvalidity="3",
+                              uids="1,2,5")
+        )
+        mock.assert_called_with('"INBOX"', modseq=10, uidvalidity=3,
+                                known_uids=[1, 2, 5])
+
+    def test_returns_changes(self, mock_client):
+        mock = self.mock_sync(mock_client)
+        self.login_imap_client()
+        response = self.client.get(url_for("mail.imap_sync"),
+                                   query_string=dict(mailbox="INBOX"))
+        data = json.loads(response.data.decode("utf-8"))
+        self.assertEqual(data["status"], "OK")
+        self.assertEqual(data["data"]["modseq"], 12)
+
+    def test_returns_error_when_invalid_modseq(self, mock_client):
+        mock = self.mock_sync(mock_client)
+        self.login_imap_client()
+        response = self.client.get(url_for("mail.imap_sync"),
+                                   query_string=dict(mailbox="INBOX",
+                                                     modseq="abc"))
+        data = json.loads(response.data.decode("utf-8"))
+        self.assertEqual(data["status"], "ERROR")
+        self.assertFalse(mock.called)
+
+
+@patch("app.mail.views.ImapClient")
+class AttachmentViewTest(TestCase):
+
+    content = b"0123456789"*10
+
+    def create_app(self):
+        return create_app("testing")
+
+    def login_imap_client(self, username="Testowy", password="Testowe"):
+         with self.client.session_transaction() as sess:
+            sess["imap_username"] = username
+            sess["imap_password"] = password 
+            sess["imap_addr"] = "testowy"  
+
+    def mock_imap_client(self, mock_client):
+        mock = Mock()
+        mock.get_part.return_value = ("OK", dict(
+            maintype="application", subtype="pdf", params={"name": "a.pdf"},
+            disposition="attachment", disposition_params={"filename": "a.pdf"},
+            encoding="binary", size=len(self.content), section="2"
+        ))
+        mock.fetch_partial.side_effect = \
+            lambda id, section, offset, length, uid: \
+                self.content[offset:offset+length]
+        mock_client.return_value = mock
+        return mock
+
+    def test_returns_error_when_invalid_section(self, mock_client):
+        mock = self.mock_imap_client(mock_client)
+        self.login_imap_client()
+        response = self.client.get(url_for("mail.imap_attachment"),
+                                   query_string=dict(id="5", section="1 BODY"))
+        data = json.loads(response.data.decode("utf-8"))
+        self.assertEqual(data["status"], "ERROR")
+        self.assertFalse(mock.get_part.called)
+
+    def test_streams_part_as_attachment(self, mock_client):
+        mock = self.mock_imap_client(mock_client)
+        self.login_imap_client()
+        response = self.client.get(url_for("mail.imap_attachment"),
+                                   query_string=dict(id="5", section="2",
+                                                     uid="TRUE"))
+        mock.get_part.assert_called_with("5", "2", uid=True,
+                                         mailbox='"INBOX"')
+        self.assertEqual(response.data, self.content)
+        self.assertEqual(response.headers["Content-Type"], "application/pdf")
+        self.assertEqual(response.headers["Content-Length"], "100")
+        self.assertIn('filename="a.pdf"',
+                      response.headers["Content-Disposition"])
+
+    def test_streams_requested_range(self, mock_client):
+        mock = self.mock_imap_client(mock_client)
+        self.login_imap_client()
+        response = self.client.get(url_for("mail.imap_attachment"),
+                                   query_string=dict(id="5", section="2"),
+                                   headers={"Range": "bytes=10-19"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, self.content[10:20])
+        self.assertEqual(response.headers["Content-Range"], "bytes 10-19/100")
+        mock.fetch_partial.assert_called_with("5", "2", 10, 10, uid=False)
+
+    def test_returns_416_for_unsatisfiable_range(self, mock_client):
+        mock = self.mock_imap_client(mock_client)
+        self.login_imap_client()
+        response = self.client.get(url_for("mail.imap_attachment"),
+                                   query_string=dict(id="5", section="2"),
+                                   headers={"Range": "bytes=200-300"})
+        self.assertEqual(response.status_code, 416)
+
+    def test_releases_connection_after_streaming(self, mock_client):
+        mock = self.mock_imap_client(mock_client)
+        self.login_imap_client()
+        for _ in range(2):
+            response = self.client.get(url_for("mail.imap_attachment"),
+                                       query_string=dict(id="5", section="2"))
+            response.data
+            response.close()
+        self.assertEqual(mock_client.call_count, 1)
+
+
 # @patch("app.mail.views.imap_clients")
 # @patch("app.mail.views.current_user")
 # class ListViewTest(TestCase):
@@ -1107,4 +1363,247 @@ class GetHeadersViewTest(TestCase):
 #             data=dict(username="test@gmail.com", password="testowe", 
 #                       imap="imap.gmail.com")
 #         )
-#         self.assertEqual(g_mock.imap_client, client_mock)
\ No newline at end of file
+#         self.assertEqual(g_mock.imap_client, client_mock)
+
+
+@patch("app.mail.views.ImapClient")
+class ListViewTest(TestCase):
+
+    def create_app(self):
+        return create_app("testing")
+
+    def login_imap_client(self, username="Testowy", password="Testowe"):
+         with self.client.session_transaction() as sess:
+            sess["imap_username"] = username
+            sess["imap_password"] = password 
+            sess["imap_addr"] = "testowy"  
+
+    def mock_list(self, imap_client):
+        mock = Mock()
+        mock.return_value = ("OK", [
+            ("INBOX", ["\\HasNoChildren"], {"MESSAGES": 3, "UNSEEN": 1}),
+            ("Wa&AXw-ne", ["\\HasNoChildren"], {"MESSAGES": 0, "UNSEEN": 0})
+        ])
+        imap_client.return_value.list = mock
+        imap_client.return_value.account = "Testowy@testowy"
+        return mock
+
+    def test_returns_mailboxes_with_status_and_decoded_names(self,
+                                                             mock_client):
+        mock = self.mock_list(mock_client)
+        self.login_imap_client()
+        response = self.client.get(url_for("mail.imap_list"))
+        data = json.loads(response.data.decode("utf-8"))
+        self.assertEqual(data["data"][1], {
+            "utf7": "Wa&AXw-ne", "utf16": "Wa\u017cne",
+            "flags": ["\\HasNoChildren"],
+            "status": {"MESSAGES": 0, "UNSEEN": 0}
+        })
+
+    def test_caches_list_until_invalidated(self, mock_client):
+        mock = self.mock_list(mock_client)
+        self.login_imap_client()
+        self.client.get(url_for("mail.imap_list"))
+        self.client.get(url_for("mail.imap_list"))
+        self.assertEqual(mock.call_count, 1)
+        mock_client.return_value.delete.return_value = ("OK", [b"Success"])
+        self.client.get(url_for("mail.imap_delete"),
+                        query_string=dict(mailbox="Work"))
+        self.client.get(url_for("mail.imap_list"))
+        self.assertEqual(mock.call_count, 2)
+
+
+@patch("app.mail.views.ImapClient")
+class UnifiedViewTest(TestCase):
+
+    def create_app(self):
+        return create_app("testing")
+
+    def login_imap_client(self, username="Testowy", password="Testowe"):
+         with self.client.session_transaction() as sess:
+            sess["imap_username"] = username
+            sess["imap_password"] = password 
+            sess["imap_addr"] = "testowy"  
+
+    def test_merges_headers_of_mailboxes_by_date(self, mock_client):
+        pages = {
+            '"INBOX"': {"headers": [{"id": 1, "Date": 
+                                     "Wed, 01 Feb 2017 10:00:00 +0100"}],
+                        "next_cursor": None, "total": 1},
+            '"Sent"': {"headers": [{"id": 7, "Date": 
+                                    "Thu, 02 Feb 2017 10:00:00 +0100"}],
+                       "next_cursor": "abc", "total": 2}
+        }
+        def get_headers_page(mailbox, **kwargs):
+            if mailbox not in pages:
+                raise ImapClientError("No such mailbox.")
+            return ("OK", pages[mailbox])
+        # Every connection of the pool is a separate client.
+        mock_client.side_effect = lambda *args, **kwargs: Mock(**{
+            "get_headers_page.side_effect": get_headers_page,
+            "socket.return_value.gettimeout.return_value": 5
+        })
+        self.login_imap_client()
+        response = self.client.get(
+            url_for("mail.imap_unified"), 
+            query_string=[("mailbox", "INBOX"), ("mailbox", "Sent"),
+                          ("mailbox", "Nope")]
+        )
+        data = json.loads(response.data.decode("utf-8"))
+        self.assertEqual([(header["mailbox"], header["id"]) 
+                          for header in data["data"]],
+                         [("Sent", 7), ("INBOX", 1)])
+        self.assertEqual(data["mailboxes"]["Sent"]["next_cursor"], "abc")
+        self.assertEqual(data["mailboxes"]["Nope"], 
+                         {"status": "ERROR", "msg": "No such mailbox."})
+
+
+class StatsViewTest(TestCase):
+
+    def create_app(self):
+        return create_app("testing")
+
+    def test_stats_are_not_available_without_debug(self):
+        response = self.client.get(url_for("mail.imap_stats"))
+        self.assertEqual(response.status_code, 404)
+
+
+config["testing_imap_debug"] = type("DebugHeaderConfig", (TestingConfig,),
+                                    dict(IMAP_DEBUG_HEADER=True))
+
+
+@patch("app.mail.views.ImapClient")
+class EventsViewTest(TestCase):
+
+    def create_app(self):
+        return create_app("testing")
+
+    def login_imap_client(self):
+        with self.client.session_transaction() as sess:
+            sess["imap_username"] = "Testowy"
+            sess["imap_password"] = "Testowe"
+            sess["imap_addr"] = "testowy"
+
+    @patch("app.mail.views.get_idle_manager")
+    def test_streams_events_without_pooled_connection(self, mock_manager,
+                                                      mock_client):
+        events = queue.Queue()
+        events.put({"type": "exists", "count": 3})
+        events.put({"type": "error", "unsupported": False, "msg": "Lost.",
+                    "retry": 5})
+        watcher = Mock()
+        mock_manager.return_value.failure.return_value = None
+        mock_manager.return_value.subscribe.return_value = (watcher, events)
+        self.login_imap_client()
+        response = self.client.get(url_for("mail.imap_events"),
+                                   query_string=dict(mailbox="INBOX"))
+        data = response.data.decode("utf-8")
+        self.assertIn('event: exists\ndata: {"type": "exists", "count": 3}',
+                      data)
+        self.assertIn("event: imap-error\n", data)
+        self.assertNotIn("event: error\n", data)
+        watcher.unsubscribe.assert_called_with(events)
+        self.assertFalse(mock_client.called)
+
+    def test_reports_failure_without_logging_in_again(self, mock_client):
+        manager = self.app.extensions["imap_idle"]
+        manager.failures[("testowy", "Testowy", '"INBOX"')] = (
+            time.monotonic() + 60, 60,
+            {"type": "error", "unsupported": True, "msg": "No IDLE."}
+        )
+        self.login_imap_client()
+        with patch.object(manager, "subscribe") as subscribe:
+            response = self.client.get(url_for("mail.imap_events"),
+                                       query_string=dict(mailbox="INBOX"))
+            data = response.data.decode("utf-8")
+        self.assertFalse(subscribe.called)
+        self.assertFalse(mock_client.called)
+        event = json.loads(data.split("event: imap-error\ndata: ")[1])
+        self.assertTrue(event["unsupported"])
+        self.assertLessEqual(event["retry"], 60)
+
+    def test_requires_session(self, mock_client):
+        response = self.client.get(url_for("mail.imap_events"))
+        data = json.loads(response.data.decode("utf-8"))
+        self.assertEqual(data["status"], "ERROR")
+
+
+@patch("app.mail.views.ImapClient")
+class DebugHeaderTest(TestCase):
+
+    def create_app(self):
+        return create_app("testing_imap_debug")
+
+    def test_server_timing_lists_commands(self, mock_client):
+        def list_mailbox(*args, **kwargs):
+            get_instrumentation().record(CommandEvent(
+                "Testowy@testowy", "UID SEARCH", "OK", 0.005, 30, 60, 60
+            ))
+            return ("OK", [1, 2])
+        mock_client.return_value.list_mailbox.side_effect = list_mailbox
+        with self.client.session_transaction() as sess:
+            sess["imap_username"] = "Testowy"
+            sess["imap_password"] = "Testowe"
+            sess["imap_addr"] = "testowy"
+        response = self.client.get(url_for("mail.imap_list_mailbox"),
+                                   query_string=dict(mailbox="INBOX"))
+        self.assertEqual(response.headers["Server-Timing"],
+                         'imap0;desc="UID SEARCH OK 60B";dur=5.0, '
+                         'imap;dur=5.0')
+        stats = self.app.extensions["imap_stats"].snapshot()
+        self.assertEqual(stats["UID SEARCH"]["count"], 1)
+        response = self.client.get(url_for("mail.imap_stats"))
+        data = json.loads(response.data.decode("utf-8"))
+        self.assertEqual(data["data"]["UID SEARCH"]["count"], 1)
+
+
+config["testing_imap_prefetch"] = type("PrefetchConfig", (TestingConfig,),
+                                      dict(IMAP_PREFETCH=True))
+
+
+class DisplayCacheTest(TestCase):
+
+    def create_app(self):
+        return create_app("testing")
+
+    def test_display_cache_is_created_only_for_prefetch(self):
+        self.assertIsNone(get_display_cache())
+        app = create_app("testing_imap_prefetch")
+        self.assertIsInstance(app.extensions["imap_display_cache"], LRUCache)
+
+@patch("app.mail.views.get_prefetcher")
+@patch("app.mail.views.ImapClient")
+class PrefetchTest(TestCase):
+
+    def create_app(self):
+        return create_app("testing")
+
+    def test_prefetches_unseen_emails_and_next_page(self, mock_client,
+                                                    mock_prefetcher):
+        mock_client.return_value.get_headers_page.return_value = ("OK", {
+            "headers": [{"id": 9, "Flags": []}, {"id": 8, "Flags": ["\\Seen"]},
+                        {"id": 7, "Flags": []}],
+            "next_cursor": "abc", "total": 20
+        })
+        with self.client.session_transaction() as sess:
+            sess["imap_username"] = "Testowy"
+            sess["imap_password"] = "Testowe"
+            sess["imap_addr"] = "testowy"
+        response = self.client.get(url_for("mail.imap_get_headers"),
+                                   query_string=dict(mailbox="INBOX",
+                                                     limit=3))
+        response.close()
+        account, mailbox, tasks = mock_prefetcher().schedule.call_args[0]
+        self.assertEqual(account.username, "Testowy")
+        self.assertEqual(mailbox, "INBOX")
+
+        imap_client = Mock()
+        for task in tasks:
+            task(imap_client)
+        self.assertEqual(imap_client.get_email_for_display.call_args_list, [
+            call(9, uid=True, mailbox='"INBOX"'),
+            call(7, uid=True, mailbox='"INBOX"')
+        ])
+        imap_client.get_headers_page.assert_called_with(
+            '"INBOX"', cursor="abc", limit=3, max_age=30, fields=ANY
+        )